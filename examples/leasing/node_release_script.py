@@ -63,19 +63,22 @@ def release_from_project(
 
     node_info = hil_client.node.show(node)
 
+    status_ids = []
     for nic in node_info['nics']:
         port = nic['port']
         switch = nic['switch']
         if port and switch:
             try:
-                hil_client.port.port_revert(switch, port)
+                response = hil_client.port.port_revert(switch, port)
+                status_ids.append(response['status_id'])
                 print('Removed all networks from node `%s`' % node)
             except FailedAPICallException:
                 print('Failed to revert port `%s` on node \
                         `%s` switch `%s`' % (port, node, switch))
                 raise HILClientFailure()
 
-    time.sleep(5)
+    for status_id in status_ids:
+        hil_client.node.wait_for(status_id, timeout=30)
     # tries 2 times to detach the project because there might be a pending
     # networking action setup (revert port in the previous step).
     for counter in range(2):
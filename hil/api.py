@@ -2,25 +2,45 @@
 
 TODO: Spec out and document what sanitization is required.
 """
+from datetime import datetime
+import itertools
 import json
 import requests
+import time
 import uuid
 
-from schema import Schema, Optional
+import flask
 
-from hil import model, errors
+from schema import Schema, Optional, Or, Use
+from sqlalchemy import or_
+
+from hil import model, errors, metrics, power_poller
 from hil.model import db
 from hil.auth import get_auth_backend
 from hil.config import cfg
-from hil.rest import rest_call
+from hil.rest import rest_call, run_batch, JSONStream, StreamedObject, \
+    STREAM_BATCH_SIZE
 from hil.class_resolver import concrete_class_for
 from hil.network_allocator import get_network_allocator
 import logging
 
+# How often (in seconds) to check on networking actions when waiting for
+# them to change:
+ACTION_POLL_INTERVAL = 0.5
+
+# The longest show_networking_action will wait for an action to finish:
+MAX_ACTION_WAIT = 60
+
+# The longest networking_action_events will stream events for, and the
+# longest it will go without sending anything:
+MAX_EVENT_STREAM_TIME = 300
+EVENT_STREAM_KEEPALIVE = 15
+
 
 # Project Code #
 ################
-@rest_call('GET', '/projects', Schema({}))
+@rest_call('GET', '/projects', Schema({}), cache_tables=('project',),
+           read_only=True)
 def list_projects():
     """List all projects.
 
@@ -55,11 +75,12 @@ def project_delete(project):
     """
     get_auth_backend().require_admin()
     project = get_or_404(model.Project, project)
-    if project.nodes:
+    if exists(model.Node.query.filter_by(project_id=project.id)):
         raise errors.BlockedError("Project has nodes still")
-    if project.networks_created:
+    if exists(model.Network.query.filter_by(owner_id=project.id)):
         raise errors.BlockedError("Project still has networks")
-    if project.networks_access:
+    if exists(db.session.query(model.network_projects).filter(
+            model.network_projects.c.project_id == project.id)):
         # FIXME: This is not the user's fault, and they cannot fix it.  The
         # only reason we need to error here is that, with how network access
         # is done, the following bad thing happens.  If there's a network
@@ -70,7 +91,7 @@ def project_delete(project):
         # will not be an issue---instead, the network will be accessible by
         # NO projects.
         raise errors.BlockedError("Project can still access networks")
-    if project.headnodes:
+    if exists(model.Headnode.query.filter_by(project_id=project.id)):
         raise errors.BlockedError("Project still has a headnode")
     db.session.delete(project)
     db.session.commit()
@@ -165,20 +186,25 @@ def network_revoke_project_access(project, network):
     auth_backend = get_auth_backend()
     network = get_or_404(model.Network, network)
     project = get_or_404(model.Project, project)
+    access = db.session.query(model.network_projects).filter(
+        model.network_projects.c.network_id == network.id)
+    project_access = access.filter(
+        model.network_projects.c.project_id == project.id)
+    has_access = exists(project_access)
     # must be admin, the owner of the network, or <project> to remove
     # <project>.
 
-    if network.access:
+    if has_access or exists(access):
         if not (auth_backend.have_admin() or
                 (network.owner is not None and
                     auth_backend.have_project_access(network.owner)) or
-                (project in network.access and
+                (has_access and
                     auth_backend.have_project_access(project))):
             raise errors.AuthorizationError(
                 "You are not authorized to remove the "
                 "specified project from this network.")
 
-    if project not in network.access:
+    if not has_access:
         raise errors.NotFoundError(
             "Network %r is not in project %r" %
             (network.label, project.label))
@@ -189,17 +215,23 @@ def network_revoke_project_access(project, network):
             "its access cannot be removed" % (project.label,
                                               network.label))
 
-    # TODO: Make this and the next loop more SQLAlchemy-friendly
-    for attachment in network.attachments:
-        if attachment.nic.owner.project.label == project.label:
-            raise errors.BlockedError(
-                "Project still has node(s) attached to the network")
+    if exists(model.NetworkAttachment.query
+              .join(model.NetworkAttachment.nic)
+              .join(model.Nic.owner)
+              .filter(model.NetworkAttachment.network_id == network.id,
+                      model.Node.project_id == project.id)):
+        raise errors.BlockedError(
+            "Project still has node(s) attached to the network")
 
-    for hnic in network.hnics:
-        if hnic.owner.project.label == project.label:
-            raise errors.BlockedError(
-                "Project still has headnode(s) attached to the network")
+    if exists(model.Hnic.query
+              .join(model.Hnic.owner)
+              .filter(model.Hnic.network_id == network.id,
+                      model.Headnode.project_id == project.id)):
+        raise errors.BlockedError(
+            "Project still has headnode(s) attached to the network")
 
+    # Go through the ORM, rather than deleting the row directly, so that
+    # the read cache sees the change to the network:
     network.access.remove(project)
     db.session.commit()
 
@@ -260,6 +292,48 @@ def node_power_off(node):
     node.obm.power_off()
 
 
+@rest_call('GET', '/node/<node>/power', Schema({
+    'node': basestring,
+    Optional('fresh'): Or('true', 'false'),
+}))
+def show_node_power(node, fresh='false'):
+    """Show the power state of the node.
+
+    Normally this reports the state last recorded by the power poller. If
+    ``fresh`` is 'true', the node's OBM is queried directly instead (and the
+    cached state updated).
+
+    Returns a JSON object; see `_power_status_dict`.
+    """
+    node = get_or_404(model.Node, node)
+    get_auth_backend().require_project_access(node.project)
+    if fresh == 'true':
+        power_poller.refresh(node)
+        db.session.commit()
+    return json.dumps(_power_status_dict(node))
+
+
+def _power_status_dict(node):
+    """Return a dictionary describing the cached power state of ``node``.
+
+    If the node has never been polled, all of the values are None.
+    """
+    status = node.power_status
+    if status is None:
+        return {
+            'power': None,
+            'reachable': None,
+            'error': None,
+            'last_checked': None,
+        }
+    return {
+        'power': status.power,
+        'reachable': status.reachable,
+        'error': status.error,
+        'last_checked': status.last_checked.isoformat(),
+    }
+
+
 @rest_call('PUT', '/node/<node>/boot_device', Schema({
     'node': basestring, 'bootdev': basestring,
 }))
@@ -285,7 +359,7 @@ def node_delete(node):
         raise errors.BlockedError(
             "Node %r is part of project %r; remove from "
             "project before deleting" % (node.label, node.project.label))
-    if node.nics != []:
+    if exists(model.Nic.query.filter_by(owner_id=node.id)):
         raise errors.BlockedError(
             "Node %r has nics; remove them before deleting %r." % (node.label,
                                                                    node.label))
@@ -525,11 +599,15 @@ def headnode_create(headnode, project, base_img):
 def headnode_delete(headnode):
     """Delete headnode.
 
-    If the node does not exist, a NotFoundError will be raised.
+    If the node does not exist, a NotFoundError will be raised. A headnode
+    which is still being started can't be deleted until that finishes.
     """
-    headnode = get_or_404(model.Headnode, headnode)
+    headnode = _lock_headnode(headnode)
     get_auth_backend().require_project_access(headnode.project)
-    if not headnode.dirty:
+    _require_idle(headnode)
+    if not headnode.dirty or headnode.job_status is not None:
+        # The VM may exist, or be on its way; this also works if it was
+        # never created:
         headnode.delete()
     for hnic in headnode.hnics:
         db.session.delete(hnic)
@@ -547,12 +625,26 @@ def headnode_start(headnode):
     within libvirt if needed. Once the VM has been started once, it is
     "frozen," and all other headnode-related api calls will fail (by raising
     an IllegalStateError), with the exception of headnode_stop.
+
+    Creating and starting the VM happen in the background. Until they are
+    done, the headnode's ``job_status`` (see `show_headnode`) is
+    ``PENDING``, and it can't be changed or started again. The headnode is
+    frozen once the VM has been created; if that fails, ``job_status``
+    becomes ``ERROR``, and the headnode stays as it was.
     """
-    headnode = get_or_404(model.Headnode, headnode)
+    headnode = _lock_headnode(headnode)
     get_auth_backend().require_project_access(headnode.project)
+    _require_idle(headnode)
+    headnode.job_status = 'PENDING'
+    headnode.job_error = None
+    headnode.generation += 1
+    # The jobs record their outcome in the database, from another thread,
+    # so commit before starting them:
+    db.session.commit()
     if headnode.dirty:
         headnode.create()
     headnode.start()
+    # In dry run mode, the "jobs" are done already:
     db.session.commit()
 
 
@@ -565,10 +657,15 @@ def headnode_stop(headnode):
     This powers off the headnode. This is a hard poweroff; the VM is not given
     the opportunity to shut down cleanly. This does *not* unfreeze the VM;
     headnode_start will be the only valid API call after the VM is powered off.
+    A headnode which is still being started can't be stopped until that
+    finishes.
     """
-    headnode = get_or_404(model.Headnode, headnode)
+    headnode = _lock_headnode(headnode)
     get_auth_backend().require_project_access(headnode.project)
+    _require_idle(headnode)
     headnode.stop()
+    headnode.generation += 1
+    db.session.commit()
 
 
 @rest_call('PUT', '/headnode/<headnode>/hnic/<hnic>', Schema({
@@ -582,14 +679,14 @@ def headnode_create_hnic(headnode, hnic):
     If there is already an hnic with that name, a DuplicateError will
     be raised.
 
-    If the headnode's VM has already created (headnode is not "dirty"), raises
-    an IllegalStateError
+    If the headnode's VM has already created (headnode is not "dirty"), or is
+    being created, raises an IllegalStateError
     """
     headnode = get_or_404(model.Headnode, headnode)
     get_auth_backend().require_project_access(headnode.project)
     absent_child_or_conflict(headnode, model.Hnic, hnic)
 
-    if not headnode.dirty:
+    if not headnode.dirty or headnode.busy:
         raise errors.IllegalStateError
 
     hnic = model.Hnic(headnode, hnic)
@@ -605,14 +702,14 @@ def headnode_delete_hnic(headnode, hnic):
 
     If the headnode or hnic does not exist, a NotFoundError will be raised.
 
-    If the headnode's VM has already created (headnode is not "dirty"), raises
-    an IllegalStateError
+    If the headnode's VM has already created (headnode is not "dirty"), or is
+    being created, raises an IllegalStateError
     """
     headnode = get_or_404(model.Headnode, headnode)
     get_auth_backend().require_project_access(headnode.project)
     hnic = get_child_or_404(headnode, model.Hnic, hnic)
 
-    if not headnode.dirty:
+    if not headnode.dirty or headnode.busy:
         raise errors.IllegalStateError
 
     db.session.delete(hnic)
@@ -625,7 +722,8 @@ def headnode_delete_hnic(headnode, hnic):
 def headnode_connect_network(headnode, hnic, network):
     """Connect a headnode's hnic to a network.
 
-    Raises IllegalStateError if the headnode has already been started.
+    Raises IllegalStateError if the headnode has already been started, or is
+    being started.
 
     Raises ProjectMismatchError if the project does not have access rights to
     the given network.
@@ -644,7 +742,7 @@ def headnode_connect_network(headnode, hnic, network):
             "Headnodes may only be connected to networks "
             "allocated by the project.")
 
-    if not headnode.dirty:
+    if not headnode.dirty or headnode.busy:
         raise errors.IllegalStateError
 
     project = headnode.project
@@ -663,13 +761,14 @@ def headnode_connect_network(headnode, hnic, network):
 def headnode_detach_network(headnode, hnic):
     """Detach a heanode's nic from any network it's on.
 
-    Raises IllegalStateError if the headnode has already been started.
+    Raises IllegalStateError if the headnode has already been started, or is
+    being started.
     """
     headnode = get_or_404(model.Headnode, headnode)
     get_auth_backend().require_project_access(headnode.project)
     hnic = get_child_or_404(headnode, model.Hnic, hnic)
 
-    if not headnode.dirty:
+    if not headnode.dirty or headnode.busy:
         raise errors.IllegalStateError
 
     hnic.network = None
@@ -679,31 +778,36 @@ def headnode_detach_network(headnode, hnic):
 # Network Code #
 ################
 
-@rest_call('GET', '/networks', Schema({}))
+@rest_call('GET', '/networks', Schema({}),
+           cache_tables=('network', 'project'), cache_non_admin=True,
+           read_only=True)
 def list_networks():
     """Lists all networks"""
-    result = {}
+    query = db.session.query(model.Network.label,
+                             model.Network.network_id,
+                             model.Project.label) \
+        .outerjoin(model.Network.access) \
+        .order_by(model.Network.label, model.Project.label)
     # Admin Operation
-    if get_auth_backend().have_admin():
-        networks = db.session.query(model.Network).all()
-    else:
-        networks = db.session.query(model.Network).filter_by(access=None).all()
+    if not get_auth_backend().have_admin():
+        # Only public networks (those with no access list):
+        query = query.filter(model.Project.id.is_(None))
 
-    for n in networks:
-        if n.access:
-            projects = sorted([p.label for p in n.access])
-            result[n.label] = {'network_id': n.network_id,
-                               'projects': projects}
-        else:
-            result[n.label] = {'network_id': n.network_id,
-                               'projects': None}
+    def networks():
+        """Yield the (label, details) pairs of the networks."""
+        rows = query.yield_per(STREAM_BATCH_SIZE)
+        for label, group in itertools.groupby(rows, lambda row: row[0]):
+            group = list(group)
+            projects = [row[2] for row in group if row[2] is not None]
+            yield label, {'network_id': group[0][1],
+                          'projects': projects or None}
 
-    return json.dumps(result, sort_keys=True)
+    return JSONStream(StreamedObject(networks()))
 
 
 @rest_call('GET', '/network/<network>/attachments', schema=Schema({
     'network': basestring, Optional('project'): basestring,
-}))
+}), read_only=True)
 def list_network_attachments(network, project=None):
     """Lists all the attachments from <project> for <network>
 
@@ -735,18 +839,32 @@ def list_network_attachments(network, project=None):
                 raise errors.AuthorizationError(
                     "You do not have access to this project.")
 
-    attachments = network.attachments
-    nodes = {}
-    for attachment in attachments:
-        if project is None or project is attachment.nic.owner.project:
-            node = {
-                'nic': attachment.nic.label,
-                'channel': attachment.channel,
-                'project': attachment.nic.owner.project.label
-            }
-            nodes[attachment.nic.owner.label] = node
+    query = db.session.query(model.Node.label,
+                             model.Nic.label,
+                             model.NetworkAttachment.channel,
+                             model.Project.label) \
+        .select_from(model.NetworkAttachment) \
+        .join(model.NetworkAttachment.nic) \
+        .join(model.Nic.owner) \
+        .join(model.Node.project) \
+        .filter(model.NetworkAttachment.network_id == network.id) \
+        .order_by(model.Node.label, model.NetworkAttachment.id)
+    if project is not None:
+        query = query.filter(model.Node.project_id == project.id)
+
+    def nodes():
+        """Yield the (label, attachment) pairs of the attached nodes.
+
+        Where a node has several attachments, the last is reported.
+        """
+        rows = query.yield_per(STREAM_BATCH_SIZE)
+        for node, group in itertools.groupby(rows, lambda row: row[0]):
+            _, nic, channel, node_project = list(group)[-1]
+            yield node, {'nic': nic,
+                         'channel': channel,
+                         'project': node_project}
 
-    return json.dumps(nodes, sort_keys=True)
+    return JSONStream(StreamedObject(nodes()))
 
 
 @rest_call('PUT', '/network/<network>', Schema({
@@ -827,11 +945,12 @@ def network_delete(network):
     network = get_or_404(model.Network, network)
     get_auth_backend().require_project_access(network.owner)
 
-    if len(network.attachments) != 0:
+    if exists(model.NetworkAttachment.query.filter_by(network_id=network.id)):
         raise errors.BlockedError("Network still connected to nodes")
-    if network.hnics:
+    if exists(model.Hnic.query.filter_by(network_id=network.id)):
         raise errors.BlockedError("Network still connected to headnodes")
-    if len(network.scheduled_nics) != 0:
+    if exists(model.NetworkingAction.query
+              .filter_by(new_network_id=network.id)):
         raise errors.BlockedError("There are pending actions on this network")
     if network.allocated:
         get_network_allocator().free_network_id(network.network_id)
@@ -840,7 +959,9 @@ def network_delete(network):
     db.session.commit()
 
 
-@rest_call('GET', '/network/<network>', Schema({'network': basestring}))
+@rest_call('GET', '/network/<network>', Schema({'network': basestring}),
+           cache_tables=('network', 'project', 'network_attachment', 'nic',
+                         'node'), read_only=True)
 def show_network(network):
     """Show details of a network.
 
@@ -875,19 +996,39 @@ def show_network(network):
     else:
         result['access'] = None
 
-    connected_nodes = {}
-    for n in network.attachments:
-        if auth_backend.have_project_access(network.owner) or \
-                auth_backend.have_project_access(n.nic.owner.project):
-            node, nic = n.nic.owner.label, n.nic.label
-            # build a dictonary mapping a node to list of nics
-            if node not in connected_nodes:
-                connected_nodes[node] = [nic]
-            else:
-                connected_nodes[node].append(nic)
-    result['connected-nodes'] = connected_nodes
+    owner_access = auth_backend.have_project_access(network.owner)
+    query = db.session.query(model.Node.label,
+                             model.Nic.label,
+                             model.Node.project_id) \
+        .select_from(model.NetworkAttachment) \
+        .join(model.NetworkAttachment.nic) \
+        .join(model.Nic.owner) \
+        .filter(model.NetworkAttachment.network_id == network.id) \
+        .order_by(model.Node.label, model.NetworkAttachment.id)
+    # Maps project ids to whether the caller has access to the project:
+    project_access = {}
+
+    def visible(row):
+        """Return whether the caller may see the attachment `row`."""
+        project_id = row[2]
+        if project_id not in project_access:
+            project = None
+            if project_id is not None:
+                project = model.Project.query.get(project_id)
+            project_access[project_id] = \
+                auth_backend.have_project_access(project)
+        return project_access[project_id]
+
+    def connected_nodes():
+        """Yield pairs mapping each attached node to its list of nics."""
+        rows = query.yield_per(STREAM_BATCH_SIZE)
+        if not owner_access:
+            rows = itertools.ifilter(visible, rows)
+        for node, group in itertools.groupby(rows, lambda row: row[0]):
+            yield node, [row[1] for row in group]
+    result['connected-nodes'] = StreamedObject(connected_nodes())
 
-    return json.dumps(result, sort_keys=True)
+    return JSONStream(result)
 
 
 @rest_call('PUT', '/switch/<switch>', schema=Schema({
@@ -918,7 +1059,7 @@ def switch_delete(switch):
     get_auth_backend().require_admin()
     switch = get_or_404(model.Switch, switch)
 
-    if switch.ports != []:
+    if exists(model.Port.query.filter_by(owner_id=switch.id)):
         raise errors.BlockedError(
             "Switch %r has ports; delete them first." % switch.label)
 
@@ -968,7 +1109,7 @@ def switch_delete_port(switch, port):
 
 @rest_call('GET', '/switch/<switch>', Schema({
     'switch': basestring,
-}))
+}), read_only=True)
 def show_switch(switch):
     """Show details of a switch.
 
@@ -988,8 +1129,45 @@ def show_switch(switch):
     }, sort_keys=True)
 
 
+@rest_call('GET', '/switch/<switch>/health', Schema({
+    'switch': basestring,
+}), read_only=True)
+def show_switch_health(switch):
+    """Show how the networking daemon's recent attempts to use a switch went.
+
+    Returns a JSON object; see `docs/rest_api.md` for a full description of
+    the output.
+    """
+    get_auth_backend().require_admin()
+    switch = get_or_404(model.Switch, switch)
+    pending = model.NetworkingAction.query \
+        .join(model.Nic, model.NetworkingAction.nic_id == model.Nic.id) \
+        .join(model.Port, model.Nic.port_id == model.Port.id) \
+        .filter(model.Port.owner_id == switch.id,
+                model.NetworkingAction.status == 'PENDING') \
+        .count()
+    result = {
+        'state': 'closed',
+        'consecutive_failures': 0,
+        'last_failure': None,
+        'last_error': None,
+        'open_until': None,
+        'pending_actions': pending,
+    }
+    health = switch.health
+    if health is not None:
+        result['state'] = health.state(datetime.utcnow())
+        result['consecutive_failures'] = health.consecutive_failures
+        result['last_error'] = health.last_error
+        if health.last_failure is not None:
+            result['last_failure'] = health.last_failure.isoformat()
+        if health.open_until is not None:
+            result['open_until'] = health.open_until.isoformat()
+    return json.dumps(result, sort_keys=True)
+
+
 @rest_call('GET', '/switch/<switch>/port/<path:port>', Schema({
-    'switch': basestring, 'port': basestring}))
+    'switch': basestring, 'port': basestring}), read_only=True)
 def show_port(switch, port):
     """show port details on a switch.
 
@@ -1009,7 +1187,7 @@ def show_port(switch, port):
     return json.dumps(return_obj)
 
 
-@rest_call('GET', '/switches', Schema({}))
+@rest_call('GET', '/switches', Schema({}), read_only=True)
 def list_switches():
     """List all switches.
 
@@ -1109,10 +1287,16 @@ def port_revert(switch, port):
 
 
 @rest_call('GET', '/networking_action/<status_id>', Schema({
-    'status_id': basestring}))
-def show_networking_action(status_id):
+    'status_id': basestring,
+    Optional('wait'): Use(float),
+}), read_only=True)
+def show_networking_action(status_id, wait=None):
     """Returns the status of the networking action by finding the status_id
     in the networking actions table.
+
+    If ``wait`` is given, and the action is still pending, wait up to that
+    many seconds (but no more than `MAX_ACTION_WAIT`) for it to finish
+    before responding.
     """
     action = model.NetworkingAction.query.filter_by(uuid=status_id).first()
     if action is None:
@@ -1121,21 +1305,110 @@ def show_networking_action(status_id):
     project = action.nic.owner.project
     get_auth_backend().require_project_access(project)
 
+    if wait is not None:
+        action_id = action.id
+        deadline = time.time() + min(wait, MAX_ACTION_WAIT)
+        while action.status == 'PENDING' and time.time() < deadline:
+            # Don't hold on to a transaction (and database connection)
+            # while we wait; this also means we pick up changes committed
+            # by the networking daemon in the meantime:
+            db.session.rollback()
+            time.sleep(ACTION_POLL_INTERVAL)
+            action = model.NetworkingAction.query.get(action_id)
+
+    return json.dumps(_networking_action_dict(action))
+
+
+@rest_call('GET', '/project/<project>/networking_actions/events', Schema({
+    'project': basestring,
+    Optional('timeout'): Use(float),
+}))
+def networking_action_events(project, timeout=MAX_EVENT_STREAM_TIME):
+    """Stream changes to the networking actions on a project's nodes.
+
+    The response is a stream of server-sent events (i.e. has content type
+    ``text/event-stream``); there is one event for each networking action
+    when the stream starts, and one each time an action is created or its
+    status changes after that. The stream ends after ``timeout`` seconds (but
+    no more than `MAX_EVENT_STREAM_TIME`), at which point clients should
+    reconnect.
+    """
+    project = get_or_404(model.Project, project)
+    get_auth_backend().require_project_access(project)
+    project_id = project.id
+    deadline = time.time() + min(timeout, MAX_EVENT_STREAM_TIME)
+
+    def generate():
+        """Yield the events, as described above."""
+        # Only actions which are new, or were pending last time we looked,
+        # can have changed since then:
+        last_id = 0
+        pending = set()
+        last_sent = time.time()
+        while True:
+            changed = model.NetworkingAction.id > last_id
+            if pending:
+                changed = or_(changed, model.NetworkingAction.id.in_(pending))
+            actions = model.NetworkingAction.query \
+                .join(model.Nic).join(model.Node) \
+                .filter(model.Node.project_id == project_id, changed) \
+                .order_by(model.NetworkingAction.id)
+            for action in actions:
+                if action.id in pending:
+                    if action.status == 'PENDING':
+                        continue
+                    pending.remove(action.id)
+                elif action.status == 'PENDING':
+                    pending.add(action.id)
+                last_id = max(last_id, action.id)
+                last_sent = time.time()
+                info = _networking_action_dict(action)
+                info['status_id'] = action.uuid
+                yield 'event: networking_action\ndata: %s\n\n' % \
+                    json.dumps(info)
+            now = time.time()
+            if now >= deadline:
+                return
+            if now - last_sent >= EVENT_STREAM_KEEPALIVE:
+                # A comment, to keep proxies from timing out the connection:
+                last_sent = now
+                yield ': keepalive\n\n'
+            # As in show_networking_action, don't hold on to a transaction
+            # while we sleep:
+            db.session.rollback()
+            time.sleep(ACTION_POLL_INTERVAL)
+
+    return flask.Response(flask.stream_with_context(generate()),
+                          mimetype='text/event-stream')
+
+
+def _networking_action_dict(action):
+    """Return a dictionary describing ``action``, as returned by
+    `show_networking_action`.
+    """
     action_info = {'status': action.status,
                    'node': action.nic.owner.label,
                    'nic': action.nic.label,
                    'type': action.type,
-                   'channel': action.channel}
+                   'channel': action.channel,
+                   'attempts': action.attempts,
+                   'next_attempt': None,
+                   'failed_attempts': [{'time': attempt.time.isoformat(),
+                                        'error': attempt.error}
+                                       for attempt in action.failed_attempts]}
+
+    if action.next_attempt is not None:
+        action_info['next_attempt'] = action.next_attempt.isoformat()
 
     if action.new_network is None:
         action_info['new_network'] = None
     else:
         action_info['new_network'] = action.new_network.label
-
-    return json.dumps(action_info)
+    return action_info
 
 
-@rest_call('GET', '/nodes/<is_free>', Schema({'is_free': basestring}))
+@rest_call('GET', '/nodes/<is_free>', Schema({'is_free': basestring}),
+           cache_tables=('node',), cache_non_admin=True, read_only=True)
 def list_nodes(is_free):
     """List all nodes or all free nodes
 
@@ -1152,7 +1425,25 @@ def list_nodes(is_free):
     return json.dumps(nodes)
 
 
-@rest_call('GET', '/project/<project>/nodes', Schema({'project': basestring}))
+@rest_call('GET', '/nodes/<is_free>/power', Schema({'is_free': basestring}),
+           read_only=True)
+def list_nodes_power(is_free):
+    """Show the cached power state of all nodes, or all free nodes.
+
+    Returns a JSON object mapping node names to objects as returned by
+    `show_node_power`. Unlike `show_node_power`, this never queries the
+    OBMs directly.
+    """
+    get_auth_backend().require_admin()
+    query = model.Node.query.options(db.joinedload('power_status'))
+    if is_free == "free":
+        query = query.filter_by(project_id=None)
+    return json.dumps({node.label: _power_status_dict(node)
+                       for node in query})
+
+
+@rest_call('GET', '/project/<project>/nodes', Schema({'project': basestring}),
+           read_only=True)
 def list_project_nodes(project):
     """List all nodes belonging the given project.
 
@@ -1169,7 +1460,7 @@ def list_project_nodes(project):
 
 @rest_call('GET', '/project/<project>/networks', Schema({
     'project': basestring,
-}))
+}), read_only=True)
 def list_project_networks(project):
     """List all private networks the project can access.
 
@@ -1184,7 +1475,8 @@ def list_project_networks(project):
     return json.dumps(networks)
 
 
-@rest_call('GET', '/node/<nodename>', Schema({'nodename': basestring}))
+@rest_call('GET', '/node/<nodename>', Schema({'nodename': basestring}),
+           read_only=True)
 def show_node(nodename):
     """Show the details of a node.
 
@@ -1221,7 +1513,7 @@ def show_node(nodename):
 
 @rest_call('GET', '/project/<project>/headnodes', Schema({
     'project': basestring,
-}))
+}), read_only=True)
 def list_project_headnodes(project):
     """List all headnodes belonging the given project.
 
@@ -1238,7 +1530,7 @@ def list_project_headnodes(project):
 
 @rest_call('GET', '/headnode/<nodename>', Schema({
     'nodename': basestring,
-}))
+}), read_only=True)
 def show_headnode(nodename):
     """Show details of a headnode.
 
@@ -1253,6 +1545,8 @@ def show_headnode(nodename):
         'vncport': headnode.get_vncport(),
         'uuid': headnode.uuid,
         'base_img': headnode.base_img,
+        'job_status': headnode.job_status,
+        'job_error': headnode.job_error,
     }, sort_keys=True)
 
 
@@ -1271,7 +1565,7 @@ def list_headnode_images():
 
 # Extension code #
 #################
-@rest_call('GET', '/active_extensions', Schema({}))
+@rest_call('GET', '/active_extensions', Schema({}), read_only=True)
 def list_active_extensions():
     """List all active extensions"""
     get_auth_backend().require_admin()
@@ -1281,15 +1575,25 @@ def list_active_extensions():
 
 # Console code #
 ################
-@rest_call('GET', '/node/<nodename>/console', Schema({'nodename': basestring}))
-def show_console(nodename):
-    """Show the contents of the console log."""
+@rest_call('GET', '/node/<nodename>/console', Schema({
+    'nodename': basestring,
+    Optional('since'): Use(float),
+    Optional('until'): Use(float),
+}), read_only=True)
+def show_console(nodename, since=None, until=None):
+    """Show the contents of the console log.
+
+    If ``since`` and/or ``until`` are given (as seconds since the epoch), only
+    the output logged within that time range is returned.
+    """
     node = get_or_404(model.Node, nodename)
-    log = node.obm.get_console()
+    log = node.obm.get_console(since=since, until=until)
     if log is None:
         raise errors.NotFoundError(
             'The console log for %s does not exist.' % nodename)
-    return log
+    # Returning a Response, rather than a string, means it isn't gzipped;
+    # see `hil.rest._rest_wrapper`:
+    return flask.Response(log, mimetype='text/plain')
 
 
 @rest_call('PUT', '/node/<nodename>/console', Schema({'nodename': basestring}))
@@ -1309,6 +1613,45 @@ def stop_console(nodename):
     node.obm.delete_console()
 
 
+# Batch code #
+##############
+@rest_call('POST', '/batch', Schema({
+    'calls': [{
+        'method': basestring,
+        'path': basestring,
+        Optional('body'): object,
+        Optional('params'): {basestring: basestring},
+    }],
+    Optional('atomic'): bool,
+}))
+def batch(calls, atomic=False):
+    """Make several API calls in one request.
+
+    See `hil.rest.run_batch` for the format of ``calls`` and the meaning of
+    ``atomic``, and `docs/rest_api.md` for the format of the response. Each
+    call does its own authorization checks.
+    """
+    responses, committed = run_batch(calls, atomic)
+    return json.dumps({
+        'responses': responses,
+        'committed': committed,
+    })
+
+
+# Metrics #
+###########
+@rest_call('GET', '/metrics', Schema({}))
+def show_metrics():
+    """Show metrics about the API server's operation.
+
+    The response is in the Prometheus text exposition format; see
+    `hil.metrics`.
+    """
+    get_auth_backend().require_admin()
+    return flask.Response(metrics.REGISTRY.expose(),
+                          content_type=metrics.CONTENT_TYPE)
+
+
 # Helper functions #
 ####################
 def absent_or_conflict(cls, name):
@@ -1329,6 +1672,39 @@ def absent_or_conflict(cls, name):
                                                                name))
 
 
+def exists(query):
+    """Returns whether the query `query` matches any rows.
+
+    This makes a single ``SELECT EXISTS (...)`` query, which takes the same
+    time however many rows match. Use it instead of loading a relationship
+    just to see whether it is empty.
+
+    Must be called within a request context.
+    """
+    return db.session.query(query.exists()).scalar()
+
+
+def _lock_headnode(label):
+    """Return the headnode named `label`, locking it until the end of the
+    transaction. Raises a NotFoundError if it doesn't exist.
+
+    Starting, stopping and deleting a headnode lock it, so that these
+    operations are serialized even across API server processes, each of
+    which has its own queue of headnode jobs (see `hil.virsh`).
+    """
+    headnode = model.Headnode.query.filter_by(label=label) \
+        .with_for_update().first()
+    if headnode is None:
+        raise errors.NotFoundError('Headnode %s does not exist.' % label)
+    return headnode
+
+
+def _require_idle(headnode):
+    """Raise an IllegalStateError if `headnode` is still being started."""
+    if headnode.busy:
+        raise errors.IllegalStateError('Headnode is still being started.')
+
+
 def get_or_404(cls, name):
     """Raises a NotFoundError if the given object doesn't exist in the datbase.
     Otherwise returns the object
@@ -1,19 +1,22 @@
-"""This module implements the HIL command line tool."""
-from hil import config, server, migrations
-from hil.config import cfg
+"""This module implements the HIL command line tool.
+
+Most commands are just clients of the API, and only need `hil.client`. To
+keep those fast to start, the server side of HIL (`hil.server`,
+`hil.config`, the database...) and other heavyweight modules are imported
+only by the commands which use them, rather than at the top of this module.
+"""
 from hil.commands.util import ensure_not_root
 
 import inspect
 import json
 import os
 import requests
+import shlex
 import sys
+import threading
 import urllib
-import schema
 import logging
 
-import pkg_resources
-
 from functools import wraps
 
 from hil.client.client import Client, RequestsHTTPClient, KeystoneHTTPClient
@@ -26,7 +29,11 @@ command_dict = {}
 usage_dict = {}
 MIN_PORT_NUMBER = 1
 MAX_PORT_NUMBER = 2**16 - 1
-VERSION = pkg_resources.require('hil')[0].version
+
+# Commands which can't be run by `batch`, since they never return (or, for
+# batch itself, to avoid nesting):
+NOT_BATCHABLE = frozenset(['batch', 'serve', 'serve_networks',
+                           'serve_power_poller'])
 
 # An instance of HTTPClient, which will be used to make the request.
 http_client = None
@@ -55,23 +62,32 @@ def cmd(f):
         showee += ['<%s...>' % varargs]
     usage_dict[f.__name__] = ' '.join(showee)
 
+    def run(*args, **kwargs):
+        """Run the command, without the exception handling.
+
+        Raises InvalidAPIArgumentsException if the number of arguments is
+        wrong.
+        """
+        # For commands which accept a variable number of arguments,
+        # num_args is the *minimum* required arguments; there is no
+        # maximum. For other commands, there must be *exactly* `num_args`
+        # arguments:
+        if len(args) < num_args or not varargs and len(args) > num_args:
+            raise InvalidAPIArgumentsException()
+        f(*args, **kwargs)
+
     @wraps(f)
     def wrapped(*args, **kwargs):
         """Wrapper that implements the functionality described above."""
         try:
-            # For commands which accept a variable number of arguments,
-            # num_args is the *minimum* required arguments; there is no
-            # maximum. For other commands, there must be *exactly* `num_args`
-            # arguments:
-            if len(args) < num_args or not varargs and len(args) > num_args:
-                raise InvalidAPIArgumentsException()
-            f(*args, **kwargs)
+            run(*args, **kwargs)
         except InvalidAPIArgumentsException as e:
             if e.message != '':
                 sys.stderr.write(e.message + '\n\n')
             sys.stderr.write('Invalid arguments.  Usage:\n')
             help(f.__name__)
 
+    wrapped.run = run
     command_dict[f.__name__] = wrapped
     return wrapped
 
@@ -179,8 +195,9 @@ def object_url(*args):
     # Prefer an environmental variable for getting the endpoint if available.
     url = os.environ.get('HIL_ENDPOINT')
     if url is None:
+        from hil import config
         config.setup()
-        url = cfg.get('client', 'endpoint')
+        url = config.cfg.get('client', 'endpoint')
 
     for arg in args:
         url += '/' + urllib.quote(arg, '')
@@ -221,12 +238,18 @@ def do_delete(url):
 @cmd
 def version():
     """Check hil version"""
-    sys.stdout.write("HIL version: %s\n" % VERSION)
+    # pkg_resources is slow to import, so only do so when needed:
+    import pkg_resources
+    version = pkg_resources.require('hil')[0].version
+    sys.stdout.write("HIL version: %s\n" % version)
 
 
 @cmd
 def serve(port):
     """Run a development api server. Don't use this in production."""
+    import schema
+    from hil import config, server, migrations
+    from hil.config import cfg
     try:
         port = schema.And(
             schema.Use(int),
@@ -257,7 +280,8 @@ def serve(port):
 @cmd
 def serve_networks():
     """Start the HIL networking server"""
-    from hil import model, deferred
+    from hil import config, server, migrations, model, deferred
+    from hil.config import cfg
     from time import sleep
     config.setup()
     server.init()
@@ -281,6 +305,21 @@ def serve_networks():
     else:
         sleep_time = 2
 
+    try:
+        deferred.retry_policy()
+        deferred.breaker_policy()
+    except ValueError as e:
+        sys.exit("Error: %s" % e)
+
+    if cfg.has_option('network-daemon', 'metrics_port'):
+        from hil import metrics
+        host = '127.0.0.1'
+        if cfg.has_option('network-daemon', 'metrics_host'):
+            host = cfg.get('network-daemon', 'metrics_host')
+        metrics.serve_in_background(host,
+                                    cfg.getint('network-daemon',
+                                               'metrics_port'))
+
     while True:
         # Empty the journal until it's empty; then delay so we don't tight
         # loop.
@@ -289,6 +328,43 @@ def serve_networks():
         sleep(sleep_time)
 
 
+@cmd
+def serve_power_poller():
+    """Start the HIL power poller, which caches nodes' power state"""
+    from hil import config, server, migrations, model, power_poller
+    from hil.config import cfg
+    from time import sleep
+    config.setup()
+    server.init()
+    server.register_drivers()
+    server.validate_state()
+    model.init_db()
+    migrations.check_db_schema()
+
+    def _get_option(name, default):
+        if not cfg.has_option('power-poller', name):
+            return default
+        try:
+            return cfg.getfloat('power-poller', name)
+        except ValueError:
+            sys.exit("Error: %s set to non-float value" % name)
+
+    max_age = _get_option('max_age', 300)
+    rate = _get_option('rate', 1)
+    jitter = _get_option('jitter', 0.2)
+    if max_age <= 0:
+        sys.exit("Error: max_age must be > 0")
+    if rate <= 0:
+        sys.exit("Error: rate must be > 0")
+    if not 0 <= jitter < 1:
+        sys.exit("Error: jitter not within bounds 0 <= jitter < 1")
+
+    while True:
+        if power_poller.poll(max_age, rate, jitter) == 0:
+            # Nothing is stale yet; check back shortly.
+            sleep(1.0 / rate)
+
+
 @cmd
 def list_users():
     """List all users when the database authentication is active.
@@ -463,6 +539,18 @@ def node_power_off(node):
     C.node.power_off(node)
 
 
+@cmd
+def show_node_power(node, fresh='false'):
+    """Display the power state of <node>
+
+    If <fresh> is 'true', query the node's OBM rather than reporting the
+    last polled state.
+    """
+    q = C.node.show_power(node, fresh == 'true')
+    for item in q.items():
+        sys.stdout.write("%s\t  :  %s\n" % (item[0], item[1]))
+
+
 @cmd
 def node_set_bootdev(node, dev):
     """
@@ -786,6 +874,7 @@ def create_admin_user(username, password):
     have an initial admin, you can (and should) create additional users via
     the API.
     """
+    from hil import config
     config.setup()
     if not config.cfg.has_option('extensions', 'hil.ext.auth.database'):
         sys.exit("'make_inital_admin' is only valid with the database auth"
@@ -831,6 +920,160 @@ def help(*commands):
         sys.stdout.write('      %s\n' % command_dict[name].__doc__)
 
 
+class _ThreadLocalOutput(object):
+    """A file-like object which redirects writes on a per-thread basis.
+
+    Writes go to the thread's ``buffer`` attribute (see `capture`) if it has
+    been set, and to `stream` otherwise. `batch` replaces ``sys.stdout`` and
+    ``sys.stderr`` with these, so that it can collect the output of each of
+    the commands it runs concurrently.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, data):
+        """Write `data` to the current thread's buffer, or `stream`."""
+        buf = getattr(self.local, 'buffer', None)
+        if buf is None:
+            self.stream.write(data)
+        else:
+            buf.append(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def _parse_batch(text):
+    """Parse the input to `batch`.
+
+    `text` is either a JSON array, each element of which is a command (as a
+    list of strings, or a single string to split like a shell would), or a
+    sequence of lines, one command per line. Blank lines, and lines starting
+    with ``#``, are skipped.
+
+    Returns a list of ``(line, argv)`` pairs, where `line` identifies where
+    the command came from (its line number or index into the array), and
+    `argv` is the command and its arguments.
+    """
+    if text.lstrip().startswith('['):
+        try:
+            commands = json.loads(text)
+        except ValueError as e:
+            raise InvalidAPIArgumentsException('Invalid JSON: %s' % e)
+        result = []
+        for i, command in enumerate(commands):
+            if isinstance(command, basestring):
+                command = shlex.split(command)
+            result.append((i, [str(arg) for arg in command]))
+        return result
+    result = []
+    for i, line in enumerate(text.splitlines(), 1):
+        argv = shlex.split(line, comments=True)
+        if argv:
+            result.append((i, argv))
+    return result
+
+
+def _run_batched(line, argv, stdout, stderr):
+    """Run one of the commands for `batch`, returning a result dictionary.
+
+    `stdout` and `stderr` should be the `_ThreadLocalOutput` objects that
+    ``sys.stdout`` and ``sys.stderr`` have been replaced with.
+    """
+    result = {'line': line, 'command': argv}
+    out = stdout.local.buffer = []
+    err = stderr.local.buffer = []
+    error = None
+    try:
+        if not argv or argv[0] not in command_dict:
+            raise InvalidAPIArgumentsException('Unknown command: %s' %
+                                               ' '.join(argv[:1]))
+        if argv[0] in NOT_BATCHABLE:
+            raise InvalidAPIArgumentsException(
+                "The '%s' command can't be used in a batch." % argv[0])
+        command_dict[argv[0]].run(*argv[1:])
+    except InvalidAPIArgumentsException as e:
+        error = e.message or 'Invalid arguments. Usage: %s' % \
+            usage_dict[argv[0]]
+    except (FailedAPICallException, BadArgumentError) as e:
+        error = e.message
+    except SystemExit as e:
+        error = str(e.code)
+    except Exception as e:
+        error = 'Unexpected error: %s' % e
+    finally:
+        stdout.local.buffer = None
+        stderr.local.buffer = None
+    result['output'] = ''.join(out)
+    if error is None:
+        result['status'] = 'ok'
+    else:
+        result['status'] = 'error'
+        result['error'] = (''.join(err) + error).strip()
+    return result
+
+
+@cmd
+def batch(*options):
+    """Run many commands, read from a file (or stdin), printing their results
+
+    Usage: batch [--jobs <n>] [<file>]. Commands are given one per line, or
+    as a JSON array. All of them share one connection (or up to <n>, if they
+    are run <n> at a time). For each command, a line of JSON is printed with
+    its output and status; failed commands do not stop the rest.
+    """
+    import argparse
+    from multiprocessing.pool import ThreadPool
+    from requests.adapters import HTTPAdapter
+    parser = argparse.ArgumentParser(prog='hil batch')
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('file', nargs='?', default='-')
+    try:
+        args = parser.parse_args(options)
+    except SystemExit:
+        raise InvalidAPIArgumentsException()
+    if args.jobs < 1:
+        raise InvalidAPIArgumentsException('--jobs must be at least 1.')
+
+    if args.file == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.file) as f:
+            text = f.read()
+    commands = _parse_batch(text)
+
+    if args.jobs > 1 and isinstance(http_client, requests.Session):
+        # Keep enough connections open for all of the workers:
+        adapter = HTTPAdapter(pool_maxsize=args.jobs)
+        http_client.mount('http://', adapter)
+        http_client.mount('https://', adapter)
+
+    real_stdout, real_stderr = sys.stdout, sys.stderr
+    stdout = sys.stdout = _ThreadLocalOutput(real_stdout)
+    stderr = sys.stderr = _ThreadLocalOutput(real_stderr)
+    pool = ThreadPool(args.jobs)
+    failed = 0
+
+    def run(command):
+        """Run one of `commands`, returning its result."""
+        line, argv = command
+        return _run_batched(line, argv, stdout, stderr)
+
+    try:
+        for result in pool.imap(run, commands):
+            if result['status'] != 'ok':
+                failed += 1
+            real_stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            real_stdout.flush()
+    finally:
+        pool.close()
+        sys.stdout, sys.stderr = real_stdout, real_stderr
+    if failed:
+        sys.exit('%d of %d commands failed.' % (failed, len(commands)))
+
+
 def main():
     """Entry point to the CLI.
 
@@ -1,8 +1,11 @@
 """ This module implements the HIL client library. """
 
 from urlparse import urljoin
+from collections import OrderedDict
 import json
 import re
+import threading
+import zlib
 from hil.errors import BadArgumentError
 import inspect
 
@@ -22,6 +25,46 @@ class FailedAPICallException(Exception):
         self.error_type = error_type
 
 
+class ResponseCache(object):
+    """A least-recently-used cache of responses to GET requests.
+
+    Responses are stored along with their ETag, and are keyed by URL and
+    query parameters. At most `maxsize` responses are kept. The cache may be
+    shared by several threads.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(url, params):
+        """Return the cache key for a request to `url` with `params`."""
+        if params:
+            return url, tuple(sorted(params.items()))
+        return url, ()
+
+    def get(self, key):
+        """Return the (etag, response) pair for `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, etag, response):
+        """Store `response`, which had the ETag `etag`, under `key`."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (etag, response)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
 class ClientBase(object):
     """Main class which contains all the methods to
 
@@ -32,17 +75,25 @@ class ClientBase(object):
     appropriate message.
     """
 
-    def __init__(self, endpoint, httpClient):
+    def __init__(self, endpoint, httpClient, cache=None):
         """ Initialize an instance of the library with following parameters.
 
        endpoint: stands for the http endpoint eg. endpoint=http://127.0.0.1
        sess: depending on the authentication backend (db vs keystone) the
        parameters required to make up the session vary.
        user: username as which you wish to connect to HIL
+       cache: an optional ResponseCache. If supplied, GET requests are
+       made conditional on the cached response's ETag, and the cached
+       response is reused if the server reports it is unchanged. It is
+       ignored if httpClient can't send extra headers (see
+       `_accepts_headers`).
        Currently all this information is fetched from the user's environment.
         """
         self.endpoint = endpoint
         self.httpClient = httpClient
+        if cache is not None and not _accepts_headers(httpClient):
+            cache = None
+        self.cache = cache
 
     def object_url(self, *args):
         """Generate URL from combining endpoint and args as relative URL"""
@@ -50,6 +101,30 @@ class ClientBase(object):
         url = urljoin(self.endpoint, rel)
         return url
 
+    def request(self, method, url, data=None, params=None):
+        """Make an HTTP request via ``self.httpClient``.
+
+        The arguments and return value are as for `HTTPClient.request`. GET
+        requests go through ``self.cache``, if there is one.
+        """
+        if self.cache is None or method != 'GET':
+            return self.httpClient.request(method, url, data=data,
+                                           params=params)
+        key = ResponseCache.key(url, params)
+        cached = self.cache.get(key)
+        if cached is None:
+            response = self.httpClient.request(method, url, params=params)
+        else:
+            response = self.httpClient.request(
+                method, url, params=params,
+                headers={'If-None-Match': cached[0]})
+            if response.status_code == 304:
+                return cached[1]
+        etag = response.headers.get('ETag')
+        if response.status_code == 200 and etag:
+            self.cache.put(key, etag, response)
+        return response
+
     def check_response(self, response):
         """
         Check the response from an API call, and do any needed error handling
@@ -57,21 +132,50 @@ class ClientBase(object):
         Returns the body of the response as (parsed) JSON, or None if there
         was no body. Raises a FailedAPICallException on any non 2xx status.
         """
+        content = _decode_body(response)
         if 200 <= response.status_code < 300:
             try:
-                return json.loads(response.content)
+                return json.loads(content)
             except ValueError:  # No JSON request body; typical
                                 # For methods PUT, POST, DELETE
                 return
         try:
-            e = json.loads(response.content)
+            e = json.loads(content)
             raise FailedAPICallException(
                 error_type=e['type'],
                 message=e['msg'],
             )
         # Catching responses that do not return JSON
         except ValueError:
-            return response.content
+            return content
+
+
+def _accepts_headers(http_client):
+    """Return whether ``http_client.request`` takes a ``headers`` argument.
+
+    It was added to `HTTPClient.request` along with `ResponseCache`, so
+    HTTPClients written before then don't take it.
+    """
+    try:
+        argspec = inspect.getargspec(http_client.request)
+    except TypeError:
+        return False
+    return 'headers' in argspec.args or argspec.keywords is not None
+
+
+def _decode_body(response):
+    """Return the body of `response`, decompressed if need be.
+
+    The server gzips large responses for clients which accept it. HTTP
+    clients based on requests (which asks for gzip by default) decompress
+    the body as it is read, but leave the ``Content-Encoding`` header in
+    place, so the body is only decompressed here if it is still gzipped.
+    """
+    content = response.content
+    if response.headers.get('Content-Encoding') == 'gzip' and \
+            content.startswith('\x1f\x8b'):
+        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+    return content
 
 
 def _find_reserved(string, slashes_ok=False):
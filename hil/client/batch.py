@@ -0,0 +1,165 @@
+"""Client support for making several API calls in one request.
+
+Use `Client.batch` to create a `Batch`:
+
+    with client.batch(atomic=True) as b:
+        info = b.node.show('node-23')
+        b.port.port_revert('switch-01', 'gi1/0/23')
+        b.project.detach('runway', 'node-23')
+    print(info.get())
+
+Within the block, the batch has the same attributes as the `Client` (``node``,
+``project``, ...), with the same methods. Calling them doesn't contact the
+server; instead, the call is recorded and a `BatchResult` is returned. When
+the block exits, all of the recorded calls are sent to the server in one
+request, and the results become available.
+"""
+import json
+from urlparse import urlparse
+
+from hil.client.base import ClientBase, FailedAPICallException
+from hil.client.client import Client, HTTPClient, HTTPResponse
+
+
+class BatchResult(object):
+    """The result of a call made as part of a `Batch`."""
+
+    def __init__(self, batch, index):
+        self._batch = batch
+        self._index = index
+
+    def ready(self):
+        """Return whether the batch has been sent."""
+        return self._batch.sent
+
+    def get(self):
+        """Return the result of the call.
+
+        This returns (or raises) whatever calling the method directly
+        would have. If the call was not run, because an earlier call in an
+        atomic batch failed, a `FailedAPICallException` with an error_type
+        of ``BatchAbortedError`` is raised.
+
+        It is an error to call this before the batch has been sent.
+        """
+        if not self._batch.sent:
+            raise RuntimeError('The batch has not been sent yet.')
+        if self._index >= len(self._batch.responses):
+            raise FailedAPICallException(
+                error_type='BatchAbortedError',
+                message='The call was not run, since an earlier call in '
+                        'the batch failed.')
+        return self._batch.check_response(self._batch.responses[self._index])
+
+
+class _RecordingHTTPClient(HTTPClient):
+    """An HTTPClient which just records the requests made through it.
+
+    Every request "succeeds", with an empty body. The paths are recorded
+    relative to `endpoint`, which may be served under a prefix (e.g.
+    ``https://example.com/hil/``), since that is what the server expects.
+    """
+
+    def __init__(self, endpoint):
+        self.calls = []
+        self.prefix = urlparse(endpoint).path.rstrip('/')
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        path = urlparse(url).path
+        if path.startswith(self.prefix + '/'):
+            path = path[len(self.prefix):]
+        call = {'method': method, 'path': path}
+        if data is not None:
+            call['body'] = json.loads(data)
+        if params:
+            call['params'] = params
+        self.calls.append(call)
+        return HTTPResponse(status_code=200, headers={}, content='')
+
+
+class _BatchProxy(object):
+    """Wraps one of `Client`'s attributes (e.g. a `Node`), so that calling
+    its methods records a call in the batch, returning a `BatchResult`.
+    """
+
+    def __init__(self, obj, batch):
+        self._obj = obj
+        self._batch = batch
+
+    def __getattr__(self, name):
+        method = getattr(self._obj, name)
+        if not callable(method):
+            return method
+
+        def record(*args, **kwargs):
+            """Record a call to the method; return a BatchResult."""
+            if self._batch.sent:
+                raise RuntimeError('The batch has already been sent.')
+            method(*args, **kwargs)
+            return BatchResult(self._batch, len(self._batch.calls) - 1)
+        record.__name__ = name
+        record.__doc__ = method.__doc__
+        return record
+
+
+class Batch(ClientBase):
+    """A batch of API calls, to be sent to the server together.
+
+    See the module documentation for usage. If `atomic` is True, the calls'
+    changes to the database are committed together, only if all of them
+    succeed; if one of them fails, the remaining calls are not run. Note
+    that some operations (e.g. powering off a node) take effect immediately,
+    and are not undone if a later call fails.
+
+    After the batch is sent, ``committed`` is False iff an atomic batch was
+    rolled back.
+    """
+
+    _attrs = ('node', 'project', 'switch', 'port', 'network', 'user',
+              'extensions')
+
+    def __init__(self, endpoint, httpClient, atomic=False):
+        ClientBase.__init__(self, endpoint, httpClient)
+        self.atomic = atomic
+        self.responses = []
+        self.sent = False
+        self.committed = None
+        recorder = _RecordingHTTPClient(endpoint)
+        # The calls recorded so far, in the form expected by the server:
+        self.calls = recorder.calls
+        recording_client = Client(endpoint, recorder, cache_size=0)
+        for attr in self._attrs:
+            setattr(self, attr,
+                    _BatchProxy(getattr(recording_client, attr), self))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+
+    def send(self):
+        """Send the recorded calls to the server.
+
+        This is called automatically at the end of a ``with`` block. Raises
+        a `FailedAPICallException` if the batch as a whole fails (errors
+        from the individual calls are instead reported by their
+        `BatchResult`).
+        """
+        if self.sent:
+            raise RuntimeError('The batch has already been sent.')
+        url = self.object_url('batch')
+        payload = json.dumps({
+            'calls': self.calls,
+            'atomic': self.atomic,
+        })
+        response = self.check_response(
+            self.request('POST', url, data=payload)
+        )
+        self.sent = True
+        self.committed = response['committed']
+        self.responses = [HTTPResponse(status_code=r['status'],
+                                       headers={},
+                                       content=r['body'])
+                          for r in response['responses']]
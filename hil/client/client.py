@@ -10,6 +10,7 @@ from hil.client.switch import Port
 from hil.client.network import Network
 from hil.client.user import User
 from hil.client.extensions import Extensions
+from hil.client.base import ResponseCache
 import abc
 import requests
 
@@ -26,12 +27,13 @@ class HTTPClient(object):
     __metaclass__ = abc.ABCMeta
 
     @abc.abstractmethod
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
         """Make an HTTP request
 
         Makes an HTTP request on URL `url` with method `method`, request body
-        `data`(if supplied) and query parameter `params`(if supplied). May add
-        authentication or other backend-specific information to the request.
+        `data`(if supplied), query parameter `params`(if supplied) and extra
+        headers `headers`(if supplied). May add authentication or other
+        backend-specific information to the request.
 
         Parameters
         ----------
@@ -45,6 +47,8 @@ class HTTPClient(object):
         params : dictionary, optional
             The query parameter, e.g. {'key1': 'val1', 'key2': 'val2'},
             dictionary key can't be `None`
+        headers : dictionary, optional
+            Extra headers to send, e.g. {'If-None-Match': '"abc123"'}
 
         Returns
         -------
@@ -113,7 +117,7 @@ class KeystoneHTTPClient(HTTPClient):
         """
         self.session = session
 
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
         """Make an HTTP request using keystone for authentication.
 
         Smooths over the differences between python-keystoneclient's
@@ -129,7 +133,8 @@ class KeystoneHTTPClient(HTTPClient):
             resp = self.session.request(method=method,
                                         url=url,
                                         data=data,
-                                        params=params)
+                                        params=params,
+                                        headers=headers)
 
         except HttpError as e:
             resp = e.response
@@ -139,15 +144,37 @@ class KeystoneHTTPClient(HTTPClient):
 
 
 class Client(object):
-    """A HIL API client."""
+    """A HIL API client.
 
-    def __init__(self, endpoint, httpClient):
+    If `cache_size` is non-zero, responses to GET requests are cached (up to
+    `cache_size` of them), and subsequent requests for the same URL are made
+    conditional on the cached response's ETag, so that unchanged data is not
+    sent again. This needs an `HTTPClient` whose ``request`` method accepts
+    the ``headers`` argument; with older ones, the cache is not used.
+    """
+
+    def __init__(self, endpoint, httpClient, cache_size=0):
         self.httpClient = httpClient
         self.endpoint = endpoint
-        self.node = Node(self.endpoint, self.httpClient)
-        self.project = Project(self.endpoint, self.httpClient)
-        self.switch = Switch(self.endpoint, self.httpClient)
-        self.port = Port(self.endpoint, self.httpClient)
-        self.network = Network(self.endpoint, self.httpClient)
-        self.user = User(self.endpoint, self.httpClient)
-        self.extensions = Extensions(self.endpoint, self.httpClient)
+        if cache_size:
+            self.cache = ResponseCache(cache_size)
+        else:
+            self.cache = None
+        self.node = Node(self.endpoint, self.httpClient, self.cache)
+        self.project = Project(self.endpoint, self.httpClient, self.cache)
+        self.switch = Switch(self.endpoint, self.httpClient, self.cache)
+        self.port = Port(self.endpoint, self.httpClient, self.cache)
+        self.network = Network(self.endpoint, self.httpClient, self.cache)
+        self.user = User(self.endpoint, self.httpClient, self.cache)
+        self.extensions = Extensions(self.endpoint, self.httpClient,
+                                     self.cache)
+
+    def batch(self, atomic=False):
+        """Return a `hil.client.batch.Batch`, for making several calls in
+        one request.
+
+        See the documentation for `hil.client.batch` for details.
+        """
+        # Imported here to avoid a circular import:
+        from hil.client.batch import Batch
+        return Batch(self.endpoint, self.httpClient, atomic=atomic)
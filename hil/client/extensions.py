@@ -11,4 +11,4 @@ class Extensions(ClientBase):
     def list_active(self):
         """List all active extensions. """
         url = self.object_url('active_extensions')
-        return self.check_response(self.httpClient.request("GET", url))
+        return self.check_response(self.request("GET", url))
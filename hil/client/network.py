@@ -13,24 +13,24 @@ class Network(ClientBase):
         def list(self):
             """Lists all networks under HIL """
             url = self.object_url('networks')
-            return self.check_response(self.httpClient.request("GET", url))
+            return self.check_response(self.request("GET", url))
 
         @check_reserved_chars()
         def list_network_attachments(self, network, project):
             """Lists nodes connected to a network"""
             url = self.object_url('network', network, 'attachments')
             if project == "all":
-                return self.check_response(self.httpClient.request("GET", url))
+                return self.check_response(self.request("GET", url))
 
             params = {'project': project}
             return self.check_response(
-                    self.httpClient.request("GET", url, params=params))
+                    self.request("GET", url, params=params))
 
         @check_reserved_chars()
         def show(self, network):
             """Shows attributes of a network. """
             url = self.object_url('network', network)
-            return self.check_response(self.httpClient.request("GET", url))
+            return self.check_response(self.request("GET", url))
 
         @check_reserved_chars(slashes_ok=['net_id'])
         def create(self, network, owner, access, net_id):
@@ -44,14 +44,14 @@ class Network(ClientBase):
                 'net_id': net_id
                 })
             return self.check_response(
-                    self.httpClient.request("PUT", url, data=payload)
+                    self.request("PUT", url, data=payload)
                     )
 
         @check_reserved_chars()
         def delete(self, network):
             """Delete a <network>. """
             url = self.object_url('network', network)
-            return self.check_response(self.httpClient.request("DELETE", url))
+            return self.check_response(self.request("DELETE", url))
 
         @check_reserved_chars()
         def grant_access(self, project, network):
@@ -59,7 +59,7 @@ class Network(ClientBase):
             url = self.object_url(
                     'network', network, 'access', project
                     )
-            return self.check_response(self.httpClient.request("PUT", url))
+            return self.check_response(self.request("PUT", url))
 
         @check_reserved_chars()
         def revoke_access(self, project, network):
@@ -67,4 +67,4 @@ class Network(ClientBase):
             url = self.object_url(
                     'network', network, 'access', project
                     )
-            return self.check_response(self.httpClient.request("DELETE", url))
+            return self.check_response(self.request("DELETE", url))
@@ -1,9 +1,14 @@
 """Client support for node related api calls."""
 import json
+import time
 from hil.client.base import ClientBase
 from hil.client.base import check_reserved_chars
 from hil.errors import BadArgumentError, UnknownSubtypeError
 
+# The longest we ask the server to wait in one call to
+# show_networking_action (the server caps this anyway):
+MAX_WAIT = 60
+
 
 class Node(ClientBase):
     """Consists of calls to query and manipulate node related
@@ -14,13 +19,13 @@ class Node(ClientBase):
     def list(self, is_free):
         """List all nodes that HIL manages """
         url = self.object_url('nodes', is_free)
-        return self.check_response(self.httpClient.request('GET', url))
+        return self.check_response(self.request('GET', url))
 
     @check_reserved_chars()
     def show(self, node_name):
         """Shows attributes of a given node """
         url = self.object_url('node', node_name)
-        return self.check_response(self.httpClient.request('GET', url))
+        return self.check_response(self.request('GET', url))
 
     @check_reserved_chars()
     def register(self, node, subtype, *args):
@@ -54,14 +59,14 @@ class Node(ClientBase):
         url = self.object_url('node', node)
         payload = json.dumps({"obm": obminfo})
         return self.check_response(
-                self.httpClient.request('PUT', url, data=payload)
+                self.request('PUT', url, data=payload)
                 )
 
     @check_reserved_chars()
     def delete(self, node_name):
         """Deletes the node from database. """
         url = self.object_url('node', node_name)
-        return self.check_response(self.httpClient.request('DELETE', url))
+        return self.check_response(self.request('DELETE', url))
 
     @check_reserved_chars(dont_check=['force'])
     def power_cycle(self, node_name, force=False):
@@ -69,14 +74,34 @@ class Node(ClientBase):
         url = self.object_url('node', node_name, 'power_cycle')
         payload = json.dumps({'force': force})
         return self.check_response(
-                self.httpClient.request('POST', url, data=payload)
+                self.request('POST', url, data=payload)
                 )
 
     @check_reserved_chars()
     def power_off(self, node_name):
         """Power offs the <node> """
         url = self.object_url('node', node_name, 'power_off')
-        return self.check_response(self.httpClient.request('POST', url))
+        return self.check_response(self.request('POST', url))
+
+    @check_reserved_chars(dont_check=['fresh'])
+    def show_power(self, node_name, fresh=False):
+        """Show the power state of <node_name>.
+
+        If <fresh> is True, the node's OBM is queried directly, rather than
+        returning the state last recorded by the power poller.
+        """
+        url = self.object_url('node', node_name, 'power')
+        params = None
+        if fresh:
+            params = {'fresh': 'true'}
+        return self.check_response(
+                self.request('GET', url, params=params)
+                )
+
+    def list_power(self, is_free):
+        """List the cached power state of all (or all free) nodes."""
+        url = self.object_url('nodes', is_free, 'power')
+        return self.check_response(self.request('GET', url))
 
     @check_reserved_chars()
     def set_bootdev(self, node, dev):
@@ -84,7 +109,7 @@ class Node(ClientBase):
         url = self.object_url('node', node, 'boot_device')
         payload = json.dumps({'bootdev': dev})
         return self.check_response(
-                self.httpClient.request('PUT', url, data=payload)
+                self.request('PUT', url, data=payload)
                 )
 
     @check_reserved_chars(dont_check=['macaddr'])
@@ -93,14 +118,14 @@ class Node(ClientBase):
         url = self.object_url('node', node_name, 'nic', nic_name)
         payload = json.dumps({'macaddr': macaddr})
         return self.check_response(
-                self.httpClient.request('PUT', url, data=payload)
+                self.request('PUT', url, data=payload)
                 )
 
     @check_reserved_chars()
     def remove_nic(self, node_name, nic_name):
         """Remove a <nic> from <node>"""
         url = self.object_url('node', node_name, 'nic', nic_name)
-        return self.check_response(self.httpClient.request('DELETE', url))
+        return self.check_response(self.request('DELETE', url))
 
     @check_reserved_chars(slashes_ok=['channel'])
     def connect_network(self, node, nic, network, channel):
@@ -112,7 +137,7 @@ class Node(ClientBase):
             'network': network, 'channel': channel
             })
         return self.check_response(
-                self.httpClient.request('POST', url, data=payload)
+                self.request('POST', url, data=payload)
                 )
 
     @check_reserved_chars()
@@ -123,7 +148,7 @@ class Node(ClientBase):
                 )
         payload = json.dumps({'network': network})
         return self.check_response(
-                self.httpClient.request('POST', url, data=payload)
+                self.request('POST', url, data=payload)
                 )
 
     @check_reserved_chars()
@@ -132,14 +157,14 @@ class Node(ClientBase):
         url = self.object_url('node', node, 'metadata', label)
         payload = json.dumps({'value': value})
         return self.check_response(
-                self.httpClient.request('PUT', url, data=payload)
+                self.request('PUT', url, data=payload)
                )
 
     @check_reserved_chars()
     def metadata_delete(self, node, label):
         """Delete metadata with <label> from a <node>"""
         url = self.object_url('node', node, 'metadata', label)
-        return self.check_response(self.httpClient.request('DELETE', url))
+        return self.check_response(self.request('DELETE', url))
 
     def show_console(self, node):
         """Display console log for <node> """
@@ -149,15 +174,40 @@ class Node(ClientBase):
     def start_console(self, node):
         """Start logging console output from <node> """
         url = self.object_url('node', node, 'console')
-        return self.check_response(self.httpClient.request('PUT', url))
+        return self.check_response(self.request('PUT', url))
 
     @check_reserved_chars()
     def stop_console(self, node):
         """Stop logging console output from <node> and delete the log"""
         url = self.object_url('node', node, 'console')
-        return self.check_response(self.httpClient.request('DELETE', url))
+        return self.check_response(self.request('DELETE', url))
+
+    def show_networking_action(self, status_id, wait=None):
+        """Returns the status of the networking action
 
-    def show_networking_action(self, status_id):
-        """Returns the status of the networking action"""
+        If `wait` is given, the server waits up to that many seconds for a
+        pending action to finish before responding.
+        """
         url = self.object_url('networking_action', status_id)
-        return self.check_response(self.httpClient.request('GET', url))
+        params = None
+        if wait is not None:
+            params = {'wait': str(wait)}
+        return self.check_response(self.request('GET', url, params=params))
+
+    def wait_for(self, status_id, timeout=None):
+        """Wait for the networking action to finish, and return its status.
+
+        Returns as soon as the action is no longer pending, or after
+        `timeout` seconds (if given), whichever comes first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            wait = MAX_WAIT
+            if timeout is not None:
+                wait = min(wait, max(deadline - time.time(), 0))
+            info = self.show_networking_action(status_id, wait=wait)
+            if info['status'] != 'PENDING':
+                return info
+            if timeout is not None and time.time() >= deadline:
+                return info
@@ -0,0 +1,257 @@
+"""Concurrent access to the HIL API.
+
+The objects in `hil.client.client` make one request at a time. Callers
+which need to make many requests -- e.g. showing every node in a large
+project -- can use a `ParallelClient` instead, which runs calls on a pool of
+worker threads:
+
+    client = ParallelClient(endpoint, pooled_http_client(workers=16))
+    result = client.node.show('node-23')   # returns immediately
+    print(result.get())                    # waits for the response
+
+    # Fan-out helpers wait for all of the responses:
+    nodes = client.show_project_nodes('runway')
+
+`ParallelClient` has the same attributes (``node``, ``project``, ``switch``,
+etc.) as `Client`, with the same methods, except that each method returns an
+`AsyncResult` (see `multiprocessing.pool`) instead of the response.
+
+`RetryingHTTPClient` wraps another `HTTPClient`, retrying requests which fail
+for transient reasons with exponential backoff. `pooled_http_client` builds
+the combination of the two that most callers want.
+"""
+
+import random
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+from hil.client.client import Client, HTTPClient, RequestsHTTPClient
+
+DEFAULT_WORKERS = 8
+
+# Status codes which indicate that the server (or a proxy in front of it) is
+# temporarily unable to handle the request:
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+# Methods which can safely be sent more than once. HIL's PUT and DELETE
+# calls aren't idempotent in effect, even if they are in HTTP terms: a
+# project_create or node_delete which succeeded, but whose response was
+# lost, fails with a 409 or 404 if it's sent again. POST calls (e.g.
+# node_connect_network) aren't idempotent at all.
+SAFE_METHODS = frozenset(['GET', 'HEAD'])
+
+
+def _not_sent(error):
+    """Return whether the `requests` exception `error` means that the
+    request never reached the server, e.g. because the connection was
+    refused, so that it is safe to send again whatever the method.
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.ConnectionError) or not error.args:
+        return False
+    # requests wraps urllib3's exceptions, which may themselves wrap the
+    # underlying error:
+    reason = getattr(error.args[0], 'reason', error.args[0])
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryingHTTPClient(HTTPClient):
+    """An HTTPClient which retries failed requests with backoff.
+
+    Requests using `SAFE_METHODS` are retried up to `retries` times if
+    they fail to connect or time out, or if the server responds with one of
+    `RETRY_STATUS_CODES`. Other requests are only retried if they never
+    reached the server (see `_not_sent`). The n-th retry waits for a random
+    time of up to ``backoff * 2**n`` seconds (but no more than
+    `max_backoff`) first.
+    """
+
+    def __init__(self, http_client, retries=3, backoff=0.1, max_backoff=5,
+                 sleep=time.sleep):
+        """Create a RetryingHTTPClient
+
+        Parameters
+        ----------
+
+        http_client : HTTPClient
+            The client to make the requests with
+        retries : int
+            The maximum number of times to retry a request
+        backoff : float
+            The base of the exponential backoff, in seconds
+        max_backoff : float
+            The longest to wait between any two attempts, in seconds
+        sleep : callable
+            The function to wait with; this is a parameter for the sake of
+            the tests.
+        """
+        self.http_client = http_client
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        safe = method.upper() in SAFE_METHODS
+        attempt = 0
+        while True:
+            try:
+                resp = self.http_client.request(method, url, data=data,
+                                                params=params,
+                                                headers=headers)
+                if not safe or resp.status_code not in RETRY_STATUS_CODES \
+                        or attempt >= self.retries:
+                    return resp
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or not (safe or _not_sent(e)):
+                    raise
+            self.sleep(random.uniform(0, min(self.max_backoff,
+                                             self.backoff * 2 ** attempt)))
+            attempt += 1
+
+
+def pooled_http_client(workers=DEFAULT_WORKERS, retries=3, auth=None):
+    """Return an HTTPClient suitable for use with a `ParallelClient`.
+
+    The client keeps up to `workers` connections open to the server, to be
+    shared by the worker threads, and retries requests as described in
+    `RetryingHTTPClient`. If `auth` is not None, it is used as the
+    underlying session's ``auth`` attribute, e.g. a (username, password)
+    pair.
+    """
+    sess = RequestsHTTPClient()
+    if auth is not None:
+        sess.auth = auth
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+    return RetryingHTTPClient(sess, retries=retries)
+
+
+class _AsyncProxy(object):
+    """Wraps one of `Client`'s attributes (e.g. a `Node`).
+
+    Calling any of the wrapped object's methods through the proxy submits
+    the call to `pool`, returning an `AsyncResult`.
+    """
+
+    def __init__(self, obj, pool):
+        self._obj = obj
+        self._pool = pool
+
+    def __getattr__(self, name):
+        method = getattr(self._obj, name)
+        if not callable(method):
+            return method
+
+        def submit(*args, **kwargs):
+            """Run the method on the pool; return an AsyncResult."""
+            return self._pool.apply_async(method, args, kwargs)
+        submit.__name__ = name
+        submit.__doc__ = method.__doc__
+        return submit
+
+
+class ParallelClient(object):
+    """A HIL API client which makes calls concurrently.
+
+    At most `workers` calls are in flight at once; further calls are queued
+    until a worker is free. The client should be closed (or used as a
+    context manager) when it is no longer needed, to stop the workers.
+
+    Note that `http_client` is shared by all of the workers, so it must be
+    safe to use from multiple threads; `pooled_http_client` returns a
+    suitable one.
+    """
+
+    _attrs = ('node', 'project', 'switch', 'port', 'network', 'user',
+              'extensions')
+
+    def __init__(self, endpoint, http_client, workers=DEFAULT_WORKERS):
+        self.endpoint = endpoint
+        self.httpClient = http_client
+        self.client = Client(endpoint, http_client)
+        self.pool = ThreadPool(workers)
+        for attr in self._attrs:
+            setattr(self, attr,
+                    _AsyncProxy(getattr(self.client, attr), self.pool))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Stop the worker threads, once all submitted calls finish."""
+        self.pool.close()
+        self.pool.join()
+
+    def map(self, func, args_list):
+        """Call `func` once for each element of `args_list`, concurrently.
+
+        `func` should be a (synchronous) method of ``self.client``, e.g.
+        ``self.client.node.show``. Each element of `args_list` is a tuple of
+        arguments (or a single argument, if it is not a tuple).
+
+        Returns a list of the results, in the same order as `args_list`. If
+        any of the calls raise an exception, it is re-raised here, once all
+        of the calls have finished.
+        """
+        results = [self.pool.apply_async(func, _as_tuple(args))
+                   for args in args_list]
+        for result in results:
+            result.wait()
+        return [result.get() for result in results]
+
+    def show_nodes(self, node_names):
+        """Show each of the nodes in `node_names`.
+
+        Returns a dictionary mapping node names to the result of
+        ``node.show``.
+        """
+        return dict(zip(node_names,
+                        self.map(self.client.node.show, node_names)))
+
+    def show_networks(self, network_names):
+        """Show each of the networks in `network_names`.
+
+        Returns a dictionary mapping network names to the result of
+        ``network.show``.
+        """
+        return dict(zip(network_names,
+                        self.map(self.client.network.show, network_names)))
+
+    def show_project_nodes(self, project_name):
+        """Show every node in the project `project_name`.
+
+        Returns a dictionary as for `show_nodes`.
+        """
+        return self.show_nodes(self.client.project.nodes_in(project_name))
+
+    def show_project_networks(self, project_name):
+        """Show every network the project `project_name` can access.
+
+        Returns a dictionary as for `show_networks`.
+        """
+        return self.show_networks(
+            self.client.project.networks_in(project_name))
+
+    def show_free_nodes(self):
+        """Show every node which is not allocated to a project.
+
+        Returns a dictionary as for `show_nodes`.
+        """
+        return self.show_nodes(self.client.node.list('free'))
+
+
+def _as_tuple(args):
+    """Return `args` if it is a tuple, or a 1-tuple containing it if not."""
+    if isinstance(args, tuple):
+        return args
+    return (args,)
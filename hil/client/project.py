@@ -14,13 +14,13 @@ class Project(ClientBase):
             """Lists all projects under HIL """
 
             url = self.object_url('/projects')
-            return self.check_response(self.httpClient.request("GET", url))
+            return self.check_response(self.request("GET", url))
 
         @check_reserved_chars()
         def nodes_in(self, project_name):
             """Lists nodes allocated to project <project_name> """
             url = self.object_url('project', project_name, 'nodes')
-            return self.check_response(self.httpClient.request("GET", url))
+            return self.check_response(self.request("GET", url))
 
         @check_reserved_chars()
         def networks_in(self, project_name):
@@ -28,19 +28,19 @@ class Project(ClientBase):
             url = self.object_url(
                     'project', project_name, 'networks'
                     )
-            return self.check_response(self.httpClient.request("GET", url))
+            return self.check_response(self.request("GET", url))
 
         @check_reserved_chars()
         def create(self, project_name):
             """Creates a project named <project_name> """
             url = self.object_url('project', project_name)
-            return self.check_response(self.httpClient.request("PUT", url))
+            return self.check_response(self.request("PUT", url))
 
         @check_reserved_chars()
         def delete(self, project_name):
             """Deletes a project named <project_name> """
             url = self.object_url('project', project_name)
-            return self.check_response(self.httpClient.request("DELETE", url))
+            return self.check_response(self.request("DELETE", url))
 
         @check_reserved_chars()
         def connect(self, project_name, node_name):
@@ -50,7 +50,7 @@ class Project(ClientBase):
                     )
             self.payload = json.dumps({'node': node_name})
             return self.check_response(
-                    self.httpClient.request("POST", url, data=self.payload)
+                    self.request("POST", url, data=self.payload)
                     )
 
         @check_reserved_chars()
@@ -59,5 +59,5 @@ class Project(ClientBase):
             url = self.object_url('project', project_name, 'detach_node')
             self.payload = json.dumps({'node': node_name})
             return self.check_response(
-                    self.httpClient.request("POST", url, data=self.payload)
+                    self.request("POST", url, data=self.payload)
                     )
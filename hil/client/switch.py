@@ -13,7 +13,7 @@ class Switch(ClientBase):
     def list(self):
         """List all nodes that HIL manages """
         url = self.object_url('/switches')
-        return self.check_response(self.httpClient.request("GET", url))
+        return self.check_response(self.request("GET", url))
 
     def register(self, switch, subtype, *args):
         """Registers a switch with name <switch> and
@@ -29,13 +29,13 @@ class Switch(ClientBase):
     def delete(self, switch):
         """Deletes the switch named <switch>."""
         url = self.object_url('switch', switch)
-        return self.check_response(self.httpClient.request("DELETE", url))
+        return self.check_response(self.request("DELETE", url))
 
     @check_reserved_chars()
     def show(self, switch):
         """Shows attributes of <switch>. """
         url = self.object_url('switch', switch)
-        return self.check_response(self.httpClient.request("GET", url))
+        return self.check_response(self.request("GET", url))
 
 
 class Port(ClientBase):
@@ -45,13 +45,13 @@ class Port(ClientBase):
     def register(self, switch, port):
         """Register a <port> with <switch>. """
         url = self.object_url('switch', switch, 'port', port)
-        return self.check_response(self.httpClient.request("PUT", url))
+        return self.check_response(self.request("PUT", url))
 
     @check_reserved_chars(slashes_ok=['port'])
     def delete(self, switch, port):
         """Deletes information of the <port> for <switch> """
         url = self.object_url('switch', switch, 'port', port)
-        return self.check_response(self.httpClient.request("DELETE", url))
+        return self.check_response(self.request("DELETE", url))
 
     @check_reserved_chars(slashes_ok=['port'])
     def connect_nic(self, switch, port, node, nic):
@@ -59,23 +59,23 @@ class Port(ClientBase):
         url = self.object_url('switch', switch, 'port', port, 'connect_nic')
         payload = json.dumps({'node': node, 'nic': nic})
         return self.check_response(
-                self.httpClient.request("POST", url, data=payload)
+                self.request("POST", url, data=payload)
                 )
 
     @check_reserved_chars(slashes_ok=['port'])
     def detach_nic(self, switch, port):
         """"Detaches <port> of <switch>. """
         url = self.object_url('switch', switch, 'port', port, 'detach_nic')
-        return self.check_response(self.httpClient.request("POST", url))
+        return self.check_response(self.request("POST", url))
 
     @check_reserved_chars(slashes_ok=['port'])
     def show(self, switch, port):
         """Show what's connected to <port>"""
         url = self.object_url('switch', switch, 'port', port)
-        return self.check_response(self.httpClient.request("GET", url))
+        return self.check_response(self.request("GET", url))
 
     @check_reserved_chars(slashes_ok=['port'])
     def port_revert(self, switch, port):
         """removes all vlans from a switch port"""
         url = self.object_url('switch', switch, 'port', port, 'revert')
-        return self.check_response(self.httpClient.request("POST", url))
+        return self.check_response(self.request("POST", url))
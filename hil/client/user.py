@@ -16,7 +16,7 @@ class User(ClientBase):
     def list(self):
         """List all users"""
         url = self.object_url('/auth/basic/users')
-        return self.check_response(self.httpClient.request("GET", url))
+        return self.check_response(self.request("GET", url))
 
     @check_reserved_chars(dont_check=['password', 'is_admin'])
     def create(self, username, password, is_admin):
@@ -32,7 +32,7 @@ class User(ClientBase):
                 'password': password, 'is_admin': is_admin,
                 })
         return self.check_response(
-                self.httpClient.request("PUT", url, data=payload)
+                self.request("PUT", url, data=payload)
                 )
 
     @check_reserved_chars()
@@ -40,7 +40,7 @@ class User(ClientBase):
         """Deletes the user <username>. """
         url = self.object_url('/auth/basic/user', username)
         return self.check_response(
-                self.httpClient.request("DELETE", url)
+                self.request("DELETE", url)
                 )
 
     @check_reserved_chars()
@@ -49,7 +49,7 @@ class User(ClientBase):
         url = self.object_url('/auth/basic/user', user, 'add_project')
         payload = json.dumps({'project': project})
         return self.check_response(
-                self.httpClient.request("POST", url, data=payload)
+                self.request("POST", url, data=payload)
                 )
 
     @check_reserved_chars()
@@ -58,7 +58,7 @@ class User(ClientBase):
         url = self.object_url('/auth/basic/user', user, 'remove_project')
         payload = json.dumps({'project': project})
         return self.check_response(
-                self.httpClient.request("POST", url, data=payload)
+                self.request("POST", url, data=payload)
                 )
 
     @check_reserved_chars(dont_check=['is_admin'])
@@ -73,5 +73,5 @@ class User(ClientBase):
         url = self.object_url('/auth/basic/user', username)
         payload = json.dumps({'is_admin': is_admin})
         return self.check_response(
-                self.httpClient.request("PATCH", url, data=payload)
+                self.request("PATCH", url, data=payload)
                 )
@@ -2,6 +2,8 @@
 from hil import config, model
 from hil.commands import db
 from hil.commands.migrate_ipmi_info import MigrateIpmiInfo
+from hil.commands.reconcile import Reconcile
+from hil.commands.serve import Serve
 from hil.commands.util import ensure_not_root
 from hil.flaskapp import app
 from flask.ext.script import Manager
@@ -9,6 +11,8 @@ from flask.ext.script import Manager
 manager = Manager(app)
 manager.add_command('db', db.command)
 manager.add_command('migrate-ipmi-info', MigrateIpmiInfo())
+manager.add_command('serve', Serve())
+manager.add_command('reconcile', Reconcile())
 
 
 def main():
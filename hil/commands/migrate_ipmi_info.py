@@ -1,12 +1,21 @@
 """Helper commands for moving IPMI info from the database to obmd.
 
 This is part of our obmd migration strategy; see issue #928.
+
+Uploads are done in parallel, and a node's obmd connection info is
+committed to the database as soon as its upload succeeds. Nodes which
+already have an ``obmd_uri`` are skipped, so if the migration is
+interrupted or some uploads fail, just run it again to pick up where it
+left off.
 """
 
 import sys
 import json
+import time
+from multiprocessing.pool import ThreadPool
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from flask_script import Command, Option
 
@@ -14,6 +23,11 @@ from hil import server
 from hil.flaskapp import app
 from hil import model
 
+DEFAULT_WORKERS = 8
+
+# Timeout (in seconds) for each request to obmd:
+REQUEST_TIMEOUT = 30
+
 
 class MigrateIpmiInfo(Command):
     """Migrate ipmi info to obmd"""
@@ -23,6 +37,10 @@ class MigrateIpmiInfo(Command):
                help='Base url for the obmd api'),
         Option('--obmd-admin-token', dest='obmd_admin_token',
                help='Admin token for obmd'),
+        Option('--workers', dest='workers', type=int,
+               default=DEFAULT_WORKERS,
+               help='Number of concurrent uploads (default %d)' %
+               DEFAULT_WORKERS),
     )
 
     # the correct arguments to this are a function of the available options;
@@ -30,16 +48,59 @@ class MigrateIpmiInfo(Command):
     # arguments.
     #
     # pylint: disable=arguments-differ
-    def run(self, obmd_base_url, obmd_admin_token):
+    def run(self, obmd_base_url, obmd_admin_token, workers=DEFAULT_WORKERS):
         server.init()
         with app.app_context():
-            info = db_extract_ipmi_info()
-            obmd_upload_ipmi_info(obmd_base_url, obmd_admin_token, info)
-            db_add_obmd_info(obmd_base_url, obmd_admin_token)
+            failed = migrate(obmd_base_url, obmd_admin_token, workers)
+        if failed:
+            sys.exit(1)
+
+
+def migrate(obmd_base_url, obmd_admin_token, workers=DEFAULT_WORKERS,
+            out=sys.stdout):
+    """Upload all not-yet-migrated nodes' ipmi info to obmd.
+
+    Each node whose upload succeeds has its obmd info recorded in the
+    database immediately. Progress and a summary are written to ``out``.
+
+    Returns the number of nodes whose upload failed.
+
+    This must be run inside of an app context.
+    """
+    info = db_extract_ipmi_info()
+    total = len(info)
+    succeeded = 0
+    failed = 0
+    start = time.time()
+    out.write('Migrating %d nodes with %d workers...\n' % (total, workers))
+    for label, error in obmd_upload_ipmi_info(obmd_base_url,
+                                              obmd_admin_token,
+                                              info,
+                                              workers=workers):
+        if error is None:
+            db_add_obmd_info(obmd_base_url, obmd_admin_token, label)
+            model.db.session.commit()
+            succeeded += 1
+        else:
+            out.write('Failed to upload node %s: %s\n' % (label, error))
+            failed += 1
+    elapsed = time.time() - start
+    if elapsed > 0:
+        rate = succeeded / elapsed
+    else:
+        rate = 0
+    out.write('Migrated %d of %d nodes in %.1f seconds (%.1f nodes/s); '
+              '%d failed.\n' % (succeeded, total, elapsed, rate, failed))
+    if failed:
+        out.write('Re-run this command to retry the failed nodes.\n')
+    return failed
 
 
 def db_extract_ipmi_info():
-    """Extract all nodes' ipmi connection info from the database.
+    """Extract ipmi connection info from the database.
+
+    Nodes which have already been migrated (i.e. which have an
+    ``obmd_uri``) are skipped.
 
     This returns an dictionary of the form:
 
@@ -61,7 +122,10 @@ def db_extract_ipmi_info():
 
     This must be run inside of an app context.
     """
-    obms = model.Obm.query.all()
+    obms = model.Obm.query \
+        .join(model.Node) \
+        .filter(model.Node.obmd_uri.is_(None)) \
+        .all()
 
     info = {}
 
@@ -91,7 +155,8 @@ def db_extract_ipmi_info():
     return info
 
 
-def obmd_upload_ipmi_info(obmd_base_url, obmd_admin_token, info):
+def obmd_upload_ipmi_info(obmd_base_url, obmd_admin_token, info,
+                          workers=DEFAULT_WORKERS):
     """Upload nodes' info to obmd.
 
     `info` should be a dictionary of the form returned by
@@ -102,30 +167,56 @@ def obmd_upload_ipmi_info(obmd_base_url, obmd_admin_token, info):
 
     `obmd_admin_token` is the admin token to use when authenticating against
     obmd.
+
+    Up to `workers` uploads are run concurrently, sharing a pool of
+    connections. This is a generator, yielding a ``(label, error)`` pair for
+    each node as its upload finishes, where `error` is None if the upload
+    succeeded, and a description of what went wrong otherwise.
     """
     sess = requests.Session()
     sess.auth = ('admin', obmd_admin_token)
-
-    for key, val in info.items():
-        sess.put(obmd_base_url + '/node/' + key, data=json.dumps({
-            'type': 'ipmi',
-            'info': {
-                'addr': val['host'],
-                'user': val['user'],
-                'pass': val['password'],
-            },
-        }))
-
-
-def db_add_obmd_info(obmd_base_url, obmd_admin_token):
-    """Add obmd connection info to the HIL database.
-
-    This assumes each node is available from obmd at the URL
-    `obmd_base_url + '/node/' + node.label`.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    sess.mount('http://', adapter)
+    sess.mount('https://', adapter)
+
+    def upload(item):
+        """Upload a single node's info; returns a (label, error) pair."""
+        label, val = item
+        try:
+            resp = sess.put(obmd_base_url + '/node/' + label,
+                            data=json.dumps({
+                                'type': 'ipmi',
+                                'info': {
+                                    'addr': val['host'],
+                                    'user': val['user'],
+                                    'pass': val['password'],
+                                },
+                            }),
+                            timeout=REQUEST_TIMEOUT)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            return label, str(e)
+        return label, None
+
+    pool = ThreadPool(workers)
+    try:
+        for result in pool.imap_unordered(upload, info.items()):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        sess.close()
+
+
+def db_add_obmd_info(obmd_base_url, obmd_admin_token, label):
+    """Add obmd connection info for the node `label` to the HIL database.
+
+    This assumes the node is available from obmd at the URL
+    `obmd_base_url + '/node/' + label`. The caller is responsible for
+    committing the session.
 
     This must be run inside of an app context.
     """
-    model.Node.query.update({'obmd_admin_token': obmd_admin_token})
-    for node in model.Node.query.all():
-        node.obmd_uri = obmd_base_url + '/node/' + node.label
-    model.db.session.commit()
+    node = model.Node.query.filter_by(label=label).one()
+    node.obmd_admin_token = obmd_admin_token
+    node.obmd_uri = obmd_base_url + '/node/' + label
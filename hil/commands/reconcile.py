@@ -0,0 +1,100 @@
+"""Implement the ``hil-admin reconcile`` subcommand.
+
+This compares the networks configured on the switches to those recorded in
+the database, using `hil.reconciler`, and reports any differences. With
+``--fix``, it also queues networking actions to put the switches back the
+way the database says they should be (which the networking daemon then
+carries out). With ``--interval``, it keeps running, checking again that
+many seconds after each check finishes.
+
+Settings are taken from the command line, falling back to the
+``[reconciler]`` section of ``hil.cfg``.
+"""
+
+import sys
+import time
+
+from flask_script import Command, Option
+
+from hil import migrations, reconciler, server
+from hil.config import cfg
+
+DEFAULTS = {
+    'workers': 4,
+    'rate': 0.0,
+    'interval': 0.0,
+}
+
+
+def _setting(name, value):
+    """Return `value` if it isn't None, or else the setting `name` from the
+    ``[reconciler]`` section of the config (or its default).
+    """
+    if value is not None:
+        return value
+    if cfg.has_option('reconciler', name):
+        if isinstance(DEFAULTS[name], int):
+            return cfg.getint('reconciler', name)
+        return cfg.getfloat('reconciler', name)
+    return DEFAULTS[name]
+
+
+def _print_report(report):
+    """Print the `hil.reconciler.Report` `report`."""
+    for item in report.drift:
+        print(item)
+    for switch, error in sorted(report.errors.items()):
+        print('%s: could not read the switch: %s' % (switch, error))
+    print('%d differences found, %d corrective actions queued, '
+          '%d switches could not be read.' %
+          (len(report.drift), report.queued, len(report.errors)))
+    sys.stdout.flush()
+
+
+class Reconcile(Command):
+    """Compare the switches' networks to the database"""
+
+    option_list = (
+        Option('--switch', dest='switches', action='append',
+               help='Check only this switch (may be given more than once)'),
+        Option('--fix', dest='fix', action='store_true', default=False,
+               help='Queue networking actions to fix the differences found'),
+        Option('--workers', dest='workers', type=int,
+               help='Number of switches to read at once (default %d)' %
+               DEFAULTS['workers']),
+        Option('--rate', dest='rate', type=float,
+               help='Most switches to start reading per second; '
+               '0 means no limit (default %g)' % DEFAULTS['rate']),
+        Option('--interval', dest='interval', type=float,
+               help='Keep running, waiting this many seconds between '
+               'checks; 0 means check once and exit (default %g)' %
+               DEFAULTS['interval']),
+    )
+
+    # the correct arguments to this are a function of the available options;
+    # it's normal for subclasses to have implementations with different
+    # arguments.
+    #
+    # pylint: disable=arguments-differ,too-many-arguments
+    def run(self, switches=None, fix=False, workers=None, rate=None,
+            interval=None):
+        workers = _setting('workers', workers)
+        rate = _setting('rate', rate)
+        interval = _setting('interval', interval)
+        if workers < 1:
+            sys.exit('ERROR: workers must be at least 1.')
+        if rate < 0 or interval < 0:
+            sys.exit('ERROR: rate and interval must not be negative.')
+
+        server.init()
+        migrations.check_db_schema()
+
+        while True:
+            report = reconciler.reconcile(switches=switches, fix=fix,
+                                          workers=workers, rate=rate)
+            _print_report(report)
+            if not interval:
+                break
+            time.sleep(interval)
+        if report.errors or (report.drift and not fix):
+            sys.exit(1)
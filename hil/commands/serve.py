@@ -0,0 +1,138 @@
+"""Implement the ``hil-admin serve`` subcommand.
+
+This runs the API server for production use, with `hil.prefork`. The
+application is set up once, in the master process: extensions are loaded,
+the API calls registered, and the database schema checked, before any
+workers are started. Each worker then opens its own database connections
+before it takes any requests, so the first requests it gets don't have to
+wait for them.
+
+Settings are taken from the command line, falling back to the ``[server]``
+section of ``hil.cfg``.
+"""
+
+import socket
+import sys
+
+from flask_script import Command, Option
+from sqlalchemy.orm import configure_mappers
+
+from hil import migrations, read_cache, server
+from hil.config import cfg
+from hil.flaskapp import app
+from hil.model import db
+from hil.prefork import PreforkServer
+
+DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 5000,
+    'workers': 4,
+    'threads': 1,
+    'max_requests': 0,
+    'max_requests_jitter': 0,
+    'graceful_timeout': 30,
+}
+
+
+def _setting(name, value):
+    """Return `value` if it isn't None, or else the setting `name` from the
+    ``[server]`` section of the config (or its default).
+    """
+    if value is not None:
+        return value
+    if cfg.has_option('server', name):
+        if isinstance(DEFAULTS[name], int):
+            return cfg.getint('server', name)
+        return cfg.get('server', name)
+    return DEFAULTS[name]
+
+
+def warm_up(connections):
+    """Prepare a newly started worker to take requests.
+
+    This opens (up to) `connections` database connections, and returns
+    them to the connection pool. Any connections inherited from the master
+    process are discarded first, since they can't be shared.
+    """
+    db.engine.dispose()
+    with app.app_context():
+        pool_size = getattr(db.engine.pool, 'size', None)
+        if callable(pool_size):
+            connections = min(connections, pool_size())
+        conns = [db.engine.connect() for _ in range(connections)]
+        for conn in conns:
+            conn.execute('SELECT 1')
+        for conn in conns:
+            conn.close()
+
+
+class Serve(Command):
+    """Run the API server (with several worker processes)"""
+
+    option_list = (
+        Option('--host', dest='host',
+               help='Address to listen on (default %s)' % DEFAULTS['host']),
+        Option('--port', dest='port', type=int,
+               help='Port to listen on (default %d)' % DEFAULTS['port']),
+        Option('--workers', dest='workers', type=int,
+               help='Number of worker processes (default %d)' %
+               DEFAULTS['workers']),
+        Option('--threads', dest='threads', type=int,
+               help='Number of threads per worker (default %d)' %
+               DEFAULTS['threads']),
+        Option('--max-requests', dest='max_requests', type=int,
+               help='Restart each worker after this many requests; '
+               '0 means never (default %d)' % DEFAULTS['max_requests']),
+        Option('--max-requests-jitter', dest='max_requests_jitter',
+               type=int,
+               help='Add a random number of requests, up to this many, to '
+               'each worker\'s --max-requests (default %d)' %
+               DEFAULTS['max_requests_jitter']),
+        Option('--graceful-timeout', dest='graceful_timeout', type=int,
+               help='Seconds to let a worker finish its requests before '
+               'killing it (default %d)' % DEFAULTS['graceful_timeout']),
+    )
+
+    # the correct arguments to this are a function of the available options;
+    # it's normal for subclasses to have implementations with different
+    # arguments.
+    #
+    # pylint: disable=arguments-differ,too-many-arguments
+    def run(self, host=None, port=None, workers=None, threads=None,
+            max_requests=None, max_requests_jitter=None,
+            graceful_timeout=None):
+        workers = _setting('workers', workers)
+        threads = _setting('threads', threads)
+
+        # Register the API calls:
+        # pylint: disable=unused-variable
+        from hil import api
+        server.init()
+        migrations.check_db_schema()
+        server.stop_orphan_consoles()
+        cache = read_cache.get_cache()
+        if workers > 1 and cache is not None and \
+                isinstance(cache.backend, read_cache.MemoryBackend):
+            sys.exit("ERROR: The memory cache backend can't be used with "
+                     "more than one worker; use the file backend instead.")
+        # Do the work of setting up the ORM once, rather than in each worker:
+        configure_mappers()
+        db.engine.dispose()
+
+        try:
+            prefork = PreforkServer(
+                app,
+                host=_setting('host', host),
+                port=_setting('port', port),
+                workers=workers,
+                threads=threads,
+                max_requests=_setting('max_requests', max_requests),
+                max_requests_jitter=_setting('max_requests_jitter',
+                                             max_requests_jitter),
+                graceful_timeout=_setting('graceful_timeout',
+                                          graceful_timeout),
+                post_fork=lambda: warm_up(threads),
+            )
+        except (ValueError, socket.error) as e:
+            sys.exit('ERROR: %s' % e)
+        prefork.run()
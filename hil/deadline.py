@@ -0,0 +1,166 @@
+"""Time limits for talking to switches and OBMs.
+
+A switch or BMC which stops responding shouldn't be able to hold up the
+networking daemon or an API server worker indefinitely, so every call which
+talks to one is given a timeout, and each operation as a whole (e.g. a
+networking action, which may involve logging in to the switch, reading the
+port's state and then changing it) is given a budget, or deadline:
+
+* `budget` (or the `operation` decorator) sets the deadline for the
+  operation the current thread is carrying out, for either a ``'switch'``
+  or an ``'obm'``. If there is already a deadline, the earlier one applies.
+* Drivers call `timeout` before each call which does I/O, to find out how
+  long it may take: the time left before the deadline, but no more than
+  the limit for a single call. Once the deadline has passed, `timeout`
+  raises `SwitchError` or `OBMError` instead.
+* `communicate` runs a subprocess (e.g. ``ipmitool``) within such a
+  timeout, killing it if it takes too long.
+
+The limits are set in the ``[timeouts]`` section of ``hil.cfg``; see
+`DEFAULTS`.
+"""
+
+from contextlib import contextmanager
+from functools import wraps
+import threading
+import time
+
+from hil.config import cfg
+from hil.errors import SwitchError, OBMError
+
+# Seconds allowed for a single I/O call (``<kind>_io``), and for a whole
+# operation (``<kind>_operation``), by default:
+DEFAULTS = {
+    'switch_io': 30.0,
+    'switch_operation': 120.0,
+    'obm_io': 30.0,
+    'obm_operation': 60.0,
+}
+
+_ERRORS = {
+    'switch': SwitchError,
+    'obm': OBMError,
+}
+
+_local = threading.local()
+
+
+def _setting(name):
+    """Return the setting `name` from the ``[timeouts]`` section of the
+    config (or its default).
+    """
+    if cfg.has_option('timeouts', name):
+        return cfg.getfloat('timeouts', name)
+    return DEFAULTS[name]
+
+
+def _deadlines():
+    """Return this thread's deadlines, as a dict mapping kinds to times."""
+    if not hasattr(_local, 'deadlines'):
+        _local.deadlines = {}
+    return _local.deadlines
+
+
+@contextmanager
+def budget(kind, seconds=None):
+    """Limit the time taken by the code in a ``with`` block, which talks to
+    a `kind` (``'switch'`` or ``'obm'``).
+
+    `seconds` defaults to the ``<kind>_operation`` setting. An enclosing
+    deadline which is earlier still applies.
+    """
+    if seconds is None:
+        seconds = _setting(kind + '_operation')
+    deadlines = _deadlines()
+    previous = deadlines.get(kind)
+    deadline = time.time() + seconds
+    if previous is not None:
+        deadline = min(deadline, previous)
+    deadlines[kind] = deadline
+    try:
+        yield
+    finally:
+        if previous is None:
+            del deadlines[kind]
+        else:
+            deadlines[kind] = previous
+
+
+def operation(kind):
+    """Decorator which runs the decorated function within a `budget` for
+    `kind`.
+    """
+    def decorator(f):
+        """Wrap `f`."""
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            """Call `f` within the budget."""
+            with budget(kind):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def remaining(kind):
+    """Return the number of seconds before the current deadline for `kind`,
+    or None if there isn't one.
+    """
+    deadline = _deadlines().get(kind)
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+def timeout(kind):
+    """Return the number of seconds which the next I/O call to a `kind` may
+    take.
+
+    This is the ``<kind>_io`` setting, or the time left before the current
+    deadline, whichever is less. Raises `SwitchError` or `OBMError` (as
+    appropriate for `kind`) if the deadline has passed.
+    """
+    limit = _setting(kind + '_io')
+    left = remaining(kind)
+    if left is None:
+        return limit
+    if left <= 0:
+        raise _ERRORS[kind]('Ran out of time talking to the %s' % kind)
+    return min(limit, left)
+
+
+def communicate(proc, kind='obm'):
+    """Like ``proc.communicate()``, for the `subprocess.Popen` `proc`, but
+    kills the process if it takes longer than `timeout` allows.
+
+    Returns ``(stdout, stderr)``. Raises `SwitchError` or `OBMError` (as
+    appropriate for `kind`) if the process had to be killed.
+    """
+    try:
+        seconds = timeout(kind)
+    except Exception:
+        proc.kill()
+        proc.wait()
+        raise
+    killed = []
+
+    def kill():
+        """Kill the process, and note that we did."""
+        if proc.returncode is not None:
+            return
+        killed.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            # It has just exited.
+            pass
+
+    timer = threading.Timer(seconds, kill)
+    timer.start()
+    try:
+        out, err = proc.communicate()
+    finally:
+        timer.cancel()
+    if killed:
+        raise _ERRORS[kind]('Timed out after %g seconds talking to the %s' %
+                            (seconds, kind))
+    return out, err
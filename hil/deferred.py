@@ -1,12 +1,131 @@
-"""Performs deferred networking actions."""
+"""Performs deferred networking actions.
 
-from hil import model
+An action which fails is retried, up to ``max_attempts`` times in all,
+waiting longer after each failure: ``retry_delay`` seconds after the first,
+doubling each time up to ``retry_max_delay``. Each delay is shortened by a
+random fraction of up to ``retry_jitter``, so that actions which failed
+together (say, because a switch was unreachable) aren't all retried at
+once. In the meantime, the action stays ``PENDING``. Once the last attempt
+has failed, the action is marked ``ERROR``, and left for an administrator
+(or the tenant) to deal with.
+
+Each switch also has a circuit breaker, so that one dead switch doesn't
+hold up the actions for all of the others while its actions time out, one
+after another. Once ``breaker_threshold`` actions in a row have failed on a
+switch, the circuit "opens": the switch's actions are left pending, without
+being tried, for ``breaker_open_time`` seconds. After that, the next action
+on the switch is tried; if it succeeds the circuit closes again, and if not
+it stays open for another ``breaker_open_time`` seconds. The state of each
+switch is kept in the database (see `model.SwitchHealth`), so it survives
+restarts, and can be seen with the ``show_switch_health`` API call.
+
+These settings are taken from the ``[network-daemon]`` section of
+``hil.cfg``.
+
+Each attempt at an action (including logging in to the switch, if there
+isn't a session yet) must finish within the ``switch_operation`` time limit
+from the ``[timeouts]`` section; see `hil.deadline`. One which runs out of
+time fails like any other, and the switch session is thrown away rather
+than reused, since there's no telling what state it was left in.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import random
+
+from sqlalchemy import or_
+
+from hil import deadline, metrics, model
+from hil.config import cfg
 from hil.model import db
 from hil.errors import SwitchError
-import logging
 
 logger = logging.getLogger(__name__)
 
+JOURNAL_DEPTH = metrics.REGISTRY.gauge(
+    'hil_networking_journal_depth',
+    'Pending networking actions, as of the start of the last run of '
+    'apply_networking.')
+SWITCH_ACTION_LATENCY = metrics.REGISTRY.histogram(
+    'hil_switch_action_duration_seconds',
+    'Time taken to apply networking actions, by switch and action type.',
+    ['switch', 'type'])
+SWITCH_ACTION_FAILURES = metrics.REGISTRY.counter(
+    'hil_switch_action_failures_total',
+    'Failed attempts at networking actions (including those which are '
+    'retried), by switch and action type.',
+    ['switch', 'type'])
+SWITCH_ACTIONS_SKIPPED = metrics.REGISTRY.counter(
+    'hil_switch_actions_skipped_total',
+    'Networking actions which needed no changes on the switch, by switch '
+    'and action type.',
+    ['switch', 'type'])
+
+RETRY_DEFAULTS = {
+    'max_attempts': 3,
+    'retry_delay': 5.0,
+    'retry_max_delay': 300.0,
+    'retry_jitter': 0.5,
+}
+
+BREAKER_DEFAULTS = {
+    'breaker_threshold': 3,
+    'breaker_open_time': 60.0,
+}
+
+
+def _settings(defaults):
+    """Return the settings named in `defaults` from the ``[network-daemon]``
+    section of the config, falling back to the values in `defaults`.
+    """
+    settings = {}
+    for name, default in defaults.items():
+        if not cfg.has_option('network-daemon', name):
+            settings[name] = default
+        elif isinstance(default, int):
+            settings[name] = cfg.getint('network-daemon', name)
+        else:
+            settings[name] = cfg.getfloat('network-daemon', name)
+    return settings
+
+
+def retry_policy():
+    """Return the retry settings, as a dict like `RETRY_DEFAULTS`.
+
+    Raises ValueError if any of them are invalid.
+    """
+    policy = _settings(RETRY_DEFAULTS)
+    if policy['max_attempts'] < 1:
+        raise ValueError('max_attempts must be at least 1')
+    if policy['retry_delay'] < 0 or policy['retry_max_delay'] < 0:
+        raise ValueError('retry_delay and retry_max_delay must not be '
+                         'negative')
+    if not 0 <= policy['retry_jitter'] <= 1:
+        raise ValueError('retry_jitter must be between 0 and 1')
+    return policy
+
+
+def breaker_policy():
+    """Return the circuit breaker settings, as a dict like
+    `BREAKER_DEFAULTS`. A threshold of 0 turns the breaker off.
+
+    Raises ValueError if any of them are invalid.
+    """
+    policy = _settings(BREAKER_DEFAULTS)
+    if policy['breaker_threshold'] < 0 or policy['breaker_open_time'] < 0:
+        raise ValueError('breaker_threshold and breaker_open_time must not '
+                         'be negative')
+    return policy
+
+
+def retry_delay(attempts, policy):
+    """Return how many seconds to wait before retrying an action which has
+    failed `attempts` times, under the retry policy `policy`.
+    """
+    delay = min(policy['retry_max_delay'],
+                policy['retry_delay'] * 2 ** (attempts - 1))
+    return delay * (1 - policy['retry_jitter'] * random.random())
+
 
 class DaemonSession(object):
     """A daemon session tracks switch sessions during a call to
@@ -15,10 +134,21 @@ class DaemonSession(object):
     When applying a networking action, if the DaemonSession does not
     already have a switch session for the relevant switch, it will
     create one, and cache it for next time.
+
+    If the switch's driver can report the state of a port (see
+    `SwitchSession.get_port_state`), the state is read before the port is
+    first changed, and kept up to date as actions are applied. Actions which
+    wouldn't change anything are then not sent to the switch, though the
+    database is still updated as usual.
     """
 
     def __init__(self):
         self.switch_sessions = {}
+        self.retry_policy = retry_policy()
+        self.breaker_policy = breaker_policy()
+        # Maps (switch label, port label) pairs to the port's state, as
+        # returned by get_port_state (None if the driver doesn't say):
+        self.port_states = {}
 
     def handle_action(self, action):
         """apply the networking action ``action``."""
@@ -29,11 +159,20 @@ class DaemonSession(object):
             logger.warn('Not modifying NIC %s; NIC is not on a port.',
                         action.nic.label)
         else:
-            getattr(self, action.type)(action)
+            labels = {
+                'switch': action.nic.port.owner.label,
+                'type': action.type,
+            }
+            action.attempts += 1
+            with SWITCH_ACTION_LATENCY.time(**labels), \
+                    deadline.budget('switch'):
+                getattr(self, action.type)(action)
+            if action.status == 'DONE':
+                self.switch_succeeded(action.nic.port.owner)
 
     def modify_port(self, action):
         """Apply a modify_port action."""
-        session = self.get_session(action.nic.port.owner)
+        port = action.nic.port
 
         if action.new_network is None:
             network_id = None
@@ -41,35 +180,159 @@ class DaemonSession(object):
             network_id = action.new_network.network_id
 
         try:
-            session.modify_port(action.nic.port.label,
-                                action.channel,
-                                network_id)
+            session = self.get_session(port.owner)
+            state = self.get_port_state(session, port)
+            if state is not None and \
+                    state.get(action.channel) == network_id:
+                self.skipped(action)
+            else:
+                session.modify_port(port.label, action.channel, network_id)
+                if state is not None:
+                    if network_id is None:
+                        state.pop(action.channel, None)
+                    else:
+                        state[action.channel] = network_id
+            attachment = model.NetworkAttachment.query \
+                .filter_by(nic=action.nic, channel=action.channel).first()
             if action.new_network is None:
-                model.NetworkAttachment.query \
-                    .filter_by(nic=action.nic, channel=action.channel)\
-                    .delete()
+                if attachment is not None:
+                    db.session.delete(attachment)
+            elif attachment is not None:
+                # The channel was already (supposed to be) on a network;
+                # this happens when `hil.reconciler` puts it back where the
+                # database says it should be.
+                attachment.network = action.new_network
             else:
                 db.session.add(model.NetworkAttachment(
                     nic=action.nic,
                     network=action.new_network,
                     channel=action.channel))
             action.status = 'DONE'
-        except SwitchError:
-            action.status = 'ERROR'
-            logger.error('Modify port failed on port %s of switch %s',
-                         action.nic.port.label, action.nic.port.owner.label)
+        except SwitchError as e:
+            self.forget_port_state(port)
+            self.forget_session(port.owner)
+            self.failed(action, e)
 
     def revert_port(self, action):
         """Apply a revert_port action."""
-        session = self.get_session(action.nic.port.owner)
+        port = action.nic.port
         try:
-            session.revert_port(action.nic.port.label)
+            session = self.get_session(port.owner)
+            state = self.get_port_state(session, port)
+            if state == {}:
+                self.skipped(action)
+            else:
+                session.revert_port(port.label)
+                if state is not None:
+                    state.clear()
             model.NetworkAttachment.query.filter_by(nic=action.nic).delete()
             action.status = 'DONE'
-        except SwitchError:
+        except SwitchError as e:
+            self.forget_port_state(port)
+            self.forget_session(port.owner)
+            self.failed(action, e)
+
+    def failed(self, action, error):
+        """Record that an attempt at `action` failed with `error`.
+
+        The action is scheduled to be retried, unless that was the last
+        attempt allowed, in which case it is marked 'ERROR'.
+        """
+        port = action.nic.port
+        SWITCH_ACTION_FAILURES.inc(switch=port.owner.label, type=action.type)
+        # SwitchErrors are HTTP exceptions, whose str() is just the status;
+        # the driver's message is the description:
+        error = error.description or str(error)
+        now = datetime.utcnow()
+        action.failed_attempts.append(
+            model.NetworkingActionAttempt(time=now, error=error))
+        self.switch_failed(port.owner, error, now)
+        if action.attempts < self.retry_policy['max_attempts']:
+            delay = retry_delay(action.attempts, self.retry_policy)
+            action.next_attempt = now + timedelta(seconds=delay)
+            logger.warning('%s failed on port %s of switch %s (attempt %d '
+                           'of %d); retrying in %.1f seconds: %s',
+                           action.type, port.label, port.owner.label,
+                           action.attempts,
+                           self.retry_policy['max_attempts'], delay, error)
+        else:
             action.status = 'ERROR'
-            logger.error('Revert port failed on port %s of switch %s',
-                         action.nic.port.label, action.nic.port.owner.label)
+            action.next_attempt = None
+            logger.error('%s failed on port %s of switch %s, after %d '
+                         'attempts; giving up: %s',
+                         action.type, port.label, port.owner.label,
+                         action.attempts, error)
+
+    def switch_failed(self, switch, error, now):
+        """Record that an action on `switch` failed at `now` with `error`,
+        opening its circuit if that's one failure too many.
+        """
+        health = switch.health
+        if health is None:
+            health = model.SwitchHealth(switch=switch, consecutive_failures=0)
+        health.consecutive_failures += 1
+        health.last_failure = now
+        health.last_error = error
+        threshold = self.breaker_policy['breaker_threshold']
+        if threshold and health.consecutive_failures >= threshold:
+            open_time = self.breaker_policy['breaker_open_time']
+            health.open_until = now + timedelta(seconds=open_time)
+            logger.error('%d actions in a row have failed on switch %s; '
+                         'not trying it again for %.1f seconds.',
+                         health.consecutive_failures, switch.label,
+                         open_time)
+
+    @staticmethod
+    def switch_succeeded(switch):
+        """Record that an action on `switch` succeeded, closing its circuit.
+        """
+        health = switch.health
+        if health is None or health.consecutive_failures == 0:
+            return
+        if health.open_until is not None:
+            logger.warning('Switch %s is working again, after %d failed '
+                           'actions.', switch.label,
+                           health.consecutive_failures)
+        health.consecutive_failures = 0
+        health.open_until = None
+
+    @staticmethod
+    def skipped(action):
+        """Record that `action` needed no changes on the switch."""
+        port = action.nic.port
+        SWITCH_ACTIONS_SKIPPED.inc(switch=port.owner.label, type=action.type)
+        logger.debug('Port %s of switch %s is already as %s action %s '
+                     'would leave it; not changing it.',
+                     port.label, port.owner.label, action.type, action.uuid)
+
+    def get_port_state(self, session, port):
+        """Get the state of the `Port` `port`, using the switch session
+        `session`.
+
+        The state is read from the switch the first time, and cached. It is
+        a dict mapping channels to network IDs, which the caller should keep
+        up to date as it changes the port, or None if the driver can't say.
+        """
+        key = (port.owner.label, port.label)
+        if key not in self.port_states:
+            # Sessions needn't subclass SwitchSession, so the method may
+            # be missing altogether:
+            get_state = getattr(session, 'get_port_state', None)
+            state = None
+            if get_state is not None:
+                state = get_state(port.label)
+            if state is not None:
+                state = dict((channel, str(net))
+                             for channel, net in state.items()
+                             if net is not None)
+            self.port_states[key] = state
+        return self.port_states[key]
+
+    def forget_port_state(self, port):
+        """Drop the cached state of `port`, e.g. after a failed change left
+        it unknown.
+        """
+        self.port_states.pop((port.owner.label, port.label), None)
 
     def get_session(self, switch):
         """Get a session for the switch.
@@ -81,19 +344,38 @@ class DaemonSession(object):
             self.switch_sessions[switch.label] = switch.session()
         return self.switch_sessions[switch.label]
 
+    def forget_session(self, switch):
+        """Drop the cached session for `switch`, without disconnecting it,
+        e.g. after an action failed part way through.
+
+        The next action on the switch will start a new session.
+        """
+        self.switch_sessions.pop(switch.label, None)
+
     def close(self):
-        """Shut down all of the open switch sessions."""
-        for session in self.switch_sessions.values():
-            session.disconnect()
+        """Shut down all of the open switch sessions.
+
+        A session which can't be shut down cleanly (in the time allowed) is
+        logged and abandoned; its actions are already done.
+        """
+        for label, session in self.switch_sessions.items():
+            try:
+                with deadline.budget('switch'):
+                    session.disconnect()
+            except SwitchError as e:
+                logger.warning('Could not disconnect from switch %s: %s',
+                               label, e.description or e)
         self.switch_sessions = {}
+        self.port_states = {}
 
 
 def apply_networking():
     """Do each networking action in the journal, then cross them off.
 
-    Returns False if the journal was empty, and True if there were journal
-    entries.  Equivalently, returns True if an action was performed, and False
-    if no action was performed.
+    Returns False if the journal was empty (or all of the actions in it are
+    waiting to be retried, or on switches whose circuits are open), and True
+    if there were journal entries. Equivalently, returns True if an action
+    was performed, and False if no action was performed.
 
     The networking server calls this function in a loop, to ensure that all
     pending network operations get processed within a reasonable amount of
@@ -106,9 +388,25 @@ def apply_networking():
     tight-looping.
     """
 
-    action = model.NetworkingAction.query \
-        .order_by(model.NetworkingAction.id) \
-        .filter_by(status='PENDING').first()
+    pending = model.NetworkingAction.query.filter_by(status='PENDING')
+    JOURNAL_DEPTH.set(pending.count())
+    # Actions waiting to be retried are left until their time comes. This
+    # uses the time at the start of the run, so that an action which fails
+    # is not retried until the next run, however short its delay:
+    now = datetime.utcnow()
+    # Likewise, actions on switches whose circuits are open are left alone.
+    # A circuit which opens during the run stays open until it's over:
+    blocked = db.session.query(model.Nic.id) \
+        .join(model.Port, model.Nic.port_id == model.Port.id) \
+        .join(model.SwitchHealth,
+              model.SwitchHealth.switch_id == model.Port.owner_id) \
+        .filter(model.SwitchHealth.open_until > now)
+    ready = pending \
+        .filter(or_(model.NetworkingAction.next_attempt.is_(None),
+                    model.NetworkingAction.next_attempt <= now)) \
+        .filter(~model.NetworkingAction.nic_id.in_(blocked)) \
+        .order_by(model.NetworkingAction.id)
+    action = ready.first()
 
     if action is None:
         db.session.commit()
@@ -119,9 +417,7 @@ def apply_networking():
         session.handle_action(action)
         db.session.commit()
         # Get the next action
-        action = model.NetworkingAction.query \
-            .order_by(model.NetworkingAction.id)\
-            .filter_by(status='PENDING').first()
+        action = ready.first()
 
     # the last statement in the while loop opens a new db session that we must
     # close when we exit the loop.
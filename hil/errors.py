@@ -6,7 +6,6 @@ and ServerError.
 """
 
 import json
-import flask
 from werkzeug.exceptions import HTTPException, InternalServerError
 
 
@@ -28,6 +27,11 @@ class APIError(HTTPException):
         """The body of the http response corresponding to this error."""
         # TODO: We're getting deprecation errors about the use of self.message.
         # We should figure out what the right way to do this is.
+        #
+        # flask is imported here, rather than at the top of the module, since
+        # this module is also used by the client library (and CLI), which
+        # shouldn't have to pay for importing it:
+        import flask
         return flask.make_response(json.dumps({
             'type': self.__class__.__name__,
             'msg': self.message,
@@ -104,6 +108,10 @@ class OBMError(ServerError):
     """An error occured communicating with the OBM for a node."""
 
 
+class HeadnodeError(ServerError):
+    """An error occured managing a headnode's VM."""
+
+
 class SwitchError(ServerError):
     """Exception thrown by a switch driver indicating failure to perform the
     requested operation.
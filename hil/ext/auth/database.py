@@ -5,15 +5,16 @@ Includes API calls for managing users.
 from hil import api, model, auth, errors
 from hil.model import db
 from hil.auth import get_auth_backend
-from hil.rest import rest_call, local, ContextLogger
+from hil.rest import rest_call, local, ContextLogger, JSONStream, \
+    StreamedObject, STREAM_BATCH_SIZE
 from passlib.hash import sha512_crypt
 from schema import Schema, Optional
 import flask
+import itertools
 import logging
 from os.path import join, dirname
 from hil.migrations import paths
 from hil.model import BigIntegerType
-import json
 
 logger = ContextLogger(logging.getLogger(__name__), {})
 
@@ -61,17 +62,23 @@ user_projects = db.Table('user_projects',
                          db.Column('project_id', db.ForeignKey('project.id')))
 
 
-@rest_call('GET', '/auth/basic/users', schema=Schema({}))
+@rest_call('GET', '/auth/basic/users', schema=Schema({}), read_only=True)
 def list_users():
     """List all users with database authentication"""
     get_auth_backend().require_admin()
-    users = User.query.all()
-    result = {}
-    for u in users:
-        user = {'is_admin': u.is_admin,
-                'projects': sorted(p.label for p in u.projects)}
-        result[u.label] = user
-    return json.dumps(result, sort_keys=True)
+    query = db.session.query(User.label, User.is_admin, model.Project.label) \
+        .outerjoin(User.projects) \
+        .order_by(User.label, model.Project.label)
+
+    def users():
+        """Yield the (label, details) pairs of the users."""
+        rows = query.yield_per(STREAM_BATCH_SIZE)
+        for label, group in itertools.groupby(rows, lambda row: row[0]):
+            group = list(group)
+            yield label, {'is_admin': group[0][1],
+                          'projects': [row[2] for row in group
+                                       if row[2] is not None]}
+    return JSONStream(StreamedObject(users()))
 
 
 @rest_call('PUT', '/auth/basic/user/<user>', schema=Schema({
@@ -0,0 +1,33 @@
+"""add vlan_bitmap allocator
+
+Revision ID: 3f67e96df815
+Revises:
+Create Date: 2018-02-13 15:08:22.736410
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from hil.model import BigIntegerType
+
+
+# revision identifiers, used by Alembic.
+revision = '3f67e96df815'
+down_revision = None
+branch_labels = ('hil.ext.network_allocators.vlan_bitmap',)
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table(
+        'vlan_bitmap',
+        sa.Column('id', BigIntegerType, nullable=False),
+        sa.Column('pool', sa.LargeBinary(), nullable=False),
+        sa.Column('in_use', sa.LargeBinary(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('vlan_bitmap')
@@ -0,0 +1,253 @@
+"""Bitmap-backed VLAN ``network_allocator`` implementation.
+
+This is a drop-in alternative to ``hil.ext.network_allocators.vlan_pool``,
+configured the same way (via a ``vlans`` option in the extension's config
+section). Rather than one database row per VLAN, the whole pool is stored
+in a single row, as two bitmaps of 4096 bits each:
+
+* ``pool``, in which bit ``n - 1`` is set iff VLAN ``n`` is in the pool
+  (i.e. is listed in the config file), and
+* ``in_use``, in which bit ``n - 1`` is set iff VLAN ``n`` is allocated.
+
+Every operation which modifies the bitmaps first locks the row (via
+``SELECT ... FOR UPDATE``), so concurrent allocations are serialized by the
+database and can never hand out the same VLAN twice. Since the bitmaps are
+fixed-size, each operation does a bounded amount of work regardless of the
+size of the pool, and ``populate`` is a single insert or update.
+"""
+
+import logging
+
+from schema import Schema
+
+from hil import errors
+from hil.auth import get_auth_backend
+from hil.network_allocator import NetworkAllocator, set_network_allocator
+from hil.model import db
+from hil.config import cfg
+from hil.rest import rest_call
+
+from os.path import join, dirname
+from hil.migrations import paths
+from hil.model import BigIntegerType
+import json
+
+paths[__name__] = join(dirname(__file__), 'migrations', 'vlan_bitmap')
+
+# The highest legal VLAN id:
+MAX_VLAN = 4096
+
+_BITMAP_BYTES = MAX_VLAN // 8
+
+# The id of the (single) row in the vlan_bitmap table:
+_ROW_ID = 1
+
+
+def get_vlan_list():
+    """Return a list of vlans in the module's config section."""
+    vlan_str = cfg.get(__name__, 'vlans')
+    returnee = []
+    for r in vlan_str.split(","):
+        r = r.strip().split("-")
+        if len(r) == 1:
+            returnee.append(int(r[0]))
+        else:
+            returnee += range(int(r[0]), int(r[1])+1)
+    return returnee
+
+
+def _test_bit(bitmap, vlan_no):
+    """Return whether the bit for ``vlan_no`` is set in ``bitmap``."""
+    i = vlan_no - 1
+    return bool(bitmap[i // 8] & (1 << (i % 8)))
+
+
+def _set_bit(bitmap, vlan_no, value):
+    """Set the bit for ``vlan_no`` in the bytearray ``bitmap`` to ``value``."""
+    i = vlan_no - 1
+    if value:
+        bitmap[i // 8] |= 1 << (i % 8)
+    else:
+        bitmap[i // 8] &= ~(1 << (i % 8)) & 0xff
+
+
+def _count_bits(bitmap):
+    """Return the number of bits set in ``bitmap``."""
+    return sum(bin(byte).count('1') for byte in bitmap)
+
+
+def _vlan_no(net_id):
+    """Return ``net_id`` as a VLAN number, or None if it isn't one."""
+    try:
+        vlan_no = int(net_id)
+    except ValueError:
+        return None
+    if 1 <= vlan_no <= MAX_VLAN:
+        return vlan_no
+    return None
+
+
+class VlanBitmapAllocator(NetworkAllocator):
+    """A allocator of VLANs. The interface is as specified in
+    ``NetworkAllocator``.
+    """
+
+    def get_new_network_id(self):
+        row = VlanBitmap.lock()
+        if row is None:
+            return None
+        pool = bytearray(row.pool)
+        in_use = bytearray(row.in_use)
+        for i in range(_BITMAP_BYTES):
+            free = pool[i] & ~in_use[i]
+            if free:
+                bit = (free & -free).bit_length() - 1
+                vlan_no = i * 8 + bit + 1
+                _set_bit(in_use, vlan_no, True)
+                row.in_use = bytes(in_use)
+                return str(vlan_no)
+        return None
+
+    def free_network_id(self, net_id):
+        vlan_no = _vlan_no(net_id)
+        row = None if vlan_no is None else VlanBitmap.lock()
+        if row is None:
+            logger = logging.getLogger(__name__)
+            logger.error('vlan %s does not exist in database', net_id)
+            return
+        in_use = bytearray(row.in_use)
+        # VLANs which have been removed from the pool since they were
+        # allocated are still marked in use (see populate), so clear the bit
+        # regardless:
+        if not _test_bit(in_use, vlan_no) and \
+                not _test_bit(bytearray(row.pool), vlan_no):
+            logger = logging.getLogger(__name__)
+            logger.error('vlan %s does not exist in database', net_id)
+            return
+        _set_bit(in_use, vlan_no, False)
+        row.in_use = bytes(in_use)
+
+    def populate(self):
+        pool = bytearray(_BITMAP_BYTES)
+        for vlan_no in get_vlan_list():
+            _set_bit(pool, vlan_no, True)
+        row = VlanBitmap.lock()
+        if row is None:
+            db.session.add(VlanBitmap(pool=bytes(pool)))
+        else:
+            # Leave the in_use bits alone; VLANs which have been allocated
+            # stay allocated until they are freed, even if they've since
+            # been removed from the config.
+            row.pool = bytes(pool)
+        db.session.commit()
+
+    def legal_channels_for(self, net_id):
+        return ["vlan/native",
+                "vlan/" + net_id]
+
+    def is_legal_channel_for(self, channel_id, net_id):
+        return channel_id in self.legal_channels_for(net_id)
+
+    def get_default_channel(self):
+        return "vlan/native"
+
+    def validate_network_id(self, net_id):
+        return _vlan_no(net_id) is not None
+
+    def claim_network_id(self, net_id):
+        vlan_no = _vlan_no(net_id)
+        if vlan_no is None:
+            return
+        row = VlanBitmap.lock()
+        if row is None or not _test_bit(bytearray(row.pool), vlan_no):
+            return
+        in_use = bytearray(row.in_use)
+        if _test_bit(in_use, vlan_no):
+            raise errors.BlockedError("Network ID is not available."
+                                      " Please choose a different ID.")
+        _set_bit(in_use, vlan_no, True)
+        row.in_use = bytes(in_use)
+
+    def is_network_id_in_pool(self, net_id):
+        vlan_no = _vlan_no(net_id)
+        row = VlanBitmap.get()
+        if vlan_no is None or row is None:
+            return False
+        return _test_bit(bytearray(row.pool), vlan_no)
+
+
+class VlanBitmap(db.Model):
+    """The pool of VLANs available to HIL, and which of them are in use.
+
+    There is only ever one row in this table; see the module docstring.
+    """
+    id = db.Column(BigIntegerType, primary_key=True)
+    pool = db.Column(db.LargeBinary, nullable=False)
+    in_use = db.Column(db.LargeBinary, nullable=False)
+
+    def __init__(self, pool):
+        self.id = _ROW_ID
+        self.pool = pool
+        self.in_use = bytes(bytearray(_BITMAP_BYTES))
+
+    @staticmethod
+    def get():
+        """Return the (only) row, without locking it.
+
+        Returns None if the row hasn't been created yet.
+        """
+        return VlanBitmap.query.get(_ROW_ID)
+
+    @staticmethod
+    def lock():
+        """Return the (only) row, locking it until the end of the
+        transaction.
+
+        Returns None if the row hasn't been created yet.
+        """
+        # Note that we can't use Query.get() here; it will happily return
+        # an already-loaded object without querying (and so locking)
+        # anything. populate_existing() makes sure we see the values as of
+        # when we acquired the lock. It also disables autoflush, so we have
+        # to flush any changes we've made ourselves first:
+        db.session.flush()
+        return VlanBitmap.query \
+            .filter_by(id=_ROW_ID) \
+            .with_for_update() \
+            .populate_existing() \
+            .one_or_none()
+
+
+@rest_call('GET', '/network_allocators/vlan_bitmap/utilization',
+           Schema({}), read_only=True)
+def show_vlan_utilization():
+    """Show how much of the VLAN pool is in use.
+
+    Returns a JSON object of the form:
+
+        {
+            "total": <number of VLANs in the pool>,
+            "in_use": <number of VLANs in the pool that are allocated>,
+            "available": <number of VLANs in the pool that are free>
+        }
+
+    If the pool hasn't been populated yet, it is reported as empty.
+    """
+    get_auth_backend().require_admin()
+    row = VlanBitmap.get()
+    if row is None:
+        return json.dumps({'total': 0, 'in_use': 0, 'available': 0})
+    pool = bytearray(row.pool)
+    in_use = bytearray(row.in_use)
+    total = _count_bits(pool)
+    used = _count_bits(bytearray(p & u for p, u in zip(pool, in_use)))
+    return json.dumps({
+        'total': total,
+        'in_use': used,
+        'available': total - used,
+    })
+
+
+def setup(*args, **kwargs):
+    """Register a VlanBitmapAllocator as the network allocator."""
+    set_network_allocator(VlanBitmapAllocator())
@@ -0,0 +1,341 @@
+"""On-disk storage for node console logs.
+
+Each node's console output is kept in its own directory, as a sequence of
+fixed-size segments:
+
+    <directory>/
+        00000000000000000000.log.gz
+        00000000000001048576.log.gz
+        00000000000002097152.log
+        index
+
+Each segment is named after the offset (in the node's overall console
+stream) of its first byte. All but the newest segment are gzip compressed;
+the newest one is the segment currently being appended to. Once it grows
+past the configured segment size it is compressed, and a fresh segment is
+started. Only a configurable number of compressed segments is retained;
+older ones are deleted.
+
+``index`` maps wall-clock time to stream offsets. It is a text file with one
+``<timestamp> <offset>`` line per entry, where ``timestamp`` is seconds since
+the epoch. An entry is written at most once every ``index_interval``
+seconds, so the index stays small even for very chatty consoles, while
+still letting readers seek close to a point in time without decompressing
+the whole log.
+
+This module can also be run as a script, in which case it copies its
+standard input into a store; this is how ``hil.ext.obm.ipmi`` records
+console output from ipmitool.
+"""
+
+import argparse
+import bisect
+import errno
+import gzip
+import os
+import re
+import shutil
+import signal
+import sys
+import time
+
+DEFAULT_SEGMENT_SIZE = 1024 * 1024
+DEFAULT_SEGMENTS = 16
+DEFAULT_INDEX_INTERVAL = 1.0
+
+_SEGMENT_RE = re.compile(r'^(\d{20})\.log(\.gz)?$')
+
+
+def _segment_name(offset, compressed):
+    """Return the file name of the segment starting at ``offset``."""
+    name = '%020d.log' % offset
+    if compressed:
+        name += '.gz'
+    return name
+
+
+class ConsoleLogStore(object):
+    """A rotated, compressed console log for a single node.
+
+    ``directory`` is the directory holding the log; it is created on the
+    first write. ``segment_size`` is the (uncompressed) size in bytes at
+    which the active segment is compressed and a new one started.
+    ``segments`` is the number of compressed segments to retain.
+    """
+
+    def __init__(self, directory,
+                 segment_size=DEFAULT_SEGMENT_SIZE,
+                 segments=DEFAULT_SEGMENTS,
+                 index_interval=DEFAULT_INDEX_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segments = segments
+        self.index_interval = index_interval
+
+        # Writer state; initialized lazily by _open_for_writing:
+        self._active = None
+        self._active_start = None
+        self._offset = None
+        self._last_index_time = None
+
+    def exists(self):
+        """Return whether anything has been logged to the store."""
+        return os.path.isdir(self.directory)
+
+    def delete(self):
+        """Remove the store and everything in it."""
+        self.close()
+        if self.exists():
+            shutil.rmtree(self.directory)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _list_segments(self):
+        """Return a sorted list of (start offset, compressed) pairs.
+
+        While a segment is being rotated, both its compressed and
+        uncompressed forms exist for a moment (or indefinitely, if the
+        writer crashed in between); only the compressed one is listed.
+        """
+        segments = {}
+        if not self.exists():
+            return []
+        for name in os.listdir(self.directory):
+            match = _SEGMENT_RE.match(name)
+            if match is not None:
+                start = int(match.group(1))
+                compressed = match.group(2) is not None
+                segments[start] = segments.get(start, False) or compressed
+        return sorted(segments.items())
+
+    def _read_index(self):
+        """Return the index as a sorted list of (timestamp, offset) pairs."""
+        entries = []
+        if not os.path.isfile(self._path('index')):
+            return entries
+        with open(self._path('index')) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 2:
+                    # Possibly a torn write from a crashed writer; the rest
+                    # of the index is still usable.
+                    continue
+                entries.append((float(fields[0]), int(fields[1])))
+        return entries
+
+    # Writing #
+    ###########
+
+    def _open_for_writing(self):
+        if self._active is not None:
+            return
+        if not self.exists():
+            os.makedirs(self.directory)
+        segments = self._list_segments()
+        for start, compressed in segments:
+            stale = self._path(_segment_name(start, False))
+            if compressed and os.path.exists(stale):
+                # Left behind by a crash part way through _rotate:
+                os.remove(stale)
+        if segments and not segments[-1][1]:
+            # Resume appending to an existing active segment:
+            self._active_start = segments[-1][0]
+            size = os.path.getsize(self._path(
+                _segment_name(self._active_start, False)))
+            self._offset = self._active_start + size
+        elif segments:
+            # The last segment was sealed, so the next one starts where
+            # it left off:
+            start = segments[-1][0]
+            self._active_start = start + _gzip_size(self._path(
+                _segment_name(start, True)))
+            self._offset = self._active_start
+        else:
+            self._active_start = 0
+            self._offset = 0
+        self._active = open(self._path(
+            _segment_name(self._active_start, False)), 'ab')
+        index = self._read_index()
+        if index:
+            self._last_index_time = index[-1][0]
+
+    def write(self, data, now=None):
+        """Append ``data`` (a string) to the log.
+
+        ``now`` is the time at which the data was received; it defaults to
+        the current time.
+        """
+        if not data:
+            return
+        if now is None:
+            now = time.time()
+        self._open_for_writing()
+        if self._last_index_time is None or \
+                now - self._last_index_time >= self.index_interval:
+            with open(self._path('index'), 'a') as f:
+                f.write('%f %d\n' % (now, self._offset))
+            self._last_index_time = now
+        self._active.write(data)
+        self._active.flush()
+        self._offset += len(data)
+        if self._offset - self._active_start >= self.segment_size:
+            self._rotate()
+
+    def _rotate(self):
+        """Compress the active segment, and start a new one."""
+        self._active.close()
+        self._active = None
+        src = self._path(_segment_name(self._active_start, False))
+        dst = self._path(_segment_name(self._active_start, True))
+        # Write to a temporary file first, so readers never see a partial
+        # segment:
+        with open(src, 'rb') as f_in:
+            out = gzip.open(dst + '.tmp', 'wb')
+            try:
+                shutil.copyfileobj(f_in, out)
+            finally:
+                out.close()
+        os.rename(dst + '.tmp', dst)
+        os.remove(src)
+        self._active_start = self._offset
+        self._active = open(self._path(
+            _segment_name(self._active_start, False)), 'ab')
+        self._prune()
+
+    def _prune(self):
+        """Drop compressed segments and index entries past retention."""
+        compressed = [start for start, gz in self._list_segments() if gz]
+        expired = compressed[:max(0, len(compressed) - self.segments)]
+        if not expired:
+            return
+        for start in expired:
+            os.remove(self._path(_segment_name(start, True)))
+        first_offset = self._list_segments()[0][0]
+        keep = [entry for entry in self._read_index()
+                if entry[1] >= first_offset]
+        with open(self._path('index.tmp'), 'w') as f:
+            for timestamp, offset in keep:
+                f.write('%f %d\n' % (timestamp, offset))
+        os.rename(self._path('index.tmp'), self._path('index'))
+
+    def close(self):
+        """Close the active segment, if it is open."""
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+    # Reading #
+    ###########
+
+    def read(self, since=None, until=None):
+        """Return the contents of the log, as a string.
+
+        If ``since`` and/or ``until`` are specified (as seconds since the
+        epoch), only output received in that time range is returned. The
+        range is resolved via the index, so it may include up to
+        ``index_interval`` seconds of extra output at either end.
+
+        Returns None if the store does not exist.
+        """
+        if not self.exists():
+            return None
+        segments = self._list_segments()
+        if not segments:
+            return ''
+
+        start_offset = segments[0][0]
+        end_offset = None
+        if since is not None or until is not None:
+            index = self._read_index()
+            times = [timestamp for timestamp, _ in index]
+            if since is not None:
+                i = bisect.bisect_right(times, since) - 1
+                if i >= 0:
+                    start_offset = max(start_offset, index[i][1])
+            if until is not None:
+                i = bisect.bisect_right(times, until)
+                if i < len(index):
+                    end_offset = index[i][1]
+            if end_offset is not None and end_offset <= start_offset:
+                return ''
+
+        chunks = []
+        for i, (seg_start, compressed) in enumerate(segments):
+            if i + 1 < len(segments) and segments[i + 1][0] <= start_offset:
+                # Entirely before the requested range; skip it without
+                # decompressing.
+                continue
+            if end_offset is not None and seg_start >= end_offset:
+                break
+            data = self._read_segment(seg_start, compressed)
+            lo = max(0, start_offset - seg_start)
+            if end_offset is None:
+                chunks.append(data[lo:])
+            else:
+                chunks.append(data[lo:end_offset - seg_start])
+        return ''.join(chunks)
+
+    def _read_segment(self, start, compressed):
+        """Return the contents of the segment starting at ``start``.
+
+        If the segment is compressed by the writer after it was listed, it
+        is read from the compressed file instead.
+        """
+        if not compressed:
+            try:
+                with open(self._path(_segment_name(start, False)),
+                          'rb') as f:
+                    return f.read()
+            except IOError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        f = gzip.open(self._path(_segment_name(start, True)), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+
+def _gzip_size(path):
+    """Return the uncompressed size of the gzip file at ``path``."""
+    f = gzip.open(path, 'rb')
+    try:
+        size = 0
+        while True:
+            data = f.read(64 * 1024)
+            if not data:
+                return size
+            size += len(data)
+    finally:
+        f.close()
+
+
+def main(argv=None):
+    """Copy standard input into a ``ConsoleLogStore``, until EOF."""
+    parser = argparse.ArgumentParser(
+        description='Record console output from stdin.')
+    parser.add_argument('directory')
+    parser.add_argument('--segment-size', type=int,
+                        default=DEFAULT_SEGMENT_SIZE)
+    parser.add_argument('--segments', type=int, default=DEFAULT_SEGMENTS)
+    args = parser.parse_args(argv)
+
+    store = ConsoleLogStore(args.directory,
+                            segment_size=args.segment_size,
+                            segments=args.segments)
+    # stop_console kills us with SIGTERM; close the store cleanly:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    fd = sys.stdin.fileno()
+    try:
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            store.write(data)
+    finally:
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
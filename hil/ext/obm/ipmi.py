@@ -3,11 +3,17 @@
 import schema
 import logging
 
+from hil import deadline, metrics
 from hil.model import db, Obm
+from hil.config import cfg
 from hil.errors import OBMError, BadArgumentError
 from hil.dev_support import no_dry_run
+from hil.ext.obm._console_log import ConsoleLogStore, DEFAULT_SEGMENT_SIZE, \
+    DEFAULT_SEGMENTS
 from subprocess import call, Popen, PIPE
 import os
+import re
+import sys
 
 from os.path import join, dirname
 from hil.migrations import paths
@@ -19,6 +25,24 @@ paths[__name__] = join(dirname(__file__), 'migrations', 'ipmi')
 BigIntegerType = BigInteger().with_variant(
                 sqlite.INTEGER(), 'sqlite')
 
+IPMI_LATENCY = metrics.REGISTRY.histogram(
+    'hil_ipmi_call_duration_seconds',
+    'Time taken by calls to ipmitool, by command (e.g. "chassis power").',
+    ['command'])
+IPMI_FAILURES = metrics.REGISTRY.counter(
+    'hil_ipmi_call_failures_total',
+    'Calls to ipmitool which exited with a non-zero status, by command.',
+    ['command'])
+
+
+def _command_name(args):
+    """Return the name of the ipmitool command `args`, for use in metrics.
+
+    This is the first two arguments, e.g. "chassis power"; the rest (e.g.
+    "on" or "off") are left out, to keep the number of label values small.
+    """
+    return ' '.join(args[:2])
+
 
 class Ipmi(Obm):
     """IPMI obm driver"""
@@ -45,27 +69,38 @@ class Ipmi(Obm):
             'password': basestring,
             }).validate(kwargs)
 
+    def _ipmitool_command(self, args):
+        """Return the ipmitool command line to run `args` against this node.
+
+        Note: Includes the ``-I lanplus`` flag, available only in IPMI v2+.
+        This is needed for machines which do not accept the older version.
+        """
+        return ['ipmitool',
+                '-I', 'lanplus',  # see docstring above
+                '-U', self.user,
+                '-P', self.password,
+                '-H', self.host] + args
+
     def _ipmitool(self, args):
         """Invoke ipmitool with the right host/pass etc. for this node.
 
         `args`- A list of any additional arguments to pass to ipmitool.
-        Returns the exit status of ipmitool.
-
-        Note: Includes the ``-I lanplus`` flag, available only in IPMI v2+.
-        This is needed for machines which do not accept the older version.
+        Returns the exit status of ipmitool. Raises `OBMError` if ipmitool
+        takes longer than `hil.deadline` allows.
         """
-        status = call(['ipmitool',
-                       '-I', 'lanplus',  # see docstring above
-                       '-U', self.user,
-                       '-P', self.password,
-                       '-H', self.host] + args)
+        with IPMI_LATENCY.time(command=_command_name(args)):
+            proc = Popen(self._ipmitool_command(args))
+            deadline.communicate(proc)
+            status = proc.returncode
 
         if status != 0:
+            IPMI_FAILURES.inc(command=_command_name(args))
             logger = logging.getLogger(__name__)
             logger.info('Nonzero exit status form ipmitool, args = %r', args)
         return status
 
     @no_dry_run
+    @deadline.operation('obm')
     def power_cycle(self, force):
         self._ipmitool(['chassis', 'bootdev', 'pxe'])
         if force:
@@ -84,15 +119,37 @@ class Ipmi(Obm):
         raise OBMError('Could not power cycle node %s' % self.node.label)
 
     @no_dry_run
+    @deadline.operation('obm')
     def power_off(self):
         if self._ipmitool(['chassis', 'power', 'off']) != 0:
             raise OBMError('Could not power off node %s', self.label)
 
+    @no_dry_run
+    @deadline.operation('obm')
+    def get_power_status(self):
+        args = ['chassis', 'power', 'status']
+        with IPMI_LATENCY.time(command=_command_name(args)):
+            proc = Popen(self._ipmitool_command(args),
+                         stdin=PIPE,
+                         stdout=PIPE,
+                         stderr=PIPE)
+            out, err = deadline.communicate(proc)
+        if proc.returncode != 0:
+            IPMI_FAILURES.inc(command=_command_name(args))
+            raise OBMError('Could not read power status of node %s: %s' %
+                           (self.node.label, err.strip()))
+        # The output looks like "Chassis Power is on":
+        words = out.split()
+        if words and words[-1] in ('on', 'off'):
+            return words[-1]
+        raise OBMError('Unexpected output from ipmitool: %r' % out)
+
     def require_legal_bootdev(self, dev):
         if dev not in self.valid_bootdevices:
             raise BadArgumentError('Invald boot device')
 
     @no_dry_run
+    @deadline.operation('obm')
     def set_bootdev(self, dev):
         self.require_legal_bootdev(dev)
         if self._ipmitool(['chassis', 'bootdev', dev,
@@ -107,7 +164,12 @@ class Ipmi(Obm):
         # to prevent stdout from becoming garbled.  This happens because
         # ipmitool sets shell settings to behave like a tty when communicateing
         # over Serial over Lan
-        Popen(
+        #
+        # stdout is fed to a separate process, which writes it into the
+        # node's console log store; see ``hil.ext.obm._console_log``. That
+        # process exits on its own when ipmitool does, but stop_console
+        # also stops it explicitly.
+        ipmitool = Popen(
             ['ipmitool',
              '-H', self.host,
              '-U', self.user,
@@ -115,14 +177,29 @@ class Ipmi(Obm):
              '-I', 'lanplus',
              'sol', 'activate'],
             stdin=PIPE,
-            stdout=open(self.get_console_log_filename(), 'a'),
+            stdout=PIPE,
             stderr=PIPE)
+        Popen([_console_python(), '-m', 'hil.ext.obm._console_log',
+               self.get_console_log_filename(),
+               '--segment-size', str(_console_segment_size()),
+               '--segments', str(_console_segments())],
+              stdin=ipmitool.stdout,
+              close_fds=True)
+        # The writer has its own copy of the pipe; drop ours so ipmitool
+        # sees SIGPIPE if the writer dies:
+        ipmitool.stdout.close()
 
-    # stdin, stdout, and stderr are redirected to a pipe that is never read
-    # because we are not interested in the ouput of this command.
+    # stdin, stdout, and stderr are redirected to pipes whose contents are
+    # thrown away, because we are not interested in the ouput of this
+    # command.
     @no_dry_run
+    @deadline.operation('obm')
     def stop_console(self):
         call(['pkill', '-f', 'ipmitool -H %s' % self.host])
+        # The trailing space keeps us from matching other nodes' writers
+        # whose directory names start with this one's:
+        call(['pkill', '-f', 'hil\\.ext\\.obm\\._console_log %s ' %
+              re.escape(self.get_console_log_filename())])
         proc = Popen(
             ['ipmitool',
              '-H', self.host,
@@ -133,17 +210,64 @@ class Ipmi(Obm):
             stdin=PIPE,
             stdout=PIPE,
             stderr=PIPE)
-        proc.wait()
+        deadline.communicate(proc)
 
     def delete_console(self):
-        if os.path.isfile(self.get_console_log_filename()):
-            os.remove(self.get_console_log_filename())
+        self._console_log_store().delete()
+        # Logs written by older versions of HIL were a single flat file:
+        legacy_filename = os.path.join(_console_log_dir(),
+                                       '%s.log' % self.host)
+        if os.path.isfile(legacy_filename):
+            os.remove(legacy_filename)
 
-    def get_console(self):
-        if not os.path.isfile(self.get_console_log_filename()):
+    def get_console(self, since=None, until=None):
+        log = self._console_log_store().read(since=since, until=until)
+        if log is None:
             return None
-        with open(self.get_console_log_filename(), 'r') as log:
-            return "".join(i for i in log.read() if ord(i) < 128)
+        return "".join(i for i in log if ord(i) < 128)
 
     def get_console_log_filename(self):
-        return '/var/run/hil_console_logs/%s.log' % self.host
+        return os.path.join(_console_log_dir(), self.host)
+
+    def _console_log_store(self):
+        """Return the ``ConsoleLogStore`` for this node's console."""
+        return ConsoleLogStore(self.get_console_log_filename(),
+                               segment_size=_console_segment_size(),
+                               segments=_console_segments())
+
+
+def _console_log_dir():
+    """Return the directory under which console logs are stored."""
+    if cfg.has_option(__name__, 'console_log_dir'):
+        return cfg.get(__name__, 'console_log_dir')
+    return '/var/run/hil_console_logs'
+
+
+def _console_python():
+    """Return the python interpreter with which to run the console log
+    writer.
+
+    This is the ``console_python`` option if set, or else the interpreter
+    running HIL. Under mod_wsgi, ``sys.executable`` is the web server (e.g.
+    httpd) rather than python, in which case the interpreter installed
+    alongside HIL's python environment is used.
+    """
+    if cfg.has_option(__name__, 'console_python'):
+        return cfg.get(__name__, 'console_python')
+    if os.path.basename(sys.executable).startswith('python'):
+        return sys.executable
+    return os.path.join(sys.exec_prefix, 'bin', 'python')
+
+
+def _console_segment_size():
+    """Return the configured console log segment size, in bytes."""
+    if cfg.has_option(__name__, 'console_segment_size'):
+        return cfg.getint(__name__, 'console_segment_size')
+    return DEFAULT_SEGMENT_SIZE
+
+
+def _console_segments():
+    """Return the configured number of compressed segments to retain."""
+    if cfg.has_option(__name__, 'console_segments'):
+        return cfg.getint(__name__, 'console_segments')
+    return DEFAULT_SEGMENTS
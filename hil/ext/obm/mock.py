@@ -44,6 +44,9 @@ class MockObm(Obm):
     def power_off(self):
         return
 
+    def get_power_status(self):
+        return 'on'
+
     def require_legal_bootdev(self, dev):
         return
 
@@ -63,7 +66,7 @@ class MockObm(Obm):
         return
 
     @no_dry_run
-    def get_console(self):
+    def get_console(self, since=None, until=None):
         return
 
     @no_dry_run
@@ -4,6 +4,8 @@ import logging
 import pexpect
 
 from abc import ABCMeta, abstractmethod
+from hil import deadline
+from hil.errors import SwitchError
 from hil.model import Port, NetworkAttachment, SwitchSession
 from hil.ext.switches.common import should_save
 import re
@@ -12,6 +14,28 @@ _CHANNEL_RE = re.compile(r'vlan/(\d+)')
 logger = logging.getLogger(__name__)
 
 
+class Console(pexpect.spawn):
+    """A pexpect connection to a switch's console.
+
+    Unless a timeout is given explicitly, ``expect`` waits only as long as
+    `hil.deadline` allows, and raises a `SwitchError` (rather than a pexpect
+    exception) if the switch doesn't produce the expected output in time,
+    or closes the connection unexpectedly.
+    """
+
+    def expect(self, pattern, timeout=-1, searchwindowsize=-1):
+        if timeout == -1:
+            timeout = deadline.timeout('switch')
+        try:
+            return super(Console, self).expect(pattern, timeout,
+                                               searchwindowsize)
+        except (pexpect.EOF, pexpect.TIMEOUT) as e:
+            logger.error('Waiting for %r from switch failed: %s',
+                         pattern, type(e).__name__)
+            raise SwitchError('Waiting for %r from switch failed: %s' %
+                              (pattern, type(e).__name__))
+
+
 class Session(SwitchSession):
     """Common base class for sessions in console-based drivers."""
 
@@ -70,7 +94,7 @@ class Session(SwitchSession):
         where the switch only exits out of enable mode and doesn't actually
         log out"""
 
-        if should_save(self):
+        if not self.read_only and should_save(self):
             self.save_running_config()
         self._sendline('exit')
         alternatives = [pexpect.EOF, '>']
@@ -174,7 +198,7 @@ def login(switch):
     """
 
     alternatives = ['User Name:', '[Pp]assword:*', '>', '#']
-    console = pexpect.spawn(
+    console = Console(
             'ssh ' + switch.username + '@' + switch.hostname)
 
     outcome = console.expect(alternatives)
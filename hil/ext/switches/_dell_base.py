@@ -4,6 +4,7 @@ import re
 import logging
 
 from hil.ext.switches import _console
+from hil.ext.switches.common import parse_vlans
 
 logger = logging.getLogger(__name__)
 
@@ -37,6 +38,7 @@ class _BaseSession(_console.Session):
 
     def get_port_networks(self, ports):
         num_re = re.compile(r'(\d+)')
+        range_re = re.compile(r'(\d+(?:-\d+)?)')
         port_configs = self._port_configs(ports)
         result = {}
         for k, v in port_configs.iteritems():
@@ -53,14 +55,12 @@ class _BaseSession(_console.Session):
             networks = []
             range_str = v['Trunking VLANs Enabled']
             for range_str in v['Trunking VLANs Enabled'].split(','):
-                for num_str in range_str.split('-'):
-                    num_str = num_str.strip()
-                    match = re.match(num_re, num_str)
-                    if match:
-                        # There may be other tokens in the output, e.g.
-                        # the string "(Inactive)" somteimtes appears.
-                        # We should only use the value if it's an actual number
-                        num_str = match.groups()[0]
+                # There may be other tokens in the output, e.g. the string
+                # "(Inactive)" sometimes appears. We should only use the value
+                # if it's an actual number, or range of numbers (e.g. 2-7):
+                match = re.match(range_re, range_str.strip())
+                if match:
+                    for num_str in parse_vlans(match.group(1)):
                         networks.append(('vlan/%s' % num_str, int(num_str)))
             if native is not None:
                 networks.append(('vlan/native', native))
@@ -10,6 +10,7 @@ import re
 import requests
 import schema
 
+from hil import deadline
 from hil.migrations import paths
 from hil.model import db, Switch, SwitchSession
 from hil.errors import BadArgumentError
@@ -97,8 +98,11 @@ class Brocade(Switch, SwitchSession):
                 self._add_vlan_to_trunk(interface, vlan_id)
 
     def revert_port(self, port):
-        self._remove_all_vlans_from_trunk(port)
-        if self._get_native_vlan(port) is not None:
+        # Read the port once, and remove only what's actually on it:
+        trunk = self._get_trunk(port)
+        if self._parse_vlans(trunk):
+            self._remove_all_vlans_from_trunk(port)
+        if self._parse_native_vlan(trunk) is not None:
             self._remove_native_vlan(port)
 
     def get_port_networks(self, ports):
@@ -118,11 +122,19 @@ class Brocade(Switch, SwitchSession):
         """
         response = {}
         for port in ports:
-            response[port] = filter(None,
-                                    [self._get_native_vlan(port.label)]) \
-                                    + self._get_vlans(port.label)
+            trunk = self._get_trunk(port.label)
+            response[port] = filter(None, [self._parse_native_vlan(trunk)]) \
+                + self._parse_vlans(trunk)
         return response
 
+    def get_port_state(self, port):
+        trunk = self._get_trunk(port)
+        state = dict(self._parse_vlans(trunk))
+        native = self._parse_native_vlan(trunk)
+        if native is not None:
+            state[native[0]] = native[1]
+        return state
+
     def _get_mode(self, interface):
         """ Return the mode of an interface.
 
@@ -164,6 +176,19 @@ class Brocade(Switch, SwitchSession):
         else:
             raise AssertionError('Invalid mode')
 
+    def _get_trunk(self, interface):
+        """ Return the trunk configuration of an interface.
+
+        Args:
+            interface: interface to return the configuration of
+
+        Returns: the parsed XML, to pass to _parse_vlans and
+        _parse_native_vlan.
+        """
+        url = self._construct_url(interface, suffix='trunk')
+        response = self._make_request('GET', url)
+        return etree.fromstring(response.text)
+
     def _get_vlans(self, interface):
         """ Return the vlans of a trunk port.
 
@@ -175,10 +200,13 @@ class Brocade(Switch, SwitchSession):
         Returns: List containing the vlans of the form:
         [('vlan/vlan1', vlan1), ('vlan/vlan2', vlan2)]
         """
+        return self._parse_vlans(self._get_trunk(interface))
+
+    def _parse_vlans(self, root):
+        """ Return the vlans in root (as returned by _get_trunk), as for
+        _get_vlans.
+        """
         try:
-            url = self._construct_url(interface, suffix='trunk')
-            response = self._make_request('GET', url)
-            root = etree.fromstring(response.text)
             vlans = root. \
                 find(self._construct_tag('allowed')).\
                 find(self._construct_tag('vlan')).\
@@ -204,10 +232,13 @@ class Brocade(Switch, SwitchSession):
 
         Returns: Tuple of the form ('vlan/native', vlan) or None
         """
+        return self._parse_native_vlan(self._get_trunk(interface))
+
+    def _parse_native_vlan(self, root):
+        """ Return the native vlan in root (as returned by _get_trunk), as
+        for _get_native_vlan.
+        """
         try:
-            url = self._construct_url(interface, suffix='trunk')
-            response = self._make_request('GET', url)
-            root = etree.fromstring(response.text)
             vlan = root.find(self._construct_tag('native-vlan')).text
             return ('vlan/native', vlan)
         except AttributeError:
@@ -246,7 +277,7 @@ class Brocade(Switch, SwitchSession):
         """
         url = self._construct_url(interface, suffix='trunk/allowed/vlan')
         payload = '<vlan><none>true</none></vlan>'
-        requests.put(url, data=payload, auth=self._auth)
+        self._request('PUT', url, data=payload)
 
     def _set_native_vlan(self, interface, vlan):
         """ Set the native vlan of an interface.
@@ -311,9 +342,23 @@ class Brocade(Switch, SwitchSession):
         """ Construct the xml tag by prepending the brocade tag prefix. """
         return '{urn:brocade.com:mgmt:brocade-interface}%s' % name
 
+    def _request(self, method, url, data=None):
+        """Send a request to the switch, within the time allowed by
+        `hil.deadline`.
+
+        Raises `SwitchError` if the switch can't be reached or doesn't
+        answer in time; the response's status is not checked.
+        """
+        try:
+            return requests.request(method, url, data=data, auth=self._auth,
+                                    timeout=deadline.timeout('switch'))
+        except requests.RequestException as e:
+            logger.error('Request to switch failed: %s', e)
+            raise SwitchError('Request to switch failed: %s' % e)
+
     def _make_request(self, method, url, data=None,
                       acceptable_error_codes=()):
-        r = requests.request(method, url, data=data, auth=self._auth)
+        r = self._request(method, url, data=data)
         if r.status_code >= 400 and \
            r.status_code not in acceptable_error_codes:
             logger.error('Bad Request to switch. '
@@ -9,8 +9,9 @@ import re
 import requests
 import schema
 
+from hil import deadline
 from hil.model import db, Switch, SwitchSession
-from hil.errors import BadArgumentError
+from hil.errors import BadArgumentError, SwitchError
 from hil.model import BigIntegerType
 from hil.network_allocator import get_network_allocator
 from hil.ext.switches.common import should_save, check_native_networks, \
@@ -94,9 +95,16 @@ class DellNOS9(Switch, SwitchSession):
             self.save_running_config()
 
     def revert_port(self, port):
-        self._remove_all_vlans_from_trunk(port)
-        if self._get_native_vlan(port) is not None:
-            self._remove_native_vlan(port)
+        # A port which is shut down has no VLANs on it, so there's nothing
+        # to do. Otherwise, read the port once, and remove only the VLANs
+        # which are actually on it:
+        if not self._is_port_on(port):
+            return
+        response = self._get_port_info(port)
+        self._remove_vlans_from_trunk(port, self._parse_vlans(response))
+        native = self._parse_native_vlan(response)
+        if native is not None:
+            self._remove_native_vlan(port, native[1])
         self._port_shutdown(port)
         if should_save(self):
             self.save_running_config()
@@ -104,13 +112,36 @@ class DellNOS9(Switch, SwitchSession):
     def get_port_networks(self, ports):
         response = {}
         for port in ports:
-            response[port] = self._get_vlans(port.label)
-            native = self._get_native_vlan(port.label)
+            native, response[port] = self._get_port_vlans(port.label)
             if native is not None:
                 response[port].append(native)
 
         return response
 
+    def get_port_state(self, port):
+        native, vlans = self._get_port_vlans(port)
+        state = dict(vlans)
+        if native is not None:
+            state[native[0]] = native[1]
+        return state
+
+    def _get_port_vlans(self, interface):
+        """ Return the native vlan and the other vlans of an interface.
+
+        This reads the port once, rather than once for each of
+        _get_native_vlan and _get_vlans.
+
+        Args:
+            interface: interface to return the vlans of
+
+        Returns: a tuple (native, vlans), where native is as returned by
+        _get_native_vlan, and vlans as returned by _get_vlans.
+        """
+        if not self._is_port_on(interface):
+            return None, []
+        response = self._get_port_info(interface)
+        return self._parse_native_vlan(response), self._parse_vlans(response)
+
     def _get_vlans(self, interface):
         """ Return the vlans of a trunk port.
 
@@ -131,8 +162,13 @@ class DellNOS9(Switch, SwitchSession):
 
         if not self._is_port_on(interface):
             return []
-        response = self._get_port_info(interface)
+        return self._parse_vlans(self._get_port_info(interface))
 
+    @staticmethod
+    def _parse_vlans(response):
+        """ Return the vlans in response (the output of _get_port_info), as
+        for _get_vlans.
+        """
         # finds a comma separated list of integers and/or ranges starting with
         # T. Sample T12,14-18,23,28,80-90 or T20 or T20,22 or T20-22
         match = re.search(r'T(\d+(-\d+)?)(,\d+(-\d+)?)*', response)
@@ -155,7 +191,13 @@ class DellNOS9(Switch, SwitchSession):
         """
         if not self._is_port_on(interface):
             return None
-        response = self._get_port_info(interface)
+        return self._parse_native_vlan(self._get_port_info(interface))
+
+    @staticmethod
+    def _parse_native_vlan(response):
+        """ Return the native vlan in response (the output of
+        _get_port_info), as for _get_native_vlan.
+        """
         match = re.search(r'NativeVlanId:(\d+)\.', response)
         if match is not None:
             vlan = match.group(1)
@@ -210,14 +252,15 @@ class DellNOS9(Switch, SwitchSession):
         command = self._remove_vlan_command(interface, vlan)
         self._execute(CONFIG, command)
 
-    def _remove_all_vlans_from_trunk(self, interface):
-        """ Remove all vlan from a trunk port.
+    def _remove_vlans_from_trunk(self, interface, vlans):
+        """ Remove several vlans from a trunk port, with one command.
 
         Args:
-            interface: interface to remove the vlan from
+            interface: interface to remove the vlans from
+            vlans: the vlans to remove, as returned by _get_vlans
         """
         command = ''
-        for vlan in self._get_vlans(interface):
+        for vlan in vlans:
             command += self._remove_vlan_command(interface, vlan[1]) + '\r\n '
         # execute command only if there are some vlans to remove, otherwise
         # the switch complains
@@ -244,14 +287,17 @@ class DellNOS9(Switch, SwitchSession):
             self.interface_type + ' ' + interface
         self._execute(CONFIG, command)
 
-    def _remove_native_vlan(self, interface):
+    def _remove_native_vlan(self, interface, vlan=None):
         """ Remove the native vlan from an interface.
 
         Args:
             interface: interface to remove the native vlan from.vlan
+            vlan: the native vlan, if the caller already knows it; otherwise
+                it is read from the switch.
         """
         try:
-            vlan = self._get_native_vlan(interface)[1]
+            if vlan is None:
+                vlan = self._get_native_vlan(interface)[1]
             command = 'interface vlan ' + vlan + '\r\n no untagged ' + \
                 self.interface_type + ' ' + interface
             self._execute(CONFIG, command)
@@ -413,7 +459,12 @@ class DellNOS9(Switch, SwitchSession):
         return '{http://www.dell.com/ns/dell:0.1/root}%s' % name
 
     def _make_request(self, method, url, data=None):
-        r = requests.request(method, url, data=data, auth=self._auth)
+        try:
+            r = requests.request(method, url, data=data, auth=self._auth,
+                                 timeout=deadline.timeout('switch'))
+        except requests.RequestException as e:
+            logger.error('Request to switch failed: %s', e)
+            raise SwitchError('Request to switch failed: %s' % e)
         if r.status_code >= 400:
             logger.error('Bad Request to switch. Response: %s', r.text)
         return r
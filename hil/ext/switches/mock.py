@@ -88,5 +88,8 @@ class MockSwitch(Switch, SwitchSession):
                     ret[port].append((chan, net))
         return ret
 
+    def get_port_state(self, port):
+        return dict(LOCAL_STATE[self.label][port])
+
     def get_capabilities(self):
         return ['nativeless-trunk-mode']
@@ -11,6 +11,7 @@ import schema
 from hil.model import db, Switch
 from hil.migrations import paths
 from hil.ext.switches import _console
+from hil.ext.switches.common import parse_vlans
 from hil.ext.switches._dell_base import _BaseSession
 from os.path import dirname, join
 from hil.errors import BadArgumentError
@@ -152,6 +153,7 @@ class _DellN3000Session(_BaseSession):
 
     def get_port_networks(self, ports):
         num_re = re.compile(r'(\d+)')
+        range_re = re.compile(r'(\d+(?:-\d+)?)')
         port_configs = self._port_configs(ports)
         result = {}
         for k, v in port_configs.iteritems():
@@ -169,14 +171,12 @@ class _DellN3000Session(_BaseSession):
                 native = None
             networks = []
             for range_str in v['Trunking Mode VLANs Enabled'].split(','):
-                for num_str in range_str.split('-'):
-                    num_str = num_str.strip()
-                    match = re.match(num_re, num_str)
-                    if match:
-                        # There may be other tokens in the output, e.g.
-                        # the string "(Inactive)" somteimtes appears.
-                        # We should only use the value if it's an actual number
-                        num_str = match.groups()[0]
+                # There may be other tokens in the output, e.g. the string
+                # "(Inactive)" sometimes appears. We should only use the value
+                # if it's an actual number, or range of numbers (e.g. 2-7):
+                match = re.match(range_re, range_str.strip())
+                if match:
+                    for num_str in parse_vlans(match.group(1)):
                         networks.append(('vlan/%s' % num_str, int(num_str)))
             if native is not None:
                 networks.append(('vlan/native', native))
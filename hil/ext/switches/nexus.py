@@ -10,6 +10,7 @@ import logging
 
 from hil.model import db, Switch
 from hil.ext.switches import _console
+from hil.ext.switches.common import parse_vlans
 from hil.errors import BadArgumentError
 from os.path import join, dirname
 from hil.migrations import paths
@@ -175,6 +176,7 @@ class _Session(_console.Session):
 
     def get_port_networks(self, ports):
         num_re = re.compile(r'(\d+)')
+        range_re = re.compile(r'(\d+(?:-\d+)?)')
         port_configs = self._port_configs(ports)
         result = {}
 
@@ -196,16 +198,12 @@ class _Session(_console.Session):
             else:
                 native = None
             for range_str in v['Trunking VLANs Allowed'].split(','):
-                # XXX TODO make this actualy interpret e.g. 2-7 as a *range*
-                for num_str in range_str.split('-'):
-                    num_str = num_str.strip()
-                    match = re.match(num_re, num_str)
-                    if match:
-                        # There may be other tokens in the output, e.g.
-                        # the string "(Inactive)" somteimtes appears.
-                        # We should only use the value if it's an actual
-                        # number.
-                        num_str = match.groups()[0]
+                # There may be other tokens in the output, e.g. the string
+                # "(Inactive)" sometimes appears. We should only use the value
+                # if it's an actual number, or range of numbers (e.g. 2-7):
+                match = re.match(range_re, range_str.strip())
+                if match:
+                    for num_str in parse_vlans(match.group(1)):
                         networks.append(('vlan/%s' % num_str, int(num_str)))
 
             if native is not None:
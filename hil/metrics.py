@@ -0,0 +1,370 @@
+"""Metrics about HIL's operation, in the Prometheus text format.
+
+This module provides a small registry of metrics -- counters, gauges and
+histograms, optionally with labels -- without depending on any external
+library. Modules define the metrics they maintain at import time, e.g.:
+
+    ACTIONS = metrics.REGISTRY.counter(
+        'hil_example_actions_total',
+        'Actions performed, by type.',
+        ['type'])
+    ...
+    ACTIONS.inc(type='frobnicate')
+
+`Registry.expose` renders every metric in the text exposition format
+understood by Prometheus (and many other monitoring systems). The API server
+serves it at ``GET /metrics``; ``hil serve_networks`` can serve it on a
+separate port (see `serve_in_background`).
+
+Metrics are kept in the memory of each process; if the API server runs as
+several processes, each one reports its own.
+"""
+
+import BaseHTTPServer
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# The content type of the exposition format:
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets, in seconds; suitable for timing API calls, and
+# the like:
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    """Escape `value` for use as a label value."""
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    """Format the label set ``zip(names, values)``, plus `extra` pairs."""
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    """Base class for the metric types.
+
+    Each metric has a `name`, some `help` text, and a (possibly empty) list
+    of `labelnames`. Values must be given for all of the labels each time the
+    metric is updated.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        # pylint: disable=redefined-builtin
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        """Return the key into ``_values`` for the label set `labels`."""
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Metric %s has labels %r, but got %r' %
+                             (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """Return a list of ``(suffix, labels, value)`` triples.
+
+        `labels` is a (possibly empty) string of formatted labels.
+        """
+        with self._lock:
+            return [('', _format_labels(self.labelnames, key), value)
+                    for key, value in sorted(self._values.items())]
+
+    def expose(self):
+        """Return this metric in the text exposition format."""
+        lines = ['# HELP %s %s' % (self.name, self.help.replace('\n', ' ')),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, labels, value in self._samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    """A value which only goes up, e.g. a number of requests."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increase the counter for `labels` by `amount`."""
+        if amount < 0:
+            raise ValueError('Counters can only be increased.')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Return the current value for `labels`."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value which may go up or down, e.g. the length of a queue."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge for `labels` to `value`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """Increase the gauge for `labels` by `amount`."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        """Decrease the gauge for `labels` by `amount`."""
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        """Return the current value for `labels`."""
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """A distribution of observed values, e.g. request latencies.
+
+    Observations are counted in cumulative `buckets`, each of which counts
+    the observations less than or equal to its upper bound.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        # pylint: disable=redefined-builtin
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """Record an observation of `value` for `labels`."""
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                    'buckets': [0] * len(self.buckets),
+                    'sum': 0,
+                    'count': 0,
+                }
+            entry = self._values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['buckets'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time taken (in seconds) by the body of a ``with``."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def count(self, **labels):
+        """Return the number of observations for `labels`."""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return 0 if entry is None else entry['count']
+
+    def sum(self, **labels):
+        """Return the sum of the observations for `labels`."""
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return 0 if entry is None else entry['sum']
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, entry in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, entry['buckets']):
+                    labels = _format_labels(self.labelnames, key,
+                                            [('le', _format_value(bound))])
+                    samples.append(('_bucket', labels, count))
+                labels = _format_labels(self.labelnames, key)
+                samples.append(('_sum', labels, entry['sum']))
+                samples.append(('_count', labels, entry['count']))
+        return samples
+
+
+class Registry(object):
+    """A collection of metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        """Add `metric` to the registry, and return it.
+
+        If a metric of the same type and name is already registered, that is
+        returned instead, so that registering a module's metrics more than
+        once (e.g. if the module is reloaded) is harmless.
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+            if type(existing) is not type(metric) or \
+                    existing.labelnames != metric.labelnames:
+                raise ValueError('A different metric named %s is already '
+                                 'registered.' % metric.name)
+            return existing
+
+    def counter(self, name, help, labelnames=()):
+        """Register and return a new `Counter`."""
+        # pylint: disable=redefined-builtin
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        """Register and return a new `Gauge`."""
+        # pylint: disable=redefined-builtin
+        return self.register(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        """Register and return a new `Histogram`."""
+        # pylint: disable=redefined-builtin
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def get(self, name):
+        """Return the metric named `name`, or None if there isn't one."""
+        with self._lock:
+            return self._metrics.get(name)
+
+    def add_collector(self, collector):
+        """Call `collector` (with no arguments) whenever metrics are exposed.
+
+        This is for gauges whose values are cheap to look up when needed, but
+        not to keep up to date, such as the state of a connection pool.
+        """
+        with self._lock:
+            if collector not in self._collectors:
+                self._collectors.append(collector)
+
+    def expose(self):
+        """Return all of the metrics in the text exposition format."""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            collector()
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return ''.join(metric.expose() for _, metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+# Counting database queries #
+#############################
+
+_local = threading.local()
+
+
+class QueryCounter(object):
+    """Counts the database queries made by this thread; see `count_queries`.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+
+@contextmanager
+def count_queries():
+    """Count the database queries made within a ``with`` block.
+
+    Yields a `QueryCounter`, whose ``count`` is the number of queries made
+    (so far) by the current thread within the block. Blocks may be nested,
+    in which case queries count towards each of the enclosing blocks.
+    Queries are only counted once `init` has been called.
+    """
+    counter = QueryCounter()
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = []
+    counters.append(counter)
+    try:
+        yield counter
+    finally:
+        counters.remove(counter)
+
+
+def _count_query(*args):
+    """Engine event handler, counting a query for `count_queries`."""
+    # pylint: disable=unused-argument
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+
+
+def init():
+    """Start counting database queries (see `count_queries`)."""
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+
+# Serving metrics #
+###################
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the metrics in `REGISTRY` in response to ``GET /metrics``."""
+
+    def do_GET(self):
+        """Handle a GET request."""
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.expose()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Don't log every request to stderr."""
+        # pylint: disable=redefined-builtin
+
+
+def serve_in_background(host, port):
+    """Serve the metrics over HTTP on `host`:`port`, from a daemon thread.
+
+    Metrics are available at the path ``/metrics``. This is meant for
+    processes other than the API server (which serves them as an API call),
+    such as the networking daemon. Returns the HTTP server, whose
+    ``shutdown()`` method stops it.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics server')
+    thread.daemon = True
+    thread.start()
+    return server
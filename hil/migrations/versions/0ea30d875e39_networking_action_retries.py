@@ -0,0 +1,48 @@
+"""add retries to networking actions
+
+Revision ID: 0ea30d875e39
+Revises: 4ce4eefa17fa
+Create Date: 2026-10-19 10:12:40.517214
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from hil.model import BigIntegerType
+
+
+# revision identifiers, used by Alembic.
+revision = '0ea30d875e39'
+down_revision = '4ce4eefa17fa'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    # Existing actions have been tried once if they're finished, and not at
+    # all if they're pending. The server default is only there to fill in
+    # the existing rows:
+    op.add_column('networking_action',
+                  sa.Column('attempts', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.alter_column('networking_action', 'attempts', server_default=None)
+    op.execute("UPDATE networking_action SET attempts = 1 "
+               "WHERE status != 'PENDING'")
+    op.add_column('networking_action',
+                  sa.Column('next_attempt', sa.DateTime(), nullable=True))
+    op.create_table(
+        'networking_action_attempt',
+        sa.Column('id', BigIntegerType, nullable=False),
+        sa.Column('action_id', BigIntegerType, nullable=False),
+        sa.Column('time', sa.DateTime(), nullable=False),
+        sa.Column('error', sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(['action_id'], ['networking_action.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+    )
+
+
+def downgrade():
+    op.drop_table('networking_action_attempt')
+    op.drop_column('networking_action', 'next_attempt')
+    op.drop_column('networking_action', 'attempts')
@@ -0,0 +1,38 @@
+"""add power_status
+
+Revision ID: 4ce4eefa17fa
+Revises: 89ff8a6d72b2
+Create Date: 2018-02-06 11:22:41.318204
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from hil.model import BigIntegerType
+
+
+# revision identifiers, used by Alembic.
+revision = '4ce4eefa17fa'
+down_revision = '89ff8a6d72b2'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table(
+        'power_status',
+        sa.Column('id', BigIntegerType, nullable=False),
+        sa.Column('node_id', BigIntegerType, nullable=False),
+        sa.Column('power', sa.String(), nullable=True),
+        sa.Column('reachable', sa.Boolean(), nullable=False),
+        sa.Column('error', sa.String(), nullable=True),
+        sa.Column('last_checked', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['node_id'], ['node.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('node_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('power_status')
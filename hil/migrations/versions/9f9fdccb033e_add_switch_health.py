@@ -0,0 +1,38 @@
+"""add switch_health
+
+Revision ID: 9f9fdccb033e
+Revises: 0ea30d875e39
+Create Date: 2026-10-19 11:03:17.284519
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+from hil.model import BigIntegerType
+
+
+# revision identifiers, used by Alembic.
+revision = '9f9fdccb033e'
+down_revision = '0ea30d875e39'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.create_table(
+        'switch_health',
+        sa.Column('id', BigIntegerType, nullable=False),
+        sa.Column('switch_id', BigIntegerType, nullable=False),
+        sa.Column('consecutive_failures', sa.Integer(), nullable=False),
+        sa.Column('last_failure', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('open_until', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['switch_id'], ['switch.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('switch_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('switch_health')
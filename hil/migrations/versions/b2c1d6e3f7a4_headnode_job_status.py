@@ -0,0 +1,32 @@
+"""add headnode job status
+
+Revision ID: b2c1d6e3f7a4
+Revises: 9f9fdccb033e
+Create Date: 2026-10-19 14:21:05.603118
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b2c1d6e3f7a4'
+down_revision = '9f9fdccb033e'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.add_column('headnode',
+                  sa.Column('job_status', sa.String(), nullable=True))
+    op.add_column('headnode',
+                  sa.Column('job_error', sa.String(), nullable=True))
+    # Headnodes which aren't dirty have already been started:
+    op.execute("UPDATE headnode SET job_status = 'DONE' WHERE NOT dirty")
+
+
+def downgrade():
+    op.drop_column('headnode', 'job_error')
+    op.drop_column('headnode', 'job_status')
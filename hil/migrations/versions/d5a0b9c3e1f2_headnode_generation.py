@@ -0,0 +1,28 @@
+"""add headnode generation
+
+Revision ID: d5a0b9c3e1f2
+Revises: b2c1d6e3f7a4
+Create Date: 2026-10-19 16:02:41.318270
+
+"""
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a0b9c3e1f2'
+down_revision = 'b2c1d6e3f7a4'
+branch_labels = None
+
+# pylint: disable=missing-docstring
+
+
+def upgrade():
+    op.add_column('headnode',
+                  sa.Column('generation', sa.Integer(), nullable=False,
+                            server_default='0'))
+
+
+def downgrade():
+    op.drop_column('headnode', 'generation')
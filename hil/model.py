@@ -11,13 +11,16 @@ Extensions are permitted to create new database objects by subclassing from
 # from sqlalchemy import *
 # from sqlalchemy.ext.declarative import declarative_base, declared_attr
 # from sqlalchemy.orm import relationship, sessionmaker,backref
-from flask.ext.sqlalchemy import SQLAlchemy
-from subprocess import call, check_call, Popen, PIPE
+from contextlib import contextmanager
+from functools import partial
+import threading
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession
 from hil.flaskapp import app
 from hil.config import cfg
-from hil.dev_support import no_dry_run
+from hil.dev_support import no_dry_run, have_dry_run
+from hil.virsh import get_virsh
+from hil import metrics
 import uuid
-import xml.etree.ElementTree
 from sqlalchemy import BigInteger
 from sqlalchemy.dialects import sqlite
 
@@ -27,7 +30,57 @@ from sqlalchemy.dialects import sqlite
 # just opt-in to the change now:
 app.config.update(SQLALCHEMY_TRACK_MODIFICATIONS=False)
 
-db = SQLAlchemy(app)
+# The name of the bind (see Flask-SQLAlchemy's SQLALCHEMY_BINDS) for the
+# read replica, if any:
+REPLICA = 'replica'
+
+# Options from the [database] section of the config which are passed on to
+# Flask-SQLAlchemy (as the given config keys). These only apply to databases
+# which use a connection pool, i.e. not SQLite:
+_POOL_OPTIONS = {
+    'pool_size': 'SQLALCHEMY_POOL_SIZE',
+    'max_overflow': 'SQLALCHEMY_MAX_OVERFLOW',
+    'pool_timeout': 'SQLALCHEMY_POOL_TIMEOUT',
+    'pool_recycle': 'SQLALCHEMY_POOL_RECYCLE',
+}
+
+_local = threading.local()
+
+
+class _RoutingSession(SignallingSession):
+    """A session which reads from the replica when asked to.
+
+    See `replica_reads`. Flushes always go to the primary database.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Return the engine to use for `mapper` or `clause`."""
+        if getattr(_local, 'replica_reads', False) and not self._flushing:
+            return db.get_engine(self.app, bind=REPLICA)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class _SQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, plus the engine options it doesn't support itself.
+    """
+
+    def create_session(self, options):
+        """Create a `_RoutingSession`."""
+        return _RoutingSession(self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        """Add our own options to those used to create an engine."""
+        # pylint: disable=redefined-outer-name
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if app.config.get('HIL_POOL_PRE_PING'):
+            options['pool_pre_ping'] = True
+        timeout = app.config.get('HIL_STATEMENT_TIMEOUT')
+        if timeout and info.drivername.startswith('postgresql'):
+            options.setdefault('connect_args', {})['options'] = \
+                '-c statement_timeout=%d' % (timeout * 1000)
+
+
+db = _SQLAlchemy(app)
 
 # Sets up variant type so that postgresql can use BIGINT primary keys
 # while sqlite uses Integer primary keys.
@@ -40,11 +93,95 @@ def init_db(uri=None):
 
     `uri` is the uri to use for the database. If it is None, the uri from the
     config file will be used.
+
+    The connection pool, statement timeout and read replica are configured
+    from the ``[database]`` section of the config; see ``examples/hil.cfg``.
     """
     if uri is None:
         uri = cfg.get('database', 'uri')
     app.config.update(SQLALCHEMY_DATABASE_URI=uri)
 
+    def _get(option, getter=cfg.get):
+        if cfg.has_option('database', option):
+            return getter('database', option)
+        return None
+
+    for option, key in _POOL_OPTIONS.items():
+        if uri.startswith('sqlite'):
+            app.config[key] = None
+        else:
+            app.config[key] = _get(option, cfg.getint)
+    app.config['HIL_POOL_PRE_PING'] = _get('pool_pre_ping', cfg.getboolean)
+    app.config['HIL_STATEMENT_TIMEOUT'] = _get('statement_timeout',
+                                               cfg.getfloat)
+    replica_uri = _get('replica_uri')
+    if replica_uri:
+        app.config['SQLALCHEMY_BINDS'] = {REPLICA: replica_uri}
+    else:
+        app.config['SQLALCHEMY_BINDS'] = None
+    app.config['HIL_REPLICA_PIN_SECONDS'] = _get('replica_pin_seconds',
+                                                 cfg.getfloat)
+
+
+def have_replica():
+    """Return whether a read replica is configured."""
+    return bool((app.config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA))
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Send the queries made by this thread within a ``with`` block to the
+    read replica, if there is one (and `enabled` is true).
+
+    Writes still go to the primary database, but note that the replica may
+    lag behind it, so only use this for read-only work.
+    """
+    if not enabled or not have_replica():
+        yield
+        return
+    previous = getattr(_local, 'replica_reads', False)
+    _local.replica_reads = True
+    try:
+        yield
+    finally:
+        _local.replica_reads = previous
+
+
+# Connection pool metrics #
+###########################
+
+DB_POOL_SIZE = metrics.REGISTRY.gauge(
+    'hil_db_pool_size',
+    'The configured size of the database connection pool.',
+    ['database'])
+DB_POOL_CONNECTIONS = metrics.REGISTRY.gauge(
+    'hil_db_pool_connections',
+    'Connections in the database connection pool, by state: checked_out '
+    '(in use), idle, or overflow (beyond the pool size).',
+    ['database', 'state'])
+
+
+def _collect_pool_metrics():
+    """Update the connection pool metrics; see `metrics.Registry.expose`."""
+    engines = [('primary', None)]
+    if have_replica():
+        engines.append((REPLICA, REPLICA))
+    for name, bind in engines:
+        pool = db.get_engine(app, bind=bind).pool
+        if not hasattr(pool, 'checkedout'):
+            # Not a queue pool (e.g. SQLite's), so nothing to report.
+            continue
+        DB_POOL_SIZE.set(pool.size(), database=name)
+        DB_POOL_CONNECTIONS.set(pool.checkedout(), database=name,
+                                state='checked_out')
+        DB_POOL_CONNECTIONS.set(pool.checkedin(), database=name,
+                                state='idle')
+        DB_POOL_CONNECTIONS.set(max(pool.overflow(), 0), database=name,
+                                state='overflow')
+
+
+metrics.REGISTRY.add_collector(_collect_pool_metrics)
+
 
 # A joining table for project's access to networks, which have a many to many
 # relationship:
@@ -266,6 +403,11 @@ class SwitchSession(object):
     HIL avoid connecting and disconnecting for each change.
     """
 
+    # Set by users of sessions which only read from the switch (e.g.
+    # `hil.reconciler`); drivers which save the switch's running config
+    # when disconnecting should skip that if this is True.
+    read_only = False
+
     def modify_port(self, port, channel, new_network):
         """Move the specified (port, channel) pair to new_network.
 
@@ -311,10 +453,28 @@ class SwitchSession(object):
 
         With one key for each element in the ``ports`` argument.
 
-        This method is only for use by the test suite.
+        This is used by the test suite, and by `hil.reconciler` to check
+        the switches against the database.
         """
         assert False, "Subclasses MUST override get_port_networks"
 
+    def get_port_state(self, port):
+        """Return the networks currently on a port, as a dictionary mapping
+        channels to network IDs, e.g. ``{"vlan/native": "23", "vlan/52":
+        "52"}``.
+
+        `port` is the name of a port (`Port.label`) on the switch.
+
+        This is optional. If a driver implements it, the networking daemon
+        reads each port's state before changing it, and doesn't send the
+        switch changes which wouldn't do anything (for instance, when
+        retrying an action which failed part way through). Drivers for which
+        reading a port is about as slow as changing it should leave it
+        alone; the default returns None, meaning the state is unknown, and
+        every change is sent to the switch.
+        """
+        return None
+
     def save_running_config(self):
         """saves the running config to startup config"""
         assert False, "Subclasses MUST override save_running_config"
@@ -331,6 +491,49 @@ class SwitchSession(object):
         assert False, "Subclasses MUST override save_running_config"
 
 
+class SwitchHealth(db.Model):
+    """How the networking daemon's recent attempts to use a switch went.
+
+    This is maintained by the networking daemon (see ``hil.deferred``),
+    which stops sending a switch networking actions for a while after
+    several of them fail in a row (i.e. "opens the circuit"), rather than
+    waiting for each to time out. There is only a row for switches which
+    have failed at some point.
+    """
+    id = db.Column(BigIntegerType, primary_key=True)
+
+    switch_id = db.Column(db.ForeignKey('switch.id'), nullable=False,
+                          unique=True)
+    switch = db.relationship('Switch',
+                             backref=db.backref('health',
+                                                uselist=False,
+                                                cascade='all, delete-orphan'))
+
+    # The number of actions on the switch which have failed since the last
+    # one which succeeded:
+    consecutive_failures = db.Column(db.Integer, nullable=False)
+
+    # When the last failure was (UTC), and what went wrong:
+    last_failure = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String, nullable=True)
+
+    # If the circuit is open, when (UTC) to next try the switch; None if
+    # it's closed:
+    open_until = db.Column(db.DateTime, nullable=True)
+
+    def state(self, now):
+        """Return the state of the circuit at `now` (a UTC datetime):
+        'closed' if the switch is in use, 'open' if it isn't, or
+        'half-open' if the next action on it will be tried, to see whether
+        it has recovered.
+        """
+        if self.open_until is None:
+            return 'closed'
+        if self.open_until > now:
+            return 'open'
+        return 'half-open'
+
+
 class Obm(db.Model):
     """Obm superclass supporting various drivers
 
@@ -385,6 +588,16 @@ class Obm(db.Model):
         """
         assert False, "Subclasses MUST override the set_bootdev method "
 
+    def get_power_status(self):
+        """Read the node's current power state from its OBM.
+
+        Returns ``'on'`` or ``'off'``. Raises an ``OBMError`` if the state
+        could not be determined (e.g. because the BMC is unreachable).
+
+        Exact implementation is left to the subclasses.
+        """
+        assert False, "Subclasses MUST override the get_power_status method"
+
     def start_console(self):
         """Starts logging to the console. """
         assert False, "Subclasses MUST override the start_console method"
@@ -397,24 +610,48 @@ class Obm(db.Model):
         """Delete the console log."""
         assert False, "Subclasses MUST override the delete_console method"
 
-    def get_console(self):
-        """Return the contents of the console log."""
+    def get_console(self, since=None, until=None):
+        """Return the contents of the console log.
+
+        If ``since`` and/or ``until`` are given (as seconds since the epoch),
+        only output logged within that time range should be returned.
+
+        Returns None if there is no console log.
+        """
         assert False, "Subclasses MUST override the get_console method"
 
     def get_console_log_filename(self):
-        """Return the name of the file containing the console log."""
+        """Return the name of the file (or directory) containing the console
+        log."""
         assert False, "Subclasses MUST override the get_console_log_filename" \
             "method"
 
 
-def _on_virt_uri(args_list):
-    """Make an argument list to libvirt tools use right URI.
+class PowerStatus(db.Model):
+    """The last known power state of a node.
 
-    This will work for virt-clone and virsh, at least.  It gets the
-    appropriate endpoint URI from the config file.
+    This is a cache of ``Obm.get_power_status``, maintained by the power
+    poller (see ``hil.power_poller``), so that API calls can report power
+    state without querying the BMC.
     """
-    libvirt_endpoint = cfg.get('headnode', 'libvirt_endpoint')
-    return [args_list[0], '--connect', libvirt_endpoint] + args_list[1:]
+    id = db.Column(BigIntegerType, primary_key=True)
+
+    node_id = db.Column(db.ForeignKey('node.id'), nullable=False, unique=True)
+    node = db.relationship('Node',
+                           backref=db.backref('power_status',
+                                              uselist=False,
+                                              cascade='all, delete-orphan'))
+
+    # 'on' or 'off', or None if the state could not be determined:
+    power = db.Column(db.String, nullable=True)
+
+    # Whether the BMC responded the last time it was polled, and if not,
+    # what went wrong:
+    reachable = db.Column(db.Boolean, nullable=False)
+    error = db.Column(db.String, nullable=True)
+
+    # When the node was last polled (UTC):
+    last_checked = db.Column(db.DateTime, nullable=False)
 
 
 class Headnode(db.Model):
@@ -427,10 +664,22 @@ class Headnode(db.Model):
     project = db.relationship(
         "Project", backref=db.backref('headnodes', uselist=True))
 
-    # True iff there are unapplied changes to the Headnode:
+    # True iff there are unapplied changes to the Headnode, i.e. its VM
+    # hasn't been created yet:
     dirty = db.Column(db.Boolean, nullable=False)
     base_img = db.Column(db.String, nullable=False)
 
+    # The outcome of the last call to `start`, which runs in the
+    # background: None if it was never started, otherwise 'PENDING',
+    # 'DONE' or 'ERROR'. If it failed, `job_error` says why:
+    job_status = db.Column(db.String, nullable=True)
+    job_error = db.Column(db.String, nullable=True)
+
+    # Incremented whenever the VM is started or stopped, so that API server
+    # processes can tell when what they have cached about it (e.g. its VNC
+    # port; see `hil.virsh`) is out of date:
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
     # We need a guaranteed unique name to generate the libvirt machine name;
     # The name is therefore a function of a uuid:
     uuid = db.Column(db.String, nullable=False, unique=True)
@@ -442,41 +691,55 @@ class Headnode(db.Model):
         self.dirty = True
         self.uuid = str(uuid.uuid1())
         self.base_img = base_img
+        self.generation = 0
+
+    @property
+    def busy(self):
+        """Whether the headnode is still being created or started."""
+        return self.job_status == 'PENDING'
 
-    @no_dry_run
     def create(self):
         """Creates the vm within libvirt, by cloning the base image.
 
-        The vm is not started at this time.
+        The vm is not started at this time. Cloning happens in the
+        background; see ``hil.virsh``. Once it succeeds, the headnode is
+        no longer dirty. If it fails, the headnode is left dirty, and the
+        error is recorded in `job_error`.
+
+        The caller must have set `job_status` to 'PENDING', and committed
+        that, first. In dry run mode, nothing is cloned, and the headnode is
+        marked as created straight away; the caller must commit that.
         """
-        check_call(_on_virt_uri(['virt-clone',
-                                 '-o', self.base_img,
-                                 '-n', self._vmname(),
-                                 '--auto-clone']))
-        for hnic in self.hnics:
-            hnic.create()
+        if have_dry_run():
+            self.dirty = False
+            return
+        get_virsh().clone(self.base_img,
+                          self._vmname(),
+                          [hnic.bridge() for hnic in self.hnics
+                           if hnic.network],
+                          callback=partial(_headnode_cloned, self.id))
 
     @no_dry_run
     def delete(self):
         """Delete the vm, including associated storage"""
-        # Don't check return value.  If the headnode was powered off, this
-        # will fail, and we don't care.  If it fails for some other reason,
-        # then the following line will also fail, and we'll catch that error.
-        call(_on_virt_uri(['virsh', 'destroy', self._vmname()]))
-        check_call(_on_virt_uri(['virsh',
-                                 'undefine', self._vmname(),
-                                 '--remove-all-storage']))
+        get_virsh().delete(self._vmname())
 
-    @no_dry_run
     def start(self):
         """Powers on the vm, which must have been previously created.
 
         Once the headnode has been started once it is "frozen," and no changes
         may be made to it, other than starting, stopping or deleting it.
+
+        The vm is started in the background, and the outcome recorded in
+        `job_status` and `job_error`. As with `create`, the caller must
+        have set `job_status` to 'PENDING', and committed that, first, and
+        in dry run mode the job is marked as done straight away.
         """
-        check_call(_on_virt_uri(['virsh', 'start', self._vmname()]))
-        check_call(_on_virt_uri(['virsh', 'autostart', self._vmname()]))
-        self.dirty = False
+        if have_dry_run():
+            self.job_status = 'DONE'
+            return
+        get_virsh().start(self._vmname(),
+                          callback=partial(_headnode_started, self.id))
 
     @no_dry_run
     def stop(self):
@@ -484,9 +747,7 @@ class Headnode(db.Model):
 
         This does a hard poweroff; the OS is not given a chance to react.
         """
-        check_call(_on_virt_uri(['virsh', 'destroy', self._vmname()]))
-        check_call(_on_virt_uri(
-            ['virsh', 'autostart', '--disable', self._vmname()]))
+        get_virsh().stop(self._vmname())
 
     def _vmname(self):
         """Returns the name (as recognized by libvirt) of this vm."""
@@ -498,30 +759,63 @@ class Headnode(db.Model):
     # a JSON object.
     @no_dry_run
     def get_vncport(self):
-        """Return the port that VNC is listening on, as an int.
+        """Return the port that VNC is listening on.
 
         If the VM is powered off, the return value may be None -- this is
         dependant on the configuration of libvirt. A powered on VM will always
         have a vnc port.
 
-        If the VM has not been created yet (and is therefore dirty) the return
-        value will be None.
+        If the VM has not been created yet (and is therefore dirty), or is
+        still being created or started, the return value will be None.
         """
-        if self.dirty:
+        if self.dirty or self.busy:
             return None
+        return get_virsh().get_vncport(self._vmname(), self.generation)
 
-        p = Popen(_on_virt_uri(['virsh', 'dumpxml', self._vmname()]),
-                  stdout=PIPE)
-        xmldump, _ = p.communicate()
-        root = xml.etree.ElementTree.fromstring(xmldump)
-        port = root.findall("./devices/graphics")[0].get('port')
-        if port == -1:
-            # No port allocated (yet)
-            return None
-        else:
-            return port
-        # No VNC service found, so no port available
-        return None
+
+def _update_headnode(headnode_id, values, **criteria):
+    """Update the headnode with id `headnode_id` (if it still exists, and
+    matches `criteria`), setting the columns in `values`.
+
+    This is called from the background threads which run headnode jobs, so
+    it uses (and then removes) that thread's own session.
+    """
+    try:
+        Headnode.query.filter_by(id=headnode_id, **criteria).update(values)
+        db.session.commit()
+    finally:
+        db.session.remove()
+
+
+def _job_error(error):
+    """Return the message to record for the headnode job error `error`."""
+    # HeadnodeErrors are HTTP exceptions, whose str() is just the status;
+    # the message is the description:
+    return getattr(error, 'description', None) or str(error)
+
+
+def _headnode_cloned(headnode_id, error):
+    """Record the outcome of `Headnode.create`."""
+    if error is None:
+        _update_headnode(headnode_id, {'dirty': False})
+    else:
+        _update_headnode(headnode_id, {'job_status': 'ERROR',
+                                       'job_error': _job_error(error)})
+
+
+def _headnode_started(headnode_id, error):
+    """Record the outcome of `Headnode.start`.
+
+    If the clone before it failed, that error is kept, rather than being
+    replaced by the less helpful one from trying to start a VM which
+    doesn't exist.
+    """
+    if error is None:
+        values = {'job_status': 'DONE', 'job_error': None}
+    else:
+        values = {'job_status': 'ERROR', 'job_error': _job_error(error)}
+    values['generation'] = Headnode.generation + 1
+    _update_headnode(headnode_id, values, job_status='PENDING')
 
 
 class Hnic(db.Model):
@@ -544,24 +838,15 @@ class Hnic(db.Model):
         self.owner = headnode
         self.label = label
 
-    @no_dry_run
-    def create(self):
-        """Create the hnic within livbirt.
+    def bridge(self):
+        """Return the name of the host bridge for the hnic's network.
 
-        XXX: This is a noop if the Hnic isn't connected to a network. This
-        means that the headnode won't have a corresponding nic, even a
-        disconnected one.
+        XXX: Hnics which aren't connected to a network aren't created within
+        libvirt at all (see `Headnode.create`). This means that the headnode
+        won't have a corresponding nic, even a disconnected one; it is
+        non-trivial to make a NIC not connected to a network.
         """
-        if not self.network:
-            # It is non-trivial to make a NIC not connected to a network, so
-            # do nothing at all instead.
-            return
-        vlan_no = str(self.network.network_id)
-        bridge = 'br-vlan%s' % vlan_no
-        check_call(_on_virt_uri(['virsh',
-                                 'attach-interface', self.owner._vmname(),
-                                 'bridge', bridge,
-                                 '--config']))
+        return 'br-vlan%s' % self.network.network_id
 
 
 class NetworkingAction(db.Model):
@@ -586,9 +871,19 @@ class NetworkingAction(db.Model):
     # networking action.
     uuid = db.Column(db.String, nullable=False, index=True)
 
-    # status of the operation; it can either be 'PENDING', 'DONE' or 'ERROR'
+    # status of the operation; it can either be 'PENDING', 'DONE' or 'ERROR'.
+    # An action which fails is retried (see `hil.deferred`), and stays
+    # 'PENDING' in the meantime; 'ERROR' means that every attempt failed.
     status = db.Column(db.String, nullable=False)
 
+    # The number of times the networking daemon has tried to carry out the
+    # action so far:
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    # If the action has failed, and is to be retried, the earliest time
+    # (UTC) at which to try again. None means as soon as possible.
+    next_attempt = db.Column(db.DateTime, nullable=True)
+
     # The type of action.
     #
     # * 'modify_port' attaches the (nic, channel) pair to a specified network,
@@ -617,6 +912,27 @@ class NetworkingAction(db.Model):
                                                      uselist=True))
 
 
+class NetworkingActionAttempt(db.Model):
+    """A failed attempt at carrying out a `NetworkingAction`.
+
+    These are kept, oldest first, in the action's `failed_attempts`, and
+    deleted along with it.
+    """
+    id = db.Column(BigIntegerType, primary_key=True)
+
+    action_id = db.Column(db.ForeignKey('networking_action.id'),
+                          nullable=False)
+    action = db.relationship('NetworkingAction',
+                             backref=db.backref(
+                                 'failed_attempts',
+                                 order_by='NetworkingActionAttempt.id',
+                                 cascade='all, delete-orphan'))
+
+    # When the attempt was made (UTC), and why it failed:
+    time = db.Column(db.DateTime, nullable=False)
+    error = db.Column(db.String, nullable=False)
+
+
 class NetworkAttachment(db.Model):
     """An attachment of a network to a particular nic on a channel"""
     id = db.Column(BigIntegerType, primary_key=True)
@@ -0,0 +1,103 @@
+"""Polls nodes' OBMs for power state, and caches the results.
+
+Querying a BMC is slow, and BMCs tend to be fragile, so rather than reading
+power state from the OBM on every API call, the power poller (started via
+``hil serve_power_poller``) refreshes a ``PowerStatus`` row per node in the
+background. It visits the nodes with the oldest data first, and limits the
+rate at which it contacts BMCs, adding some random jitter so that polling
+doesn't settle into lock step with anything else talking to them.
+"""
+
+from datetime import datetime, timedelta
+import logging
+import random
+import time
+
+from hil import model
+from hil.model import db
+from hil.errors import OBMError
+
+logger = logging.getLogger(__name__)
+
+
+def refresh(node):
+    """Read the power state of ``node`` from its OBM, and cache it.
+
+    Returns the node's (updated) ``PowerStatus``. If the state can't be
+    read, for whatever reason, the node is recorded as unreachable. The
+    caller is responsible for committing the session.
+    """
+    try:
+        power = node.obm.get_power_status()
+        reachable = True
+        error = None
+    except OBMError as e:
+        logger.info('Could not read power status of node %s: %s',
+                    node.label, e.description)
+        power = None
+        reachable = False
+        error = e.description
+    except Exception as e:  # pylint: disable=broad-except
+        # Most likely a missing or broken ipmitool, or a driver bug. Either
+        # way, it shouldn't stop the other nodes from being polled:
+        logger.exception('Error reading power status of node %s',
+                         node.label)
+        power = None
+        reachable = False
+        error = '%s: %s' % (type(e).__name__, e)
+
+    status = node.power_status
+    if status is None:
+        status = model.PowerStatus(node=node)
+        db.session.add(status)
+    status.power = power
+    status.reachable = reachable
+    status.error = error
+    status.last_checked = datetime.utcnow()
+    return status
+
+
+def stale_nodes(max_age):
+    """Return the nodes whose cached power state is older than ``max_age``.
+
+    ``max_age`` is in seconds. Nodes which have never been polled are
+    included. The result is ordered oldest first, with never-polled nodes
+    at the front.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    last_checked = model.PowerStatus.last_checked
+    return model.Node.query \
+        .outerjoin(model.PowerStatus) \
+        .filter(last_checked.is_(None) | (last_checked < cutoff)) \
+        .order_by(last_checked.isnot(None), last_checked, model.Node.id) \
+        .all()
+
+
+def poll(max_age, rate, jitter=0, sleep=time.sleep):
+    """Refresh the power state of each node whose data is stale.
+
+    ``max_age`` is as for `stale_nodes`. At most ``rate`` nodes are polled
+    per second; each delay between nodes is randomly scaled by up to
+    ``jitter`` (a fraction, e.g. 0.2 for +/- 20%).
+
+    Returns the number of nodes polled. Like
+    ``hil.deferred.apply_networking``, this is meant to be called in a loop;
+    if it returns 0, the caller should sleep before calling it again.
+    """
+    node_ids = [node.id for node in stale_nodes(max_age)]
+    for i, node_id in enumerate(node_ids):
+        if i != 0:
+            sleep(random.uniform(1 - jitter, 1 + jitter) / rate)
+        # The node may have been deleted while we were busy with others:
+        node = model.Node.query.get(node_id)
+        if node is not None:
+            refresh(node)
+        # Commit after each node, so results become visible as soon as
+        # they're available. Note that the transaction which loaded the
+        # node is still open while refresh() waits on its BMC, since the
+        # OBM drivers may load more of the node as they go; committing
+        # here at least means it spans only one BMC call, and not the
+        # sleeps between them.
+        db.session.commit()
+    db.session.commit()
+    return len(node_ids)
@@ -0,0 +1,267 @@
+"""A pre-forking WSGI server, for running the API server in production.
+
+`PreforkServer` binds its listening socket, and then forks a number of
+worker processes, which accept connections on the shared socket and handle
+them, each with up to ``threads`` threads. Anything done before the fork --
+loading extensions, importing the API, checking the database schema -- is
+done once, and shared by all of the workers. The master process does no
+request handling itself; it just keeps the right number of workers running:
+
+* A worker which exits (or crashes) is replaced.
+* If ``max_requests`` is set, each worker exits (and so is replaced) after
+  handling about that many requests. This bounds the damage done by memory
+  leaks and the like. To keep the workers from all restarting at once, each
+  one's limit is randomly increased by up to ``max_requests_jitter``.
+* On ``SIGHUP``, a new set of workers is started, and the old ones are
+  stopped gracefully. Note that the application is *not* reloaded, since it
+  was loaded by the master; restart the server to pick up code or config
+  changes.
+* On ``SIGTERM`` or ``SIGINT``, the workers are stopped gracefully, and the
+  master exits.
+
+Stopping a worker gracefully means letting it finish the requests it is
+handling; a worker which hasn't finished ``graceful_timeout`` seconds later
+is killed.
+"""
+
+import errno
+import logging
+import os
+import random
+import select
+import signal
+import threading
+import time
+
+from werkzeug.serving import BaseWSGIServer
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) the master checks on its workers, and the workers
+# check whether they should stop:
+POLL_INTERVAL = 0.5
+
+
+class _Server(BaseWSGIServer):
+    """The server run by each worker, on the socket shared by all of them.
+
+    The socket is non-blocking, since another worker may accept a
+    connection between us finding out about it and trying to accept it.
+    """
+
+    multiprocess = True
+
+    def __init__(self, host, port, app, threads):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.socket.setblocking(False)
+        self.threads = threads
+        self.multithread = threads > 1
+        self.handled = 0
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def get_request(self):
+        request, client_address = BaseWSGIServer.get_request(self)
+        request.setblocking(True)
+        self.handled += 1
+        return request, client_address
+
+    def process_request(self, request, client_address):
+        if self.threads == 1:
+            BaseWSGIServer.process_request(self, request, client_address)
+            return
+        # Wait for one of our threads to be free:
+        self._slots.acquire()
+        thread = threading.Thread(target=self._process_in_thread,
+                                  args=(request, client_address))
+        thread.start()
+
+    def _process_in_thread(self, request, client_address):
+        """Handle `request` in a new thread; see `process_request`."""
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=broad-except
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+
+class PreforkServer(object):
+    """Serves the WSGI application `app` on `host`:`port`, from `workers`
+    worker processes; see the module docstring.
+
+    `post_fork`, if given, is called (with no arguments) in each worker as
+    soon as it starts, before it takes any requests.
+
+    The listening socket is bound by the constructor, so that any error in
+    doing so is reported straight away; `run` starts the workers.
+    """
+
+    def __init__(self, app, host, port, workers=2, threads=1,
+                 max_requests=0, max_requests_jitter=0, graceful_timeout=30,
+                 post_fork=None):
+        if workers < 1 or threads < 1:
+            raise ValueError('workers and threads must be at least 1.')
+        self.server = _Server(host, port, app, threads)
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.post_fork = post_fork
+
+        self._master_pid = None
+        # Maps the pids of our current workers to None, and of the workers
+        # being stopped to the time at which they should be killed:
+        self._workers = {}
+        self._retiring = {}
+        self._stopping = False
+        self._reloading = False
+
+    @property
+    def address(self):
+        """The ``(host, port)`` the server is listening on."""
+        return self.server.server_address
+
+    # The master #
+    ##############
+
+    def run(self):
+        """Run the master process, until it is told to stop."""
+        self._master_pid = os.getpid()
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        logger.info('Serving on %s:%d with %d workers',
+                    self.address[0], self.address[1], self.workers)
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reloading:
+                    self._reloading = False
+                    logger.info('Replacing all workers')
+                    self._retire(list(self._workers))
+                while len(self._workers) < self.workers:
+                    self._spawn()
+                self._kill_overdue()
+                time.sleep(POLL_INTERVAL)
+        finally:
+            self._retire(list(self._workers))
+            while self._retiring:
+                self._reap()
+                self._kill_overdue()
+                time.sleep(POLL_INTERVAL / 10.0)
+            self.server.server_close()
+            logger.info('Stopped')
+
+    def _handle_stop(self, signum, frame):
+        """Signal handler, stopping the server."""
+        # pylint: disable=unused-argument
+        self._stopping = True
+
+    def _handle_reload(self, signum, frame):
+        """Signal handler, replacing the workers."""
+        # pylint: disable=unused-argument
+        self._reloading = True
+
+    def _spawn(self):
+        """Start a new worker."""
+        pid = os.fork()
+        if pid != 0:
+            self._workers[pid] = None
+            return
+        status = 0
+        try:
+            self._run_worker()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Worker %d failed', os.getpid())
+            status = 1
+        finally:
+            # Don't run any of the master's clean up code:
+            os._exit(status)  # pylint: disable=protected-access
+
+    def _retire(self, pids):
+        """Stop the workers `pids` gracefully."""
+        deadline = time.time() + self.graceful_timeout
+        for pid in pids:
+            self._workers.pop(pid, None)
+            self._retiring[pid] = deadline
+            self._signal(pid, signal.SIGTERM)
+
+    def _kill_overdue(self):
+        """Kill the retiring workers which didn't stop in time."""
+        now = time.time()
+        for pid, deadline in self._retiring.items():
+            if deadline is not None and deadline < now:
+                logger.warning('Worker %d did not stop in time; killing it',
+                               pid)
+                self._signal(pid, signal.SIGKILL)
+                self._retiring[pid] = None
+
+    def _reap(self):
+        """Clean up after any workers which have exited."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if pid in self._workers and status != 0:
+                logger.warning('Worker %d exited unexpectedly (status %d)',
+                               pid, status)
+            self._workers.pop(pid, None)
+            self._retiring.pop(pid, None)
+
+    @staticmethod
+    def _signal(pid, signum):
+        """Send `signum` to `pid`, if it's still running."""
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    # The workers #
+    ###############
+
+    def _run_worker(self):
+        """Handle requests until told to stop, or `max_requests` is reached.
+        """
+        self._stopping = False
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        random.seed()
+        if self.post_fork is not None:
+            self.post_fork()
+
+        limit = self.max_requests
+        if limit and self.max_requests_jitter:
+            limit += random.randint(0, self.max_requests_jitter)
+        sock = self.server.socket
+        while not self._stopping:
+            if limit and self.server.handled >= limit:
+                logger.info('Worker %d restarting after %d requests',
+                            os.getpid(), self.server.handled)
+                break
+            if os.getppid() != self._master_pid:
+                logger.warning('Master process exited; worker %d stopping',
+                               os.getpid())
+                break
+            try:
+                ready = select.select([sock], [], [], POLL_INTERVAL)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if ready:
+                # pylint: disable=protected-access
+                self.server._handle_request_noblock()
+
+        # Let any requests still being handled by other threads finish:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and \
+                    not thread.daemon:
+                thread.join()
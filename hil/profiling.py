@@ -0,0 +1,153 @@
+"""Optional profiling of the database queries made by each API call.
+
+If the ``[profiling]`` section is present in ``hil.cfg``, the API server
+records the number of database queries each request makes, and how long
+they take, by listening to SQLAlchemy's engine events. Requests which take
+longer than ``slow_request_threshold`` seconds are logged, along with their
+query count, time spent in the database, and their slowest statements; the
+log message includes the request's uuid (see `hil.rest.request_info`).
+
+If ``debug_header`` is set, the same numbers are also returned to the
+caller in the ``X-HIL-Profile`` response header.
+
+Profiling is off by default, in which case no event listeners are
+registered, and it costs nothing.
+"""
+
+import heapq
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from hil.config import cfg
+
+DEFAULT_SLOW_REQUEST_THRESHOLD = 1.0
+DEFAULT_SLOWEST_STATEMENTS = 3
+
+# Key in ``Connection.info`` under which we keep the start times of the
+# statements currently executing on the connection:
+_START_KEY = 'hil.profiling.start'
+
+Settings = namedtuple('Settings', [
+    'slow_request_threshold',
+    'slowest_statements',
+    'debug_header',
+])
+
+_settings = None
+_local = threading.local()
+
+
+class Profile(object):
+    """The database activity of one request.
+
+    ``queries`` is the number of statements executed, ``db_time`` the total
+    time (in seconds) spent executing them, and ``slowest`` a list of the
+    (at most `keep`) slowest ``(duration, statement)`` pairs, slowest first.
+    """
+
+    def __init__(self, keep):
+        self.keep = keep
+        self.queries = 0
+        self.db_time = 0.0
+        self._slowest = []
+
+    def record(self, statement, duration):
+        """Record the execution of `statement`, which took `duration`."""
+        self.queries += 1
+        self.db_time += duration
+        if self.keep <= 0:
+            return
+        if len(self._slowest) < self.keep:
+            heapq.heappush(self._slowest, (duration, statement))
+        else:
+            heapq.heappushpop(self._slowest, (duration, statement))
+
+    @property
+    def slowest(self):
+        """The slowest statements, as described above."""
+        return sorted(self._slowest, reverse=True)
+
+
+def get_settings():
+    """Return the profiling `Settings`, or None if profiling is disabled."""
+    return _settings
+
+
+def init():
+    """Set up profiling according to the config."""
+    global _settings
+    if not cfg.has_section('profiling'):
+        _settings = None
+        return
+
+    def _get(name, default, getter=cfg.get):
+        if cfg.has_option('profiling', name):
+            return getter('profiling', name)
+        return default
+
+    _settings = Settings(
+        slow_request_threshold=_get('slow_request_threshold',
+                                    DEFAULT_SLOW_REQUEST_THRESHOLD,
+                                    cfg.getfloat),
+        slowest_statements=_get('slowest_statements',
+                                DEFAULT_SLOWEST_STATEMENTS,
+                                cfg.getint),
+        debug_header=_get('debug_header', False, cfg.getboolean),
+    )
+    if not event.contains(Engine, 'before_cursor_execute', _before_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+
+
+@contextmanager
+def profile():
+    """Profile the queries made by this thread within a ``with`` block.
+
+    Yields a `Profile`, or None if profiling is disabled. Blocks may be
+    nested (as happens with batched API calls), in which case only the
+    outermost one is recorded; the inner ones yield None.
+    """
+    if _settings is None or getattr(_local, 'profile', None) is not None:
+        yield None
+        return
+    _local.profile = Profile(_settings.slowest_statements)
+    try:
+        yield _local.profile
+    finally:
+        _local.profile = None
+
+
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    """Engine event handler, noting when a statement starts."""
+    # pylint: disable=unused-argument,too-many-arguments
+    conn.info.setdefault(_START_KEY, []).append(time.time())
+
+
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    """Engine event handler, recording a statement that finished."""
+    # pylint: disable=unused-argument,too-many-arguments
+    starts = conn.info.get(_START_KEY)
+    if not starts:
+        # The statement started before we were listening.
+        return
+    start = starts.pop()
+    profile = getattr(_local, 'profile', None)
+    if profile is not None:
+        profile.record(statement, time.time() - start)
+
+
+def _handle_error(context):
+    """Engine event handler, forgetting about a statement that failed."""
+    if context.connection is None:
+        return
+    starts = context.connection.info.get(_START_KEY)
+    if starts:
+        starts.pop()
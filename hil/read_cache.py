@@ -0,0 +1,312 @@
+"""Server-side cache for the responses to read-only API calls.
+
+Some API calls (e.g. ``list_nodes``, ``list_networks``) are made often, but
+their results only change when some other API call commits a change to the
+database. If the ``[cache]`` section is present in ``hil.cfg``, the
+responses to such calls are cached, keyed by the call, its arguments and
+the caller's "scope" (see below).
+
+Which calls are cached is declared via the ``cache_tables`` argument to
+`hil.rest.rest_call`, which lists the database tables the response is
+computed from. Each table has a version, which is changed whenever a
+transaction which modified the table is committed (we find out about these
+via SQLAlchemy's session events). A cached response is only used if none of
+its tables' versions have changed since it was computed.
+
+Since the authorization checks are made by the API calls themselves, which
+are skipped when a cached response is used, a response is only shared
+between requests which are sure to be authorized to see the same thing:
+
+* Requests made with administrative access share one scope.
+* Requests without administrative access share another scope, but only for
+  API calls which declare (via ``cache_non_admin``) that such requests all
+  get the same response. Otherwise, they are never cached.
+
+Two backends are available:
+
+* ``memory`` keeps everything in the memory of the API server process.
+  This is only correct if nothing else modifies the database, i.e. the API
+  server is a single process, and the networking daemon is not in use.
+* ``file`` keeps everything in a directory, which is shared by all of the
+  HIL processes on the host (including ``hil serve_networks``) that are
+  configured to use it.
+
+Either way, at most ``max_entries`` responses are kept.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, inspect
+
+from hil.config import cfg
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1024
+
+# Key in ``Session.info`` under which we record the tables touched by the
+# current transaction:
+_TABLES_KEY = 'hil.read_cache.tables'
+
+_cache = None
+
+
+class MemoryBackend(object):
+    """A backend storing entries in this process's memory.
+
+    At most `max_entries` entries are kept; the least recently used are
+    dropped first.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._versions = {}
+        self._entries = OrderedDict()
+
+    def get_versions(self, tables):
+        """Return the current versions of `tables`, as a list."""
+        with self._lock:
+            return [self._versions.get(table, 0) for table in tables]
+
+    def bump(self, tables):
+        """Change the versions of each of `tables`."""
+        with self._lock:
+            for table in tables:
+                self._versions[table] = self._versions.get(table, 0) + 1
+
+    def get(self, key):
+        """Return the ``(versions, body)`` stored under `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+
+    def put(self, key, versions, body):
+        """Store `body`, computed at `versions`, under `key`."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (versions, body)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class FileBackend(object):
+    """A backend storing entries as files in `directory`.
+
+    Each table's version is a random token, stored in its own file. Files
+    are always replaced atomically (by renaming a temporary file into
+    place), so concurrent readers and writers never see partial files.
+
+    Once there are more than `max_entries` entries, the least recently used
+    (going by the files' modification times, which `get` updates) are
+    removed. Since the directory may be shared by several processes, this
+    is approximate.
+    """
+
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, kind, name):
+        return os.path.join(self.directory, '%s-%s' % (kind, name))
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def _write(self, path, data):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def _prune(self):
+        """Remove the least recently used entries, if there are more than
+        ``self.max_entries``.
+        """
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith('entry-')]
+        if len(names) <= self.max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                # Another process has removed it already.
+                pass
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def get_versions(self, tables):
+        """Return the current versions of `tables`, as a list."""
+        return [self._read(self._path('version', table)) or ''
+                for table in tables]
+
+    def bump(self, tables):
+        """Change the versions of each of `tables`."""
+        for table in tables:
+            self._write(self._path('version', table), uuid.uuid4().hex)
+
+    def get(self, key):
+        """Return the ``(versions, body)`` stored under `key`, or None."""
+        path = self._path('entry', _digest(key))
+        data = self._read(path)
+        if data is None:
+            return None
+        stored_key, versions, body = json.loads(data)
+        if stored_key != key:
+            return None
+        try:
+            # Mark the entry as recently used:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return versions, body
+
+    def put(self, key, versions, body):
+        """Store `body`, computed at `versions`, under `key`."""
+        self._write(self._path('entry', _digest(key)),
+                    json.dumps([key, versions, body]))
+        self._prune()
+
+
+def _digest(key):
+    """Return a hash of `key`, suitable for use in a file name."""
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ReadCache(object):
+    """A cache of API responses, stored in `backend`.
+
+    ``stats`` maps the name of each API call to a dictionary with the number
+    of ``hits`` and ``misses`` it has had.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    @staticmethod
+    def key(name, kwargs, scope):
+        """Return the key for API call `name` with `kwargs`, in `scope`."""
+        return json.dumps([name, sorted(kwargs.items()), scope])
+
+    def lookup(self, name, kwargs, scope, tables):
+        """Look up the response to an API call.
+
+        Returns a pair ``(body, versions)``. `body` is the cached response
+        body, or None if there isn't an up to date one. In the latter case,
+        the response should be passed to `store` along with `versions`.
+        """
+        key = self.key(name, kwargs, scope)
+        versions = self.backend.get_versions(tables)
+        entry = self.backend.get(key)
+        hit = entry is not None and list(entry[0]) == list(versions)
+        with self._stats_lock:
+            stats = self.stats.setdefault(name, {'hits': 0, 'misses': 0})
+            if hit:
+                stats['hits'] += 1
+            else:
+                stats['misses'] += 1
+        if hit:
+            return entry[1], versions
+        return None, versions
+
+    def store(self, name, kwargs, scope, versions, body):
+        """Store `body`, as returned by `lookup`, in the cache."""
+        self.backend.put(self.key(name, kwargs, scope), versions, body)
+
+
+def get_cache():
+    """Return the `ReadCache`, or None if caching is disabled."""
+    return _cache
+
+
+def init():
+    """Set up the cache according to the config.
+
+    This also registers the session event listeners which track changes to
+    the database, which is done even if caching is disabled in this process,
+    since another process might share its cache with us.
+    """
+    global _cache
+    # db.session is a scoped_session, which can't be passed to
+    # event.listen() as-is; listen on the class of its sessions instead:
+    target = SignallingSession
+    if not event.contains(target, 'after_flush', _record_flush):
+        event.listen(target, 'after_flush', _record_flush)
+        event.listen(target, 'after_bulk_update', _record_bulk)
+        event.listen(target, 'after_bulk_delete', _record_bulk)
+        event.listen(target, 'after_commit', _after_commit)
+
+    if not cfg.has_section('cache'):
+        _cache = None
+        return
+    backend = 'memory'
+    if cfg.has_option('cache', 'backend'):
+        backend = cfg.get('cache', 'backend')
+    max_entries = DEFAULT_MAX_ENTRIES
+    if cfg.has_option('cache', 'max_entries'):
+        max_entries = cfg.getint('cache', 'max_entries')
+    if backend == 'memory':
+        _cache = ReadCache(MemoryBackend(max_entries))
+    elif backend == 'file':
+        _cache = ReadCache(FileBackend(cfg.get('cache', 'directory'),
+                                       max_entries))
+    else:
+        raise ValueError('Unknown cache backend: %r' % backend)
+    logger.info('Caching API responses using the %s backend', backend)
+
+
+def _touched_tables(session):
+    """Return the set of tables touched by `session`'s transaction."""
+    return session.info.setdefault(_TABLES_KEY, set())
+
+
+def _record_flush(session, flush_context):
+    """Session event handler, recording the tables touched by a flush."""
+    # pylint: disable=unused-argument
+    tables = _touched_tables(session)
+    for objs in session.new, session.dirty, session.deleted:
+        for obj in objs:
+            tables.update(table.name for table in inspect(obj).mapper.tables)
+
+
+def _record_bulk(context):
+    """Session event handler, recording the table touched by a bulk
+    update or delete (e.g. ``Query.delete()``).
+    """
+    _touched_tables(context.session).add(context.primary_table.name)
+
+
+def _after_commit(session):
+    """Session event handler, bumping the versions of the touched tables."""
+    tables = session.info.pop(_TABLES_KEY, None)
+    if tables and _cache is not None:
+        _cache.backend.bump(tables)
@@ -0,0 +1,270 @@
+"""Finds, and optionally fixes, drift between the database and the switches.
+
+HIL records which networks each nic is attached to (``NetworkAttachment``),
+but nothing checks that the switches still agree: a switch may have been
+configured by hand, or a networking action may have failed part way. The
+reconciler (run via ``hil-admin reconcile``) compares the two:
+
+* Each switch's VLAN state is read in bulk, with one switch session per
+  switch, using the driver's ``get_port_networks``. Several switches are
+  read at once (up to ``workers``), and at most ``rate`` switches are
+  started per second, so as not to swamp them.
+* The result is compared with the database, with one query per switch.
+  This happens *after* the switch has been read, so that a networking
+  action which completes in between makes the database look newer than the
+  switch, rather than the reverse; see `enqueue_fixes`. Nics with pending
+  networking actions are skipped, since they are about to change anyway.
+* Any differences are reported, and, if asked, corrective networking
+  actions are queued for the networking daemon to carry out.
+
+Only ports which are connected to nics are checked, since HIL manages
+networks through nics.
+"""
+
+from collections import namedtuple
+import logging
+import threading
+import time
+import uuid
+
+from hil import deadline, model
+from hil.model import db
+
+logger = logging.getLogger(__name__)
+
+
+class Drift(namedtuple('Drift', ['switch', 'port', 'node', 'nic', 'channel',
+                                 'expected', 'actual'])):
+    """A (port, channel) pair whose network differs between the database and
+    the switch.
+
+    `switch`, `port`, `node` and `nic` are labels. `expected` is the
+    network ID the database has on `channel`, and `actual` the one the
+    switch has; either may be None.
+    """
+
+    def __str__(self):
+        return '%s %s (%s/%s) %s: database has %s, switch has %s' % (
+            self.switch, self.port, self.node, self.nic, self.channel,
+            self.expected, self.actual)
+
+
+class Report(object):
+    """The results of `reconcile`.
+
+    Attributes:
+
+    * drift - a list of `Drift`s, for all of the switches
+    * errors - a dict mapping the labels of switches which couldn't be read
+      to the error
+    * queued - the number of corrective networking actions queued
+    """
+
+    def __init__(self):
+        self.drift = []
+        self.errors = {}
+        self.queued = 0
+
+
+def _normalize(networks):
+    """Return the set of ``(channel, network ID)`` pairs in `networks`.
+
+    Network IDs are converted to strings, since some drivers report them as
+    integers.
+    """
+    return set((channel, str(net)) for channel, net in networks
+               if net is not None)
+
+
+def snapshot(switch, ports):
+    """Read the networks on `ports` (a list of `Port`s of `switch`).
+
+    Returns a dict mapping each port's label to a set of ``(channel,
+    network ID)`` pairs. Ports the driver couldn't read are left out.
+
+    This must finish within the ``switch_operation`` time limit (see
+    `hil.deadline`).
+    """
+    with deadline.budget('switch'):
+        session = switch.session()
+        # We don't change anything, so there's nothing to save:
+        session.read_only = True
+        try:
+            networks = session.get_port_networks(ports)
+        finally:
+            session.disconnect()
+    return dict((port.label, _normalize(networks[port]))
+                for port in ports if port in networks)
+
+
+def diff(switch, actual):
+    """Compare `actual` (the result of `snapshot`) to the database.
+
+    Returns a list of ``(drift, nic_id, network)`` triples: a `Drift`, the
+    id of the nic concerned, and the id of the network the database has on
+    the channel (or None).
+    """
+    pending = (model.NetworkingAction.nic_id == model.Nic.id) & \
+        (model.NetworkingAction.status == 'PENDING')
+    rows = db.session.query(model.Port.label,
+                            model.Node.label,
+                            model.Nic.label,
+                            model.Nic.id,
+                            model.NetworkAttachment.channel,
+                            model.Network.id,
+                            model.Network.network_id,
+                            model.NetworkingAction.id) \
+        .select_from(model.Port) \
+        .join(model.Nic, model.Nic.port_id == model.Port.id) \
+        .join(model.Node, model.Nic.owner_id == model.Node.id) \
+        .outerjoin(model.NetworkAttachment,
+                   model.NetworkAttachment.nic_id == model.Nic.id) \
+        .outerjoin(model.Network,
+                   model.Network.id == model.NetworkAttachment.network_id) \
+        .outerjoin(model.NetworkingAction, pending) \
+        .filter(model.Port.owner_id == switch.id) \
+        .all()
+
+    # Maps port labels to (node, nic, nic id), and to the networks the
+    # database has on them, as {channel: (network ID, Network.id)}:
+    nics = {}
+    expected = {}
+    for port, node, nic, nic_id, channel, net, network_id, action in rows:
+        if action is not None or port not in actual:
+            continue
+        nics[port] = (node, nic, nic_id)
+        expected.setdefault(port, {})
+        if channel is not None:
+            expected[port][channel] = (network_id, net)
+
+    result = []
+    for port in sorted(nics):
+        node, nic, nic_id = nics[port]
+        on_switch = dict(actual[port])
+        # Some switches list the native VLAN among the tagged ones, which
+        # HIL does not; ignore that, unless the VLAN is meant to be tagged:
+        native = on_switch.get('vlan/native')
+        if native is not None and 'vlan/' + native not in expected[port]:
+            on_switch.pop('vlan/' + native, None)
+        channels = set(expected[port]) | set(on_switch)
+        for channel in sorted(channels):
+            network_id, net = expected[port].get(channel, (None, None))
+            if network_id != on_switch.get(channel):
+                result.append((Drift(switch.label, port, node, nic, channel,
+                                     network_id, on_switch.get(channel)),
+                               nic_id, net))
+    return result
+
+
+def enqueue_fixes(drift):
+    """Queue networking actions to make the switches match the database.
+
+    `drift` is a list of triples, as returned by `diff`. Each nic may only
+    have one networking action at a time, so only the first difference for
+    each nic is dealt with; any others will be found again next time.
+
+    A channel which the database says should be on a network is moved to
+    that network; the attachment is left as it is, and the networking
+    daemon updates it (if need be) when the action succeeds. A channel
+    which should not be on any network is detached.
+
+    Returns the number of actions queued. The caller is responsible for
+    committing the session.
+    """
+    queued = 0
+    seen = set()
+    for item, nic_id, network in drift:
+        if nic_id in seen:
+            continue
+        seen.add(nic_id)
+        nic = model.Nic.query.get(nic_id)
+        if nic is None:
+            continue
+        if nic.current_action is not None:
+            if nic.current_action.status == 'PENDING':
+                continue
+            db.session.delete(nic.current_action)
+            db.session.flush()
+        new_network = None
+        if network is not None:
+            new_network = model.Network.query.get(network)
+        db.session.add(model.NetworkingAction(type='modify_port',
+                                              nic=nic,
+                                              new_network=new_network,
+                                              channel=item.channel,
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+        logger.info('Queued a networking action to fix: %s', item)
+        queued += 1
+    return queued
+
+
+def reconcile(switches=None, fix=False, workers=4, rate=0,
+              sleep=time.sleep):
+    """Check the switches labelled `switches` (by default, all of them).
+
+    Up to `workers` switches are read at once; if `rate` is non-zero, at
+    most `rate` switches are started per second. If `fix` is true,
+    corrective networking actions are queued (see `enqueue_fixes`) and
+    committed.
+
+    This commits the database session, and removes everything from it
+    first, so objects loaded beforehand must not be used afterwards.
+
+    Returns a `Report`.
+    """
+    query = model.Switch.query.with_polymorphic('*') \
+        .order_by(model.Switch.label)
+    if switches is not None:
+        query = query.filter(model.Switch.label.in_(switches))
+    targets = []
+    for switch in query:
+        ports = model.Port.query \
+            .join(model.Nic, model.Nic.port_id == model.Port.id) \
+            .filter(model.Port.owner_id == switch.id) \
+            .order_by(model.Port.label) \
+            .all()
+        targets.append((switch, ports))
+    # The switches are read from other threads, which must not use our
+    # database session; detach the objects they need (which are already
+    # loaded), and don't hold a transaction open while they work:
+    db.session.expunge_all()
+    db.session.commit()
+
+    report = Report()
+    snapshots = {}
+    slots = threading.BoundedSemaphore(workers)
+
+    def read(switch, ports):
+        """Read `switch`'s state into `snapshots` (or `report.errors`)."""
+        try:
+            snapshots[switch.label] = snapshot(switch, ports)
+        except Exception as e:  # pylint: disable=broad-except
+            logger.exception('Could not read the state of switch %s',
+                             switch.label)
+            report.errors[switch.label] = e
+        finally:
+            slots.release()
+
+    threads = []
+    for i, (switch, ports) in enumerate(targets):
+        if i != 0 and rate:
+            sleep(1.0 / rate)
+        slots.acquire()
+        thread = threading.Thread(target=read, args=(switch, ports))
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for switch, _ in targets:
+        if switch.label not in snapshots:
+            continue
+        drift = diff(switch, snapshots[switch.label])
+        for item, _, _ in drift:
+            logger.warning('Drift: %s', item)
+        report.drift.extend(item for item, _, _ in drift)
+        if fix:
+            report.queued += enqueue_fixes(drift)
+        db.session.commit()
+    return report
@@ -8,18 +8,26 @@ The main things of interest in this module are:
 """
 import logging
 import json
+import hashlib
+import math
+import time
+import zlib
+from contextlib import contextmanager
 
 import flask
 from flask import _app_ctx_stack as ctx_stack
 
 from hil.flaskapp import app
-from hil.errors import APIError, AuthorizationError
+from hil.errors import APIError, AuthorizationError, BadArgumentError, \
+    ServerError
 from hil.config import cfg
+from hil.model import db
 
 from schema import SchemaError
 from uuid import uuid4
+from werkzeug.exceptions import HTTPException
 
-from hil import auth
+from hil import auth, metrics, model, profiling, read_cache
 
 local = flask.g
 
@@ -84,12 +92,39 @@ class ContextLogger(logging.LoggerAdapter):
 
 logger = ContextLogger(logging.getLogger(__name__), {})
 
+API_REQUESTS = metrics.REGISTRY.counter(
+    'hil_api_requests_total',
+    'API calls handled, by call, HTTP method and status code.',
+    ['call', 'method', 'status'])
+API_LATENCY = metrics.REGISTRY.histogram(
+    'hil_api_request_duration_seconds',
+    'Time taken to handle API calls, by call and HTTP method.',
+    ['call', 'method'])
+API_DB_QUERIES = metrics.REGISTRY.histogram(
+    'hil_api_db_queries',
+    'Database queries made per API call, by call.',
+    ['call'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+# The cookie used to keep clients on the primary database after they make
+# changes; see `_pin_to_primary`:
+PIN_COOKIE = 'hil_primary_until'
+
+# Streamed responses (see `JSONStream`) are sent in chunks of about this
+# many bytes, and the queries behind them fetch this many rows at a time:
+STREAM_CHUNK_SIZE = 8192
+STREAM_BATCH_SIZE = 1000
+
+# Responses smaller than this many bytes aren't worth compressing:
+COMPRESS_MIN_SIZE = 1024
+
 
 class ValidationError(APIError):
     """An exception indicating that the body of the request was invalid."""
 
 
-def rest_call(methods, path, schema, dont_log=()):
+def rest_call(methods, path, schema, dont_log=(), cache_tables=(),
+              cache_non_admin=False, read_only=False):
     """A decorator which registers an http mapping to a python api call.
 
     `rest_call` makes no modifications to the function itself, though the
@@ -122,6 +157,22 @@ def rest_call(methods, path, schema, dont_log=()):
             perform type validation and conversion.
     * dont_log (optional): a list of "sensitive" argument names, which should
             not be logged.
+    * cache_tables (optional): for GET calls, a list of the names of the
+            database tables the response is computed from. If supplied, and
+            caching is enabled, responses are cached as described in
+            `hil.read_cache`. The response must depend only on the
+            arguments, those tables and whether the caller has
+            administrative access.
+    * cache_non_admin (optional): If True, requests without administrative
+            access may also be answered from the cache; the call must return
+            the same response for all such requests. Otherwise, only
+            requests with administrative access are.
+    * read_only (optional): If True, the call never changes anything, so
+            (for GET requests) its queries may be sent to the read replica,
+            if there is one; see `hil.model.replica_reads`. A client which
+            has recently made a call that isn't read-only is still sent to
+            the primary database, for ``replica_pin_seconds`` (see
+            ``examples/hil.cfg``), so it sees its own changes.
 
     For example, given::
 
@@ -162,6 +213,16 @@ def rest_call(methods, path, schema, dont_log=()):
           the status code will be 200.
         * A tuple, whose first element is a string (the response body), and
           whose second is an integer (the status code).
+        * A flask ``Response`` object, e.g. for streaming responses.
+        * A `JSONStream`, for large JSON results, which is encoded and
+          sent incrementally (with status code 200).
+
+    Successful responses to GET requests carry an ``ETag`` header, derived
+    from the body (except for streamed responses). If the request's
+    ``If-None-Match`` header matches it, the body is omitted and the status
+    code is 304 (Not Modified). If the client accepts it (per its
+    ``Accept-Encoding`` header), the body of a successful GET response is
+    gzipped.
     """
     def register(f):
         """Return value from rest call; this decorates the function itself."""
@@ -173,10 +234,14 @@ def rest_call(methods, path, schema, dont_log=()):
             meths = methods
         else:
             meths = [methods]
+        if read_only and set(meths) - {'GET', 'HEAD'}:
+            raise ValueError('Only GET calls may be read-only, but %s is %s' %
+                             (f.__name__, ', '.join(meths)))
 
         app.add_url_rule(path,
                          f.__name__,
-                         _rest_wrapper(f, schema, dont_log),
+                         _rest_wrapper(f, schema, dont_log, cache_tables,
+                                       cache_non_admin, read_only),
                          methods=meths)
         return f
     return register
@@ -245,7 +310,8 @@ def _do_validation(schema, kwargs):
         raise validation_error
 
 
-def _rest_wrapper(f, schema, dont_log):
+def _rest_wrapper(f, schema, dont_log, cache_tables=(),
+                  cache_non_admin=False, read_only=False):
     """Return a wrapper around `f` that does the following:
 
     * Validate the current request against the schema.
@@ -254,29 +320,467 @@ def _rest_wrapper(f, schema, dont_log):
       `rest_call`.
     * Log arguments, except those in `dont_log`.
     * Convert `None` return values to empty bodies.
+    * Add ETags to GET responses, as described in the documentation to
+      `rest_call`.
+    * Use the read cache, if `cache_tables` is non-empty.
+    * Record metrics about the call (see `hil.metrics`).
+    * Profile the call's database queries, if enabled (see `hil.profiling`).
+    * Send the queries made by read-only calls to the read replica, if there
+      is one, or else pin the client to the primary database after other
+      calls (see `rest_call`).
+    * Stream `JSONStream` return values, and gzip GET responses for clients
+      which accept it, unless `f` returned a ``flask.Response`` of its own.
 
     The result of this is suitable to hand directly to flask.
     """
 
     def wrapper(**kwargs):
         """The wrapper described above."""
+        method = flask.request.method
+        start = time.time()
+        status = 500
+        profile = None
+        try:
+            with metrics.count_queries() as queries, \
+                    profiling.profile() as profile:
+                ret = call(**kwargs)
+            status = _status_code(ret)
+            if profile is not None and \
+                    profiling.get_settings().debug_header:
+                ret = flask.make_response(ret)
+                ret.headers['X-HIL-Profile'] = \
+                    _profile_header(profile, time.time() - start)
+            return ret
+        except HTTPException as e:
+            # Our own APIErrors keep their status code in `status_code`:
+            status = getattr(e, 'status_code', None) or e.code
+            raise
+        finally:
+            elapsed = time.time() - start
+            API_REQUESTS.inc(call=f.__name__, method=method, status=status)
+            API_LATENCY.observe(elapsed, call=f.__name__, method=method)
+            API_DB_QUERIES.observe(queries.count, call=f.__name__)
+            if profile is not None:
+                _log_if_slow(f.__name__, status, elapsed, profile)
+
+    def call(**kwargs):
+        """Do everything but recording metrics."""
         kwargs = _do_validation(schema, kwargs)
 
         censored_kwargs = kwargs.copy()
         for argname in dont_log:
             censored_kwargs[argname] = '<<CENSORED>>'
 
-        init_auth()
-        logger.info('API call: %s(%s)',
-                    f.__name__, _format_arglist(**censored_kwargs))
-
-        ret = f(**kwargs)
+        # Read-only calls may be served from the read replica, if there is
+        # one -- but not within a batch, whose earlier calls may have made
+        # changes the replica doesn't know about yet:
+        batch = getattr(local, 'batch', False)
+        use_replica = read_only and not batch and not _pinned_to_primary()
+        if flask.request.method not in ('GET', 'HEAD'):
+            _pin_to_primary()
+        with model.replica_reads(use_replica):
+            # Calls made as part of a batch (see `run_batch`) were already
+            # authenticated along with the batch itself:
+            if not batch:
+                init_auth()
+            logger.info('API call: %s(%s)',
+                        f.__name__, _format_arglist(**censored_kwargs))
+
+            ret = _call_cached(f, kwargs, cache_tables, cache_non_admin,
+                               use_replica)
+        # Calls which build their own response (e.g. a stream of server-sent
+        # events, which mustn't be held up in a compressor's buffer) are
+        # sent as they are:
+        compress = not batch and not isinstance(ret, flask.Response)
         if ret is None:
             ret = ''
+        elif isinstance(ret, JSONStream):
+            if batch:
+                ret = ret.read()
+            else:
+                ret = _stream(ret, use_replica)
+        if flask.request.method in ('GET', 'HEAD'):
+            ret = _make_conditional(ret)
+            if compress:
+                ret = _compress(ret)
         return ret
     return wrapper
 
 
+def _pinned_to_primary():
+    """Return whether the current request should use the primary database
+    (rather than the read replica) because of the client's recent changes.
+
+    See `_pin_to_primary`.
+    """
+    try:
+        until = float(flask.request.cookies.get(PIN_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def _pin_to_primary():
+    """Keep the client making the current request on the primary database
+    for a while, if it succeeds.
+
+    This is done with a cookie, which records how long the client should be
+    kept there; clients which don't keep cookies just don't get the benefit.
+    """
+    seconds = app.config.get('HIL_REPLICA_PIN_SECONDS')
+    if not seconds or not model.have_replica():
+        return
+
+    def set_cookie(response):
+        """Set the cookie, if the request succeeded."""
+        if response.status_code < 400:
+            response.set_cookie(PIN_COOKIE, '%.3f' % (time.time() + seconds),
+                                max_age=int(math.ceil(seconds)))
+        return response
+    flask.after_this_request(set_cookie)
+
+
+def _profile_header(profile, elapsed):
+    """Return the value of the ``X-HIL-Profile`` header (see
+    `hil.profiling`) for a request with `profile`, which took `elapsed`.
+    """
+    return 'request_id=%s; time=%.6f; queries=%d; db_time=%.6f' % (
+        request_info.uuid, elapsed, profile.queries, profile.db_time)
+
+
+def _log_if_slow(name, status, elapsed, profile):
+    """Log the API call `name` if it was slow; see `hil.profiling`."""
+    if elapsed < profiling.get_settings().slow_request_threshold:
+        return
+    slowest = ''.join('\n    %.6fs: %s' % (duration, ' '.join(stmt.split()))
+                      for duration, stmt in profile.slowest)
+    logger.warning('Slow API call: %s took %.6fs (status %s); '
+                   '%d queries took %.6fs. Slowest statements:%s',
+                   name, elapsed, status, profile.queries, profile.db_time,
+                   slowest)
+
+
+def _status_code(ret):
+    """Return the status code of `ret`, a return value of `wrapper` in
+    `_rest_wrapper`.
+    """
+    if isinstance(ret, flask.Response):
+        return ret.status_code
+    if isinstance(ret, tuple):
+        return ret[1]
+    return 200
+
+
+def _call_cached(f, kwargs, cache_tables, cache_non_admin, use_replica):
+    """Call ``f(**kwargs)``, using the read cache if possible.
+
+    See the documentation for `rest_call` and `hil.read_cache`. If
+    `use_replica` is true (and there is a replica), the response is not
+    stored, since the replica may not have caught up with the versions of
+    the tables we'd store it under. It may still be served from the cache,
+    which is never further behind the primary database than the replica.
+    """
+    cache = read_cache.get_cache()
+    if not cache_tables or cache is None or \
+            flask.request.method not in ('GET', 'HEAD') or \
+            getattr(local, 'batch', None) == 'atomic':
+        # Note that in atomic batches, changes made earlier in the batch
+        # haven't been committed yet, so the cache doesn't know about them.
+        return f(**kwargs)
+    if auth.get_auth_backend().have_admin():
+        scope = 'admin'
+    elif cache_non_admin:
+        scope = 'non-admin'
+    else:
+        return f(**kwargs)
+    body, versions = cache.lookup(f.__name__, kwargs, scope, cache_tables)
+    if body is not None:
+        return body
+    ret = f(**kwargs)
+    if isinstance(ret, JSONStream):
+        ret = ret.read()
+    if isinstance(ret, basestring) and \
+            not (use_replica and model.have_replica()):
+        cache.store(f.__name__, kwargs, scope, versions, ret)
+    return ret
+
+
+def _make_conditional(ret):
+    """Convert `ret` into a response with an ETag.
+
+    `ret` should be the (non-None) return value of an API call. Responses
+    with status codes other than 200, and streamed responses, are passed
+    through unchanged. If the ETag matches the request's ``If-None-Match``
+    header, the response is turned into a 304 (Not Modified).
+    """
+    response = flask.make_response(ret)
+    if response.status_code != 200 or response.is_streamed:
+        return response
+    response.set_etag(hashlib.sha1(response.get_data()).hexdigest())
+    return response.make_conditional(flask.request)
+
+
+def _compress(response):
+    """Gzip the body of `response`, if the client accepts that.
+
+    Only successful responses are compressed, and then only if they are
+    streamed or at least `COMPRESS_MIN_SIZE` bytes long. Streamed responses
+    are compressed a chunk at a time, as they are sent; see `_gzip_chunks`.
+    """
+    response.vary.add('Accept-Encoding')
+    if response.status_code != 200 or \
+            'Content-Encoding' in response.headers or \
+            not flask.request.accept_encodings['gzip']:
+        return response
+    if response.is_streamed:
+        response.response = _gzip_chunks(response.response)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(''.join(_gzip_chunks([data])))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+def _gzip_chunks(chunks):
+    """Gzip the strings `chunks`, yielding the compressed data as it's
+    produced.
+
+    The compressor is flushed after each chunk, so that the client can
+    decompress everything it has been sent so far, rather than having to
+    wait for data held back in the compressor's buffer.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + \
+            compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+class StreamedObject(object):
+    """A JSON object whose members are produced as it is encoded.
+
+    `items` is an iterable of ``(key, value)`` pairs, without duplicate
+    keys, which are encoded in the order given -- normally the order of key,
+    as from a query with an ``ORDER BY``. It is only iterated over once.
+    Used as part of a `JSONStream`.
+    """
+
+    def __init__(self, items):
+        self.items = items
+
+
+class JSONStream(object):
+    """A JSON document which is encoded as it is sent to the client.
+
+    API calls whose results may be large can return one of these, rather
+    than a string, to avoid building the whole result in memory before
+    sending any of it. `value` may be anything ``json.dumps`` accepts, and
+    may also contain `StreamedObject`s, which typically wrap a generator
+    reading from a query. The output is exactly that of ``json.dumps(value,
+    sort_keys=True)``, with the `StreamedObject`s treated as dicts (if
+    their items are sorted).
+
+    The API call returning this must check the caller's authorization before
+    it does so, since by the time the stream is encoded, the response's
+    status has already been sent. Streamed responses don't get ETags; if the
+    call uses the read cache, and the cache is enabled, the result is
+    encoded up front and cached (and gets an ETag) as usual. Within a
+    batch, the result is likewise encoded up front.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __iter__(self):
+        """Yield the encoded document, in chunks of about
+        `STREAM_CHUNK_SIZE` bytes.
+        """
+        chunk = []
+        size = 0
+        for piece in _iterencode(self.value):
+            chunk.append(piece)
+            size += len(piece)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk)
+
+    def read(self):
+        """Return the whole encoded document, as a string."""
+        return ''.join(self)
+
+
+def _iterencode(value):
+    """Yield the JSON encoding of `value` in pieces; see `JSONStream`."""
+    if isinstance(value, (dict, StreamedObject)):
+        if isinstance(value, dict):
+            items = sorted(value.items())
+        else:
+            items = value.items
+        yield '{'
+        separator = ''
+        for key, item in items:
+            yield separator + json.dumps(key) + ': '
+            for piece in _iterencode(item):
+                yield piece
+            separator = ', '
+        yield '}'
+    elif isinstance(value, (list, tuple)):
+        yield '['
+        separator = ''
+        for item in value:
+            yield separator
+            for piece in _iterencode(item):
+                yield piece
+            separator = ', '
+        yield ']'
+    else:
+        yield json.dumps(value)
+
+
+def _stream(body, use_replica):
+    """Return a response streaming the `JSONStream` `body`.
+
+    The queries made while encoding it go to the read replica if
+    `use_replica` is true, as with the rest of the API call.
+    """
+    def generate():
+        """Encode `body`, with the same database as the API call."""
+        with model.replica_reads(use_replica):
+            for chunk in body:
+                yield chunk
+    return flask.Response(flask.stream_with_context(generate()))
+
+
+def run_batch(requests, atomic=False):
+    """Run each of `requests` as an API call, and return the responses.
+
+    This must be called from within an (authenticated) API call. Each
+    request should be a dictionary with the keys:
+
+    * ``method`` - the HTTP method, e.g. ``'GET'``
+    * ``path`` - the path of the API call, e.g. ``'/node/node-23'``
+    * ``body`` (optional) - the body of the request, as a (decoded) JSON
+      object
+    * ``params`` (optional) - a dictionary of query parameters
+
+    The requests are handled as if they had been made separately, with the
+    same headers as the current request, except that they are not
+    authenticated again.
+
+    If `atomic` is False, each request commits its own changes (if any), and
+    all of the requests are run regardless of whether earlier ones fail.
+
+    If `atomic` is True, the changes made by all of the requests are
+    committed together at the end. If any request fails, the changes made
+    by all of them are rolled back, and the remaining requests are not run.
+
+    Returns a pair ``(responses, committed)``, where `responses` is a list
+    of ``{"status": <status code>, "body": <response body>}`` dictionaries,
+    and `committed` is False iff the changes were rolled back.
+    """
+    responses = []
+    local.batch = 'atomic' if atomic else 'independent'
+    try:
+        with _defer_commits(atomic):
+            for req in requests:
+                status, body = _run_batched_request(req)
+                responses.append({'status': status, 'body': body})
+                if not 200 <= status < 300:
+                    # Don't let anything the failed call left in the
+                    # session be committed by a later call:
+                    db.session.rollback()
+                    if atomic:
+                        return responses, False
+        if atomic:
+            db.session.commit()
+        return responses, True
+    finally:
+        local.batch = False
+
+
+def _run_batched_request(req):
+    """Run a single request on behalf of `run_batch`.
+
+    Returns a pair ``(status_code, body)``. Any cookies the request sets
+    (e.g. to pin the client to the primary database) are set on the
+    response to the batch as a whole.
+    """
+    if req['path'].rstrip('/') == flask.request.path.rstrip('/'):
+        err = BadArgumentError('Batches may not be nested.')
+        return err.status_code, err.get_response().get_data()
+
+    # Reuse the environment of the batch (headers etc.), except for things
+    # specific to the batch request itself:
+    environ_base = {}
+    for key, value in flask.request.environ.iteritems():
+        if not key.startswith(('wsgi.', 'werkzeug.', 'HTTP_IF_')):
+            environ_base[key] = value
+
+    data = None
+    if 'body' in req:
+        data = json.dumps(req['body'])
+    with app.test_request_context(req['path'],
+                                  method=req['method'],
+                                  data=data,
+                                  query_string=req.get('params'),
+                                  environ_base=environ_base):
+        try:
+            # This runs the request's before/after hooks, including any it
+            # registers with after_this_request:
+            response = app.full_dispatch_request()
+        except Exception:  # pylint: disable=broad-except
+            # Flask would turn this into a 500 for a request of its own;
+            # don't let it take the rest of the batch down with it:
+            logger.exception('Batched API call %s %s failed',
+                             req['method'], req['path'])
+            err = ServerError()
+            return err.code, err.get_response().get_data()
+        # (Error responses built from exceptions count as streamed, too.)
+        if response.is_streamed and response.status_code < 400:
+            err = BadArgumentError('Streaming API calls may not be batched.')
+            return err.status_code, err.get_response().get_data()
+    cookies = response.headers.getlist('Set-Cookie')
+    if cookies:
+        flask.after_this_request(lambda batch_response:
+                                 _add_cookies(batch_response, cookies))
+    return response.status_code, response.get_data()
+
+
+def _add_cookies(response, cookies):
+    """Add the ``Set-Cookie`` header values `cookies` to `response`, in place
+    of any it already sets for the same cookies. Returns `response`.
+    """
+    names = set(cookie.split('=', 1)[0] for cookie in cookies)
+    kept = [cookie for cookie in response.headers.getlist('Set-Cookie')
+            if cookie.split('=', 1)[0] not in names]
+    del response.headers['Set-Cookie']
+    for cookie in kept + cookies:
+        response.headers.add('Set-Cookie', cookie)
+    return response
+
+
+@contextmanager
+def _defer_commits(defer):
+    """Within the block, turn commits into flushes if `defer` is True.
+
+    This only affects this thread's session.
+    """
+    if not defer:
+        yield
+        return
+    session = db.session()
+    session.commit = session.flush
+    try:
+        yield
+    finally:
+        del session.commit
+
+
 def _format_arglist(*args, **kwargs):
     """Format the argument list in a human readable way.
 
@@ -5,7 +5,7 @@ import sys
 # use it directly from this module.
 from hil import api  # pylint: disable=unused-import
 
-from hil import model, auth
+from hil import model, auth, metrics, profiling, read_cache
 from hil.class_resolver import build_class_map_for
 from hil.network_allocator import get_network_allocator
 
@@ -61,3 +61,6 @@ def init():
     register_drivers()
     validate_state()
     model.init_db()
+    read_cache.init()
+    metrics.init()
+    profiling.init()
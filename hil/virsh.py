@@ -0,0 +1,347 @@
+"""Libvirt backend for headnodes.
+
+Rather than forking a new ``virsh`` for every operation, we keep a single,
+long-lived ``virsh`` shell per process (see `VirshShell`), and send it
+commands as needed.
+
+Cloning a headnode's disk image can take minutes, so `Virsh.clone` and
+`Virsh.start` don't wait for the operation to finish; they are queued as
+jobs and run on a small pool of background threads. Jobs for the same VM
+always run in the order they were submitted, so e.g. a ``stop`` issued
+while a ``start`` is still pending will run after it. The caller may pass a
+callback, which is called (in the background thread) with the job's
+exception, or None, once it finishes; this is how `model.Headnode` records
+the outcome in the database. `Virsh.stop` and `Virsh.delete` are queued the
+same way, but wait for their job to finish before returning, so errors are
+still reported to the caller.
+
+The background threads exit once there are no more jobs, and aren't daemon
+threads, so a process which is shutting down (e.g. an API server worker
+being replaced) waits for its jobs rather than killing ``virt-clone`` part
+way through.
+
+Note that the job queue is per-process. If the API server runs in multiple
+processes, it is the API calls which keep operations on the same headnode
+from overlapping: they lock the headnode's row while they start, stop or
+delete it, and refuse to stop or delete it while its jobs are still
+running (see ``model.Headnode.busy``).
+
+`Virsh` also caches each VM's VNC port, which ``show_headnode`` would
+otherwise have to look up (via ``virsh dumpxml``) on every call. Since other
+processes may start or stop the VM, the cache is keyed by the headnode's
+``generation``, which is stored in the database, and incremented whenever
+the VM is started or stopped.
+"""
+
+import logging
+import re
+import threading
+import xml.etree.ElementTree
+from Queue import Queue, Empty
+from subprocess import check_call, CalledProcessError
+
+import pexpect
+
+from hil.config import cfg
+from hil.errors import BadArgumentError, HeadnodeError
+
+logger = logging.getLogger(__name__)
+
+# The prompt printed by ``virsh`` in interactive mode:
+PROMPT = 'virsh # '
+
+DEFAULT_WORKERS = 4
+
+# Timeout (in seconds) for a single virsh command:
+DEFAULT_TIMEOUT = 60
+
+_SAFE_ARG_RE = re.compile(r'^[\w./:=-]+$')
+
+
+def _quote(arg):
+    """Quote ``arg`` for use as an argument in a virsh shell command."""
+    if _SAFE_ARG_RE.match(arg):
+        return arg
+    if "'" in arg:
+        raise BadArgumentError('Invalid virsh argument: %r' % arg)
+    return "'%s'" % arg
+
+
+class VirshShell(object):
+    """A long-lived, interactive virsh process.
+
+    ``command`` is the command line used to start virsh; typically
+    ``['virsh', '--connect', <uri>]``. The process is started on first
+    use, and restarted if it dies. Commands may be issued from multiple
+    threads; they are run one at a time.
+    """
+
+    def __init__(self, command, timeout=DEFAULT_TIMEOUT):
+        self.command = command
+        self.timeout = timeout
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        self._proc = pexpect.spawn(self.command[0], self.command[1:],
+                                   timeout=self.timeout)
+        self._proc.expect_exact(PROMPT)
+
+    def run(self, *args):
+        """Run the virsh command ``args``, and return its output.
+
+        Raises a `HeadnodeError` if virsh reports an error.
+        """
+        line = ' '.join(_quote(arg) for arg in args)
+        with self._lock:
+            try:
+                if self._proc is None or not self._proc.isalive():
+                    self._spawn()
+                self._proc.sendline(line)
+                self._proc.expect_exact(PROMPT)
+                output = self._proc.before
+            except (pexpect.EOF, pexpect.TIMEOUT) as e:
+                # We don't know what state the shell is in, so start over
+                # with a fresh one next time:
+                self.close()
+                raise HeadnodeError('virsh %s failed: %s' %
+                                    (line, type(e).__name__))
+        # The first line of output is the terminal echoing our command:
+        lines = output.splitlines()[1:]
+        errors = [text for text in lines if text.startswith('error:')]
+        if errors:
+            raise HeadnodeError('virsh %s failed: %s' %
+                                (line, ' '.join(errors)))
+        return '\n'.join(lines)
+
+    def close(self):
+        """Shut down the virsh process, if it is running."""
+        if self._proc is not None:
+            self._proc.close(force=True)
+            self._proc = None
+
+
+class Job(object):
+    """A queued operation on a VM; see `JobQueue`."""
+
+    def __init__(self, key, fn, after, callback=None):
+        self.key = key
+        self.fn = fn
+        self.after = after
+        self.callback = callback
+        self.error = None
+        self.finished = threading.Event()
+
+    def done(self):
+        """Return whether the job has finished."""
+        return self.finished.is_set()
+
+    def wait(self):
+        """Wait for the job to finish, re-raising any exception it raised."""
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class JobQueue(object):
+    """Runs jobs on a pool of background threads.
+
+    Jobs submitted with the same ``key`` are run one at a time, in the order
+    in which they were submitted; jobs with different keys may run
+    concurrently. Up to ``workers`` threads are started as needed, and each
+    exits when there are no jobs left.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self._queue = Queue()
+        self._last = {}
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def submit(self, key, fn, callback=None):
+        """Queue ``fn`` to be called (with no arguments); returns a `Job`.
+
+        If ``callback`` is given, it is called once ``fn`` has finished,
+        with the exception ``fn`` raised, or None if it succeeded.
+        """
+        with self._lock:
+            job = Job(key, fn, self._last.get(key), callback)
+            self._last[key] = job
+            self._queue.put(job)
+            if self._running < self.workers:
+                self._running += 1
+                threading.Thread(target=self._work).start()
+        return job
+
+    def pending(self, key):
+        """Return whether there are unfinished jobs for ``key``."""
+        with self._lock:
+            return key in self._last
+
+    def _work(self):
+        while True:
+            # Checked under the lock, so that a job can't be submitted
+            # between us finding the queue empty and exiting:
+            with self._lock:
+                try:
+                    job = self._queue.get_nowait()
+                except Empty:
+                    self._running -= 1
+                    return
+            # The queue is FIFO, so the job we're waiting on has already
+            # been picked up by another worker; this can't deadlock.
+            if job.after is not None:
+                job.after.finished.wait()
+            try:
+                job.fn()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error('Headnode job for %s failed: %s', job.key, e)
+                job.error = e
+            if job.callback is not None:
+                try:
+                    job.callback(job.error)
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception('Callback for headnode job for %s '
+                                     'failed', job.key)
+            with self._lock:
+                if self._last.get(job.key) is job:
+                    del self._last[job.key]
+            job.finished.set()
+
+
+class Virsh(object):
+    """The headnode backend; manages VMs within libvirt.
+
+    ``endpoint`` is the libvirt URI to connect to. ``shell`` is the
+    `VirshShell` to use; by default one is created for ``endpoint``.
+    """
+
+    def __init__(self, endpoint, workers=DEFAULT_WORKERS, shell=None):
+        self.endpoint = endpoint
+        if shell is None:
+            shell = VirshShell(['virsh', '--connect', endpoint])
+        self.shell = shell
+        self.jobs = JobQueue(workers)
+        # Maps VM names to (generation, port) pairs:
+        self._vncports = {}
+        self._cache_lock = threading.Lock()
+
+    def clone(self, base_img, vmname, bridges, callback=None):
+        """Queue the creation of ``vmname`` as a clone of ``base_img``.
+
+        The VM will have one nic attached to each of the (host) bridges named
+        in ``bridges``. If this fails, whatever was created is removed
+        again. Returns the `Job`; ``callback`` is as for `JobQueue.submit`.
+        """
+        def _clone():
+            try:
+                check_call(['virt-clone',
+                            '--connect', self.endpoint,
+                            '-o', base_img,
+                            '-n', vmname,
+                            '--auto-clone'])
+            except CalledProcessError as e:
+                self._remove(vmname)
+                raise HeadnodeError('virt-clone failed with status %d' %
+                                    e.returncode)
+            try:
+                for bridge in bridges:
+                    self.shell.run('attach-interface', vmname,
+                                   'bridge', bridge, '--config')
+            except Exception:
+                self._remove(vmname)
+                raise
+        return self.jobs.submit(vmname, _clone, callback)
+
+    def _remove(self, vmname):
+        """Remove a partly created ``vmname``, if it exists, ignoring errors.
+        """
+        try:
+            self.shell.run('undefine', vmname, '--remove-all-storage')
+        except HeadnodeError as e:
+            if 'failed to get domain' not in e.description:
+                logger.error('Could not remove partly created VM %s: %s',
+                             vmname, e.description)
+
+    def start(self, vmname, callback=None):
+        """Queue starting ``vmname``, and marking it to autostart.
+
+        Returns the `Job`; ``callback`` is as for `JobQueue.submit`.
+        """
+        def _start():
+            self.shell.run('start', vmname)
+            self.shell.run('autostart', vmname)
+        return self.jobs.submit(vmname, _start, callback)
+
+    def stop(self, vmname):
+        """Power off ``vmname``, and disable autostart."""
+        def _stop():
+            self.shell.run('destroy', vmname)
+            self.shell.run('autostart', '--disable', vmname)
+        self.jobs.submit(vmname, _stop).wait()
+
+    def delete(self, vmname):
+        """Delete ``vmname``, including its storage.
+
+        This also works if the VM is running, or was never successfully
+        created.
+        """
+        def _delete():
+            with self._cache_lock:
+                self._vncports.pop(vmname, None)
+            try:
+                self.shell.run('destroy', vmname)
+            except HeadnodeError:
+                # This fails if the VM wasn't running, which is fine. If it
+                # failed for some other reason, undefine will fail too, and
+                # we'll catch it there.
+                pass
+            try:
+                self.shell.run('undefine', vmname, '--remove-all-storage')
+            except HeadnodeError as e:
+                if 'failed to get domain' not in e.description:
+                    raise
+        self.jobs.submit(vmname, _delete).wait()
+
+    def get_vncport(self, vmname, generation):
+        """Return the port that VNC is listening on for ``vmname``.
+
+        ``generation`` is the headnode's current generation; a port cached
+        for any other generation is looked up again. Returns None if no port
+        is allocated, or if there are operations on the VM still pending.
+        """
+        if self.jobs.pending(vmname):
+            return None
+        with self._cache_lock:
+            cached = self._vncports.get(vmname)
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        root = xml.etree.ElementTree.fromstring(
+            self.shell.run('dumpxml', vmname))
+        port = None
+        graphics = root.findall("./devices/graphics")
+        if graphics:
+            port = graphics[0].get('port')
+            if port == '-1':
+                # No port allocated (yet)
+                port = None
+        if port is not None:
+            # We don't cache None, since a port may still be allocated
+            # without any action on our part.
+            with self._cache_lock:
+                self._vncports[vmname] = (generation, port)
+        return port
+
+
+_virsh = None
+_virsh_lock = threading.Lock()
+
+
+def get_virsh():
+    """Return the process-wide `Virsh` instance, creating it if needed."""
+    global _virsh
+    with _virsh_lock:
+        if _virsh is None:
+            _virsh = Virsh(cfg.get('headnode', 'libvirt_endpoint'))
+        return _virsh
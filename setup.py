@@ -79,6 +79,8 @@ setup(name='hil',
       # [3]: https://bugs.launchpad.net/keystonemiddleware/+bug/1737115
       # See #923 for details.
       install_requires=['Flask-SQLAlchemy>=2.1,<2.2',
+                        # pool_pre_ping was added in 1.2:
+                        'SQLAlchemy>=1.2,<1.3',
                         'Flask-Migrate>=1.8,<2.0',
                         'Flask-Script>=2.0.5,<3.0',
                         'Werkzeug>=0.9.4,<0.10',
@@ -0,0 +1,230 @@
+"""Generate large, synthetic inventories for benchmarking HIL.
+
+`generate` fills an empty HIL database with projects, nodes (using the mock
+OBM driver), switches (using the mock switch driver) and their ports, nics,
+VLAN networks and network attachments. Creating tens of thousands of
+objects through the API would take far longer than the benchmarks
+themselves, so rows are bulk-inserted directly, with explicit ids; the
+result is the same as if it had been created through the API, except that
+the mock switches' (in-memory) state doesn't know about the attachments.
+
+The inventory is meant to look like a real deployment:
+
+* Nodes are spread evenly across projects, except for a fraction which are
+  left free.
+* Each node has the same number of nics, each of which is connected to a
+  port; consecutive nics go to different switches.
+* Networks are owned by projects (again spread evenly), each with a VLAN
+  from the ``vlan_pool`` allocator.
+* Attachments go to the nics of allocated nodes, on networks belonging to
+  their node's project: each nic's native VLAN first, then tagged VLANs,
+  until there are as many as requested. The nics of free nodes have no
+  attachments, so the networking daemon can be given work to do on them.
+
+This needs the ``vlan_pool`` network allocator, and the mock switch and OBM
+drivers, to be loaded; see ``scale.py``, which uses it.
+"""
+
+import random
+
+from hil import model
+from hil.ext.network_allocators.vlan_pool import Vlan, get_vlan_list
+from hil.ext.obm.mock import MockObm
+from hil.ext.switches.mock import MockSwitch
+from hil.flaskapp import app
+from hil.model import db
+
+# Rows are inserted this many at a time:
+CHUNK_SIZE = 5000
+
+
+def insert_rows(table, rows):
+    """Insert the dicts `rows` into `table`, in chunks."""
+    for start in range(0, len(rows), CHUNK_SIZE):
+        db.session.execute(table.insert(), rows[start:start + CHUNK_SIZE])
+
+
+def _fix_sequences(tables):
+    """Make sure the id sequences of `tables` are past the inserted rows.
+
+    Postgres doesn't advance a serial column's sequence when ids are
+    given explicitly; without this, objects created later (e.g. by the
+    benchmarks) would get ids which are already taken.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('%(t)s', 'id'), "
+            "(SELECT coalesce(max(id), 1) FROM %(t)s))" % {'t': table.name})
+
+
+def mac_addr(n):
+    """Return a (locally administered) mac address, unique for each `n`."""
+    return ':'.join(['02'] + ['%02x' % ((n >> shift) & 0xff)
+                              for shift in (32, 24, 16, 8, 0)])
+
+
+def generate(nodes=10000, switches=1000, networks=4000, attachments=50000,
+             projects=100, nics_per_node=2, free_fraction=0.2, seed=0):
+    """Fill the (empty) database with an inventory of the given size.
+
+    Returns a dict describing what was created, including the parameters,
+    and the labels of a few objects of each kind, for the benchmarks to
+    look up.
+    """
+    rng = random.Random(seed)
+    vlans = get_vlan_list()
+    if networks > len(vlans):
+        raise ValueError('Only %d VLANs are available for %d networks.' %
+                         (len(vlans), networks))
+    if projects < 1 or switches < 1 or nics_per_node < 1:
+        raise ValueError('Need at least one project, switch and nic per node.')
+    if networks < projects:
+        raise ValueError('Need at least one network per project.')
+
+    allocated_nodes = nodes - int(nodes * free_fraction)
+    networks_per_project = networks // projects
+    capacity = allocated_nodes * nics_per_node * networks_per_project
+    if attachments > capacity:
+        raise ValueError('At most %d attachments are possible with these '
+                         'parameters.' % capacity)
+
+    project_rows = [{'id': i, 'label': 'project-%04d' % i}
+                    for i in range(1, projects + 1)]
+
+    switch_rows = [{'id': i, 'label': 'switch-%04d' % i,
+                    'type': MockSwitch.api_name}
+                   for i in range(1, switches + 1)]
+    mock_switch_rows = [{'id': i, 'hostname': 'switch-%04d.example.com' % i,
+                         'username': 'admin', 'password': 'secret'}
+                        for i in range(1, switches + 1)]
+
+    obm_rows = [{'id': i, 'type': MockObm.api_name}
+                for i in range(1, nodes + 1)]
+    mock_obm_rows = [{'id': i, 'host': 'node-%05d-ipmi' % i,
+                      'user': 'root', 'password': 'secret'}
+                     for i in range(1, nodes + 1)]
+    node_rows = []
+    for i in range(1, nodes + 1):
+        if i <= allocated_nodes:
+            project_id = (i - 1) % projects + 1
+        else:
+            project_id = None
+        node_rows.append({'id': i, 'label': 'node-%05d' % i,
+                          'project_id': project_id, 'obm_id': i})
+
+    port_rows = []
+    nic_rows = []
+    for i in range(1, nodes * nics_per_node + 1):
+        switch_id = (i - 1) % switches + 1
+        port_rows.append({'id': i,
+                          'label': 'gi1/0/%d' % ((i - 1) // switches + 1),
+                          'owner_id': switch_id})
+        nic_rows.append({'id': i,
+                         'label': 'eth%d' % ((i - 1) % nics_per_node),
+                         'owner_id': (i - 1) // nics_per_node + 1,
+                         'mac_addr': mac_addr(i),
+                         'port_id': i})
+
+    # Each project gets the networks whose index is congruent to its own:
+    project_networks = dict((p['id'], []) for p in project_rows)
+    network_rows = []
+    network_project_rows = []
+    for i in range(1, networks + 1):
+        project_id = (i - 1) % projects + 1
+        network_rows.append({'id': i, 'label': 'net-%04d' % i,
+                             'owner_id': project_id, 'allocated': True,
+                             'network_id': str(vlans[i - 1])})
+        network_project_rows.append({'project_id': project_id,
+                                     'network_id': i})
+        project_networks[project_id].append(i)
+
+    # Attach the allocated nodes' nics in rounds: their native VLANs first,
+    # then one more tagged VLAN per round. Each nic starts at a random
+    # network of its project, so the networks are used evenly.
+    attachment_rows = []
+    allocated_nics = [nic for nic in nic_rows
+                      if nic['owner_id'] <= allocated_nodes]
+    offsets = [rng.randrange(networks_per_project) for _ in allocated_nics]
+    attachment_round = 0
+    while len(attachment_rows) < attachments:
+        for nic, offset in zip(allocated_nics, offsets):
+            if len(attachment_rows) == attachments:
+                break
+            project_id = node_rows[nic['owner_id'] - 1]['project_id']
+            choices = project_networks[project_id]
+            network = network_rows[
+                choices[(offset + attachment_round) % networks_per_project] - 1
+            ]
+            if attachment_round == 0:
+                channel = 'vlan/native'
+            else:
+                channel = 'vlan/' + network['network_id']
+            attachment_rows.append({'id': len(attachment_rows) + 1,
+                                    'nic_id': nic['id'],
+                                    'network_id': network['id'],
+                                    'channel': channel})
+        attachment_round += 1
+
+    with app.app_context():
+        insert_rows(model.Project.__table__, project_rows)
+        insert_rows(model.Switch.__table__, switch_rows)
+        insert_rows(MockSwitch.__table__, mock_switch_rows)
+        insert_rows(model.Obm.__table__, obm_rows)
+        insert_rows(MockObm.__table__, mock_obm_rows)
+        insert_rows(model.Node.__table__, node_rows)
+        insert_rows(model.Port.__table__, port_rows)
+        insert_rows(model.Nic.__table__, nic_rows)
+        insert_rows(model.Network.__table__, network_rows)
+        insert_rows(model.network_projects, network_project_rows)
+        insert_rows(model.NetworkAttachment.__table__, attachment_rows)
+        used = vlans[:networks]
+        for start in range(0, len(used), CHUNK_SIZE):
+            db.session.execute(
+                Vlan.__table__.update()
+                .where(Vlan.vlan_no.in_(used[start:start + CHUNK_SIZE]))
+                .values(available=False))
+        _fix_sequences([model.Project.__table__, model.Switch.__table__,
+                        model.Obm.__table__, model.Node.__table__,
+                        model.Port.__table__, model.Nic.__table__,
+                        model.Network.__table__,
+                        model.NetworkAttachment.__table__])
+        db.session.commit()
+
+    def sample(rows, count=10):
+        """Return the labels of (up to) `count` random rows."""
+        return [row['label'] for row in
+                rng.sample(rows, min(count, len(rows)))]
+
+    return {
+        'parameters': {
+            'nodes': nodes,
+            'switches': switches,
+            'networks': networks,
+            'attachments': attachments,
+            'projects': projects,
+            'nics_per_node': nics_per_node,
+            'free_fraction': free_fraction,
+            'seed': seed,
+        },
+        'counts': {
+            'projects': len(project_rows),
+            'nodes': len(node_rows),
+            'free_nodes': nodes - allocated_nodes,
+            'switches': len(switch_rows),
+            'ports': len(port_rows),
+            'nics': len(nic_rows),
+            'networks': len(network_rows),
+            'attachments': len(attachment_rows),
+        },
+        'samples': {
+            'projects': sample(project_rows),
+            'nodes': sample(node_rows),
+            'switches': sample(switch_rows),
+            'networks': sample(network_rows),
+        },
+        # The ids of the nics of free nodes, which have no attachments:
+        'free_nics': [nic['id'] for nic in nic_rows
+                      if nic['owner_id'] > allocated_nodes],
+    }
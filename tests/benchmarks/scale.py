@@ -0,0 +1,348 @@
+"""Benchmark HIL against a large, synthetic inventory.
+
+Run this as a script, from the root of the source tree:
+
+    python tests/benchmarks/scale.py [--output results.json] \\
+        [--baseline baseline.json]
+
+This creates a fresh database (by default an SQLite file in a temporary
+directory; use ``--db-uri`` for PostgreSQL), fills it with an inventory
+generated by ``inventory.py`` -- by default 10,000 nodes, 1,000 switches,
+4,000 VLAN networks and 50,000 network attachments -- and measures:
+
+* The latency (mean and percentiles) and throughput of the main read-only
+  API calls, made through Flask's test client, so that what's measured is
+  HIL itself rather than an HTTP server.
+* How quickly the networking daemon drains a journal of pending networking
+  actions, using the mock switch driver.
+* The peak memory use (maximum resident set size) of the process making
+  the API calls and running the daemon. The inventory is generated in a
+  separate process, since the generator holds all of the rows in memory
+  at once, which would otherwise swamp this.
+
+The results are printed, and may be saved as JSON with ``--output``. Given a
+``--baseline`` (the output of a previous run), any measurement which is
+worse than the baseline's by more than ``--tolerance`` is reported, and the
+script exits with a non-zero status. Baselines are only meaningful on the
+same machine and database, with the same inventory parameters, so none is
+kept in the source tree.
+
+The database given with ``--db-uri`` must be empty; it is created, and
+left in place afterwards, so it can be inspected.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+# When run as a script, this directory is already on the path, but the
+# root of the source tree may not be:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from hil import config, deferred, model, server  # noqa: E402
+from hil.flaskapp import app  # noqa: E402
+from hil.migrations import create_db  # noqa: E402
+from hil.model import db  # noqa: E402
+from hil.test_common import config_set  # noqa: E402
+
+import inventory  # noqa: E402
+
+# The API calls to benchmark: (name, path template, object kind). The path
+# is filled in with the label of a sample object of the given kind, if any,
+# taking a different one on each request.
+API_CALLS = [
+    ('list_projects', '/projects', None),
+    ('list_nodes_free', '/nodes/free', None),
+    ('list_nodes_all', '/nodes/all', None),
+    ('list_networks', '/networks', None),
+    ('list_switches', '/switches', None),
+    ('show_node', '/node/%s', 'nodes'),
+    ('show_network', '/network/%s', 'networks'),
+    ('show_switch', '/switch/%s', 'switches'),
+    ('list_project_nodes', '/project/%s/nodes', 'projects'),
+    ('list_project_networks', '/project/%s/networks', 'projects'),
+    ('list_network_attachments', '/network/%s/attachments', 'networks'),
+]
+
+# For each kind of measurement, whether bigger numbers are better; used
+# when comparing against a baseline:
+HIGHER_IS_BETTER = {
+    'mean': False,
+    'p50': False,
+    'p90': False,
+    'p99': False,
+    'throughput': True,
+    'rate': True,
+    'peak_rss_mb': False,
+}
+
+
+def configure(db_uri):
+    """Configure HIL to use the database at `db_uri`, and the mock drivers.
+    """
+    config_set({
+        'extensions': {
+            'hil.ext.auth.null': '',
+            'hil.ext.network_allocators.vlan_pool': '',
+            'hil.ext.switches.mock': '',
+            'hil.ext.obm.mock': '',
+        },
+        'hil.ext.network_allocators.vlan_pool': {
+            'vlans': '2-4094',
+        },
+        'devel': {
+            'dry_run': 'True',
+        },
+        'database': {
+            'uri': db_uri,
+        },
+    })
+    config.load_extensions()
+    server.init()
+    create_db()
+
+
+def generate_inventory(**kwargs):
+    """Call ``inventory.generate(**kwargs)`` in a child process, and return
+    the result.
+
+    HIL must already be configured; see `configure`.
+    """
+    # Don't let the child share our database connections:
+    db.engine.dispose()
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(inventory.generate, (), kwargs)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process, in MiB."""
+    # ru_maxrss is in KiB on Linux, but in bytes on OS X:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return rss / 1024.0
+
+
+def percentile(values, pct):
+    """Return the `pct`th percentile of the sorted list `values`.
+
+    This uses the nearest-rank method.
+    """
+    rank = max(1, int(round(pct / 100.0 * len(values))))
+    return values[rank - 1]
+
+
+def summarize(latencies, elapsed):
+    """Summarize the `latencies` of requests made over `elapsed` seconds.
+
+    Latencies are reported in milliseconds, throughput in requests per
+    second.
+    """
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'mean': sum(latencies) / len(latencies) * 1000,
+        'p50': percentile(latencies, 50) * 1000,
+        'p90': percentile(latencies, 90) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'throughput': len(latencies) / elapsed,
+    }
+
+
+def benchmark_api(samples, requests):
+    """Make `requests` requests for each of the `API_CALLS`."""
+    client = app.test_client()
+    results = {}
+    for name, path, kind in API_CALLS:
+        labels = samples[kind] if kind else [None]
+        paths = [path % label if label else path for label in labels]
+        # Warm up, and check that the call works at all:
+        for p in paths:
+            resp = client.get(p)
+            if resp.status_code != 200:
+                raise RuntimeError('GET %s failed with status %d: %s' %
+                                   (p, resp.status_code, resp.get_data()))
+        latencies = []
+        start = time.time()
+        for i in range(requests):
+            request_start = time.time()
+            client.get(paths[i % len(paths)])
+            latencies.append(time.time() - request_start)
+        results[name] = summarize(latencies, time.time() - start)
+    return results
+
+
+def benchmark_daemon(free_nics, networks, actions):
+    """Time the networking daemon processing `actions` pending actions.
+
+    Each action attaches the native VLAN of one of the nics `free_nics` (ids
+    of nics without attachments) to one of the networks `networks` (ids).
+    """
+    if actions > len(free_nics):
+        raise ValueError('Only %d free nics are available for %d actions.' %
+                         (len(free_nics), actions))
+    status_id = str(uuid.uuid4())
+    rows = [{'uuid': status_id,
+             'status': 'PENDING',
+             'type': 'modify_port',
+             'nic_id': nic_id,
+             'new_network_id': networks[i % len(networks)],
+             'channel': 'vlan/native'}
+            for i, nic_id in enumerate(free_nics[:actions])]
+    with app.app_context():
+        inventory.insert_rows(model.NetworkingAction.__table__, rows)
+        db.session.commit()
+        start = time.time()
+        deferred.apply_networking()
+        elapsed = time.time() - start
+        done = model.NetworkingAction.query \
+            .filter_by(uuid=status_id, status='DONE').count()
+    if done != actions:
+        raise RuntimeError('Only %d of %d networking actions succeeded.' %
+                           (done, actions))
+    return {
+        'actions': actions,
+        'seconds': elapsed,
+        'rate': actions / elapsed,
+    }
+
+
+def compare(baseline, results, tolerance):
+    """Compare `results` against `baseline`.
+
+    Returns a list of messages, one for each measurement which is worse
+    than the baseline by more than the fraction `tolerance`.
+    """
+    regressions = []
+
+    def walk(base, new, path):
+        """Compare the measurements in `base` and `new`, recursively."""
+        for key, base_value in sorted(base.items()):
+            if key not in new:
+                continue
+            if isinstance(base_value, dict):
+                walk(base_value, new[key], path + [key])
+            elif key in HIGHER_IS_BETTER and base_value:
+                change = (new[key] - base_value) / float(base_value)
+                if HIGHER_IS_BETTER[key]:
+                    change = -change
+                if change > tolerance:
+                    regressions.append('%s: %.2f -> %.2f (%+.0f%%)' % (
+                        '.'.join(path + [key]), base_value, new[key],
+                        (new[key] - base_value) / float(base_value) * 100))
+
+    for section in 'api', 'daemon', 'memory':
+        walk(baseline.get(section, {}), results.get(section, {}), [section])
+    return regressions
+
+
+def report(results):
+    """Print `results` in a human-readable form."""
+    print '%-26s %8s %8s %8s %8s %10s' % ('API call', 'mean ms', 'p50 ms',
+                                          'p90 ms', 'p99 ms', 'req/s')
+    for name, _, _ in API_CALLS:
+        r = results['api'][name]
+        print '%-26s %8.2f %8.2f %8.2f %8.2f %10.1f' % (
+            name, r['mean'], r['p50'], r['p90'], r['p99'], r['throughput'])
+    daemon = results['daemon']
+    print
+    print 'Networking daemon: %d actions in %.2fs (%.1f actions/s)' % (
+        daemon['actions'], daemon['seconds'], daemon['rate'])
+    print 'Inventory generated in %.2fs' % results['inventory']['seconds']
+    print 'Peak memory use: %.1f MiB' % results['memory']['peak_rss_mb']
+
+
+def main():
+    """Entry point; see the module docstring."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db-uri',
+                        help='the (empty) database to use; by default, a '
+                             'new SQLite database in a temporary directory')
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--switches', type=int, default=1000)
+    parser.add_argument('--networks', type=int, default=4000)
+    parser.add_argument('--attachments', type=int, default=50000)
+    parser.add_argument('--projects', type=int, default=100)
+    parser.add_argument('--nics-per-node', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='number of requests to make for each API call')
+    parser.add_argument('--actions', type=int, default=1000,
+                        help='number of networking actions for the daemon '
+                             'to perform')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the results to FILE, as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare the results to those in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='how much worse than the baseline a result may '
+                             'be (as a fraction) before it is reported as a '
+                             'regression; default: %(default)s')
+    args = parser.parse_args()
+
+    tmpdir = None
+    db_uri = args.db_uri
+    if db_uri is None:
+        tmpdir = tempfile.mkdtemp(prefix='hil-benchmark-')
+        db_uri = 'sqlite:///' + os.path.join(tmpdir, 'hil.db')
+    try:
+        configure(db_uri)
+        start = time.time()
+        generated = generate_inventory(nodes=args.nodes,
+                                       switches=args.switches,
+                                       networks=args.networks,
+                                       attachments=args.attachments,
+                                       projects=args.projects,
+                                       nics_per_node=args.nics_per_node,
+                                       seed=args.seed)
+        results = {
+            'inventory': dict(generated['parameters'],
+                              seconds=time.time() - start,
+                              database=db.engine.dialect.name),
+            'api': benchmark_api(generated['samples'], args.requests),
+            'daemon': benchmark_daemon(generated['free_nics'],
+                                       range(1, args.networks + 1),
+                                       args.actions),
+            'memory': {'peak_rss_mb': peak_rss_mb()},
+        }
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        keys = list(generated['parameters']) + ['database']
+        if any(baseline.get('inventory', {}).get(key) !=
+               results['inventory'][key] for key in keys):
+            print
+            print 'Warning: the baseline was made with a different ' \
+                'inventory or database; the comparison may be meaningless.'
+        regressions = compare(baseline, results, args.tolerance)
+        print
+        if regressions:
+            print 'Regressions (tolerance %.0f%%):' % (args.tolerance * 100)
+            for regression in regressions:
+                print '  ' + regression
+            sys.exit(1)
+        print 'No regressions against %s.' % args.baseline
+
+
+if __name__ == '__main__':
+    main()
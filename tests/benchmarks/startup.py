@@ -0,0 +1,121 @@
+"""Benchmark the start up time of the ``hil`` command line tool.
+
+Run this as a script, from the root of the source tree:
+
+    python tests/benchmarks/startup.py [<command> ...]
+
+For each command (by default, a few representative ones), the CLI is run a
+number of times in a fresh interpreter, and the median wall clock time is
+reported, along with the time spent just importing `hil.cli` and the number
+of modules the command loaded. Client commands are pointed at an endpoint
+where nothing is listening, so they fail as soon as they try to contact the
+server; what's measured is everything before that.
+
+This is not part of the test suite; `tests/unit/cli_imports.py` checks that
+client commands don't import the server side of HIL.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+DEFAULT_COMMANDS = [
+    ['help'],
+    ['version'],
+    ['list_nodes', 'free'],
+    ['show_node', 'node-01'],
+    ['list_projects'],
+]
+
+# Nothing should be listening on port 1, so the connection is refused
+# straight away:
+ENDPOINT = 'http://127.0.0.1:1'
+
+# Run in the child interpreter. Prints a JSON object with the timings, and
+# the number of modules loaded, once the command exits:
+_CHILD = '''
+import atexit, json, sys, time
+start = time.time()
+from hil import cli
+imported = time.time()
+
+def report():
+    sys.stderr.write('\\nSTARTUP ' + json.dumps({
+        'import': imported - start,
+        'total': time.time() - start,
+        'modules': len([m for m in sys.modules.values() if m is not None]),
+    }) + '\\n')
+
+atexit.register(report)
+sys.argv = ['hil'] + sys.argv[1:]
+cli.main()
+'''
+
+
+def run_once(command):
+    """Run the CLI with the arguments `command` once; return its report."""
+    env = dict(os.environ, HIL_ENDPOINT=ENDPOINT)
+    proc = subprocess.Popen([sys.executable, '-c', _CHILD] + command,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            env=env)
+    _, stderr = proc.communicate()
+    for line in stderr.splitlines():
+        if line.startswith('STARTUP '):
+            return json.loads(line[len('STARTUP '):])
+    raise RuntimeError('Command %r did not report its timings:\n%s' %
+                       (command, stderr))
+
+
+def median(values):
+    """Return the median of `values`."""
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def benchmark(command, runs):
+    """Run `command` `runs` times; return a summary of the reports."""
+    reports = [run_once(command) for _ in range(runs)]
+    return {
+        'command': ' '.join(command),
+        'import': median([r['import'] for r in reports]),
+        'total': median([r['total'] for r in reports]),
+        'modules': max(r['modules'] for r in reports),
+    }
+
+
+def main():
+    """Entry point; see the module docstring."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('command', nargs='*',
+                        help='a command to benchmark, with its arguments, '
+                             'e.g. "list_nodes free" (may be repeated)')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='number of times to run each command')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE, as JSON')
+    args = parser.parse_args()
+
+    commands = [c.split() for c in args.command] or DEFAULT_COMMANDS
+    results = []
+    print '%-24s %10s %10s %8s' % ('command', 'import ms', 'total ms',
+                                   'modules')
+    for command in commands:
+        result = benchmark(command, args.runs)
+        results.append(result)
+        print '%-24s %10.1f %10.1f %8d' % (result['command'],
+                                           result['import'] * 1000,
+                                           result['total'] * 1000,
+                                           result['modules'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
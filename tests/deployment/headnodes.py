@@ -6,6 +6,7 @@ difficult to run in other contexts.
 """
 
 import json
+import time
 
 from hil.test_common import config_testsuite, fail_on_log_warnings, \
     fresh_database, with_request_context, headnode_cleanup, \
@@ -60,6 +61,12 @@ class TestHeadNode:
             pytest.xfail("Running in dry-run mode; can't talk to libvirt.")
         assert json.loads(api.show_headnode('hn-0'))['vncport'] is None
         api.headnode_start('hn-0')
+        # The headnode is cloned and started in the background, so we may
+        # need to wait for it to come up:
+        for _ in range(300):
+            if json.loads(api.show_headnode('hn-0'))['vncport'] is not None:
+                break
+            time.sleep(1)
         assert json.loads(api.show_headnode('hn-0'))['vncport'] is not None
         api.headnode_stop('hn-0')
         api.headnode_delete('hn-0')
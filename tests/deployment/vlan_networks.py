@@ -51,7 +51,7 @@ class TestNetworkVlan(NetworkTest):
 
         def get_legal_channels(network):
             """Get the legal channels for a network."""
-            response_body = api.show_network(network)
+            response_body = api.show_network(network).read()
             response_body = json.loads(response_body)
             return response_body['channels']
 
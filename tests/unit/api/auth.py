@@ -641,6 +641,7 @@ admin_calls = [
     (api.port_connect_nic, ['stock_switch_0', 'free_port_0',
                             'free_node_0', 'boot-nic'], {}),
     (api.show_port, ['stock_switch_0', 'free_port_0'], {}),
+    (api.show_switch_health, ['stock_switch_0'], {}),
     (api.port_detach_nic, ['stock_switch_0', 'free_node_0_port'], {}),
     (api.node_set_metadata, ['free_node_0', 'EK', 'pk'], {}),
     (api.node_delete_metadata, ['runway_node_0', 'EK'], {}),
@@ -797,7 +798,10 @@ class Test_show_networking_action(unittest.TestCase):
                             'nic': 'boot-nic',
                             'type': 'modify_port',
                             'channel': 'null',
-                            'new_network': 'stock_int_pub'}
+                            'new_network': 'stock_int_pub',
+                            'attempts': 0,
+                            'next_attempt': None,
+                            'failed_attempts': []}
 
     def test_show_networking_action_failure(self):
         """Test that project with no access to node can't get the status"""
@@ -816,4 +820,7 @@ class Test_show_networking_action(unittest.TestCase):
                             'nic': 'boot-nic',
                             'type': 'modify_port',
                             'channel': 'null',
-                            'new_network': 'stock_int_pub'}
+                            'new_network': 'stock_int_pub',
+                            'attempts': 0,
+                            'next_attempt': None,
+                            'failed_attempts': []}
@@ -0,0 +1,193 @@
+"""Tests for the batch api call (POST /batch)."""
+
+import json
+
+import flask
+import pytest
+from schema import Schema
+
+from hil import config, rest
+from hil.auth import get_auth_backend
+from hil.flaskapp import app
+from hil.test_common import config_testsuite, fresh_database, \
+    fail_on_log_warnings, server_init
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config.load_extensions()
+
+
+pytestmark = pytest.mark.usefixtures('configure',
+                                     'fresh_database',
+                                     'server_init')
+
+
+@pytest.fixture
+def client():
+    """Return a flask test client."""
+    return app.test_client()
+
+
+def batch(client, calls, atomic=False):
+    """Send a batch of `calls`, returning the decoded response body."""
+    resp = client.post('/batch', data=json.dumps({
+        'calls': calls,
+        'atomic': atomic,
+    }))
+    assert resp.status_code == 200
+    return json.loads(resp.get_data())
+
+
+def statuses(result):
+    """Return the status codes of the responses in a batch result."""
+    return [r['status'] for r in result['responses']]
+
+
+def list_projects(client):
+    """Return the list of projects (via the api)."""
+    return json.loads(client.get('/projects').get_data())
+
+
+def test_independent(client):
+    """Without atomic, each call succeeds or fails on its own."""
+    result = batch(client, [
+        {'method': 'PUT', 'path': '/project/runway'},
+        {'method': 'PUT', 'path': '/project/runway'},
+        {'method': 'PUT', 'path': '/project/manhattan'},
+        {'method': 'GET', 'path': '/projects'},
+    ])
+    assert result['committed'] is True
+    assert statuses(result) == [200, 409, 200, 200]
+    assert json.loads(result['responses'][1]['body'])['type'] == \
+        'DuplicateError'
+    assert json.loads(result['responses'][3]['body']) == \
+        ['manhattan', 'runway']
+    assert list_projects(client) == ['manhattan', 'runway']
+
+
+def test_atomic_rollback(client):
+    """In an atomic batch, one failure rolls back everything."""
+    result = batch(client, [
+        {'method': 'PUT', 'path': '/project/runway'},
+        {'method': 'PUT', 'path': '/project/manhattan'},
+        {'method': 'PUT', 'path': '/project/runway'},
+        {'method': 'PUT', 'path': '/project/apollo'},
+    ], atomic=True)
+    assert result['committed'] is False
+    # The last call was never run:
+    assert statuses(result) == [200, 200, 409]
+    assert list_projects(client) == []
+
+
+def test_atomic_commit(client):
+    """Calls in an atomic batch see the changes made earlier in it."""
+    result = batch(client, [
+        {'method': 'PUT', 'path': '/project/runway'},
+        {'method': 'PUT', 'path': '/network/pxe', 'body': {
+            'owner': 'runway',
+            'access': 'runway',
+            'net_id': '',
+        }},
+        {'method': 'GET', 'path': '/network/pxe'},
+    ], atomic=True)
+    assert result['committed'] is True
+    assert statuses(result) == [200, 200, 200]
+    assert json.loads(result['responses'][2]['body'])['owner'] == 'runway'
+    assert list_projects(client) == ['runway']
+
+
+def test_bad_calls(client):
+    """Unknown paths, bad methods, bad arguments and nested batches are
+    reported as errors.
+    """
+    result = batch(client, [
+        {'method': 'GET', 'path': '/no/such/call'},
+        {'method': 'PATCH', 'path': '/projects'},
+        {'method': 'PUT', 'path': '/network/pxe', 'body': {'owner': 7}},
+        {'method': 'POST', 'path': '/batch', 'body': {'calls': []}},
+        {'method': 'GET', 'path': '/nodes/free', 'params': {'x': 'y'}},
+    ])
+    assert statuses(result) == [404, 405, 400, 400, 400]
+
+
+def test_authenticate_once(client, monkeypatch):
+    """The batch is authenticated once, not once per call."""
+    backend = get_auth_backend()
+    calls = []
+    real_authenticate = backend.authenticate
+
+    def authenticate():
+        """Count calls to the real authenticate()."""
+        calls.append(None)
+        return real_authenticate()
+    monkeypatch.setattr(backend, 'authenticate', authenticate)
+
+    result = batch(client, [{'method': 'GET', 'path': '/projects'}] * 3)
+    assert statuses(result) == [200, 200, 200]
+    assert len(calls) == 1
+
+
+def test_cookies(client):
+    """Cookies set by the calls in a batch are set on its response."""
+    @rest.rest_call('PUT', '/batch-test/cookie', Schema({}))
+    # pylint: disable=unused-variable
+    def set_cookie():
+        """Set a cookie once the request is done."""
+        def after(response):
+            """Set the cookie."""
+            response.set_cookie('flavour', 'oatmeal')
+            return response
+        flask.after_this_request(after)
+
+    resp = client.post('/batch', data=json.dumps({
+        'calls': [{'method': 'PUT', 'path': '/batch-test/cookie'}],
+    }))
+    assert resp.status_code == 200
+    assert [cookie.split(';')[0]
+            for cookie in resp.headers.getlist('Set-Cookie')] == \
+        ['flavour=oatmeal']
+
+
+def test_unexpected_error(client, monkeypatch):
+    """A call which fails with an unexpected exception gets a 500, and the
+    rest of the batch still runs.
+    """
+    @rest.rest_call('GET', '/batch-test/crash', Schema({}))
+    # pylint: disable=unused-variable
+    def crash():
+        """Fail in a way the api doesn't anticipate."""
+        raise RuntimeError('oops')
+
+    logged = []
+    monkeypatch.setattr(rest.logger, 'exception',
+                        lambda *args: logged.append(args))
+
+    result = batch(client, [
+        {'method': 'GET', 'path': '/batch-test/crash'},
+        {'method': 'PUT', 'path': '/project/runway'},
+    ])
+    assert result['committed'] is True
+    assert statuses(result) == [500, 200]
+    assert len(logged) == 1
+    assert list_projects(client) == ['runway']
+
+
+def test_streaming_call(client):
+    """Calls which stream their responses can't be batched."""
+    @rest.rest_call('GET', '/batch-test/stream', Schema({}))
+    # pylint: disable=unused-variable
+    def stream():
+        """Stream a response."""
+        return flask.Response(iter(['never', 'ending']))
+
+    result = batch(client, [{'method': 'GET', 'path': '/batch-test/stream'}])
+    assert statuses(result) == [400]
+    assert json.loads(result['responses'][0]['body'])['msg'] == \
+        'Streaming API calls may not be batched.'
@@ -41,13 +41,17 @@ General advice on working with this module:
   readability and maintainability.
 * make sure it is easy to see what a new test is trying to verify.
 """
+from datetime import datetime, timedelta
 import hil
-from hil import model, deferred, errors, config, api
+from hil import model, deferred, errors, config, api, metrics
 from hil.test_common import config_testsuite, config_merge, fresh_database, \
     fail_on_log_warnings, additional_db, with_request_context, \
     network_create_simple, server_init, uuid_pattern
 from hil.network_allocator import get_network_allocator
+from hil.flaskapp import app
 from hil.auth import get_auth_backend
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event
 import pytest
 import unittest
 import json
@@ -232,6 +236,34 @@ class TestProjectAddDeleteNetwork:
         with pytest.raises(errors.BlockedError):
             api.network_revoke_project_access('runway', 'runway_provider')
 
+    def test_network_revoke_project_access_queries(self):
+        """The number of queries network_revoke_project_access makes doesn't
+        depend on how many nodes are attached to the network.
+        """
+        def revoke_queries():
+            """Try to revoke runway's access; return the number of queries.
+            """
+            model.db.session.expire_all()
+            with metrics.count_queries() as queries:
+                with pytest.raises(errors.BlockedError):
+                    api.network_revoke_project_access(
+                        'runway', 'manhattan_runway_provider')
+            return queries.count
+
+        metrics.init()
+        network = 'manhattan_runway_provider'
+        api.node_connect_network('runway_node_0', 'boot-nic', network)
+        deferred.apply_networking()
+        before = revoke_queries()
+
+        # Attach other projects' nodes ahead of runway's:
+        api.node_detach_network('runway_node_0', 'boot-nic', network)
+        deferred.apply_networking()
+        for node in 'manhattan_node_0', 'manhattan_node_1', 'runway_node_0':
+            api.node_connect_network(node, 'boot-nic', network)
+            deferred.apply_networking()
+        assert revoke_queries() == before
+
     def test_project_remove_network_owner(self):
         """Revoking access to a network's owner should fail."""
         with pytest.raises(errors.BlockedError):
@@ -1228,19 +1260,10 @@ class TestHeadnodeFreeze:
     """Test the "freezing" behavior of headnodes.
 
     i.e, modifications become illegal once the headnode is started.
-    """
-
-    @pytest.fixture(autouse=True)
-    def patch_start(self, monkeypatch):
-        """Monkeypatch headnode.start for test purposes.
 
-        We can't start the headnodes for real in the test suite, but we need
-        "starting" them to still clear the dirty bit.
-        """
-        def start(self):
-            """Set the dirty bit, to mark the headnode as started."""
-            self.dirty = False
-        monkeypatch.setattr(model.Headnode, 'start', start)
+    These run in dry run mode, where starting a headnode completes
+    immediately.
+    """
 
     def _prep(self):
         """Helper to set up common state.
@@ -1250,6 +1273,13 @@ class TestHeadnodeFreeze:
         api.project_create('anvil-nextgen')
         api.headnode_create('hn-0', 'anvil-nextgen', 'base-headnode')
 
+    @staticmethod
+    def _assert_started():
+        """Check that hn-0 has been created, and isn't busy."""
+        headnode = api.get_or_404(model.Headnode, 'hn-0')
+        assert headnode.dirty is False
+        assert headnode.job_status == 'DONE'
+
     def _prep_delete_hnic(self):
         """Like _prep, but also creates an hnic that we will delete."""
         self._prep()
@@ -1270,6 +1300,7 @@ class TestHeadnodeFreeze:
         self._prep()
 
         api.headnode_start('hn-0')
+        self._assert_started()
         with pytest.raises(errors.IllegalStateError):
             api.headnode_create_hnic('hn-0', 'hn-0-eth0')
 
@@ -1284,6 +1315,7 @@ class TestHeadnodeFreeze:
         self._prep_delete_hnic()
 
         api.headnode_start('hn-0')
+        self._assert_started()
         with pytest.raises(errors.IllegalStateError):
             api.headnode_delete_hnic('hn-0', 'hn-0-eth0')
 
@@ -1298,6 +1330,7 @@ class TestHeadnodeFreeze:
         self._prep_connect_network()
 
         api.headnode_start('hn-0')
+        self._assert_started()
         with pytest.raises(errors.IllegalStateError):
             api.headnode_connect_network('hn-0', 'hn-0-eth0', 'hammernet')
 
@@ -1312,6 +1345,7 @@ class TestHeadnodeFreeze:
         self._prep_detach_network()
 
         api.headnode_start('hn-0')
+        self._assert_started()
         with pytest.raises(errors.IllegalStateError):
             api.headnode_detach_network('hn-0', 'hn-0-eth0')
 
@@ -1321,6 +1355,126 @@ class TestHeadnodeFreeze:
 
         api.headnode_detach_network('hn-0', 'hn-0-eth0')
 
+    def test_start_again(self):
+        """A started headnode can be stopped, and started again."""
+        self._prep()
+
+        api.headnode_start('hn-0')
+        api.headnode_stop('hn-0')
+        api.headnode_start('hn-0')
+        self._assert_started()
+
+
+class TestHeadnodeJobs:
+    """Test that the outcome of starting a headnode in the background is
+    recorded, and the headnode is only frozen once its VM is created.
+    """
+
+    @pytest.fixture(autouse=True)
+    def virsh(self, configure, monkeypatch):
+        """Replace the headnode backend with one which just records the
+        callbacks for the jobs it is given, and turn off dry run mode.
+        """
+        # pylint: disable=unused-argument,redefined-outer-name
+        class Virsh(object):
+            """Stand-in for `hil.virsh.Virsh`."""
+
+            def __init__(self):
+                self.callbacks = []
+
+            def clone(self, base_img, vmname, bridges, callback=None):
+                """Record the clone job's callback."""
+                self.callbacks.append(('clone', callback))
+
+            def start(self, vmname, callback=None):
+                """Record the start job's callback."""
+                self.callbacks.append(('start', callback))
+
+            def stop(self, vmname):
+                """Do nothing."""
+
+            def delete(self, vmname):
+                """Do nothing."""
+
+        virsh = Virsh()
+        monkeypatch.setattr(model, 'get_virsh', lambda: virsh)
+        config_merge({'devel': {'dry_run': None}})
+        return virsh
+
+    @staticmethod
+    def _show():
+        """Return the job status and error, and whether it's dirty."""
+        headnode = api.get_or_404(model.Headnode, 'hn-0')
+        return headnode.job_status, headnode.job_error, headnode.dirty
+
+    def test_clone_failure(self, virsh):
+        """If creating the VM fails, the headnode is left unfrozen, with the
+        error recorded, and can be started again.
+        """
+        api.project_create('anvil-nextgen')
+        api.headnode_create('hn-0', 'anvil-nextgen', 'base-headnode')
+        api.headnode_start('hn-0')
+        assert self._show() == ('PENDING', None, True)
+        assert [name for name, _ in virsh.callbacks] == ['clone', 'start']
+
+        # It can't be changed or started again while the jobs run:
+        with pytest.raises(errors.IllegalStateError):
+            api.headnode_create_hnic('hn-0', 'hn-0-eth0')
+        with pytest.raises(errors.IllegalStateError):
+            api.headnode_start('hn-0')
+
+        virsh.callbacks[0][1](errors.HeadnodeError('virt-clone failed'))
+        virsh.callbacks[1][1](errors.HeadnodeError('no such domain'))
+        assert self._show() == ('ERROR', 'virt-clone failed', True)
+        assert json.loads(api.show_headnode('hn-0'))['job_error'] == \
+            'virt-clone failed'
+
+        api.headnode_create_hnic('hn-0', 'hn-0-eth0')
+        del virsh.callbacks[:]
+        api.headnode_start('hn-0')
+        assert self._show() == ('PENDING', None, True)
+        virsh.callbacks[0][1](None)
+        assert self._show() == ('PENDING', None, False)
+        virsh.callbacks[1][1](None)
+        assert self._show() == ('DONE', None, False)
+        with pytest.raises(errors.IllegalStateError):
+            api.headnode_delete_hnic('hn-0', 'hn-0-eth0')
+
+    def test_start_failure(self, virsh):
+        """If the VM is created, but can't be started, the headnode is
+        frozen, and starting it again doesn't create it again.
+        """
+        api.project_create('anvil-nextgen')
+        api.headnode_create('hn-0', 'anvil-nextgen', 'base-headnode')
+        api.headnode_start('hn-0')
+        virsh.callbacks[0][1](None)
+        virsh.callbacks[1][1](errors.HeadnodeError('out of memory'))
+        assert self._show() == ('ERROR', 'out of memory', False)
+
+        del virsh.callbacks[:]
+        api.headnode_start('hn-0')
+        assert [name for name, _ in virsh.callbacks] == ['start']
+
+    def test_busy(self, virsh):
+        """A headnode can't be stopped or deleted while it's being started,
+        and each start or stop moves it to a new generation.
+        """
+        api.project_create('anvil-nextgen')
+        api.headnode_create('hn-0', 'anvil-nextgen', 'base-headnode')
+        api.headnode_start('hn-0')
+        with pytest.raises(errors.IllegalStateError):
+            api.headnode_stop('hn-0')
+        with pytest.raises(errors.IllegalStateError):
+            api.headnode_delete('hn-0')
+
+        virsh.callbacks[0][1](None)
+        virsh.callbacks[1][1](None)
+        generation = api.get_or_404(model.Headnode, 'hn-0').generation
+        api.headnode_stop('hn-0')
+        assert api.get_or_404(model.Headnode, 'hn-0').generation == \
+            generation + 1
+        api.headnode_delete('hn-0')
+
 
 class TestNetworkCreateDelete:
     """Tests for the hil.api.network_{create,delete} functions."""
@@ -1571,6 +1725,45 @@ class Test_list_show_switch:
         }
 
 
+class Test_show_switch_health:
+    """Test show_switch_health"""
+
+    def test_show_switch_health(self, switchinit):
+        """A switch which has never failed is healthy; one which has failed
+        enough times shows its circuit open.
+        """
+        new_node('compute-01')
+        api.node_register_nic('compute-01', 'eth0', 'DE:AD:BE:EF:20:14')
+        api.port_connect_nic('sw0', PORTS[2], 'compute-01', 'eth0')
+        api.port_revert('sw0', PORTS[2])
+
+        assert json.loads(api.show_switch_health('sw0')) == {
+            'state': 'closed',
+            'consecutive_failures': 0,
+            'last_failure': None,
+            'last_error': None,
+            'open_until': None,
+            'pending_actions': 1,
+        }
+
+        switch = api.get_or_404(model.Switch, 'sw0')
+        model.db.session.add(model.SwitchHealth(
+            switch=switch,
+            consecutive_failures=3,
+            last_failure=datetime(2018, 2, 6, 11, 22, 41),
+            last_error='Connection refused',
+            open_until=datetime.utcnow() + timedelta(minutes=1)))
+        model.db.session.commit()
+        health = json.loads(api.show_switch_health('sw0'))
+        assert health['state'] == 'open'
+        assert health['consecutive_failures'] == 3
+        assert health['last_failure'] == '2018-02-06T11:22:41'
+        assert health['last_error'] == 'Connection refused'
+
+        with pytest.raises(errors.NotFoundError):
+            api.show_switch_health('sw1')
+
+
 class Test_show_port:
     """Test show_port"""
 
@@ -1737,7 +1930,7 @@ class TestQuery_populated_db:
         """Test list_networks."""
         auth = get_auth_backend()
         auth.set_admin(False)
-        user_result = json.loads(api.list_networks())
+        user_result = json.loads(api.list_networks().read())
         for net in user_result.keys():
             del user_result[net]['network_id']
         assert user_result == {
@@ -1747,7 +1940,7 @@ class TestQuery_populated_db:
         }
         # Test against the Admin user
         auth.set_admin(True)
-        admin_result = json.loads(api.list_networks())
+        admin_result = json.loads(api.list_networks().read())
         for net in admin_result.keys():
             del admin_result[net]['network_id']
         assert admin_result == {
@@ -1773,7 +1966,7 @@ class TestQuery_populated_db:
         deferred.apply_networking()
 
         actual = json.loads(
-            api.list_network_attachments('manhattan_runway_pxe'))
+            api.list_network_attachments('manhattan_runway_pxe').read())
         expected = {
             'manhattan_node_0':
                 {
@@ -1802,8 +1995,8 @@ class TestQuery_populated_db:
             'manhattan_runway_pxe')
         deferred.apply_networking()
 
-        actual = json.loads(
-            api.list_network_attachments('manhattan_runway_pxe', 'runway'))
+        actual = json.loads(api.list_network_attachments(
+            'manhattan_runway_pxe', 'runway').read())
         expected = {
             'runway_node_0':
                 {
@@ -1856,7 +2049,7 @@ class TestQuery_unpopulated_db:
 
     def test_list_networks_none(self):
         """list_networks should return an empty list if the db is empty."""
-        assert json.loads(api.list_networks()) == {}
+        assert json.loads(api.list_networks().read()) == {}
 
     def test_list_projects(self):
         """Add a few projects and check the output of list_projects
@@ -2134,7 +2327,9 @@ class TestQuery_unpopulated_db:
                 'eth0',
                 'wlan0',
             ],
-            'vncport': None
+            'vncport': None,
+            'job_status': None,
+            'job_error': None,
         }
 
     def test_show_nonexistent_headnode(self):
@@ -2156,7 +2351,7 @@ class TestShowNetwork:
         api.project_create('anvil-nextgen')
         network_create_simple('spiderwebs', 'anvil-nextgen')
 
-        result = json.loads(api.show_network('spiderwebs'))
+        result = json.loads(api.show_network('spiderwebs').read())
         assert result == {
             'name': 'spiderwebs',
             'owner': 'anvil-nextgen',
@@ -2172,7 +2367,7 @@ class TestShowNetwork:
                            access='',
                            net_id='432')
 
-        result = json.loads(api.show_network('public-network'))
+        result = json.loads(api.show_network('public-network').read())
         assert result == {
             'name': 'public-network',
             'owner': 'admin',
@@ -2189,7 +2384,7 @@ class TestShowNetwork:
                            access='anvil-nextgen',
                            net_id='451')
 
-        result = json.loads(api.show_network('spiderwebs'))
+        result = json.loads(api.show_network('spiderwebs').read())
         assert result == {
             'name': 'spiderwebs',
             'owner': 'admin',
@@ -2218,7 +2413,7 @@ class TestShowNetwork:
 
         api.node_connect_network('node-anvil', 'eth0', 'spiderwebs')
         deferred.apply_networking()
-        result = json.loads(api.show_network('spiderwebs'))
+        result = json.loads(api.show_network('spiderwebs').read())
 
         assert result == {
             'name': 'spiderwebs',
@@ -2249,7 +2444,7 @@ class TestShowNetwork:
         auth.set_project(project)
         auth.set_admin(False)
 
-        result = json.loads(api.show_network('spiderwebs'))
+        result = json.loads(api.show_network('spiderwebs').read())
 
         # check that nodes not owned by this project aren't visible in output.
         assert result == {
@@ -2267,7 +2462,7 @@ class TestShowNetwork:
         auth.set_project(project)
         auth.set_admin(False)
 
-        result = json.loads(api.show_network('spiderwebs'))
+        result = json.loads(api.show_network('spiderwebs').read())
 
         # all nodes should be visible now.
         assert result == {
@@ -2412,7 +2607,10 @@ class TestShowNetworkingAction(unittest.TestCase):
                             'nic': '99-eth0',
                             'type': 'modify_port',
                             'channel': 'vlan/native',
-                            'new_network': 'hammernet'}
+                            'new_network': 'hammernet',
+                            'attempts': 0,
+                            'next_attempt': None,
+                            'failed_attempts': []}
 
         deferred.apply_networking()
         response = json.loads(api.show_networking_action(status_id))
@@ -2451,10 +2649,190 @@ class TestShowNetworkingAction(unittest.TestCase):
                             'nic': '99-eth0',
                             'type': 'revert_port',
                             'channel': '',
-                            'new_network': None}
+                            'new_network': None,
+                            'attempts': 0,
+                            'next_attempt': None,
+                            'failed_attempts': []}
 
     def test_show_networking_action_nonexistent(self):
         """Show networking action on a a non existent status_id"""
         status_id = '96c888a9-3257-491b-bca9-06be26b15525'
         with pytest.raises(errors.NotFoundError):
             api.show_networking_action(status_id)
+
+
+class FakeClock(object):
+    """Stands in for the `time` module in `hil.api`.
+
+    Sleeping advances the clock instantly, and then calls `on_sleep`, which
+    tests may use to simulate the networking daemon doing its work.
+    """
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = 0
+        self.on_sleep = lambda: None
+
+    def time(self):
+        """Return the current (fake) time."""
+        return self.now
+
+    def sleep(self, seconds):
+        """Advance the clock by `seconds`, then call `on_sleep`."""
+        self.now += seconds
+        self.sleeps += 1
+        self.on_sleep()
+
+
+class TestWaitForNetworkingAction:
+    """Tests for waiting on networking actions to finish."""
+
+    pytestmark = pytest.mark.usefixtures(*(default_fixtures +
+                                           ['switchinit']))
+
+    @pytest.fixture
+    def status_id(self):
+        """Start a networking action, and return its status id."""
+        new_node('node-99')
+        api.node_register_nic('node-99', '99-eth0', 'DE:AD:BE:EF:20:14')
+        api.project_create('anvil-nextgen')
+        api.project_connect_node('anvil-nextgen', 'node-99')
+        network_create_simple('hammernet', 'anvil-nextgen')
+        api.port_connect_nic('sw0', PORTS[2], 'node-99', '99-eth0')
+        response = api.node_connect_network('node-99', '99-eth0', 'hammernet')
+        return json.loads(response[0])['status_id']
+
+    @pytest.fixture
+    def clock(self, monkeypatch):
+        """Replace the clock used by `hil.api` with a `FakeClock`."""
+        clock = FakeClock()
+        monkeypatch.setattr(api, 'time', clock)
+        return clock
+
+    @pytest.fixture
+    def transaction_state(self):
+        """Track whether the session has a database transaction open.
+
+        Returns a dictionary, whose ``open`` key says whether it does.
+        """
+        state = {'open': False}
+
+        def begin(*args):
+            """Record the start of a transaction."""
+            # pylint: disable=unused-argument
+            state['open'] = True
+
+        def end(*args):
+            """Record the end of a transaction."""
+            # pylint: disable=unused-argument
+            state['open'] = False
+
+        listeners = [('after_begin', begin),
+                     ('after_commit', end),
+                     ('after_rollback', end)]
+        for name, fn in listeners:
+            event.listen(SignallingSession, name, fn)
+        yield state
+        for name, fn in listeners:
+            event.remove(SignallingSession, name, fn)
+
+    def test_no_transaction_while_waiting(self, status_id, clock,
+                                          transaction_state):
+        """Waiting doesn't hold a transaction open while it sleeps."""
+        open_while_sleeping = []
+
+        def on_sleep():
+            """Note whether there is a transaction open, and then
+            apply the pending networking actions.
+            """
+            open_while_sleeping.append(transaction_state['open'])
+            deferred.apply_networking()
+
+        clock.on_sleep = on_sleep
+        response = json.loads(api.show_networking_action(status_id,
+                                                         wait=30))
+        assert response['status'] == 'DONE'
+        response = api.networking_action_events('anvil-nextgen', timeout=2)
+        assert len(list(response.response)) == 1
+        assert open_while_sleeping and not any(open_while_sleeping)
+
+    def test_wait_done(self, status_id, clock):
+        """Waiting returns as soon as the action is done."""
+        clock.on_sleep = deferred.apply_networking
+        response = json.loads(api.show_networking_action(status_id,
+                                                         wait=30))
+        assert response['status'] == 'DONE'
+        assert clock.sleeps == 1
+
+    def test_wait_timeout(self, status_id, clock):
+        """Waiting gives up after the timeout."""
+        response = json.loads(api.show_networking_action(status_id,
+                                                         wait=3))
+        assert response['status'] == 'PENDING'
+        assert clock.now == 3
+
+    def test_wait_limit(self, status_id, clock):
+        """Waits longer than MAX_ACTION_WAIT are cut short."""
+        response = json.loads(api.show_networking_action(status_id,
+                                                         wait=3600))
+        assert response['status'] == 'PENDING'
+        assert clock.now == api.MAX_ACTION_WAIT
+
+    def test_no_wait(self, status_id, clock):
+        """Without wait, the status is returned immediately."""
+        response = json.loads(api.show_networking_action(status_id))
+        assert response['status'] == 'PENDING'
+        assert clock.sleeps == 0
+
+    def test_events(self, status_id, clock):
+        """The event stream reports the actions' status changes."""
+        clock.on_sleep = deferred.apply_networking
+        response = api.networking_action_events('anvil-nextgen', timeout=20)
+        assert response.mimetype == 'text/event-stream'
+        chunks = list(response.response)
+
+        events = [chunk for chunk in chunks if not chunk.startswith(':')]
+        assert len(events) == 2
+        for event, status in zip(events, ['PENDING', 'DONE']):
+            lines = event.split('\n')
+            assert lines[0] == 'event: networking_action'
+            assert lines[1].startswith('data: ')
+            data = json.loads(lines[1][len('data: '):])
+            assert data['status_id'] == status_id
+            assert data['status'] == status
+            assert data['node'] == 'node-99'
+        # With nothing happening, keepalives are sent:
+        assert ': keepalive\n\n' in chunks
+        assert clock.now == 20
+
+    def test_events_not_gzipped(self, status_id, clock, monkeypatch):
+        """The event stream isn't gzipped, even if the client accepts it,
+        since the events would be held up in the compressor's buffer.
+        """
+        clock.on_sleep = deferred.apply_networking
+        # The mock auth backend forgets our admin access at the start of
+        # each request; restore it:
+        auth = get_auth_backend()
+        authenticate = auth.authenticate
+
+        def authenticate_as_admin():
+            """Authenticate, with admin access."""
+            ok = authenticate()
+            auth.set_admin(True)
+            return ok
+        monkeypatch.setattr(auth, 'authenticate', authenticate_as_admin)
+        resp = app.test_client().get(
+            '/project/anvil-nextgen/networking_actions/events?timeout=2',
+            headers={'Accept-Encoding': 'gzip'})
+        assert resp.status_code == 200
+        assert resp.mimetype == 'text/event-stream'
+        assert 'Content-Encoding' not in resp.headers
+        events = [chunk for chunk in resp.get_data().split('\n\n')
+                  if chunk.startswith('event: ')]
+        assert len(events) == 2
+        assert '"status": "DONE"' in events[1]
+
+    def test_events_no_project(self):
+        """The event stream is only available for existing projects."""
+        with pytest.raises(errors.NotFoundError):
+            api.networking_action_events('no-such-project')
@@ -0,0 +1,114 @@
+"""Tests for the ``batch`` command of the CLI.
+
+These run the commands in-process, using a few fake commands registered
+just for the tests, rather than talking to a HIL server.
+"""
+
+import json
+import threading
+
+import pytest
+
+from hil import cli
+from hil.client.base import FailedAPICallException
+
+
+@pytest.fixture(autouse=True)
+def fake_commands(monkeypatch):
+    """Register some fake commands with the CLI."""
+    entered = []
+    lock = threading.Lock()
+    gate = threading.Event()
+
+    def echo(*words):
+        """Print the arguments."""
+        print ' '.join(words)
+
+    def fail(message):
+        """Fail with an API error."""
+        raise FailedAPICallException('NotFoundError', message)
+
+    def rendezvous(n):
+        """Wait until `n` copies of this command are running at once."""
+        with lock:
+            entered.append(None)
+            if len(entered) == int(n):
+                gate.set()
+        if not gate.wait(5):
+            raise RuntimeError('timed out')
+        print 'met'
+
+    for f in echo, fail, rendezvous:
+        # Make sure the commands are removed again after the test:
+        monkeypatch.setitem(cli.command_dict, f.__name__, None)
+        monkeypatch.setitem(cli.usage_dict, f.__name__, None)
+        cli.cmd(f)
+
+
+def run_batch(tmpdir, capsys, text, *options):
+    """Run ``batch`` on `text`; return the results and the exit status."""
+    path = tmpdir.join('commands')
+    path.write(text)
+    status = None
+    try:
+        cli.batch(*(options + (str(path),)))
+    except SystemExit as e:
+        status = e.code
+    out, _ = capsys.readouterr()
+    return [json.loads(line) for line in out.splitlines()], status
+
+
+def test_lines(tmpdir, capsys):
+    """Commands are read one per line, and run in order."""
+    results, status = run_batch(tmpdir, capsys, '\n'.join([
+        'echo hello world',
+        '',
+        '# a comment',
+        'echo "quoted words"',
+    ]))
+    assert status is None
+    assert results == [
+        {'line': 1, 'command': ['echo', 'hello', 'world'],
+         'status': 'ok', 'output': 'hello world\n'},
+        {'line': 4, 'command': ['echo', 'quoted words'],
+         'status': 'ok', 'output': 'quoted words\n'},
+    ]
+
+
+def test_json(tmpdir, capsys):
+    """Commands may be given as a JSON array."""
+    results, _ = run_batch(tmpdir, capsys, json.dumps([
+        ['echo', 'a b'],
+        'echo c d',
+    ]))
+    assert [r['output'] for r in results] == ['a b\n', 'c d\n']
+    assert [r['line'] for r in results] == [0, 1]
+
+
+def test_failures(tmpdir, capsys):
+    """Failed commands are reported, and don't stop the batch."""
+    results, status = run_batch(tmpdir, capsys, '\n'.join([
+        'fail "no such node"',
+        'no_such_command',
+        'fail',
+        'serve 5000',
+        'echo still here',
+    ]))
+    assert [r['status'] for r in results] == \
+        ['error', 'error', 'error', 'error', 'ok']
+    assert results[0]['error'] == 'no such node'
+    assert results[1]['error'] == 'Unknown command: no_such_command'
+    assert results[2]['error'] == \
+        'Invalid arguments. Usage: fail <message>'
+    assert "can't be used in a batch" in results[3]['error']
+    assert results[4]['output'] == 'still here\n'
+    assert status == '4 of 5 commands failed.'
+
+
+def test_jobs(tmpdir, capsys):
+    """With --jobs, commands run concurrently; results stay in order."""
+    lines = ['rendezvous 4'] * 4 + ['echo done']
+    results, status = run_batch(tmpdir, capsys, '\n'.join(lines),
+                                '--jobs', '4')
+    assert status is None
+    assert [r['output'] for r in results] == ['met\n'] * 4 + ['done\n']
@@ -0,0 +1,52 @@
+"""Check that the CLI doesn't import more than it needs to.
+
+Client commands should only need `hil.client` and its HTTP stack; importing
+the server side of HIL (flask, sqlalchemy, every API call...) slows down
+every invocation of the CLI. See also ``tests/benchmarks/startup.py``.
+"""
+
+import json
+import subprocess
+import sys
+
+# Modules (or packages) which client commands must not import:
+SERVER_MODULES = [
+    'flask',
+    'flask_sqlalchemy',
+    'sqlalchemy',
+    'schema',
+    'pkg_resources',
+    'hil.api',
+    'hil.config',
+    'hil.model',
+    'hil.server',
+    'hil.migrations',
+]
+
+
+def imported_modules(code):
+    """Run `code` in a fresh interpreter; return the modules it imported."""
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        code + '\nimport sys, json\n'
+        'print(json.dumps([name for name, mod in sys.modules.items() '
+        'if mod is not None]))',
+    ])
+    return set(json.loads(output.splitlines()[-1]))
+
+
+def test_client_commands_import_no_server_modules():
+    """Importing the CLI and setting up its client doesn't load the server."""
+    modules = imported_modules(
+        'import os\n'
+        'os.environ["HIL_ENDPOINT"] = "http://127.0.0.1:1"\n'
+        'os.environ["HIL_USERNAME"] = "alice"\n'
+        'os.environ["HIL_PASSWORD"] = "secret"\n'
+        'from hil import cli\n'
+        'cli.setup_http_client()\n'
+    )
+    assert 'hil.cli' in modules
+    loaded = [name for name in modules
+              for prefix in SERVER_MODULES
+              if name == prefix or name.startswith(prefix + '.')]
+    assert loaded == []
@@ -1,6 +1,7 @@
 """Unit tests for client library"""
 from hil.flaskapp import app
-from hil.client.base import ClientBase, FailedAPICallException
+from hil.client.base import ClientBase, FailedAPICallException, \
+    ResponseCache
 from hil.errors import BadArgumentError, UnknownSubtypeError
 from hil.client.client import Client, HTTPClient, HTTPResponse
 from hil.test_common import config_testsuite, config_merge, \
@@ -10,6 +11,7 @@ from hil import config, deferred
 
 import json
 import pytest
+import zlib
 
 from urlparse import urlparse
 from base64 import urlsafe_b64encode
@@ -26,15 +28,20 @@ class FlaskHTTPClient(HTTPClient):
     def __init__(self):
         self._flask_client = app.test_client()
 
-    def request(self, method, url, data=None, params=None):
+    def request(self, method, url, data=None, params=None, headers=None):
 
         # Flask doesn't provide a straightforward way to do basic auth,
         # but it's not actually that complicated:
         auth_header = 'Basic ' + urlsafe_b64encode(username + ':' + password)
+        headers = dict(headers or {})
+        headers['Authorization'] = auth_header
+        # Like requests, ask for compressed responses (which the client
+        # library has to decompress, since Flask's test client doesn't):
+        headers.setdefault('Accept-Encoding', 'gzip')
 
         resp = self._flask_client.open(
             method=method,
-            headers={'Authorization': auth_header},
+            headers=headers,
             # flask expects just a path, and assumes
             # the host & scheme:
             path=urlparse(url).path,
@@ -46,6 +53,20 @@ class FlaskHTTPClient(HTTPClient):
                             content=resp.get_data())
 
 
+class RecordingHTTPClient(HTTPClient):
+    """HTTPClient which wraps another, recording each response's status."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.statuses = []
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        resp = self.inner.request(method, url, data=data, params=params,
+                                  headers=headers)
+        self.statuses.append(resp.status_code)
+        return resp
+
+
 http_client = FlaskHTTPClient()
 C = Client(ep, http_client)  # Initializing client library
 
@@ -279,6 +300,21 @@ class Test_ClientBase:
         y = x.object_url('abc', '123', 'xy23z')
         assert y == 'http://127.0.0.1:8000/abc/123/xy23z'
 
+    def test_response_cache_lru(self):
+        """ResponseCache evicts the least recently used response."""
+        cache = ResponseCache(2)
+        a = ResponseCache.key(ep + '/a', None)
+        b = ResponseCache.key(ep + '/b', {'x': 'y'})
+        c = ResponseCache.key(ep + '/c', None)
+        cache.put(a, '"a"', 'A')
+        cache.put(b, '"b"', 'B')
+        assert cache.get(a) == ('"a"', 'A')
+        cache.put(c, '"c"', 'C')
+        assert len(cache) == 2
+        assert cache.get(b) is None
+        assert cache.get(a) == ('"a"', 'A')
+        assert cache.get(c) == ('"c"', 'C')
+
 
 class Test_node:
     """ Tests Node related client calls. """
@@ -327,6 +363,40 @@ class Test_node:
                 u'name': u'node-07'
                 }
 
+    def test_show_node_cached(self):
+        """Repeated calls to show_node only fetch the node if it changed."""
+        recorder = RecordingHTTPClient(http_client)
+        client = Client(ep, recorder, cache_size=16)
+        first = client.node.show('node-07')
+        assert client.node.show('node-07') == first
+        assert recorder.statuses == [200, 304]
+
+        client.node.metadata_set('node-07', 'EK', 'pk')
+        assert client.node.show('node-07')['metadata'] == {'EK': '"pk"'}
+        assert recorder.statuses[-1] == 200
+
+        # Without the cache (the default), every request gets the whole
+        # node:
+        recorder = RecordingHTTPClient(http_client)
+        client = Client(ep, recorder)
+        client.node.show('node-07')
+        client.node.show('node-07')
+        assert recorder.statuses == [200, 200]
+
+    def test_show_node_cached_old_client(self):
+        """The cache is ignored for HTTPClients which can't send headers."""
+        class OldHTTPClient(HTTPClient):
+            """An HTTPClient written before the headers argument existed."""
+
+            # pylint: disable=arguments-differ,signature-differs
+            def request(self, method, url, data=None, params=None):
+                return http_client.request(method, url, data=data,
+                                           params=params)
+
+        client = Client(ep, OldHTTPClient(), cache_size=16)
+        assert client.node.show('node-07') == C.node.show('node-07')
+        assert client.node.show('node-07') == C.node.show('node-07')
+
     def test_show_node_reserved_chars(self):
         """ test for catching illegal argument characters"""
         with pytest.raises(BadArgumentError):
@@ -363,6 +433,31 @@ class Test_node:
         with pytest.raises(BadArgumentError):
             C.node.power_off('node-/%]07')
 
+    def test_show_power(self):
+        """(successful) to show_node_power"""
+        assert C.node.show_power('node-07') == {
+            'power': None,
+            'reachable': None,
+            'error': None,
+            'last_checked': None,
+        }
+        # The nodes here use ipmi, so in dry run mode the power state stays
+        # unknown, but the node is now marked as having been checked:
+        assert C.node.show_power('node-07', fresh=True)['reachable'] is True
+        assert C.node.show_power('node-07')['last_checked'] is not None
+
+    def test_show_power_reserved_chars(self):
+        """ test for catching illegal argument characters"""
+        with pytest.raises(BadArgumentError):
+            C.node.show_power('node-/%]07')
+
+    def test_list_power(self):
+        """(successful) to list_nodes_power"""
+        C.node.show_power('node-07', fresh=True)
+        result = C.node.list_power('all')
+        assert result['node-07']['reachable'] is True
+        assert result['node-08']['reachable'] is None
+
     def test_set_bootdev(self):
         """ (successful) to node_set_bootdev """
         assert C.node.set_bootdev("node-08", "pxe") is None
@@ -990,7 +1085,10 @@ class TestShowNetworkingAction:
                             'nic': 'eth0',
                             'type': 'modify_port',
                             'channel': 'vlan/native',
-                            'new_network': 'net-01'}
+                            'new_network': 'net-01',
+                            'attempts': 0,
+                            'next_attempt': None,
+                            'failed_attempts': []}
 
         deferred.apply_networking()
         response = C.node.show_networking_action(status_id)
@@ -1000,3 +1098,91 @@ class TestShowNetworkingAction:
         """(unsuccessful) call to show_networking_action"""
         with pytest.raises(FailedAPICallException):
             C.node.show_networking_action('non-existent-entry')
+
+    def test_wait_for(self):
+        """wait_for returns once the action is done, or on timeout."""
+        response = C.node.connect_network(
+                'node-01', 'eth0', 'net-01', 'vlan/native'
+                )
+        status_id = response['status_id']
+
+        response = C.node.wait_for(status_id, timeout=0)
+        assert response['status'] == 'PENDING'
+
+        deferred.apply_networking()
+        response = C.node.wait_for(status_id)
+        assert response['status'] == 'DONE'
+
+
+class TestBatch:
+    """Test sending calls in batches"""
+
+    def test_batch(self):
+        """Calls in a batch are run in order, and report their results."""
+        recorder = RecordingHTTPClient(http_client)
+        client = Client(ep, recorder)
+        with client.batch() as b:
+            info = b.node.show('node-01')
+            detach = b.project.detach('proj-01', 'node-01')
+            nodes = b.project.nodes_in('proj-01')
+            bad = b.node.show('node-99')
+            assert not info.ready()
+        # One request for the whole batch:
+        assert recorder.statuses == [200]
+        assert b.committed
+        assert info.get()['project'] == 'proj-01'
+        assert detach.get() is None
+        assert nodes.get() == []
+        with pytest.raises(FailedAPICallException):
+            bad.get()
+        assert C.node.show('node-01')['project'] is None
+
+    def test_atomic_batch(self):
+        """If a call in an atomic batch fails, nothing is committed."""
+        with C.batch(atomic=True) as b:
+            detach = b.project.detach('proj-01', 'node-01')
+            bad = b.project.detach('proj-01', 'node-02')
+            connect = b.project.connect('proj-02', 'node-01')
+        assert not b.committed
+        assert detach.get() is None
+        with pytest.raises(FailedAPICallException):
+            bad.get()
+        with pytest.raises(FailedAPICallException) as excinfo:
+            connect.get()
+        assert excinfo.value.error_type == 'BatchAbortedError'
+        assert C.node.show('node-01')['project'] == 'proj-01'
+
+    def test_batch_reserved_chars(self):
+        """Client-side checks are made when the call is recorded."""
+        with C.batch() as b:
+            with pytest.raises(BadArgumentError):
+                b.node.show('node/%*01')
+        assert b.calls == []
+
+    def test_batch_prefix(self):
+        """Paths are recorded relative to the endpoint, which may have a
+        path of its own.
+        """
+        for endpoint in ep + '/hil/', ep + '/hil', ep:
+            b = Client(endpoint, http_client).batch()
+            b.node.show('node-01')
+            b.project.detach('proj-01', 'node-01')
+            assert [call['path'] for call in b.calls] == [
+                '/node/node-01',
+                '/project/proj-01/detach_node',
+            ]
+
+
+def test_check_response_gzip():
+    """check_response decompresses gzipped bodies, unless the HTTP client
+    already did.
+    """
+    body = json.dumps({'network': 'pxe'})
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(body) + compressor.flush()
+    headers = {'Content-Encoding': 'gzip'}
+    for content in compressed, body:
+        response = HTTPResponse(status_code=200, headers=headers,
+                                content=content)
+        assert ClientBase(ep, http_client).check_response(response) == \
+            {'network': 'pxe'}
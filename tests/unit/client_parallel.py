@@ -0,0 +1,184 @@
+"""Unit tests for hil.client.parallel
+
+These run against a fake HTTPClient, which serves canned responses and keeps
+track of how many requests are in flight at once.
+"""
+
+import json
+import threading
+import time
+
+import pytest
+import requests
+from requests.packages.urllib3.exceptions import MaxRetryError, \
+    NewConnectionError
+
+from hil.client.base import FailedAPICallException
+from hil.client.client import HTTPClient, HTTPResponse
+from hil.client.parallel import ParallelClient, RetryingHTTPClient
+
+ep = "http://127.0.0.1:8000"
+
+NODES = ['node-%d' % i for i in range(20)]
+
+
+class FakeHTTPClient(HTTPClient):
+    """An HTTPClient serving a handful of (GET) API calls.
+
+    Each request takes `delay` seconds. `responses` may be used to override
+    the response to a particular URL; the value should be a list of
+    responses (or exceptions to raise), which are used in turn.
+    """
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.responses = {}
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def request(self, method, url, data=None, params=None, headers=None):
+        with self.lock:
+            self.requests.append((method, url))
+            self.in_flight += 1
+            self.max_in_flight = max(self.in_flight, self.max_in_flight)
+        try:
+            time.sleep(self.delay)
+            return self._respond(url[len(ep):])
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _respond(self, path):
+        if path in self.responses:
+            with self.lock:
+                resp = self.responses[path].pop(0)
+            if isinstance(resp, Exception):
+                raise resp
+            return resp
+        parts = path.split('/')
+        if path == '/project/runway/nodes':
+            return _ok(NODES[:10])
+        elif parts[1] == 'node' and parts[2] in NODES:
+            return _ok({'name': parts[2]})
+        return HTTPResponse(status_code=404, headers={}, content=json.dumps({
+            'type': 'NotFoundError',
+            'msg': 'no such object: %s' % path,
+        }))
+
+
+def _ok(body):
+    """Return a 200 response with `body` (as JSON)."""
+    return HTTPResponse(status_code=200, headers={}, content=json.dumps(body))
+
+
+def _status(status_code):
+    """Return an empty response with the given status code."""
+    return HTTPResponse(status_code=status_code, headers={}, content='')
+
+
+@pytest.fixture
+def http_client():
+    """Return a FakeHTTPClient."""
+    return FakeHTTPClient()
+
+
+@pytest.fixture
+def client(http_client):
+    """Return a ParallelClient with 4 workers."""
+    with ParallelClient(ep, http_client, workers=4) as client:
+        yield client
+
+
+def test_async_call(client):
+    """Calls return AsyncResults, which hold the response."""
+    result = client.node.show('node-3')
+    assert result.get() == {'name': 'node-3'}
+    with pytest.raises(FailedAPICallException):
+        client.node.show('node-99').get()
+
+
+def test_fan_out(client, http_client):
+    """Fan-out helpers make their calls concurrently, but not too many."""
+    start = time.time()
+    nodes = client.show_project_nodes('runway')
+    elapsed = time.time() - start
+    assert nodes == {label: {'name': label} for label in NODES[:10]}
+    assert http_client.max_in_flight == 4
+    # 1 request for the list, then 3 rounds of 4 (the last only half full):
+    assert elapsed < 10 * http_client.delay
+
+
+def test_map_order(client):
+    """map returns results in the order of its arguments."""
+    names = list(reversed(NODES))
+    results = client.map(client.client.node.show, names)
+    assert [r['name'] for r in results] == names
+
+
+def test_map_error(client):
+    """map re-raises exceptions from the calls."""
+    with pytest.raises(FailedAPICallException):
+        client.show_nodes(['node-1', 'node-99', 'node-2'])
+
+
+def test_retry(http_client):
+    """Transient failures of GET requests are retried."""
+    delays = []
+    retrying = RetryingHTTPClient(http_client, retries=3, backoff=0.1,
+                                  sleep=delays.append)
+    http_client.responses[''] = [
+        _status(503),
+        requests.ConnectionError(),
+        _status(502),
+        _ok('hello'),
+    ]
+    resp = retrying.request('GET', ep)
+    assert json.loads(resp.content) == 'hello'
+    assert len(delays) == 3
+    for i, delay in enumerate(delays):
+        assert 0 <= delay <= 0.1 * 2 ** i
+
+
+def test_retry_gives_up(http_client):
+    """After too many retries, the last response or error is returned."""
+    retrying = RetryingHTTPClient(http_client, retries=1,
+                                  sleep=lambda _: None)
+    http_client.responses[''] = [_status(503), _status(504)]
+    assert retrying.request('GET', ep).status_code == 504
+
+    http_client.responses[''] = [_status(503), requests.Timeout()]
+    with pytest.raises(requests.Timeout):
+        retrying.request('HEAD', ep)
+
+
+@pytest.mark.parametrize('method', ['POST', 'PUT', 'DELETE'])
+def test_no_retry_unsafe(http_client, method):
+    """Other requests aren't retried if they may have reached the server,
+    since e.g. a PUT which created something fails with a 409 if it's sent
+    again.
+    """
+    retrying = RetryingHTTPClient(http_client, sleep=lambda _: None)
+    http_client.responses[''] = [_status(503), _ok('hello')]
+    assert retrying.request(method, ep).status_code == 503
+    assert len(http_client.requests) == 1
+
+    http_client.responses[''] = [requests.ReadTimeout(), _ok('hello')]
+    with pytest.raises(requests.ReadTimeout):
+        retrying.request(method, ep)
+    assert len(http_client.requests) == 2
+
+
+@pytest.mark.parametrize('method', ['POST', 'PUT', 'DELETE'])
+def test_retry_unsent(http_client, method):
+    """Requests which never reached the server are retried, whatever the
+    method.
+    """
+    retrying = RetryingHTTPClient(http_client, sleep=lambda _: None)
+    refused = requests.ConnectionError(MaxRetryError(
+        None, ep, NewConnectionError(None, 'Connection refused')))
+    http_client.responses[''] = [refused, requests.ConnectTimeout(),
+                                 _ok('hello')]
+    assert json.loads(retrying.request(method, ep).content) == 'hello'
+    assert len(http_client.requests) == 3
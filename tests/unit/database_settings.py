@@ -0,0 +1,247 @@
+"""Tests for the database settings in the ``[database]`` section of the
+config: connection pooling, statement timeouts and the read replica.
+"""
+
+import json
+
+import pytest
+from schema import Schema
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from hil import config, metrics, model, read_cache, rest
+from hil.flaskapp import app
+from hil.model import db
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, fail_on_log_warnings, server_init
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config.load_extensions()
+
+
+@pytest.fixture
+def replica(tmpdir):
+    """Configure a read replica, in an SQLite file; return its engine.
+
+    This must run before `fresh_database`. The replica is given its own
+    (empty) copy of the schema, but is otherwise independent of the primary
+    database, so tests can tell which one was used.
+    """
+    config_testsuite()
+    config_merge({
+        'database': {
+            'replica_uri': 'sqlite:///%s' % tmpdir.join('replica.db'),
+        },
+    })
+    config.load_extensions()
+    model.init_db()
+    engine = db.get_engine(app, bind=model.REPLICA)
+    db.Model.metadata.create_all(engine)
+    engine.execute(model.Project.__table__.insert(),
+                   [{'id': 1, 'label': 'on-replica'}])
+    return engine
+
+
+@pytest.fixture
+def client():
+    """Return a flask test client."""
+    return app.test_client()
+
+
+@rest.rest_call('GET', '/test/projects/read_only', Schema({}), read_only=True)
+def read_only_projects():
+    """List the projects, in a read-only call."""
+    return json.dumps(sorted(p.label for p in model.Project.query))
+
+
+@rest.rest_call('GET', '/test/projects', Schema({}))
+def projects():
+    """List the projects, in a call which isn't declared read-only."""
+    return json.dumps(sorted(p.label for p in model.Project.query))
+
+
+def test_pool_options(configure):
+    """Pool options are passed to Flask-SQLAlchemy, except for SQLite."""
+    config_merge({
+        'database': {
+            'uri': 'postgresql://hil@localhost/hil',
+            'pool_size': '20',
+            'max_overflow': '5',
+            'pool_recycle': '3600',
+        },
+    })
+    model.init_db()
+    assert app.config['SQLALCHEMY_POOL_SIZE'] == 20
+    assert app.config['SQLALCHEMY_MAX_OVERFLOW'] == 5
+    assert app.config['SQLALCHEMY_POOL_RECYCLE'] == 3600
+    assert app.config['SQLALCHEMY_POOL_TIMEOUT'] is None
+
+    config_merge({'database': {'uri': 'sqlite:///:memory:'}})
+    model.init_db()
+    assert app.config['SQLALCHEMY_POOL_SIZE'] is None
+
+
+def test_engine_options(configure):
+    """Pre-ping and the statement timeout are added to the engine options.
+    """
+    config_merge({
+        'database': {
+            'pool_pre_ping': 'True',
+            'statement_timeout': '2.5',
+        },
+    })
+    model.init_db()
+    options = {}
+    db.apply_driver_hacks(app, make_url('postgresql://hil@localhost/hil'),
+                          options)
+    assert options['pool_pre_ping'] is True
+    assert options['connect_args'] == {'options': '-c statement_timeout=2500'}
+
+    # The statement timeout is only supported for PostgreSQL:
+    options = {}
+    db.apply_driver_hacks(app, make_url('sqlite:///:memory:'), options)
+    assert 'options' not in options.get('connect_args', {})
+
+
+def test_replica_reads(replica, fresh_database):
+    """Queries go to the replica within `replica_reads`, but flushes don't.
+    """
+    with app.app_context():
+        with model.replica_reads():
+            assert [p.label for p in model.Project.query] == ['on-replica']
+            db.session.add(model.Project('on-primary'))
+            db.session.commit()
+        with model.replica_reads(enabled=False):
+            assert [p.label for p in model.Project.query] == ['on-primary']
+    assert replica.execute('SELECT count(*) FROM project').scalar() == 1
+
+
+def test_no_replica(configure, fresh_database):
+    """Without a replica, `replica_reads` changes nothing."""
+    assert not model.have_replica()
+    with app.app_context():
+        db.session.add(model.Project('on-primary'))
+        db.session.commit()
+        with model.replica_reads():
+            assert [p.label for p in model.Project.query] == ['on-primary']
+
+
+def test_api_replica_reads(replica, fresh_database, server_init, client):
+    """Read-only calls are served from the replica; others from the primary.
+    """
+    assert client.put('/project/on-primary').status_code == 200
+    resp = client.get('/projects')
+    assert json.loads(resp.get_data()) == ['on-replica']
+    assert client.delete('/project/on-replica').status_code == 404
+
+    resp = client.get('/test/projects/read_only')
+    assert json.loads(resp.get_data()) == ['on-replica']
+    resp = client.get('/test/projects')
+    assert json.loads(resp.get_data()) == ['on-primary']
+
+
+def test_pin_to_primary(replica, fresh_database, server_init, client):
+    """Clients are kept on the primary for a while after making changes."""
+    config_merge({'database': {'replica_pin_seconds': '60'}})
+    model.init_db()
+
+    def projects(client):
+        """Return the projects `client` sees."""
+        return json.loads(client.get('/test/projects/read_only').get_data())
+
+    assert projects(client) == ['on-replica']
+    assert client.put('/project/on-primary').status_code == 200
+    assert projects(client) == ['on-primary']
+    # Other clients still use the replica:
+    assert projects(app.test_client()) == ['on-replica']
+    # Failed requests don't pin the client:
+    other = app.test_client()
+    assert other.put('/project/on-primary').status_code == 409
+    assert projects(other) == ['on-replica']
+
+
+def test_no_pin_without_option(replica, fresh_database, server_init,
+                               client):
+    """Clients aren't pinned to the primary unless configured to be."""
+    assert client.put('/project/on-primary').status_code == 200
+    assert rest.PIN_COOKIE not in str(client.cookie_jar)
+    resp = client.get('/test/projects/read_only')
+    assert json.loads(resp.get_data()) == ['on-replica']
+
+
+@pytest.fixture
+def replica_cache(replica):
+    """Like `replica`, but with the read cache enabled too; returns the
+    cache.
+    """
+    config_merge({'cache': {'backend': 'memory'}})
+    read_cache.init()
+    yield read_cache.get_cache()
+    config_testsuite()
+    read_cache.init()
+
+
+def test_replica_not_cached(replica_cache, fresh_database, server_init,
+                            client):
+    """Responses computed from the replica aren't cached, since it may lag
+    behind the primary; those computed from the primary are.
+    """
+    config_merge({'database': {'replica_pin_seconds': '60'}})
+    model.init_db()
+
+    assert json.loads(client.get('/projects').get_data()) == ['on-replica']
+    assert json.loads(client.get('/projects').get_data()) == ['on-replica']
+    assert replica_cache.stats['list_projects'] == {'hits': 0, 'misses': 2}
+
+    # The pinned client reads from the primary, so its response is cached,
+    # and served to other clients:
+    assert client.put('/project/on-primary').status_code == 200
+    assert json.loads(client.get('/projects').get_data()) == ['on-primary']
+    other = app.test_client()
+    assert json.loads(other.get('/projects').get_data()) == ['on-primary']
+    assert replica_cache.stats['list_projects'] == {'hits': 1, 'misses': 3}
+
+
+def test_read_only_post():
+    """Only GET calls may be declared read-only."""
+    with pytest.raises(ValueError):
+        rest.rest_call('POST', '/test/read_only_post', Schema({}),
+                       read_only=True)(lambda: None)
+
+
+def test_pool_metrics(configure, monkeypatch):
+    """The state of the connection pool is exposed as metrics."""
+    import sqlite3
+
+    class FakeEngine(object):
+        """Just enough of an engine for `_collect_pool_metrics`."""
+        pool = QueuePool(lambda: sqlite3.connect(':memory:'), pool_size=3)
+
+    monkeypatch.setattr(db, 'get_engine',
+                        lambda app, bind=None: FakeEngine())
+    conn = FakeEngine.pool.connect()
+    try:
+        exposed = metrics.REGISTRY.expose()
+    finally:
+        conn.close()
+    assert 'hil_db_pool_size{database="primary"} 3.0' in exposed
+    assert 'hil_db_pool_connections{database="primary",' \
+        'state="checked_out"} 1.0' in exposed
+
+
+def test_collectors():
+    """Collectors are called whenever the metrics are exposed."""
+    registry = metrics.Registry()
+    gauge = registry.gauge('calls', 'Calls.')
+    registry.add_collector(gauge.inc)
+    registry.add_collector(gauge.inc)
+    assert registry.expose().endswith('calls 1.0\n')
+    assert registry.expose().endswith('calls 2.0\n')
@@ -0,0 +1,113 @@
+"""Tests for hil.deadline, and the drivers' use of it."""
+
+from subprocess import Popen, PIPE
+import sys
+import time
+
+import pexpect
+import pytest
+
+from hil import deadline
+from hil.errors import OBMError, SwitchError
+from hil.test_common import config_testsuite, config_merge
+
+
+@pytest.fixture(autouse=True)
+def configure():
+    """Configure HIL, with short time limits."""
+    config_testsuite()
+    config_merge({
+        'timeouts': {
+            'switch_io': '0.5',
+            'switch_operation': '10',
+            'obm_io': '0.5',
+        },
+    })
+
+
+def test_timeout_defaults():
+    """Outside of an operation, each call gets the configured limit."""
+    assert deadline.remaining('switch') is None
+    assert deadline.timeout('switch') == 0.5
+    assert deadline.timeout('obm') == 0.5
+    config_merge({'timeouts': {'obm_io': None}})
+    assert deadline.timeout('obm') == deadline.DEFAULTS['obm_io']
+
+
+def test_budget():
+    """Calls get no more than the time left in the operation, and nested
+    operations keep the earlier deadline.
+    """
+    with deadline.budget('switch', 0.2):
+        assert 0.1 < deadline.timeout('switch') <= 0.2
+        with deadline.budget('switch'):
+            assert deadline.timeout('switch') <= 0.2
+        with deadline.budget('switch', 0.05):
+            assert deadline.timeout('switch') <= 0.05
+        assert deadline.timeout('switch') > 0.1
+        # Budgets for switches don't affect OBMs:
+        assert deadline.timeout('obm') == 0.5
+        time.sleep(0.2)
+        with pytest.raises(SwitchError):
+            deadline.timeout('switch')
+    assert deadline.remaining('switch') is None
+
+
+def test_operation():
+    """The operation decorator sets a budget, from the config."""
+    @deadline.operation('obm')
+    def power_cycle():
+        """Return the time left."""
+        return deadline.remaining('obm')
+    assert 59 < power_cycle() <= 60
+
+    @deadline.operation('obm')
+    def too_slow():
+        """Run out of time."""
+        time.sleep(0.1)
+        deadline.timeout('obm')
+    config_merge({'timeouts': {'obm_operation': '0.05'}})
+    with pytest.raises(OBMError):
+        too_slow()
+
+
+def test_communicate():
+    """Processes which take too long are killed."""
+    proc = Popen([sys.executable, '-c', 'print("on")'], stdout=PIPE)
+    assert deadline.communicate(proc) == ('on\n', None)
+
+    proc = Popen([sys.executable, '-c', 'import time; time.sleep(10)'])
+    start = time.time()
+    with pytest.raises(OBMError):
+        deadline.communicate(proc)
+    assert time.time() - start < 5
+    assert proc.returncode is not None
+
+    proc = Popen([sys.executable, '-c', 'import time; time.sleep(10)'])
+    with pytest.raises(SwitchError):
+        with deadline.budget('switch', 0):
+            deadline.communicate(proc, kind='switch')
+    assert proc.returncode is not None
+
+
+def test_console():
+    """Switch consoles raise SwitchErrors if the expected output doesn't
+    come in time, or the connection is closed.
+    """
+    from hil.ext.switches._console import Console
+    console = Console(sys.executable,
+                      ['-c', 'import time; print("User Name:"); '
+                             'time.sleep(10)'])
+    assert console.expect(['User Name:', '#']) == 0
+    start = time.time()
+    with pytest.raises(SwitchError):
+        console.expect('#')
+    assert time.time() - start < 5
+    console.close(force=True)
+
+    console = Console(sys.executable, ['-c', 'print("bye")'])
+    with pytest.raises(SwitchError):
+        console.expect('#')
+    # EOF can still be expected explicitly:
+    console = Console(sys.executable, ['-c', 'print("bye")'])
+    assert console.expect(['#', pexpect.EOF]) == 1
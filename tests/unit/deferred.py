@@ -2,13 +2,15 @@
 
 import pytest
 import tempfile
+import time
 import uuid
 
-from hil import config, deferred, model, api
+from hil import config, deadline, deferred, model, api
 from hil.model import db, Switch
 from hil.errors import SwitchError
 from hil.test_common import config_testsuite, config_merge, \
                              fresh_database
+from datetime import datetime, timedelta
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 
@@ -208,6 +210,9 @@ def test_apply_networking(switch, network, fresh_database):
     The test also verifies that if a new networking action fails, then the
     old networking actions in the queue were commited.
     '''
+    # Don't retry failed actions; see test_retry for that:
+    config_merge({'network-daemon': {'max_attempts': '1'}})
+
     nic = []
     actions = []
     # initialize 3 nics and networking actions
@@ -303,3 +308,251 @@ def test_apply_networking(switch, network, fresh_database):
 
     local_db.session.commit()
     local_db.session.close()
+
+
+def test_noop_actions_skipped(switch, network, fresh_database, monkeypatch):
+    '''Actions which wouldn't change a port aren't sent to the switch.
+
+    If the driver reports the ports' state, actions which would leave a port
+    as it is are skipped, but still recorded in the database as done.
+    '''
+    state = {
+        'gi1/0/0': {'vlan/native': '102'},
+        'gi1/0/1': {},
+        'gi1/0/2': {},
+    }
+    calls = []
+    monkeypatch.setattr(DeferredTestSwitch, 'get_port_state',
+                        lambda self, port: state[port], raising=False)
+    monkeypatch.setattr(DeferredTestSwitch, 'modify_port',
+                        lambda self, *args: calls.append(args))
+    monkeypatch.setattr(DeferredTestSwitch, 'revert_port',
+                        lambda self, *args: calls.append(args))
+
+    nics = []
+    for i, (action_type, new_network, channel) in enumerate([
+            ('modify_port', network, 'vlan/native'),
+            ('revert_port', None, ''),
+            ('modify_port', network, 'vlan/native')]):
+        nics.append(new_nic(str(i)))
+        nics[i].port = model.Port(label='gi1/0/%d' % i, switch=switch)
+        db.session.add(model.NetworkingAction(nic=nics[i],
+                                              new_network=new_network,
+                                              channel=channel,
+                                              type=action_type,
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+    db.session.commit()
+
+    deferred.apply_networking()
+
+    # Only the last action changes anything:
+    assert calls == [('gi1/0/2', 'vlan/native', '102')]
+    assert model.NetworkingAction.query.filter_by(status='DONE').count() \
+        == 3
+    assert model.NetworkAttachment.query.count() == 2
+    db.session.close()
+
+
+def test_retry(switch, fresh_database):
+    '''Failed actions are retried, with increasing delays, until they run
+    out of attempts.
+    '''
+    config_merge({'network-daemon': {
+        'max_attempts': '3',
+        'retry_delay': '10',
+        'retry_jitter': '0',
+    }})
+    nic = new_nic('0')
+    nic.port = model.Port(label='gi1/0/0', switch=switch)
+    db.session.add(model.NetworkingAction(nic=nic,
+                                          new_network=None,
+                                          channel='',
+                                          type='revert_port',
+                                          uuid=str(uuid.uuid4()),
+                                          status='PENDING'))
+    db.session.commit()
+
+    for attempt, delay in (1, 10), (2, 20):
+        before = datetime.utcnow()
+        assert deferred.apply_networking()
+        action = model.NetworkingAction.query.one()
+        assert action.status == 'PENDING'
+        assert action.attempts == attempt
+        assert before + timedelta(seconds=delay) <= action.next_attempt \
+            <= datetime.utcnow() + timedelta(seconds=delay)
+
+        # The action isn't retried until it's time:
+        assert not deferred.apply_networking()
+        action = model.NetworkingAction.query.one()
+        assert action.attempts == attempt
+        action.next_attempt = datetime.utcnow()
+        db.session.commit()
+
+    assert deferred.apply_networking()
+    action = model.NetworkingAction.query.one()
+    assert action.status == 'ERROR'
+    assert action.attempts == 3
+    assert action.next_attempt is None
+
+    info = api._networking_action_dict(action)
+    assert info['attempts'] == 3
+    assert info['next_attempt'] is None
+    assert [attempt['error'] for attempt in info['failed_attempts']] == \
+        ['revert_port always fails.'] * 3
+    db.session.close()
+
+
+def test_retry_delay():
+    '''Retry delays double each time, up to the maximum, and are cut
+    short by up to the jitter.
+    '''
+    policy = dict(deferred.RETRY_DEFAULTS,
+                  retry_delay=2, retry_max_delay=10, retry_jitter=0)
+    assert [deferred.retry_delay(attempts, policy)
+            for attempts in range(1, 6)] == [2, 4, 8, 10, 10]
+
+    policy['retry_jitter'] = 0.5
+    delays = [deferred.retry_delay(3, policy) for _ in range(100)]
+    assert all(4 <= delay <= 8 for delay in delays)
+    assert len(set(delays)) > 1
+
+    config_merge({'network-daemon': {'retry_jitter': '2'}})
+    with pytest.raises(ValueError):
+        deferred.retry_policy()
+
+
+def test_circuit_breaker(_deferred_test_switch_class, network, fresh_database,
+                         monkeypatch):
+    '''Once enough actions on a switch fail in a row, its actions are left
+    alone for a while, without holding up the other switches'.
+    '''
+    config_merge({'network-daemon': {
+        'max_attempts': '10',
+        'retry_delay': '0',
+        'breaker_threshold': '2',
+        'breaker_open_time': '60',
+    }})
+    tried = []
+    broken = set(['bad'])
+
+    def revert_port(self, port):
+        """Fail on broken switches."""
+        tried.append((self.label, port))
+        if self.label in broken:
+            raise SwitchError('Connection refused')
+    monkeypatch.setattr(DeferredTestSwitch, 'revert_port', revert_port)
+    monkeypatch.setattr(DeferredTestSwitch, 'modify_port',
+                        lambda self, port, *args: tried.append((self.label,
+                                                                port)))
+
+    switches = {}
+    for label in 'bad', 'good':
+        switches[label] = DeferredTestSwitch(label=label,
+                                             hostname='http://example.com',
+                                             username='admin',
+                                             password='admin')
+    for i, label in enumerate(['bad', 'bad', 'bad', 'good']):
+        nic = new_nic(str(i))
+        nic.port = model.Port(label='gi1/0/%d' % i, switch=switches[label])
+        db.session.add(model.NetworkingAction(nic=nic,
+                                              new_network=network,
+                                              channel='vlan/native',
+                                              type='revert_port',
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+    db.session.commit()
+
+    def run():
+        """Run the networking daemon, and return the ports it tried."""
+        del tried[:]
+        deferred.apply_networking()
+        return tried[:]
+
+    def health():
+        """Return the bad switch's health."""
+        return model.SwitchHealth.query.one()
+
+    # The circuit opens after the second failure:
+    assert run() == [('bad', 'gi1/0/0'), ('bad', 'gi1/0/1'),
+                     ('good', 'gi1/0/3')]
+    assert health().consecutive_failures == 2
+    assert health().last_error == 'Connection refused'
+    assert health().state(datetime.utcnow()) == 'open'
+
+    # Nothing is tried while it's open:
+    assert run() == []
+
+    # Once it's time, one action is tried, and the circuit opens again if
+    # it fails:
+    health().open_until = datetime.utcnow() - timedelta(seconds=1)
+    assert health().state(datetime.utcnow()) == 'half-open'
+    db.session.commit()
+    assert run() == [('bad', 'gi1/0/0')]
+    assert health().consecutive_failures == 3
+    assert health().state(datetime.utcnow()) == 'open'
+
+    # ...and closes if it succeeds:
+    broken.clear()
+    health().open_until = datetime.utcnow() - timedelta(seconds=1)
+    db.session.commit()
+    assert run() == [('bad', 'gi1/0/0'), ('bad', 'gi1/0/1'),
+                     ('bad', 'gi1/0/2')]
+    assert health().consecutive_failures == 0
+    assert health().state(datetime.utcnow()) == 'closed'
+    assert model.NetworkingAction.query.filter_by(status='DONE').count() == 4
+    db.session.close()
+
+
+def test_timeouts(switch, network, fresh_database, monkeypatch):
+    '''An action which runs out of time fails, and the switch session is
+    not reused; a session which can't be disconnected doesn't stop the
+    daemon.
+    '''
+    config_merge({
+        'network-daemon': {'max_attempts': '1'},
+        'timeouts': {'switch_operation': '0.1'},
+    })
+    sessions = []
+
+    def session(self):
+        """Count the sessions started."""
+        sessions.append(self)
+        return self
+
+    def revert_port(self, port):
+        """Take too long, then ask for the time for the next request, as a
+        driver would.
+        """
+        time.sleep(0.2)
+        deadline.timeout('switch')
+
+    def disconnect(self):
+        """Fail to disconnect."""
+        raise SwitchError('Connection reset')
+    monkeypatch.setattr(DeferredTestSwitch, 'session', session)
+    monkeypatch.setattr(DeferredTestSwitch, 'revert_port', revert_port)
+    monkeypatch.setattr(DeferredTestSwitch, 'modify_port',
+                        lambda self, *args: None)
+    monkeypatch.setattr(DeferredTestSwitch, 'disconnect', disconnect)
+
+    for i, action_type in enumerate(['revert_port', 'modify_port']):
+        nic = new_nic(str(i))
+        nic.port = model.Port(label='gi1/0/%d' % i, switch=switch)
+        db.session.add(model.NetworkingAction(nic=nic,
+                                              new_network=network,
+                                              channel='vlan/native',
+                                              type=action_type,
+                                              uuid=str(uuid.uuid4()),
+                                              status='PENDING'))
+    db.session.commit()
+
+    assert deferred.apply_networking()
+    assert len(sessions) == 2
+    timed_out, done = model.NetworkingAction.query \
+        .order_by(model.NetworkingAction.id).all()
+    assert timed_out.status == 'ERROR'
+    assert timed_out.failed_attempts[0].error == \
+        'Ran out of time talking to the switch'
+    assert done.status == 'DONE'
+    db.session.close()
@@ -164,7 +164,7 @@ class TestListUsers(DBAuthTestCase):
 
     def test_list_users(self):
         """Listing all users with database authentication"""
-        result = json.loads(self.dbauth.list_users())
+        result = json.loads(self.dbauth.list_users().read())
         assert result == {
             u'alice': {u'is_admin': True, u'projects': [u'runway']},
             u'bob': {u'is_admin': False, u'projects': []},
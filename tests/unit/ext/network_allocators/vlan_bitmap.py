@@ -0,0 +1,188 @@
+"""Test the vlan_bitmap network allocator."""
+from hil.config import load_extensions
+from hil.flaskapp import app
+from hil.model import db
+from hil.migrations import create_db
+from hil.network_allocator import get_network_allocator
+from hil import api, config, errors
+from hil.auth import get_auth_backend
+from hil.test_common import fail_on_log_warnings, with_request_context, \
+    fresh_database, config_testsuite, config_merge, server_init
+from hil import model
+import json
+import pytest
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+with_request_context = pytest.yield_fixture(with_request_context)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+VLANS = [100, 101, 102, 103, 104, 300, 702, 4096]
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'auth': {
+            'require_authentication': 'True',
+        },
+        'extensions': {
+            'hil.ext.auth.null': None,
+            'hil.ext.auth.mock': '',
+            'hil.ext.network_allocators.null': None,
+            'hil.ext.network_allocators.vlan_bitmap': ''
+        },
+        'hil.ext.network_allocators.vlan_bitmap': {
+            'vlans': '100-104, 300, 702, 4096',  # Arbitrary list
+        },
+    })
+    load_extensions()
+
+
+@pytest.fixture
+def set_admin_auth():
+    """Set admin auth for all calls"""
+    get_auth_backend().set_admin(True)
+
+
+default_fixtures = ['fail_on_log_warnings',
+                    'configure',
+                    'fresh_database',
+                    'server_init',
+                    'with_request_context',
+                    'set_admin_auth']
+
+pytestmark = pytest.mark.usefixtures(*default_fixtures)
+
+
+def utilization():
+    """Return the result of the utilization api call, as a dict."""
+    from hil.ext.network_allocators.vlan_bitmap import show_vlan_utilization
+    return json.loads(show_vlan_utilization())
+
+
+def test_allocate_all():
+    """Each VLAN in the pool is handed out exactly once."""
+    allocator = get_network_allocator()
+    allocated = [allocator.get_new_network_id() for _ in VLANS]
+    assert sorted(int(vlan) for vlan in allocated) == VLANS
+    assert allocator.get_new_network_id() is None
+    db.session.commit()
+    assert utilization() == {
+        'total': len(VLANS),
+        'in_use': len(VLANS),
+        'available': 0,
+    }
+
+
+def test_free():
+    """Freed VLANs can be allocated again."""
+    allocator = get_network_allocator()
+    for _ in VLANS:
+        allocator.get_new_network_id()
+    allocator.free_network_id('300')
+    assert allocator.get_new_network_id() == '300'
+    assert allocator.get_new_network_id() is None
+
+
+def test_free_removed():
+    """VLANs removed from the pool while allocated are freed anyway."""
+    from hil.ext.network_allocators.vlan_bitmap import VlanBitmap, _test_bit
+    allocator = get_network_allocator()
+    allocator.claim_network_id('300')
+    db.session.commit()
+
+    config.cfg.set('hil.ext.network_allocators.vlan_bitmap', 'vlans',
+                   '100-104')
+    with app.app_context():
+        create_db()
+
+    allocator.free_network_id('300')
+    db.session.commit()
+    assert not _test_bit(bytearray(VlanBitmap.get().in_use), 300)
+
+
+def test_not_populated():
+    """Before populate() has run, there are no VLANs in the pool."""
+    from hil.ext.network_allocators.vlan_bitmap import VlanBitmap
+    db.session.delete(VlanBitmap.get())
+    db.session.commit()
+
+    allocator = get_network_allocator()
+    assert allocator.get_new_network_id() is None
+    assert not allocator.is_network_id_in_pool('100')
+    allocator.claim_network_id('100')
+    assert utilization() == {
+        'total': 0,
+        'in_use': 0,
+        'available': 0,
+    }
+
+
+def test_claim():
+    """Claiming a VLAN takes it out of the pool, but only once."""
+    allocator = get_network_allocator()
+    allocator.claim_network_id('100')
+    with pytest.raises(errors.BlockedError):
+        allocator.claim_network_id('100')
+    assert allocator.get_new_network_id() == '101'
+    # VLANs outside the pool may be claimed any number of times:
+    allocator.claim_network_id('1511')
+    allocator.claim_network_id('1511')
+
+
+def test_is_network_id_in_pool():
+    """is_network_id_in_pool agrees with the config."""
+    allocator = get_network_allocator()
+    for vlan in VLANS:
+        assert allocator.is_network_id_in_pool(str(vlan))
+    for net_id in '99', '105', '1511', '4097', '0', 'yes':
+        assert not allocator.is_network_id_in_pool(net_id)
+
+
+def test_populate_dirty_db():
+    """Re-running populate() keeps track of allocated VLANs.
+
+    It also picks up changes to the config.
+    """
+    allocator = get_network_allocator()
+    allocator.claim_network_id('100')
+    db.session.commit()
+
+    config.cfg.set('hil.ext.network_allocators.vlan_bitmap', 'vlans',
+                   '100-101')
+    with app.app_context():
+        create_db()
+
+    assert utilization() == {
+        'total': 2,
+        'in_use': 1,
+        'available': 1,
+    }
+    assert allocator.get_new_network_id() == '101'
+    assert allocator.get_new_network_id() is None
+
+
+def test_network_create_delete():
+    """Networks allocate and free VLANs via the api."""
+    api.project_create('nuggets')
+    api.network_create('hammernet', 'nuggets', 'nuggets', '')
+    network = api.get_or_404(model.Network, 'hammernet')
+    assert network.allocated is True
+    assert int(network.network_id) in VLANS
+    assert utilization()['in_use'] == 1
+
+    with pytest.raises(errors.BlockedError):
+        api.network_create('nailnet', 'admin', '', network.network_id)
+
+    api.network_delete('hammernet')
+    assert utilization()['in_use'] == 0
+
+
+def test_utilization_requires_admin():
+    """Only admins can see the utilization."""
+    get_auth_backend().set_admin(False)
+    with pytest.raises(errors.AuthorizationError):
+        utilization()
@@ -0,0 +1,154 @@
+"""Unit tests for hil.ext.obm._console_log"""
+from subprocess import Popen, PIPE
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pytest
+
+
+@pytest.fixture
+def log_dir(request):
+    """Return the path of a (not yet existing) console log directory."""
+    tmpdir = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(tmpdir))
+    return os.path.join(tmpdir, 'node-01')
+
+
+def ConsoleLogStore(*args, **kwargs):
+    """Construct a ConsoleLogStore.
+
+    The import is deferred so that collecting this module doesn't load any
+    extensions; see ``test_dont_pollute_other_tests_extensions``.
+    """
+    from hil.ext.obm._console_log import ConsoleLogStore as store_cls
+    return store_cls(*args, **kwargs)
+
+
+def test_missing_store(log_dir):
+    """Reading a store which was never written returns None."""
+    assert ConsoleLogStore(log_dir).read() is None
+
+
+def test_read_back(log_dir):
+    """Everything written is read back, in order."""
+    store = ConsoleLogStore(log_dir)
+    store.write('hello, ', now=100)
+    store.write('world\n', now=101)
+    store.close()
+    assert ConsoleLogStore(log_dir).read() == 'hello, world\n'
+
+
+def test_rotation(log_dir):
+    """Full segments are compressed, and reads span segments."""
+    store = ConsoleLogStore(log_dir, segment_size=10, segments=100)
+    for i in range(10):
+        store.write('line %d\n' % i, now=i)
+    store.close()
+    names = sorted(os.listdir(log_dir))
+    assert len([n for n in names if n.endswith('.log.gz')]) > 1
+    assert len([n for n in names if n.endswith('.log')]) == 1
+    assert ConsoleLogStore(log_dir).read() == \
+        ''.join('line %d\n' % i for i in range(10))
+
+
+def test_retention(log_dir):
+    """Only the configured number of compressed segments is kept."""
+    store = ConsoleLogStore(log_dir, segment_size=7, segments=2)
+    for i in range(10):
+        store.write('line %d\n' % i, now=i)
+    store.close()
+    names = os.listdir(log_dir)
+    assert len([n for n in names if n.endswith('.log.gz')]) == 2
+    # Each line fills exactly one segment, so what is left is the last two
+    # lines (the active segment is empty):
+    assert ConsoleLogStore(log_dir).read() == 'line 8\nline 9\n'
+
+
+def test_resume_after_restart(log_dir):
+    """A new writer picks up where the old one left off."""
+    store = ConsoleLogStore(log_dir, segment_size=10)
+    store.write('0123456789abc', now=1)
+    store.close()
+    store = ConsoleLogStore(log_dir, segment_size=10)
+    store.write('def', now=2)
+    store.close()
+    assert ConsoleLogStore(log_dir).read() == '0123456789abcdef'
+    assert ConsoleLogStore(log_dir).read(since=2) == 'def'
+
+
+def test_read_during_rotation(log_dir):
+    """A segment caught part way through being compressed is only read
+    once, and the uncompressed copy is cleaned up by the next writer.
+    """
+    store = ConsoleLogStore(log_dir, segment_size=10)
+    store.write('0123456789abc', now=1)
+    store.close()
+    # Put back the uncompressed copy, as if the writer were between
+    # publishing the compressed segment and removing the original:
+    stale = os.path.join(log_dir, '%020d.log' % 0)
+    with open(stale, 'wb') as f:
+        f.write('0123456789abc')
+    reader = ConsoleLogStore(log_dir)
+    assert reader.read() == '0123456789abc'
+    # If the original disappears after it was listed, the compressed
+    # segment is read instead:
+    os.remove(stale)
+    # pylint: disable=protected-access
+    assert reader._read_segment(0, False) == '0123456789abc'
+
+    with open(stale, 'wb') as f:
+        f.write('0123456789abc')
+    store = ConsoleLogStore(log_dir, segment_size=10)
+    store.write('def', now=2)
+    store.close()
+    assert not os.path.exists(stale)
+    assert ConsoleLogStore(log_dir).read() == '0123456789abcdef'
+
+
+@pytest.mark.parametrize('since,until,expected', [
+    (None, None, 'a\nb\nc\nd\n'),
+    (20, None, 'b\nc\nd\n'),
+    (25, None, 'b\nc\nd\n'),
+    (None, 30, 'a\nb\nc\n'),
+    (20, 30, 'b\nc\n'),
+    (None, 5, ''),
+    (100, None, 'd\n'),
+])
+def test_time_range(log_dir, since, until, expected):
+    """Time-range queries return the output logged in that range."""
+    store = ConsoleLogStore(log_dir, segment_size=3)
+    for timestamp, line in [(10, 'a\n'), (20, 'b\n'), (30, 'c\n'),
+                            (40, 'd\n')]:
+        store.write(line, now=timestamp)
+    store.close()
+    assert ConsoleLogStore(log_dir).read(since=since, until=until) == \
+        expected
+
+
+def test_delete(log_dir):
+    """Deleting the store removes its directory."""
+    store = ConsoleLogStore(log_dir)
+    store.write('secret', now=1)
+    store.delete()
+    assert not os.path.exists(log_dir)
+    assert ConsoleLogStore(log_dir).read() is None
+
+
+def test_writer_terminated(log_dir):
+    """The writer script records its input, and exits cleanly when it is
+    terminated, as by stop_console.
+    """
+    writer = Popen([sys.executable, '-m', 'hil.ext.obm._console_log',
+                    log_dir], stdin=PIPE)
+    writer.stdin.write('booting\n')
+    writer.stdin.flush()
+    deadline = time.time() + 10
+    while ConsoleLogStore(log_dir).read() != 'booting\n':
+        assert time.time() < deadline
+        time.sleep(0.05)
+    writer.terminate()
+    assert writer.wait() == 0
+    writer.stdin.close()
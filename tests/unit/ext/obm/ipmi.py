@@ -1,4 +1,8 @@
 """Unit tests for ipmi.py"""
+import os
+import re
+import sys
+
 import pytest
 from hil import api, errors
 from hil.test_common import config, config_testsuite, fresh_database, \
@@ -66,3 +70,72 @@ class TestIpmi:
 
         with pytest.raises(errors.BadArgumentError):
             instance.require_legal_bootdev("not_valid_bootdev")
+
+
+class FakePopen(object):
+    """Stands in for `subprocess.Popen`, recording the commands run."""
+
+    commands = []
+
+    def __init__(self, args, **kwargs):
+        # pylint: disable=unused-argument
+        self.commands.append(args)
+        self.stdout = self
+        self.returncode = 0
+
+    def communicate(self):
+        """Pretend the command ran, with no output."""
+        return '', ''
+
+    def close(self):
+        """Stand in for ``stdout.close()``."""
+
+
+class TestConsole:
+    """Test starting and stopping the console."""
+
+    @pytest.fixture
+    def commands(self, monkeypatch, tmpdir):
+        """Record the commands run by the driver, rather than running them;
+        return the list they are recorded in.
+        """
+        from hil.ext.obm import ipmi
+        config_merge({'hil.ext.obm.ipmi': {'console_log_dir': str(tmpdir)}})
+        commands = []
+        monkeypatch.setattr(FakePopen, 'commands', commands)
+        monkeypatch.setattr(ipmi, 'Popen', FakePopen)
+        monkeypatch.setattr(ipmi, 'call', commands.append)
+        return commands
+
+    def test_start_stop(self, commands, tmpdir):
+        """The log writer is started with python, and stopped along with
+        ipmitool.
+        """
+        from hil.ext.obm import ipmi
+        instance = ipmi.Ipmi(host="ipmihost", user="root",
+                             password="tapeworm")
+        instance.start_console()
+        assert commands[0][-2:] == ['sol', 'activate']
+        writer = commands[1]
+        assert os.path.basename(writer[0]).startswith('python')
+        assert writer[1:4] == ['-m', 'hil.ext.obm._console_log',
+                               str(tmpdir.join('ipmihost'))]
+
+        del commands[:]
+        instance.stop_console()
+        pkills = [c for c in commands if c[0] == 'pkill']
+        assert len(pkills) == 2
+        pattern = re.compile(pkills[1][2])
+        assert pattern.search(' '.join(writer))
+        assert not pattern.search(' '.join(writer).replace('ipmihost',
+                                                           'ipmihost2'))
+
+    def test_console_python(self, monkeypatch):
+        """Under mod_wsgi, the writer isn't run with the web server."""
+        from hil.ext.obm import ipmi
+        # pylint: disable=protected-access
+        monkeypatch.setattr(sys, 'executable', '/usr/sbin/httpd')
+        monkeypatch.setattr(sys, 'exec_prefix', '/opt/hil')
+        assert ipmi._console_python() == '/opt/hil/bin/python'
+        config_merge({'hil.ext.obm.ipmi': {'console_python': '/bin/py'}})
+        assert ipmi._console_python() == '/bin/py'
@@ -296,6 +296,45 @@ class TestBrocade(object):
             assert mock.call_count == 1
             assert mock.request_history[0].text == TRUNK_REMOVE_VLAN_PAYLOAD
 
+    def test_revert_port(self, switch):
+        """revert_port reads the port once, and only removes what's there"""
+        with requests_mock.mock() as mock:
+            url_trunk = switch._construct_url(INTERFACE1, suffix='trunk')
+            mock.get(url_trunk, text=TRUNK_NATIVE_VLAN_RESPONSE_NO_VLANS)
+            url_native = switch._construct_url(INTERFACE1,
+                                               suffix='trunk/native-vlan')
+            mock.delete(url_native)
+
+            switch.revert_port(INTERFACE1)
+
+            assert [(r.method, r.url) for r in mock.request_history] == [
+                ('GET', url_trunk),
+                ('DELETE', url_native),
+            ]
+
+        with requests_mock.mock() as mock:
+            mock.get(url_trunk, text=TRUNK_VLAN_RESPONSE)
+            url_vlans = switch._construct_url(INTERFACE1,
+                                              suffix='trunk/allowed/vlan')
+            mock.put(url_vlans)
+
+            switch.revert_port(INTERFACE1)
+
+            assert mock.call_count == 2
+            assert mock.request_history[1].url == url_vlans
+
+    def test_get_port_state(self, switch):
+        """Test the get_port_state method"""
+        with requests_mock.mock() as mock:
+            mock.get(switch._construct_url(INTERFACE1, suffix='trunk'),
+                     text=TRUNK_NATIVE_VLAN_RESPONSE_WITH_VLANS)
+            assert switch.get_port_state(INTERFACE1) == {
+                'vlan/native': '10',
+                'vlan/4001': '4001',
+                'vlan/4025': '4025',
+            }
+            assert mock.call_count == 1
+
     def test_construct_url(self, switch):
         """Test the _construct_url helper method"""
         assert switch._construct_url('1/0/4') == (
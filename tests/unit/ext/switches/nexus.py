@@ -0,0 +1,83 @@
+"""Unit tests for the Cisco Nexus switch driver.
+
+These don't talk to a switch; the session is given a fake console, and the
+output it would have parsed.
+"""
+
+import pytest
+
+from hil import config
+from hil.test_common import config_testsuite, config_merge
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.switches.nexus': '',
+        },
+    })
+    config.load_extensions()
+
+
+class FakeConsole(object):
+    """Stand-in for a `hil.ext.switches._console.Console`, which records
+    the lines sent to it.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def sendline(self, line):
+        """Record `line`."""
+        self.lines.append(line)
+
+    def expect(self, pattern):
+        """Pretend the first alternative in `pattern` matched."""
+        # pylint: disable=unused-argument
+        return 0
+
+
+class FakeSwitch(object):
+    """Stand-in for a `hil.ext.switches.nexus.Nexus`."""
+    dummy_vlan = '2'
+
+
+def make_session():
+    """Return a nexus session with a fake console."""
+    from hil.ext.switches.nexus import _Session
+    return _Session(config_prompt='sw(config)# ',
+                    if_prompt='sw(config-if)# ',
+                    main_prompt='sw# ',
+                    switch=FakeSwitch(),
+                    console=FakeConsole(),
+                    dummy_vlan='2')
+
+
+def test_vlan_ranges(configure, monkeypatch):
+    """Ranges of VLANs are read as ranges, and other tokens are ignored."""
+    # pylint: disable=redefined-outer-name,unused-argument
+    session = make_session()
+    monkeypatch.setattr(session, '_port_configs', lambda ports: {
+        'Ethernet1/1': {
+            'Trunking Native Mode VLAN': '2 (Inactive)',
+            'Trunking VLANs Allowed': '10,20-23,30 (Inactive)',
+        },
+    })
+    assert sorted(session.get_port_networks(['Ethernet1/1'])['Ethernet1/1'])\
+        == [('vlan/%d' % vlan, vlan) for vlan in (10, 20, 21, 22, 23, 30)]
+
+
+@pytest.mark.parametrize('read_only', [False, True])
+def test_disconnect_saves(configure, read_only):
+    """Disconnecting saves the running config, unless the session is
+    read-only.
+    """
+    # pylint: disable=redefined-outer-name,unused-argument
+    session = make_session()
+    session.read_only = read_only
+    session.disconnect()
+    saved = 'copy running-config startup-config' in session.console.lines
+    assert saved is not read_only
@@ -0,0 +1,187 @@
+"""Tests for hil.metrics, and the metrics maintained by the rest of HIL."""
+
+import json
+import urllib2
+
+import pytest
+
+from hil import api, config, deferred, metrics, rest
+from hil.flaskapp import app
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, fail_on_log_warnings, server_init, network_create_simple
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+MOCK_SWITCH_TYPE = 'http://schema.massopencloud.org/haas/v0/switches/mock'
+OBM_TYPE_MOCK = 'http://schema.massopencloud.org/haas/v0/obm/mock'
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.switches.mock': '',
+            'hil.ext.obm.mock': '',
+        },
+    })
+    config.load_extensions()
+
+
+@pytest.fixture
+def client():
+    """Return a flask test client."""
+    return app.test_client()
+
+
+@pytest.fixture
+def registry():
+    """Return an empty Registry."""
+    return metrics.Registry()
+
+
+def test_counter(registry):
+    """Counters count, separately for each label set."""
+    counter = registry.counter('requests_total', 'Requests.', ['method'])
+    counter.inc(method='GET')
+    counter.inc(2, method='GET')
+    counter.inc(method='PUT')
+    assert counter.value(method='GET') == 3
+    assert counter.value(method='PUT') == 1
+    assert counter.value(method='POST') == 0
+    with pytest.raises(ValueError):
+        counter.inc(-1, method='GET')
+    with pytest.raises(ValueError):
+        counter.inc(verb='GET')
+
+
+def test_gauge(registry):
+    """Gauges can be set, increased and decreased."""
+    gauge = registry.gauge('depth', 'Depth.')
+    gauge.set(5)
+    gauge.inc()
+    gauge.dec(3)
+    assert gauge.value() == 3
+
+
+def test_histogram(registry):
+    """Histograms count observations in cumulative buckets."""
+    histogram = registry.histogram('latency_seconds', 'Latency.',
+                                   buckets=(0.1, 1))
+    for value in 0.05, 0.5, 0.5, 5:
+        histogram.observe(value)
+    assert histogram.count() == 4
+    assert registry.expose() == '\n'.join([
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{le="0.1"} 1.0',
+        'latency_seconds_bucket{le="1.0"} 3.0',
+        'latency_seconds_bucket{le="+Inf"} 4.0',
+        'latency_seconds_sum 6.05',
+        'latency_seconds_count 4.0',
+    ]) + '\n'
+
+
+def test_expose(registry):
+    """Metrics are exposed in order, with their labels escaped."""
+    registry.gauge('b', 'The letter b.').set(2)
+    registry.counter('a', 'The letter a.', ['x']).inc(x='say "hi"\\n')
+    assert registry.expose() == '\n'.join([
+        '# HELP a The letter a.',
+        '# TYPE a counter',
+        r'a{x="say \"hi\"\\n"} 1.0',
+        '# HELP b The letter b.',
+        '# TYPE b gauge',
+        'b 2.0',
+    ]) + '\n'
+
+
+def test_register_twice(registry):
+    """Registering the same metric twice returns the original; registering
+    a different one with the same name is an error.
+    """
+    counter = registry.counter('a', 'The letter a.')
+    assert registry.counter('a', 'The letter a.') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('a', 'The letter a.')
+
+
+def test_serve_in_background():
+    """Metrics can be served from a background thread."""
+    server = metrics.serve_in_background('127.0.0.1', 0)
+    try:
+        url = 'http://127.0.0.1:%d' % server.server_address[1]
+        resp = urllib2.urlopen(url + '/metrics')
+        assert resp.headers['Content-Type'] == metrics.CONTENT_TYPE
+        assert '# TYPE hil_api_requests_total counter' in resp.read()
+        with pytest.raises(urllib2.HTTPError):
+            urllib2.urlopen(url + '/other')
+    finally:
+        server.shutdown()
+
+
+def test_api_metrics(configure, fresh_database, server_init, client):
+    """API calls are counted and timed, and their queries counted."""
+    def requests(status):
+        """Return the number of list_projects calls with `status`."""
+        return rest.API_REQUESTS.value(call='list_projects', method='GET',
+                                       status=status)
+    before = requests(200)
+    timed_before = rest.API_LATENCY.count(call='list_projects', method='GET')
+    assert client.get('/projects').status_code == 200
+    assert client.get('/projects').status_code == 200
+    assert requests(200) == before + 2
+    assert rest.API_LATENCY.count(call='list_projects',
+                                  method='GET') == timed_before + 2
+
+    before = rest.API_REQUESTS.value(call='project_delete', method='DELETE',
+                                     status=404)
+    assert client.delete('/project/nosuch').status_code == 404
+    assert rest.API_REQUESTS.value(call='project_delete', method='DELETE',
+                                   status=404) == before + 1
+
+    metrics.init()
+    before = rest.API_DB_QUERIES.sum(call='list_projects')
+    client.get('/projects')
+    assert rest.API_DB_QUERIES.sum(call='list_projects') > before
+
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    assert resp.headers['Content-Type'] == metrics.CONTENT_TYPE
+    assert 'hil_api_requests_total{call="list_projects",method="GET",' \
+        'status="200"}' in resp.get_data()
+
+
+def test_daemon_metrics(configure, fresh_database, server_init):
+    """The networking daemon reports the journal depth and action timings.
+    """
+    with app.test_request_context():
+        rest.init_auth()
+        api.switch_register('sw0', type=MOCK_SWITCH_TYPE,
+                            username='user', password='pass',
+                            hostname='host')
+        api.switch_register_port('sw0', 'gi1/0/1')
+        api.node_register('node-1', obm={
+            'type': OBM_TYPE_MOCK,
+            'host': 'ipmihost',
+            'user': 'root',
+            'password': 'tapeworm',
+        })
+        api.node_register_nic('node-1', 'eth0', 'DE:AD:BE:EF:20:14')
+        api.port_connect_nic('sw0', 'gi1/0/1', 'node-1', 'eth0')
+        api.project_create('runway')
+        api.project_connect_node('runway', 'node-1')
+        network_create_simple('pxe', 'runway')
+        response = api.node_connect_network('node-1', 'eth0', 'pxe')
+        assert json.loads(response[0])['status_id']
+
+    labels = {'switch': 'sw0', 'type': 'modify_port'}
+    before = deferred.SWITCH_ACTION_LATENCY.count(**labels)
+    with app.app_context():
+        deferred.apply_networking()
+    assert deferred.JOURNAL_DEPTH.value() == 1
+    assert deferred.SWITCH_ACTION_LATENCY.count(**labels) == before + 1
+    assert deferred.SWITCH_ACTION_FAILURES.value(**labels) == 0
@@ -0,0 +1,169 @@
+"""Unit tests for hil.commands.migrate_ipmi_info.
+
+These run the migration against a minimal local stand-in for obmd; see
+tests/integration/migrate_ipmi_info.py for a test against the real thing.
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from StringIO import StringIO
+import base64
+import json
+import threading
+
+import pytest
+
+from hil import config, model
+from hil.commands.migrate_ipmi_info import migrate
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, fail_on_log_warnings, with_request_context
+
+ADMIN_TOKEN = '01234567890123456789012345678901'
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.obm.ipmi': '',
+        },
+    })
+    config.load_extensions()
+
+
+fresh_database = pytest.fixture(fresh_database)
+fail_on_log_warnings = pytest.fixture(fail_on_log_warnings)
+with_request_context = pytest.yield_fixture(with_request_context)
+
+
+class FakeObmd(object):
+    """A stand-in for obmd, which just records the nodes uploaded to it.
+
+    Uploads of nodes whose labels are in `failing` get a 500 response.
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self.failing = set()
+        self.lock = threading.Lock()
+
+        obmd = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Request handler for FakeObmd"""
+
+            # pylint: disable=invalid-name
+            def do_PUT(self):
+                """Handle a PUT request (the only kind we need)."""
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                label = self.path[len('/node/'):]
+                expected_auth = 'Basic ' + \
+                    base64.b64encode('admin:' + ADMIN_TOKEN)
+                if self.headers.get('Authorization') != expected_auth:
+                    self.send_response(401)
+                elif label in obmd.failing:
+                    self.send_response(500)
+                else:
+                    with obmd.lock:
+                        obmd.nodes[label] = json.loads(body)
+                    self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                """Don't log requests to stderr."""
+                # pylint: disable=redefined-builtin
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Shut down the server."""
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def obmd():
+    """Start a FakeObmd."""
+    server = FakeObmd()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def nodes():
+    """Create some nodes with ipmi obms, and return their labels."""
+    from hil.ext.obm.ipmi import Ipmi
+    labels = []
+    for i in range(10):
+        label = 'node-%d' % i
+        model.db.session.add(model.Node(label=label,
+                                        obm=Ipmi(user='admin',
+                                                 host='10.0.0.%d' % i,
+                                                 password='changeme')))
+        labels.append(label)
+    model.db.session.commit()
+    return labels
+
+
+pytestmark = pytest.mark.usefixtures('fail_on_log_warnings',
+                                     'configure',
+                                     'fresh_database',
+                                     'with_request_context')
+
+
+def test_migrate(obmd, nodes):
+    """All nodes are uploaded, and their obmd info recorded."""
+    out = StringIO()
+    assert migrate(obmd.base_url, ADMIN_TOKEN, workers=4, out=out) == 0
+    assert sorted(obmd.nodes.keys()) == sorted(nodes)
+    assert obmd.nodes['node-3'] == {
+        'type': 'ipmi',
+        'info': {
+            'addr': '10.0.0.3',
+            'user': 'admin',
+            'pass': 'changeme',
+        },
+    }
+    for node in model.Node.query.all():
+        assert node.obmd_uri == obmd.base_url + '/node/' + node.label
+        assert node.obmd_admin_token == ADMIN_TOKEN
+    assert 'Migrated 10 of 10 nodes' in out.getvalue()
+
+
+def test_migrate_resume(obmd, nodes):
+    """Failed uploads are reported, and retried on the next run."""
+    obmd.failing = {'node-2', 'node-7'}
+    out = StringIO()
+    assert migrate(obmd.base_url, ADMIN_TOKEN, workers=4, out=out) == 2
+    assert 'Failed to upload node node-2' in out.getvalue()
+    assert 'Failed to upload node node-7' in out.getvalue()
+    assert 'Migrated 8 of 10 nodes' in out.getvalue()
+    for node in model.Node.query.all():
+        if node.label in obmd.failing:
+            assert node.obmd_uri is None
+            assert node.obmd_admin_token is None
+        else:
+            assert node.obmd_uri is not None
+
+    # The second run should only upload the nodes which failed:
+    obmd.failing = set()
+    obmd.nodes = {}
+    out = StringIO()
+    assert migrate(obmd.base_url, ADMIN_TOKEN, workers=4, out=out) == 0
+    assert sorted(obmd.nodes.keys()) == ['node-2', 'node-7']
+    assert 'Migrated 2 of 2 nodes' in out.getvalue()
+    assert model.Node.query.filter_by(obmd_uri=None).count() == 0
+
+
+def test_migrate_unreachable(nodes):
+    """If obmd can't be reached, nothing is recorded as migrated."""
+    # Nothing should be listening on port 1:
+    out = StringIO()
+    assert migrate('http://127.0.0.1:1', ADMIN_TOKEN, out=out) == len(nodes)
+    assert model.Node.query.filter_by(obmd_uri=None).count() == len(nodes)
@@ -0,0 +1,194 @@
+"""Tests for hil.power_poller, and the power status API calls."""
+
+import json
+
+import pytest
+
+from hil import api, config, errors, model, power_poller
+from hil.auth import get_auth_backend
+from hil.errors import OBMError
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, fail_on_log_warnings, server_init, with_request_context
+
+OBM_TYPE_MOCK = 'http://schema.massopencloud.org/haas/v0/obm/mock'
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'auth': {
+            'require_authentication': 'True',
+        },
+        'extensions': {
+            'hil.ext.auth.null': None,
+            'hil.ext.auth.mock': '',
+            'hil.ext.obm.mock': '',
+        },
+    })
+    config.load_extensions()
+
+
+fresh_database = pytest.fixture(fresh_database)
+fail_on_log_warnings = pytest.fixture(fail_on_log_warnings)
+server_init = pytest.fixture(server_init)
+with_request_context = pytest.yield_fixture(with_request_context)
+
+
+@pytest.fixture
+def nodes():
+    """Register a few mock nodes, and return their names."""
+    get_auth_backend().set_admin(True)
+    names = ['node-%02d' % i for i in range(3)]
+    for name in names:
+        api.node_register(name, obm={
+            "type": OBM_TYPE_MOCK,
+            "host": "ipmihost",
+            "user": "root",
+            "password": "tapeworm"})
+    return names
+
+
+pytestmark = pytest.mark.usefixtures('fail_on_log_warnings',
+                                     'configure',
+                                     'fresh_database',
+                                     'server_init',
+                                     'with_request_context')
+
+
+def test_poll(nodes):
+    """Polling caches the state of every stale node, and only those."""
+    sleeps = []
+    assert power_poller.poll(60, rate=10, sleep=sleeps.append) == len(nodes)
+    for name in nodes:
+        status = model.Node.query.filter_by(label=name).one().power_status
+        assert status.power == 'on'
+        assert status.reachable
+        assert status.error is None
+
+    # We sleep between nodes, but not before the first one:
+    assert sleeps == [0.1] * (len(nodes) - 1)
+
+    # Nothing is stale yet:
+    assert power_poller.poll(60, rate=10, sleep=sleeps.append) == 0
+
+    # ...unless we ask for really fresh data:
+    assert power_poller.poll(0, rate=10, sleep=sleeps.append) == len(nodes)
+
+
+def test_poll_jitter(nodes):
+    """Delays between nodes are randomized within the jitter bounds."""
+    sleeps = []
+    power_poller.poll(60, rate=1, jitter=0.5, sleep=sleeps.append)
+    assert len(sleeps) == len(nodes) - 1
+    for delay in sleeps:
+        assert 0.5 <= delay <= 1.5
+
+
+def test_stale_nodes_order(nodes):
+    """Never-polled nodes come first, then the least recently polled."""
+    power_poller.refresh(model.Node.query.filter_by(label=nodes[2]).one())
+    power_poller.refresh(model.Node.query.filter_by(label=nodes[0]).one())
+    model.db.session.commit()
+    assert [n.label for n in power_poller.stale_nodes(0)] == \
+        [nodes[1], nodes[2], nodes[0]]
+
+
+def test_unreachable(nodes, monkeypatch):
+    """Errors reading the power state are recorded in the cache."""
+    from hil.ext.obm.mock import MockObm
+
+    def get_power_status(self):
+        """Simulate an unreachable BMC."""
+        raise OBMError("BMC is on fire")
+    monkeypatch.setattr(MockObm, 'get_power_status', get_power_status)
+
+    result = json.loads(api.show_node_power(nodes[0], fresh='true'))
+    assert result['power'] is None
+    assert result['reachable'] is False
+    assert result['error'] == 'BMC is on fire'
+
+
+def test_unexpected_errors(nodes, monkeypatch):
+    """Other exceptions from the OBM driver are logged and recorded, and
+    don't stop the other nodes from being polled.
+    """
+    from hil.ext.obm.mock import MockObm
+    get_power_status = MockObm.get_power_status
+
+    calls = []
+
+    def broken(self):
+        """Fail as if ipmitool were missing, the first time (for the first
+        node; see test_stale_nodes_order).
+        """
+        calls.append(self)
+        if len(calls) == 1:
+            raise OSError(2, 'No such file or directory')
+        return get_power_status(self)
+    monkeypatch.setattr(MockObm, 'get_power_status', broken)
+    logged = []
+    monkeypatch.setattr(power_poller.logger, 'exception',
+                        lambda msg, *args: logged.append(msg % args))
+
+    assert power_poller.poll(60, rate=10, sleep=lambda delay: None) == \
+        len(nodes)
+    assert logged == ['Error reading power status of node %s' % nodes[0]]
+    status = model.Node.query.filter_by(label=nodes[0]).one().power_status
+    assert status.reachable is False
+    assert status.power is None
+    assert status.error == 'OSError: [Errno 2] No such file or directory'
+    for name in nodes[1:]:
+        status = model.Node.query.filter_by(label=name).one().power_status
+        assert status.power == 'on'
+
+
+def test_show_node_power(nodes):
+    """show_node_power only queries the OBM if asked to."""
+    result = json.loads(api.show_node_power(nodes[0]))
+    assert result == {
+        'power': None,
+        'reachable': None,
+        'error': None,
+        'last_checked': None,
+    }
+    result = json.loads(api.show_node_power(nodes[0], fresh='true'))
+    assert result['power'] == 'on'
+    assert result['reachable'] is True
+    assert result['last_checked'] is not None
+    assert json.loads(api.show_node_power(nodes[0])) == result
+
+
+def test_show_node_power_access(nodes):
+    """Non-admins can only see the power state of their own nodes."""
+    api.project_create('anvil-nextgen')
+    api.project_connect_node('anvil-nextgen', nodes[0])
+    auth = get_auth_backend()
+    auth.set_admin(False)
+    auth.set_project(model.Project.query.filter_by(
+        label='anvil-nextgen').one())
+    api.show_node_power(nodes[0])
+    with pytest.raises(errors.AuthorizationError):
+        api.show_node_power(nodes[1])
+    with pytest.raises(errors.AuthorizationError):
+        api.list_nodes_power('all')
+
+
+def test_list_nodes_power(nodes):
+    """list_nodes_power reports the cached state of each node."""
+    api.project_create('anvil-nextgen')
+    api.project_connect_node('anvil-nextgen', nodes[0])
+    power_poller.poll(60, rate=10, sleep=lambda delay: None)
+    result = json.loads(api.list_nodes_power('all'))
+    assert sorted(result.keys()) == nodes
+    assert all(v['power'] == 'on' for v in result.values())
+    assert sorted(json.loads(api.list_nodes_power('free')).keys()) == \
+        nodes[1:]
+
+
+def test_node_delete(nodes):
+    """Deleting a node deletes its cached power state."""
+    api.show_node_power(nodes[0], fresh='true')
+    api.node_delete(nodes[0])
+    assert model.PowerStatus.query.count() == 0
@@ -0,0 +1,182 @@
+"""Tests for hil.prefork, and the ``hil-admin serve`` command's settings.
+
+The server is run in a separate process, since it forks, and installs
+signal handlers.
+"""
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib2
+
+import pytest
+
+from hil.commands import serve
+from hil.test_common import config_testsuite, config_merge
+
+# Serves an app which responds with the pid of the worker (after sleeping
+# for the number of seconds in the query string, if any), and prints the
+# port it is listening on. Takes the PreforkServer's keyword arguments as
+# a Python expression:
+_SERVER = '''
+import os, sys, time
+from hil.prefork import PreforkServer
+
+def app(environ, start_response):
+    time.sleep(float(environ['QUERY_STRING'] or 0))
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid())]
+
+server = PreforkServer(app, '127.0.0.1', 0, **eval(sys.argv[1]))
+print(server.address[1])
+sys.stdout.flush()
+server.run()
+'''
+
+
+class Server(object):
+    """A PreforkServer, running in a subprocess."""
+
+    def __init__(self, **kwargs):
+        self.proc = subprocess.Popen([sys.executable, '-c', _SERVER,
+                                      repr(kwargs)],
+                                     stdout=subprocess.PIPE)
+        self.url = 'http://127.0.0.1:%s/' % \
+            self.proc.stdout.readline().strip()
+
+    def get(self, delay=0):
+        """Make a request, and return the pid of the worker that handled it.
+        """
+        return int(urllib2.urlopen(self.url + '?%s' % delay).read())
+
+    def pids(self, requests=20):
+        """Return the set of pids handling the next `requests` requests."""
+        return set(self.get() for _ in range(requests))
+
+    def stop(self):
+        """Stop the server, and return its exit status."""
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+        return self.proc.wait()
+
+
+@pytest.yield_fixture
+def start():
+    """Return a function which starts a `Server`; stops it afterwards."""
+    servers = []
+
+    def _start(**kwargs):
+        servers.append(Server(**kwargs))
+        return servers[-1]
+    yield _start
+    for server in servers:
+        server.stop()
+
+
+def wait_for(predicate, timeout=10):
+    """Wait for `predicate()` to become true."""
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, 'Timed out'
+        time.sleep(0.1)
+
+
+def test_workers(start):
+    """Requests are handled by the workers, not the master."""
+    server = start(workers=2)
+    wait_for(lambda: len(server.pids()) == 2)
+    assert server.proc.pid not in server.pids()
+    assert server.stop() == 0
+
+
+def test_max_requests(start):
+    """Workers are replaced after handling max_requests requests."""
+    server = start(workers=1, max_requests=3)
+    pids = [server.get() for _ in range(7)]
+    assert pids[0] == pids[1] == pids[2]
+    assert pids[3] == pids[4] == pids[5]
+    assert len(set(pids)) == 3
+
+
+def test_reload(start):
+    """SIGHUP replaces all of the workers."""
+    server = start(workers=2)
+    wait_for(lambda: len(server.pids()) == 2)
+    old = server.pids()
+    server.proc.send_signal(signal.SIGHUP)
+    wait_for(lambda: not (server.pids() & old))
+    assert len(server.pids()) == 2
+
+
+def test_replace_dead_worker(start):
+    """A worker which dies is replaced."""
+    server = start(workers=1)
+    pid = server.get()
+    os.kill(pid, signal.SIGKILL)
+    wait_for(lambda: server.proc.poll() is None and server.get() != pid)
+
+
+def test_graceful_stop(start):
+    """Stopping the server lets the requests in progress finish."""
+    server = start(workers=1)
+    server.get()
+    result = []
+    thread = threading.Thread(target=lambda: result.append(server.get(1)))
+    thread.start()
+    time.sleep(0.3)
+    assert server.stop() == 0
+    thread.join()
+    assert len(result) == 1
+
+
+def test_graceful_timeout(start):
+    """Workers which take too long to stop are killed."""
+    server = start(workers=1, graceful_timeout=0)
+    server.get()
+    errors = []
+
+    def get():
+        """Make a slow request, which should fail."""
+        try:
+            server.get(5)
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+    thread = threading.Thread(target=get)
+    thread.start()
+    time.sleep(0.3)
+    before = time.time()
+    assert server.stop() == 0
+    assert time.time() - before < 4
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_threads(start):
+    """A worker with several threads handles requests concurrently."""
+    server = start(workers=1, threads=2)
+    server.get()
+    pids = []
+    threads = [threading.Thread(target=lambda: pids.append(server.get(1)))
+               for _ in range(2)]
+    before = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert time.time() - before < 1.9
+    assert len(set(pids)) == 1
+
+
+def test_settings():
+    """Settings come from the command line, then the config, then the
+    defaults.
+    """
+    config_testsuite()
+    config_merge({'server': {'workers': '8'}})
+    assert serve._setting('workers', 2) == 2
+    assert serve._setting('workers', None) == 8
+    assert serve._setting('threads', None) == serve.DEFAULTS['threads']
+    assert serve._setting('host', None) == serve.DEFAULTS['host']
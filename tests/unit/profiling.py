@@ -0,0 +1,98 @@
+"""Tests for hil.profiling"""
+
+import logging
+
+import pytest
+
+from hil import config, profiling
+from hil.flaskapp import app
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, server_init
+
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+# Note that the tests below request their fixtures as arguments, rather
+# than via usefixtures, since the configuration must happen before the
+# database is set up.
+
+
+@pytest.fixture
+def enabled():
+    """Configure HIL with profiling enabled, logging every request."""
+    config_testsuite()
+    config_merge({
+        'profiling': {
+            'slow_request_threshold': '0',
+            'slowest_statements': '2',
+            'debug_header': 'True',
+        },
+    })
+    config.load_extensions()
+    profiling.init()
+    yield
+    config_testsuite()
+    profiling.init()
+
+
+@pytest.fixture
+def disabled():
+    """Configure HIL with profiling disabled."""
+    config_testsuite()
+    config.load_extensions()
+    profiling.init()
+
+
+@pytest.fixture
+def client():
+    """Return a flask test client."""
+    return app.test_client()
+
+
+def parse_header(value):
+    """Parse the X-HIL-Profile header into a dictionary."""
+    return dict(item.split('=') for item in value.split('; '))
+
+
+def test_profile_slowest():
+    """Profiles keep the slowest statements, in order."""
+    profile = profiling.Profile(keep=2)
+    for duration, statement in (0.1, 'a'), (0.3, 'b'), (0.2, 'c'):
+        profile.record(statement, duration)
+    assert profile.queries == 3
+    assert profile.db_time == pytest.approx(0.6)
+    assert profile.slowest == [(0.3, 'b'), (0.2, 'c')]
+
+
+def test_header_and_log(enabled, fresh_database, server_init, client,
+                        caplog):
+    """Slow requests are logged, and the debug header is set."""
+    with caplog.at_level(logging.WARNING, logger='hil'):
+        resp = client.get('/projects')
+    assert resp.status_code == 200
+    profile = parse_header(resp.headers['X-HIL-Profile'])
+    assert int(profile['queries']) >= 1
+    assert float(profile['db_time']) <= float(profile['time'])
+
+    messages = [r.getMessage() for r in caplog.records
+                if 'Slow API call: list_projects' in r.getMessage()]
+    assert len(messages) == 1
+    assert profile['request_id'] in messages[0]
+    assert '%s queries' % profile['queries'] in messages[0]
+    assert 'SELECT' in messages[0]
+
+
+def test_batch(enabled, fresh_database, server_init, client):
+    """Calls within a batch are profiled as part of the batch."""
+    resp = client.post('/batch', data='{"calls": [{"method": "GET", '
+                                      '"path": "/projects"}]}')
+    assert resp.status_code == 200
+    assert 'X-HIL-Profile' in resp.headers
+
+
+def test_disabled(disabled, fresh_database, server_init, client):
+    """Without a [profiling] section, nothing is profiled."""
+    assert profiling.get_settings() is None
+    resp = client.get('/projects')
+    assert resp.status_code == 200
+    assert 'X-HIL-Profile' not in resp.headers
@@ -0,0 +1,230 @@
+"""Tests for hil.read_cache"""
+
+import errno
+import json
+import os
+
+import pytest
+
+from hil import config, model, read_cache
+from hil.flaskapp import app
+from hil.model import db
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, fail_on_log_warnings, server_init
+
+fail_on_log_warnings = pytest.fixture(autouse=True)(fail_on_log_warnings)
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+
+# Note that the tests below request their fixtures as arguments, rather
+# than via usefixtures, since the configuration must happen before the
+# database is set up.
+
+
+def configure(cache_cfg, extensions=None):
+    """Configure HIL, with `cache_cfg` as the [cache] section.
+
+    If `cache_cfg` is None, the cache is disabled. `extensions` is merged
+    into the [extensions] section.
+    """
+    config_testsuite()
+    if cache_cfg is not None:
+        config_merge({'cache': cache_cfg})
+    if extensions is not None:
+        config_merge({'extensions': extensions})
+    config.load_extensions()
+
+
+@pytest.fixture(params=['memory', 'file'])
+def cache_cfg(request, tmpdir):
+    """Return the [cache] section to use; this runs the tests against each
+    of the backends.
+    """
+    cache_cfg = {'backend': request.param}
+    if request.param == 'file':
+        cache_cfg['directory'] = str(tmpdir.join('cache'))
+    return cache_cfg
+
+
+@pytest.fixture
+def cache(cache_cfg):
+    """Configure HIL with the read cache enabled, and return the cache."""
+    configure(cache_cfg)
+    read_cache.init()
+    yield read_cache.get_cache()
+    config_testsuite()
+    read_cache.init()
+
+
+@pytest.fixture
+def mock_auth_cache():
+    """Like `cache`, but with the mock auth backend.
+
+    The mock backend doesn't give requests admin access.
+    """
+    configure({'backend': 'memory'}, {
+        'hil.ext.auth.null': None,
+        'hil.ext.auth.mock': '',
+    })
+    read_cache.init()
+    yield read_cache.get_cache()
+    config_testsuite()
+    read_cache.init()
+
+
+@pytest.fixture
+def no_cache():
+    """Configure HIL without the read cache."""
+    configure(None)
+    read_cache.init()
+
+
+@pytest.fixture
+def client():
+    """Return a flask test client."""
+    return app.test_client()
+
+
+def get_json(client, path):
+    """GET `path`, and return the body, parsed as JSON."""
+    resp = client.get(path)
+    assert resp.status_code == 200
+    return json.loads(resp.get_data())
+
+
+def test_hit_and_invalidate(cache, fresh_database, server_init, client):
+    """Repeated calls are answered from the cache until the data changes."""
+    assert get_json(client, '/projects') == []
+    assert get_json(client, '/projects') == []
+    assert cache.stats['list_projects'] == {'hits': 1, 'misses': 1}
+
+    # Creating a project bumps the version of the project table:
+    assert client.put('/project/runway').status_code == 200
+    assert get_json(client, '/projects') == ['runway']
+    assert cache.stats['list_projects'] == {'hits': 1, 'misses': 2}
+
+    # ...but doesn't affect unrelated calls:
+    assert get_json(client, '/nodes/all') == []
+    assert client.put('/project/manhattan').status_code == 200
+    assert get_json(client, '/nodes/all') == []
+    assert cache.stats['list_nodes'] == {'hits': 1, 'misses': 1}
+
+
+def test_arguments(cache, fresh_database, server_init, client):
+    """Calls with different arguments are cached separately."""
+    assert client.put('/network/pxe', data=json.dumps({
+        'owner': 'admin',
+        'access': '',
+        'net_id': '',
+    })).status_code == 200
+    assert get_json(client, '/network/pxe')['name'] == 'pxe'
+    assert client.get('/network/ipmi').status_code == 404
+    assert get_json(client, '/network/pxe')['name'] == 'pxe'
+    assert cache.stats['show_network'] == {'hits': 1, 'misses': 2}
+
+
+def test_revoke_access(cache, fresh_database, server_init, client):
+    """Revoking a project's access to a network invalidates the cache."""
+    assert client.put('/project/runway').status_code == 200
+    assert client.put('/network/pxe', data=json.dumps({
+        'owner': 'admin',
+        'access': 'runway',
+        'net_id': '',
+    })).status_code == 200
+    assert get_json(client, '/network/pxe')['access'] == ['runway']
+    assert client.delete('/network/pxe/access/runway').status_code == 200
+    assert get_json(client, '/network/pxe')['access'] is None
+    assert cache.stats['show_network'] == {'hits': 0, 'misses': 2}
+
+
+def test_bulk_delete(cache, fresh_database, server_init, client):
+    """Bulk deletes (via Query.delete()) invalidate the cache."""
+    assert client.put('/project/runway').status_code == 200
+    assert get_json(client, '/projects') == ['runway']
+    with app.app_context():
+        model.Project.query.filter_by(label='runway').delete()
+        db.session.commit()
+    assert get_json(client, '/projects') == []
+    assert cache.stats['list_projects'] == {'hits': 0, 'misses': 2}
+
+
+def test_shared_file_backend(cache, cache_cfg, fresh_database, server_init,
+                             client):
+    """Changes recorded by one FileBackend are seen by another."""
+    if cache_cfg['backend'] != 'file':
+        pytest.skip('only applies to the file backend')
+    other = read_cache.FileBackend(cache_cfg['directory'])
+    assert get_json(client, '/projects') == []
+    # Simulate another process adding a project. We can't actually use a
+    # separate database connection here, since the test database may be
+    # in-memory, so instead we make the change behind the cache's back,
+    # and then have "the other process" bump the version:
+    with app.app_context():
+        db.session.add(model.Project('runway'))
+        db.session.flush()
+        db.session.info.pop('hil.read_cache.tables')
+        db.session.commit()
+    assert get_json(client, '/projects') == []
+    other.bump(['project'])
+    assert get_json(client, '/projects') == ['runway']
+    assert cache.stats['list_projects'] == {'hits': 1, 'misses': 2}
+
+
+def test_file_backend_max_entries(tmpdir, monkeypatch):
+    """The FileBackend removes the least recently used entries, and doesn't
+    leave temporary files behind when a write fails.
+    """
+    # pylint: disable=protected-access
+    directory = str(tmpdir.join('cache'))
+    backend = read_cache.FileBackend(directory, max_entries=2)
+
+    def set_mtime(key, mtime):
+        """Set the modification time of `key`'s entry."""
+        os.utime(backend._path('entry', read_cache._digest(key)),
+                 (mtime, mtime))
+
+    backend.put('a', [1], 'A')
+    backend.put('b', [1], 'B')
+    set_mtime('a', 1000)
+    set_mtime('b', 2000)
+    backend.put('c', [1], 'C')
+    assert backend.get('a') is None
+    assert backend.get('b') == ([1], 'B')
+
+    # Reading an entry counts as using it:
+    set_mtime('b', 1000)
+    set_mtime('c', 2000)
+    assert backend.get('b') == ([1], 'B')
+    backend.put('d', [1], 'D')
+    assert backend.get('c') is None
+    assert backend.get('b') == ([1], 'B')
+    assert len(os.listdir(directory)) == 2
+
+    def fail(src, dst):
+        """Fail to rename."""
+        raise OSError(errno.ENOSPC, 'No space left on device')
+    monkeypatch.setattr(os, 'rename', fail)
+    with pytest.raises(OSError):
+        backend.put('e', [1], 'E')
+    assert len(os.listdir(directory)) == 2
+
+
+def test_non_admin(mock_auth_cache, fresh_database, server_init, client):
+    """Requests without admin access are only cached where allowed."""
+    cache = mock_auth_cache
+
+    # list_projects is admin only, and must not be served from the cache:
+    for _ in range(2):
+        assert client.get('/projects').status_code == 401
+    assert 'list_projects' not in cache.stats
+
+    # list_nodes gives the same answer to any authenticated user:
+    for _ in range(2):
+        assert get_json(client, '/nodes/all') == []
+    assert cache.stats['list_nodes'] == {'hits': 1, 'misses': 1}
+
+
+def test_disabled(no_cache, fresh_database, server_init, client):
+    """Without a [cache] section, nothing is cached."""
+    assert read_cache.get_cache() is None
+    assert get_json(client, '/projects') == []
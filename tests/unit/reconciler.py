@@ -0,0 +1,223 @@
+"""Tests for hil.reconciler."""
+
+import pytest
+
+from hil import api, config, deferred, model, reconciler
+from hil.errors import SwitchError
+from hil.test_common import config_testsuite, config_merge, \
+    fresh_database, server_init, with_request_context
+
+MOCK_SWITCH_TYPE = 'http://schema.massopencloud.org/haas/v0/switches/mock'
+OBM_TYPE_MOCK = 'http://schema.massopencloud.org/haas/v0/obm/mock'
+
+
+@pytest.fixture
+def configure():
+    """Configure HIL"""
+    config_testsuite()
+    config_merge({
+        'extensions': {
+            'hil.ext.switches.mock': '',
+            'hil.ext.obm.mock': '',
+            'hil.ext.network_allocators.null': None,
+            'hil.ext.network_allocators.vlan_pool': '',
+        },
+        'hil.ext.network_allocators.vlan_pool': {
+            'vlans': '100-200',
+        },
+    })
+    config.load_extensions()
+
+
+fresh_database = pytest.fixture(fresh_database)
+server_init = pytest.fixture(server_init)
+with_request_context = pytest.yield_fixture(with_request_context)
+
+
+@pytest.fixture
+def switch_state():
+    """Return the mock switches' state, starting out empty."""
+    from hil.ext.switches.mock import LOCAL_STATE
+    LOCAL_STATE.clear()
+    return LOCAL_STATE
+
+
+@pytest.fixture
+def inventory(configure, fresh_database, server_init, with_request_context,
+              switch_state):
+    """Create two switches, each with a node connected to one port, and
+    attach the nodes to networks.
+
+    Returns a dict mapping the networks' labels to their network IDs.
+    """
+    # pylint: disable=unused-argument,redefined-outer-name
+    api.project_create('anvil')
+    for i in range(2):
+        switch, node = 'sw%d' % i, 'node-%d' % i
+        api.switch_register(switch, type=MOCK_SWITCH_TYPE,
+                            username='admin', password='secret',
+                            hostname=switch)
+        api.switch_register_port(switch, 'gi1/0/1')
+        api.switch_register_port(switch, 'gi1/0/2')
+        api.node_register(node, obm={'type': OBM_TYPE_MOCK,
+                                     'host': 'ipmihost',
+                                     'user': 'root',
+                                     'password': 'secret'})
+        api.node_register_nic(node, 'eth0', 'de:ad:be:ef:20:1%d' % i)
+        api.port_connect_nic(switch, 'gi1/0/1', node, 'eth0')
+        api.project_connect_node('anvil', node)
+    networks = {}
+    for net in 'pxe', 'storage':
+        api.network_create(net, 'anvil', 'anvil', '')
+        networks[net] = model.Network.query.filter_by(label=net).one() \
+            .network_id
+    api.node_connect_network('node-0', 'eth0', 'pxe')
+    deferred.apply_networking()
+    api.node_connect_network('node-0', 'eth0', 'storage',
+                             channel='vlan/' + networks['storage'])
+    deferred.apply_networking()
+    api.node_connect_network('node-1', 'eth0', 'pxe')
+    deferred.apply_networking()
+    return networks
+
+
+def test_native_listed_as_tagged(inventory, switch_state):
+    """A switch listing the native VLAN as tagged as well isn't drift."""
+    # pylint: disable=redefined-outer-name
+    switch_state['sw1']['gi1/0/1']['vlan/' + inventory['pxe']] = \
+        int(inventory['pxe'])
+    assert reconciler.reconcile().drift == []
+
+
+def test_no_drift(inventory):
+    """Nothing is reported when the switches match the database."""
+    # pylint: disable=unused-argument,redefined-outer-name
+    report = reconciler.reconcile()
+    assert report.drift == []
+    assert report.errors == {}
+    assert report.queued == 0
+
+
+def test_drift(inventory, switch_state):
+    """Differences are reported, but not fixed by default."""
+    # pylint: disable=redefined-outer-name
+    storage = 'vlan/' + inventory['storage']
+    del switch_state['sw0']['gi1/0/1'][storage]
+    switch_state['sw1']['gi1/0/1']['vlan/native'] = inventory['storage']
+
+    report = reconciler.reconcile()
+    assert report.drift == [
+        reconciler.Drift('sw0', 'gi1/0/1', 'node-0', 'eth0', storage,
+                         inventory['storage'], None),
+        reconciler.Drift('sw1', 'gi1/0/1', 'node-1', 'eth0', 'vlan/native',
+                         inventory['pxe'], inventory['storage']),
+    ]
+    assert report.queued == 0
+    assert model.NetworkingAction.query.filter_by(status='PENDING') \
+        .count() == 0
+
+
+def test_fix(inventory, switch_state):
+    """With fix=True, networking actions are queued to correct the
+    switches, and once they're done, there's no more drift.
+    """
+    # pylint: disable=redefined-outer-name
+    storage = 'vlan/' + inventory['storage']
+    del switch_state['sw0']['gi1/0/1'][storage]
+    switch_state['sw1']['gi1/0/1']['vlan/native'] = inventory['storage']
+    switch_state['sw1']['gi1/0/1']['vlan/150'] = '150'
+
+    report = reconciler.reconcile(fix=True)
+    assert len(report.drift) == 3
+    # Only one action at a time per nic:
+    assert report.queued == 2
+    # The attachments are left alone until the actions succeed:
+    assert model.NetworkAttachment.query.count() == 3
+    deferred.apply_networking()
+    report = reconciler.reconcile(fix=True)
+    assert len(report.drift) == 1
+    assert report.queued == 1
+    deferred.apply_networking()
+    assert reconciler.reconcile().drift == []
+
+    assert dict(switch_state['sw0']['gi1/0/1']) == {
+        'vlan/native': inventory['pxe'],
+        storage: inventory['storage'],
+    }
+    assert dict(switch_state['sw1']['gi1/0/1']) == {
+        'vlan/native': inventory['pxe'],
+    }
+    assert model.NetworkAttachment.query.count() == 3
+
+
+def test_pending_actions_skipped(inventory, switch_state):
+    """Nics with pending networking actions aren't checked."""
+    # pylint: disable=redefined-outer-name
+    api.node_detach_network('node-1', 'eth0', 'pxe')
+    switch_state['sw1']['gi1/0/1']['vlan/native'] = inventory['storage']
+    assert reconciler.reconcile().drift == []
+
+
+def test_switch_errors(inventory, switch_state, monkeypatch):
+    """A switch which can't be read is reported, and doesn't stop the others
+    from being checked.
+    """
+    # pylint: disable=redefined-outer-name
+    from hil.ext.switches.mock import MockSwitch
+    get_port_networks = MockSwitch.get_port_networks
+
+    def broken(self, ports):
+        """Fail for sw0."""
+        if self.label == 'sw0':
+            raise SwitchError('Connection refused')
+        return get_port_networks(self, ports)
+    monkeypatch.setattr(MockSwitch, 'get_port_networks', broken)
+    switch_state['sw1']['gi1/0/1']['vlan/native'] = inventory['storage']
+
+    report = reconciler.reconcile()
+    assert report.errors.keys() == ['sw0']
+    assert [item.switch for item in report.drift] == ['sw1']
+
+
+def test_selected_switches_and_rate(inventory, switch_state):
+    """Only the switches asked for are checked, at the rate asked for."""
+    # pylint: disable=redefined-outer-name
+    switch_state['sw0']['gi1/0/1']['vlan/native'] = inventory['storage']
+    switch_state['sw1']['gi1/0/1']['vlan/native'] = inventory['storage']
+    sleeps = []
+    report = reconciler.reconcile(switches=['sw1'], rate=4,
+                                  sleep=sleeps.append)
+    assert [item.switch for item in report.drift] == ['sw1']
+    assert sleeps == []
+
+    report = reconciler.reconcile(workers=1, rate=4, sleep=sleeps.append)
+    assert [item.switch for item in report.drift] == ['sw0', 'sw1']
+    assert sleeps == [0.25]
+
+
+def test_snapshot_read_only(configure):
+    """Switch sessions used to read the switches are marked read-only."""
+    # pylint: disable=unused-argument,redefined-outer-name
+    disconnected = []
+
+    class Session(object):
+        """Stand-in for a switch session."""
+        read_only = False
+
+        def get_port_networks(self, ports):
+            """Report no networks."""
+            return dict((port, []) for port in ports)
+
+        def disconnect(self):
+            """Record whether the session was read-only."""
+            disconnected.append(self.read_only)
+
+    class Switch(object):
+        """Stand-in for a switch."""
+
+        def session(self):
+            """Return a new session."""
+            return Session()
+
+    reconciler.snapshot(Switch(), [])
+    assert disconnected == [True]
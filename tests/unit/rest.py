@@ -16,8 +16,10 @@ from abc import ABCMeta, abstractmethod
 import unittest
 import json
 import logging
+import zlib
 
 from schema import Schema, Optional, Use
+import flask
 import pytest
 
 from hil.test_common import config_testsuite, fail_on_log_warnings
@@ -608,3 +610,153 @@ def test_dont_log(client, caplog):
             "An error occured handling the request!"
         for record in caplog.records:
             assert 'sensitive info' not in record.getMessage()
+
+
+def test_etag(client):
+    """GET responses carry ETags, and honor If-None-Match."""
+    state = {'value': 'hello'}
+
+    @rest.rest_call('GET', '/etag-test', Schema({}))
+    # pylint: disable=unused-variable
+    def etag_test():
+        """Return the current value of ``state``."""
+        return json.dumps(state['value'])
+
+    resp = client.get('/etag-test')
+    assert resp.status_code == 200
+    etag = resp.headers['ETag']
+
+    # Unchanged: no body.
+    resp = client.get('/etag-test', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.get_data() == ''
+
+    # Changed: the new body, with a new ETag.
+    state['value'] = 'goodbye'
+    resp = client.get('/etag-test', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert json.loads(resp.get_data()) == 'goodbye'
+    assert resp.headers['ETag'] != etag
+
+
+def test_no_etag_on_errors(client):
+    """Error responses and non-GET responses don't get ETags."""
+
+    @rest.rest_call(['GET', 'PUT'], '/etag-error-test', Schema({}))
+    # pylint: disable=unused-variable
+    def etag_error_test():
+        """Return an empty body with a non-200 status."""
+        return '', 202
+
+    for method in client.get, client.put:
+        resp = method('/etag-error-test')
+        assert resp.status_code == 202
+        assert 'ETag' not in resp.headers
+
+
+def test_json_stream():
+    """A JSONStream encodes to the same thing as json.dumps."""
+    value = {
+        'b': [1, 2.5, None, True, {'z': u'\u2603', 'a': []}],
+        'a': rest.StreamedObject(iter([('x', {}), ('y', 'quote"d')])),
+        'c': rest.StreamedObject(iter([])),
+    }
+    expected = {
+        'b': [1, 2.5, None, True, {'z': u'\u2603', 'a': []}],
+        'a': {'x': {}, 'y': 'quote"d'},
+        'c': {},
+    }
+    assert rest.JSONStream(value).read() == \
+        json.dumps(expected, sort_keys=True)
+
+    # Large documents are produced in several chunks:
+    items = [('node-%05d' % i, ['eth0', 'eth1']) for i in range(2000)]
+    chunks = list(rest.JSONStream(rest.StreamedObject(iter(items))))
+    assert len(chunks) > 1
+    assert ''.join(chunks) == json.dumps(dict(items), sort_keys=True)
+
+
+def test_streamed_response(client):
+    """API calls returning a JSONStream are streamed, and gzipped for
+    clients which accept it.
+    """
+    items = [('node-%05d' % i, {'nic': 'eth0'}) for i in range(1000)]
+    expected = json.dumps(dict(items), sort_keys=True)
+
+    @rest.rest_call('GET', '/stream-test', Schema({}))
+    # pylint: disable=unused-variable
+    def stream_test():
+        """Return a large, streamed result."""
+        return rest.JSONStream(rest.StreamedObject(iter(items)))
+
+    resp = client.get('/stream-test')
+    assert resp.status_code == 200
+    assert resp.is_streamed
+    assert 'ETag' not in resp.headers
+    assert resp.get_data() == expected
+
+    resp = client.get('/stream-test', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert zlib.decompress(resp.get_data(), 16 + zlib.MAX_WBITS) == expected
+
+
+def test_gzip_chunks():
+    """Each chunk of a gzipped stream can be decompressed as soon as it
+    has been sent.
+    """
+    # pylint: disable=protected-access
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = rest._gzip_chunks(iter(['event: one\n\n', 'event: two\n\n']))
+    assert decompressor.decompress(next(chunks)) == 'event: one\n\n'
+    assert decompressor.decompress(next(chunks)) == 'event: two\n\n'
+    assert decompressor.decompress(next(chunks)) == ''
+    assert decompressor.flush() == ''
+
+
+def test_no_gzip_own_response(client):
+    """Calls which return their own Response aren't gzipped."""
+    body = 'x' * 10000
+
+    @rest.rest_call('GET', '/own-response-test', Schema({}))
+    # pylint: disable=unused-variable
+    def own_response_test():
+        """Return a large Response."""
+        return flask.Response(body, mimetype='text/plain')
+
+    resp = client.get('/own-response-test',
+                      headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.get_data() == body
+
+
+def test_gzip(client):
+    """Large GET responses are gzipped if the client accepts it."""
+    state = {'body': json.dumps(['x' * 10] * 1000)}
+
+    @rest.rest_call('GET', '/gzip-test', Schema({}))
+    # pylint: disable=unused-variable
+    def gzip_test():
+        """Return ``state['body']``."""
+        return state['body']
+
+    resp = client.get('/gzip-test', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in resp.headers['Vary']
+    assert zlib.decompress(resp.get_data(), 16 + zlib.MAX_WBITS) == \
+        state['body']
+    etag = resp.headers['ETag']
+    resp = client.get('/gzip-test', headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    for headers in {}, {'Accept-Encoding': 'gzip;q=0'}:
+        resp = client.get('/gzip-test', headers=headers)
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.get_data() == state['body']
+
+    # Small responses aren't worth compressing:
+    state['body'] = json.dumps('small')
+    resp = client.get('/gzip-test', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.get_data() == state['body']
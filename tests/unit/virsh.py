@@ -0,0 +1,239 @@
+"""Unit tests for hil.virsh
+
+These run against a small fake ``virsh``, which understands just enough
+commands for the tests, and logs each command it receives.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from subprocess import CalledProcessError
+
+from hil import virsh as virsh_module
+from hil.errors import BadArgumentError, HeadnodeError
+from hil.virsh import JobQueue, Virsh, VirshShell
+
+FAKE_VIRSH = r'''
+import os
+import sys
+
+log = open(sys.argv[1], 'a')
+running = set()
+defined = set(['hn-0'])
+
+while True:
+    sys.stdout.write('virsh # ')
+    sys.stdout.flush()
+    line = sys.stdin.readline()
+    if not line:
+        break
+    args = line.split()
+    log.write('%d %s\n' % (os.getpid(), ' '.join(args)))
+    log.flush()
+    cmd, vm = args[0], args[-1]
+    if cmd == 'quit':
+        break
+    if cmd == 'die':
+        sys.exit(1)
+    if vm not in defined:
+        print("error: failed to get domain '%s'" % vm)
+    elif cmd == 'start':
+        running.add(vm)
+        print('Domain %s started' % vm)
+    elif cmd == 'destroy':
+        if vm not in running:
+            print('error: Requested operation is not valid')
+        running.discard(vm)
+    elif cmd == 'undefine':
+        defined.discard(vm)
+    elif cmd == 'dumpxml':
+        port = '5900' if vm in running else '-1'
+        print("<domain><devices><graphics type='vnc' port='%s'/>"
+              "</devices></domain>" % port)
+'''
+
+
+@pytest.fixture
+def tmpdir():
+    """Create a temporary directory, holding the fake virsh."""
+    path = tempfile.mkdtemp()
+    with open(os.path.join(path, 'virsh.py'), 'w') as f:
+        f.write(FAKE_VIRSH)
+    yield path
+    shutil.rmtree(path)
+
+
+@pytest.fixture
+def virsh(tmpdir):
+    """Return a `Virsh` which talks to the fake virsh."""
+    shell = VirshShell([sys.executable,
+                        os.path.join(tmpdir, 'virsh.py'),
+                        os.path.join(tmpdir, 'log')],
+                       timeout=10)
+    yield Virsh('test:///default', shell=shell)
+    shell.close()
+
+
+def read_log(tmpdir):
+    """Return the commands received by the fake virsh, as (pid, cmd) pairs."""
+    with open(os.path.join(tmpdir, 'log')) as f:
+        return [tuple(line.rstrip('\n').split(' ', 1)) for line in f]
+
+
+def test_shell_reuse(virsh, tmpdir):
+    """Commands are all sent to the same virsh process."""
+    virsh.start('hn-0').wait()
+    virsh.stop('hn-0')
+    log = read_log(tmpdir)
+    assert [cmd for _, cmd in log] == [
+        'start hn-0',
+        'autostart hn-0',
+        'destroy hn-0',
+        'autostart --disable hn-0',
+    ]
+    assert len(set(pid for pid, _ in log)) == 1
+
+
+def test_shell_restart(virsh, tmpdir):
+    """If virsh dies, a new one is started for the next command."""
+    with pytest.raises(HeadnodeError):
+        virsh.shell.run('die')
+    virsh.shell.run('start', 'hn-0')
+    log = read_log(tmpdir)
+    assert log[-1][1] == 'start hn-0'
+    assert log[0][0] != log[-1][0]
+
+
+def test_shell_error(virsh):
+    """Errors reported by virsh are raised as HeadnodeErrors."""
+    with pytest.raises(HeadnodeError) as excinfo:
+        virsh.shell.run('start', 'hn-1')
+    assert "failed to get domain 'hn-1'" in excinfo.value.description
+
+
+def test_vncport(virsh, tmpdir):
+    """The VNC port is cached for as long as the generation is unchanged."""
+    virsh.start('hn-0').wait()
+    assert virsh.get_vncport('hn-0', 1) == '5900'
+    assert virsh.get_vncport('hn-0', 1) == '5900'
+    assert [cmd for _, cmd in read_log(tmpdir)].count('dumpxml hn-0') == 1
+
+    # Another process may have stopped the VM; all we see is the new
+    # generation:
+    virsh.shell.run('destroy', 'hn-0')
+    assert virsh.get_vncport('hn-0', 2) is None
+    assert [cmd for _, cmd in read_log(tmpdir)].count('dumpxml hn-0') == 2
+
+
+def test_delete(virsh, tmpdir):
+    """Deleting works whether or not the VM is running or exists."""
+    virsh.start('hn-0').wait()
+    virsh.delete('hn-0')
+    virsh.delete('hn-0')
+    cmds = [cmd for _, cmd in read_log(tmpdir)]
+    assert cmds.count('undefine hn-0 --remove-all-storage') == 2
+
+
+def test_job_queue_order():
+    """Jobs with the same key run in order; others run concurrently."""
+    queue = JobQueue(workers=4)
+    results = []
+    blocker = threading.Event()
+
+    def blocked():
+        """Wait until `blocker` is set."""
+        blocker.wait()
+        results.append('a1')
+
+    first = queue.submit('a', blocked)
+    second = queue.submit('a', lambda: results.append('a2'))
+    queue.submit('b', lambda: results.append('b')).wait()
+
+    # 'b' ran, even though the jobs for 'a' are stuck:
+    assert results == ['b']
+    assert queue.pending('a')
+    assert not queue.pending('b')
+    assert not first.done()
+
+    blocker.set()
+    second.wait()
+    assert results == ['b', 'a1', 'a2']
+    assert not queue.pending('a')
+
+
+def test_job_error():
+    """Exceptions raised by jobs are re-raised by wait()."""
+    queue = JobQueue(workers=1)
+
+    def fail():
+        """Raise an exception."""
+        raise HeadnodeError('oops')
+
+    job = queue.submit('a', fail)
+    with pytest.raises(HeadnodeError):
+        job.wait()
+    # A failed job doesn't stop later jobs from running:
+    results = []
+    queue.submit('a', lambda: results.append(time.time())).wait()
+    assert len(results) == 1
+
+
+def test_bad_argument(virsh):
+    """Arguments which can't be quoted are rejected as bad arguments."""
+    with pytest.raises(BadArgumentError):
+        virsh.shell.run('start', "it's")
+
+
+def test_clone_failure(virsh, tmpdir, monkeypatch):
+    """If cloning fails, the partly created VM is removed, and the callback
+    is given the error.
+    """
+    def check_call(args):
+        """Fail, as virt-clone might."""
+        raise CalledProcessError(1, args)
+    monkeypatch.setattr(virsh_module, 'check_call', check_call)
+    errors = []
+    job = virsh.clone('base', 'hn-0', [], callback=errors.append)
+    with pytest.raises(HeadnodeError):
+        job.wait()
+    assert len(errors) == 1
+    assert errors[0].description == 'virt-clone failed with status 1'
+    assert [cmd for _, cmd in read_log(tmpdir)] == [
+        'undefine hn-0 --remove-all-storage',
+    ]
+
+    # The callback is also called on success:
+    results = []
+    virsh.start('hn-1', callback=results.append)
+    virsh.start('hn-0', callback=results.append).wait()
+    assert len(results) == 2
+    assert isinstance(results[0], HeadnodeError)
+    assert results[1] is None
+
+
+def test_job_threads_exit():
+    """Jobs don't run on daemon threads (which would be killed part way
+    through a job when the process exits), and the threads exit once
+    there's nothing left to do.
+    """
+    # pylint: disable=protected-access
+    queue = JobQueue(workers=2)
+    daemon = []
+
+    def record():
+        """Note whether this is running on a daemon thread."""
+        time.sleep(0.05)
+        daemon.append(threading.current_thread().daemon)
+    for job in [queue.submit(str(i), record) for i in range(4)]:
+        job.wait()
+    assert daemon == [False] * 4
+    deadline = time.time() + 5
+    while queue._running and time.time() < deadline:
+        time.sleep(0.01)
+    assert queue._running == 0